@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, request, make_response, send_from_directory, send_file, session, redirect, url_for, g
+from flask import Flask, jsonify, request, make_response, send_from_directory, send_file, session, redirect, url_for, g, Response, copy_current_request_context
 from flask_cors import CORS
 import pandas as pd
 import yfinance as yf
@@ -98,6 +98,31 @@ from models import (
     executar_monte_carlo,
     limpar_cache_usuario,
     ativar_wal_em_todos_os_bancos,
+    obter_metricas_pool_pg,
+    obter_metricas_pool_sqlite,
+    obter_metricas_sessoes,
+    obter_metricas_cotacoes,
+    obter_metricas_universo,
+    obter_metricas_jobs,
+    FILA_JOBS,
+    obter_info_yf,
+    obter_historico_diario,
+    precos_em_datas,
+    obter_metricas_ohlcv,
+    ultimo_ponto_bcb,
+    obter_metricas_series_bcb,
+    obter_metricas_fatores_indexadores,
+    obter_metricas_limitador,
+    obter_metricas_refresh_carteiras,
+    executar_refresh_carteiras,
+    LIMITADOR,
+    UPSTREAM_MAX_THREADS,
+    obter_proventos_tickers,
+    obter_nome_ativo_yf,
+    calcular_proventos_recebidos,
+    _data_inicio_periodo_proventos,
+    validar_token_sessao,
+    fechar_conexoes_sqlite,
 )
 from fii_scraper import obter_metadata_fii
 from models import cache
@@ -229,7 +254,6 @@ else:
 
 
 ANALISE_ATIVOS_SEM = threading.Semaphore(2)
-MONTE_CARLO_SEM = threading.Semaphore(1)
 _ANALISE_CANCEL_LOCK = threading.Lock()
 _ANALISE_CANCEL_GEN_BY_USER = {}
 
@@ -1070,6 +1094,54 @@ def api_admin_ver_controle_usuario(username):
         return jsonify({"error": str(e)}), 500
 
 
+@server.route("/api/admin/carteiras/atualizar", methods=["POST"])
+def api_admin_atualizar_carteiras():
+    """
+    Reprecifica as carteiras de todos os usuários agora (modo entre usuários).
+    Roda na fila de jobs: devolve o job e o relatório sai em GET /api/jobs/<id>.
+    """
+    usuario, err = _admin_requer_admin()
+    if err:
+        return err[0], err[1]
+    try:
+        def rodar(cancelado):
+            relatorio = executar_refresh_carteiras(forcar=True)
+            if relatorio is None:
+                raise ValueError("Já existe uma atualização das carteiras em andamento")
+            return relatorio
+
+        job = FILA_JOBS.submeter('refresh_carteiras', '{}', rodar, usuario=usuario)
+        job.pop("usuario", None)
+        return jsonify(job), 200 if job["status"] == "concluido" else 202
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@server.route("/api/admin/metricas", methods=["GET"])
+def api_admin_metricas():
+    """Métricas internas do processo (pool de conexões etc.), apenas admin."""
+    _, err = _admin_requer_admin()
+    if err:
+        return err[0], err[1]
+    try:
+        return jsonify({
+            "pid": os.getpid(),
+            "pool_pg": obter_metricas_pool_pg(),
+            "pool_sqlite": obter_metricas_pool_sqlite(),
+            "sessoes": obter_metricas_sessoes(),
+            "cotacoes": obter_metricas_cotacoes(),
+            "universo_screener": obter_metricas_universo(),
+            "jobs": obter_metricas_jobs(),
+            "ohlcv": obter_metricas_ohlcv(),
+            "series_bcb": obter_metricas_series_bcb(),
+            "fatores_indexadores": obter_metricas_fatores_indexadores(),
+            "limitador_upstream": obter_metricas_limitador(),
+            "refresh_carteiras": obter_metricas_refresh_carteiras(),
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @server.route("/api/admin/usuarios", methods=["POST"])
 def api_criar_usuario():
     """Cria um novo usuário (apenas para admins)"""
@@ -1264,6 +1336,57 @@ def api_verificar_pergunta():
 
 # ==================== APIs REST ====================
 
+def _analise_cache_key(tipo, filtros):
+    """Chave do resultado de /api/analise/ativos (compartilhada com a versão em stream)."""
+    import hashlib
+    cache_key_data = {
+        'tipo': tipo,
+        'filtros': filtros
+    }
+    return f"analise_ativos_{hashlib.md5(json.dumps(cache_key_data, sort_keys=True).encode()).hexdigest()}"
+
+
+def _executar_analise_ativos(tipo, filtros, should_cancel=None):
+    from models import (
+        processar_ativos_acoes_com_filtros,
+        processar_ativos_bdrs_com_filtros,
+        processar_ativos_fiis_com_filtros
+    )
+
+    if tipo == 'acoes':
+        return processar_ativos_acoes_com_filtros(
+            filtros.get('roe_min', 0),
+            filtros.get('dy_min', 0),
+            filtros.get('pl_min', 0),
+            filtros.get('pl_max', float('inf')),
+            filtros.get('pvp_max', float('inf')),
+            filtros.get('liq_min'),
+            filtros.get('setor'),
+            should_cancel=should_cancel,
+        )
+    if tipo == 'bdrs':
+        return processar_ativos_bdrs_com_filtros(
+            filtros.get('roe_min', 0),
+            filtros.get('dy_min', 0),
+            filtros.get('pl_min', 0),
+            filtros.get('pl_max', float('inf')),
+            filtros.get('pvp_max', float('inf')),
+            filtros.get('liq_min'),
+            filtros.get('setor'),
+            should_cancel=should_cancel,
+        )
+    if tipo == 'fiis':
+        return processar_ativos_fiis_com_filtros(
+            filtros.get('dy_min', 0),
+            filtros.get('dy_max', float('inf')),
+            filtros.get('liq_min', 0),
+            filtros.get('tipo_fii'),
+            filtros.get('segmento_fii'),
+            should_cancel=should_cancel,
+        )
+    raise ValueError("Tipo inválido")
+
+
 @server.route("/api/analise/ativos", methods=["POST"])
 def api_analise_ativos():
     import time as _time
@@ -1295,57 +1418,16 @@ def api_analise_ativos():
         print(f"[ANALISE] Início /api/analise/ativos tipo={tipo}")
         
         # Criar chave de cache baseada nos parâmetros da requisição
-        import hashlib
-        cache_key_data = {
-            'tipo': tipo,
-            'filtros': filtros
-        }
-        cache_key_str = f"analise_ativos_{hashlib.md5(json.dumps(cache_key_data, sort_keys=True).encode()).hexdigest()}"
+        cache_key_str = _analise_cache_key(tipo, filtros)
         
         # Verificar cache primeiro
         cached_result = cache.get(cache_key_str)
         if cached_result is not None:
             return jsonify(cached_result)
         
-        from models import (
-            processar_ativos_acoes_com_filtros,
-            processar_ativos_bdrs_com_filtros,
-            processar_ativos_fiis_com_filtros
-        )
-        
-        if tipo == 'acoes':
-            dados = processar_ativos_acoes_com_filtros(
-                filtros.get('roe_min', 0),
-                filtros.get('dy_min', 0),
-                filtros.get('pl_min', 0),
-                filtros.get('pl_max', float('inf')),
-                filtros.get('pvp_max', float('inf')),
-                filtros.get('liq_min'),
-                filtros.get('setor'),
-                should_cancel=should_cancel_analise,
-            )
-        elif tipo == 'bdrs':
-            dados = processar_ativos_bdrs_com_filtros(
-                filtros.get('roe_min', 0),
-                filtros.get('dy_min', 0),
-                filtros.get('pl_min', 0),
-                filtros.get('pl_max', float('inf')),
-                filtros.get('pvp_max', float('inf')),
-                filtros.get('liq_min'),
-                filtros.get('setor'),
-                should_cancel=should_cancel_analise,
-            )
-        elif tipo == 'fiis':
-            dados = processar_ativos_fiis_com_filtros(
-                filtros.get('dy_min', 0),
-                filtros.get('dy_max', float('inf')),
-                filtros.get('liq_min', 0),
-                filtros.get('tipo_fii'),
-                filtros.get('segmento_fii'),
-                should_cancel=should_cancel_analise,
-            )
-        else:
+        if tipo not in ('acoes', 'bdrs', 'fiis'):
             return jsonify({"error": "Tipo inválido"}), 400
+        dados = _executar_analise_ativos(tipo, filtros, should_cancel_analise)
 
         if should_cancel_analise():
             _duracao = round(_time.time() - _inicio, 1)
@@ -1370,6 +1452,86 @@ def api_analise_ativos():
             pass
 
 
+@server.route("/api/analise/ativos/stream", methods=["POST"])
+def api_analise_ativos_stream():
+    """
+    Mesma análise de /api/analise/ativos, entregue aos poucos: uma linha JSON
+    (NDJSON) por evento, ou SSE se o cliente pedir `Accept: text/event-stream`.
+    Eventos: "fila" (aguardando slot), "progresso", "ativo" (cada ticker
+    aprovado, assim que fica pronto), "fim" (lista final ordenada por DY,
+    igual à resposta do endpoint sem stream) e "cancelado"/"erro".
+    """
+    data = request.get_json(silent=True) or {}
+    tipo = data.get('tipo', 'acoes')
+    filtros = data.get('filtros', {})
+    if tipo not in ('acoes', 'bdrs', 'fiis'):
+        return jsonify({"error": "Tipo inválido"}), 400
+
+    user_key = _analise_cancel_user_key()
+    request_generation = _analise_cancel_generation_for(user_key)
+
+    def should_cancel_analise():
+        return _analise_cancel_generation_for(user_key) != request_generation
+
+    sse = 'text/event-stream' in (request.headers.get('Accept') or '')
+    cache_key_str = _analise_cache_key(tipo, filtros)
+
+    def formatar(evento):
+        linha = json.dumps(evento, default=str)
+        return f"data: {linha}\n\n" if sse else linha + "\n"
+
+    def gerar():
+        import time as _time
+        from models import stream_ativos_com_filtros
+
+        _inicio = _time.time()
+        cached_result = cache.get(cache_key_str)
+        if cached_result is not None:
+            for ativo in cached_result:
+                yield formatar({"tipo": "ativo", "ativo": ativo})
+            yield formatar({"tipo": "fim", "ativos": cached_result})
+            return
+
+        adquirido = False
+        try:
+            while not adquirido:
+                if should_cancel_analise():
+                    yield formatar({"tipo": "cancelado"})
+                    return
+                adquirido = ANALISE_ATIVOS_SEM.acquire(timeout=1.0)
+                if not adquirido:
+                    yield formatar({"tipo": "fila"})
+                    if _time.time() - _inicio > 540:
+                        yield formatar({"tipo": "erro", "error": "Servidor ocupado processando outras análises. Tente novamente em alguns instantes."})
+                        return
+            print(f"[ANALISE] Início /api/analise/ativos/stream tipo={tipo}")
+            for evento in stream_ativos_com_filtros(tipo, filtros, should_cancel=should_cancel_analise):
+                if evento["tipo"] == "fim":
+                    cache.set(cache_key_str, evento["ativos"], timeout=1800)
+                    _duracao = round(_time.time() - _inicio, 1)
+                    print(f"[ANALISE] Fim /api/analise/ativos/stream tipo={tipo} duracao={_duracao}s len={len(evento['ativos'])}")
+                elif evento["tipo"] == "cancelado":
+                    _duracao = round(_time.time() - _inicio, 1)
+                    print(f"[ANALISE] Cancelada /api/analise/ativos/stream tipo={tipo} duracao={_duracao}s")
+                yield formatar(evento)
+        except Exception as e:
+            _duracao = round(_time.time() - _inicio, 1)
+            print(f"[ANALISE] Erro /api/analise/ativos/stream tipo={tipo} duracao={_duracao}s err={e}")
+            yield formatar({"tipo": "erro", "error": str(e)})
+        finally:
+            if adquirido:
+                try:
+                    ANALISE_ATIVOS_SEM.release()
+                except Exception:
+                    pass
+
+    resp = Response(gerar(), mimetype='text/event-stream' if sse else 'application/x-ndjson')
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.headers["X-Finmas-Backend"] = "ok"
+    return resp
+
+
 @server.route("/api/analise/cancelar", methods=["POST"])
 def api_analise_cancelar():
     try:
@@ -1604,7 +1766,7 @@ def api_get_ativo_details(ticker):
                 ticker += '.SA'
         
         acao = yf.Ticker(ticker)
-        info = acao.info or {}
+        info = obter_info_yf(ticker)
         # Criptomoedas: preço em BRL via Binance + BRL=X (card de valor na tela de detalhes)
         if is_crypto_ticker(ticker):
             info_ativo = obter_informacoes_ativo(ticker)
@@ -1612,8 +1774,9 @@ def api_get_ativo_details(ticker):
                 preco_brl = float(info_ativo['preco_atual'])
                 info['currentPrice'] = preco_brl
                 info['regularMarketPrice'] = preco_brl
-        historico = acao.history(period="max")
-        dividends = acao.dividends if hasattr(acao, 'dividends') else None
+        historico = obter_historico_diario(ticker)
+        # Ticker.dividends = coluna Dividends do histórico completo (já no store local)
+        dividends = historico['Dividends'][historico['Dividends'] != 0] if historico is not None and 'Dividends' in historico.columns else None
         # ==================== MÉTRICAS DERIVADAS E FUNDAMENTOS ====================
         try:
             total_debt = None
@@ -2090,6 +2253,28 @@ def api_get_fii_metadata(ticker):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _janela_periodo_yf(periodo):
+    """
+    (data inicial, últimas N barras) equivalente ao `period=` diário do
+    yfinance ('5d', '6mo', '1y', 'ytd', 'max'...), ou None se não reconhecido.
+    """
+    hoje = datetime.now().date()
+    m = re.fullmatch(r'(\d+)(d|mo|y)', periodo or '')
+    if periodo == 'max':
+        return (None, None)
+    if periodo == 'ytd':
+        return (hoje.replace(month=1, day=1), None)
+    if not m:
+        return None
+    n, unidade = int(m.group(1)), m.group(2)
+    if unidade == 'd':
+        # N pregões: janela corrida com folga para fins de semana/feriados
+        return (hoje - timedelta(days=n * 2 + 7), n)
+    if unidade == 'mo':
+        return (hoje - timedelta(days=31 * n), None)
+    return (hoje - timedelta(days=366 * n), None)
+
+
 @server.route("/api/ativo/<ticker>/historico", methods=["GET"])
 def api_get_ativo_historico(ticker):
     try:
@@ -2110,10 +2295,17 @@ def api_get_ativo_historico(ticker):
         # Futuramente poderíamos ajustar outros períodos (ex.: 5d com 1h), mas por enquanto
         # apenas 1d precisa de granularidade por hora para o gráfico de visão geral.
 
-        if interval:
-            historico = acao.history(period=periodo, interval=interval)
+        janela = None if interval else _janela_periodo_yf(periodo)
+        if janela is None:
+            historico = LIMITADOR.executar(
+                'yahoo', lambda: acao.history(period=periodo, interval=interval) if interval else acao.history(period=periodo)
+            )
         else:
-            historico = acao.history(period=periodo)
+            # barras diárias: store local, só a cauda nova vai ao Yahoo
+            inicio, ultimas_n = janela
+            historico = obter_historico_diario(ticker, inicio)
+            if ultimas_n:
+                historico = historico.tail(ultimas_n)
         
         # Filtrar histórico se necessário (yfinance já faz isso, mas garantimos)
         if periodo != "max" and historico is not None and not historico.empty:
@@ -2165,17 +2357,17 @@ def api_get_ativo_fundamentals(ticker):
         quarterly_balance_sheet = None
         
         try:
-            quarterly_earnings = acao.quarterly_earnings
+            quarterly_earnings = LIMITADOR.executar('yahoo', lambda: acao.quarterly_earnings)
         except Exception as e:
             print(f"[WARN] Erro ao buscar quarterly_earnings para {ticker}: {e}")
         
         try:
-            quarterly_financials = acao.quarterly_financials
+            quarterly_financials = LIMITADOR.executar('yahoo', lambda: acao.quarterly_financials)
         except Exception as e:
             print(f"[WARN] Erro ao buscar quarterly_financials para {ticker}: {e}")
         
         try:
-            quarterly_balance_sheet = acao.quarterly_balance_sheet
+            quarterly_balance_sheet = LIMITADOR.executar('yahoo', lambda: acao.quarterly_balance_sheet)
         except Exception as e:
             print(f"[WARN] Erro ao buscar quarterly_balance_sheet para {ticker}: {e}")
         
@@ -2359,8 +2551,7 @@ def _buscar_info_ticker_para_comparacao(ticker):
                 ticker_yf = ticker_original
         else:
             ticker_yf = ticker_original
-        acao = yf.Ticker(ticker_yf)
-        info = acao.info or {}
+        info = obter_info_yf(ticker_yf)
         return {
             "ticker": ticker_original,
             "nome": info.get('longName', '-'),
@@ -2394,9 +2585,9 @@ def api_comparar_ativos():
         if not tickers:
             return jsonify({"error": "Nenhum ticker fornecido"}), 400
         
-        # OTIMIZAÇÃO: Aumentado para 200 workers para processar muito mais rápido
+        # Chamadas ao Yahoo passam pelo LIMITADOR; o pool só precisa cobrir a espera de rede
         resultados = []
-        max_workers = min(len(tickers), 200)  # Até 200 workers simultâneos
+        max_workers = min(len(tickers), UPSTREAM_MAX_THREADS)
         
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             # Submete todas as tarefas de uma vez
@@ -2574,40 +2765,9 @@ def validar_usuario_autenticado(expected_user=None, validar_token=True):
                     print(f"[SEGURANCA] Validação falhou: Token não encontrado para usuário {usuario_atual}")
                     return None, (jsonify({"error": "Token inválido"}), 401)
                 
-                # Re-validar token no banco (get_usuario_atual já faz isso, mas reforçar)
-                from models import _create_sessions_table_if_needed
-                import time
-                _create_sessions_table_if_needed()
-                
-                # Verificar token diretamente no banco
-                from models import _is_postgres, _get_pg_conn, USUARIOS_DB_PATH
-                import sqlite3
-                
-                token_valido = False
-                if _is_postgres():
-                    conn = _get_pg_conn()
-                    try:
-                        with conn.cursor() as c:
-                            c.execute('SELECT username, expira_em FROM public.sessoes WHERE token = %s', (token,))
-                            row = c.fetchone()
-                            if row:
-                                username_db, expira_em = row
-                                if username_db == usuario_atual and int(expira_em) >= int(time.time()):
-                                    token_valido = True
-                    finally:
-                        conn.close()
-                else:
-                    conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
-                    try:
-                        c = conn.cursor()
-                        c.execute('SELECT username, expira_em FROM sessoes WHERE token = ?', (token,))
-                        row = c.fetchone()
-                        if row:
-                            username_db, expira_em = row
-                            if username_db == usuario_atual and expira_em >= int(time.time()):
-                                token_valido = True
-                    finally:
-                        conn.close()
+                # Re-validar token (cache de sessões preenchido por get_usuario_atual;
+                # vai ao banco só se a entrada expirou ou foi invalidada)
+                token_valido = validar_token_sessao(token, usuario_atual)
                 
                 if not token_valido:
                     print(f"[SEGURANCA] Validação falhou: Token inválido ou expirado para usuário {usuario_atual}")
@@ -2821,8 +2981,8 @@ def api_download_backup():
                 return jsonify({"error": f"Erro ao criar backup PostgreSQL: {str(e)}"}), 500
         else:
             # SQLite: copiar arquivos .db
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            bancos_dir = os.path.join(current_dir, "bancos_usuarios", usuario_atual)
+            from models import _bancos_usuarios_root
+            bancos_dir = os.path.join(_bancos_usuarios_root(), usuario_atual)
             
             if not os.path.exists(bancos_dir):
                 return jsonify({"error": "Diretório de bancos não encontrado"}), 404
@@ -2894,6 +3054,10 @@ def api_restore_backup():
                         finally:
                             conn.close()
                     
+                    # O dump recria tabelas do schema: versão de migração e vínculos em cache
+                    # (deste e dos outros workers) deixam de valer
+                    from models import _pg_esquecer_schema_usuario
+                    _pg_esquecer_schema_usuario(usuario_atual)
                     os.unlink(temp_path)
                     return jsonify({"success": True, "message": "Backup restaurado com sucesso"})
                     
@@ -2906,8 +3070,8 @@ def api_restore_backup():
                 return jsonify({"error": f"Erro ao restaurar backup PostgreSQL: {str(e)}"}), 500
         else:
             # SQLite: restaurar arquivos .db
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            bancos_dir = os.path.join(current_dir, "bancos_usuarios", usuario_atual)
+            from models import _bancos_usuarios_root
+            bancos_dir = os.path.join(_bancos_usuarios_root(), usuario_atual)
             os.makedirs(bancos_dir, exist_ok=True)
             
             # Verificar se é ZIP
@@ -2929,8 +3093,12 @@ def api_restore_backup():
                                     os.path.join(backup_dir, existing_file)
                                 )
                         
+                        # Conexões em cache apontariam para os arquivos antigos
+                        fechar_conexoes_sqlite(bancos_dir)
                         # Extrair arquivos do ZIP
                         zip_file.extractall(bancos_dir)
+                        # De novo: outro worker pode ter reaberto a pasta durante a extração
+                        fechar_conexoes_sqlite(bancos_dir)
                     
                     os.unlink(temp_path)
                     return jsonify({"success": True, "message": "Backup restaurado com sucesso"})
@@ -3046,90 +3214,16 @@ def api_batch():
                     results[endpoint] = carteira
                 
                 elif endpoint == '/indicadores' and method == 'GET':
-                    # Função inline do endpoint original
-                    def sgs_last(series_id, use_range=False):
-                        if use_range:
-                            end_date = datetime.now()
-                            start_date = end_date - timedelta(days=90)
-                            url = (f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados?"
-                                   f"formato=json&dataInicial={start_date.strftime('%d/%m/%Y')}"
-                                   f"&dataFinal={end_date.strftime('%d/%m/%Y')}")
-                            r = requests.get(url, timeout=10)
-                            r.raise_for_status()
-                            arr = r.json()
-                            return arr[-1] if arr else None
-                        else:
-                            url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados/ultimos/1?formato=json"
-                            r = requests.get(url, timeout=10)
-                            r.raise_for_status()
-                            arr = r.json()
-                            return arr[0] if arr else None
-                    
-                    selic = sgs_last(432, use_range=True)
-                    cdi = sgs_last(12, use_range=True)
-                    ipca = sgs_last(433)
+                    # Último ponto de cada série, servido pelo store local de séries SGS
+                    selic = ultimo_ponto_bcb(432)
+                    cdi = ultimo_ponto_bcb(12)
+                    ipca = ultimo_ponto_bcb(433)
                     results[endpoint] = {"selic": selic, "cdi": cdi, "ipca": ipca}
                 
                 elif endpoint == '/carteira/proventos-recebidos' and method == 'GET':
-                    # Usar a mesma lógica do endpoint api_get_proventos_recebidos
+                    # Mesma lógica do endpoint api_get_proventos_recebidos
                     periodo = params.get('periodo', 'total')
-                    carteira = obter_carteira()
-                    if not carteira:
-                        results[endpoint] = []
-                    else:
-                        # Calcular data de início baseada no período
-                        data_inicio = None
-                        if periodo != 'total':
-                            hoje = datetime.now()
-                            if periodo == 'mes':
-                                data_inicio = hoje.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                            elif periodo == '6meses':
-                                data_inicio = hoje - timedelta(days=180)
-                                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-                            elif periodo == '1ano':
-                                data_inicio = hoje - timedelta(days=365)
-                                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-                            elif periodo == '5anos':
-                                data_inicio = hoje - timedelta(days=365*5)
-                                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-                        
-                        # Buscar proventos em paralelo usando função existente
-                        # OTIMIZAÇÃO: Reduzido de 10 para 5 workers para evitar sobrecarga de RAM no Render
-                        resultado = []
-                        max_workers = min(len(carteira), 200)  # Até 200 workers simultâneos
-                        client_gone_batch = False
-
-                        executor_batch = ThreadPoolExecutor(max_workers=max_workers)
-                        try:
-                            future_to_ativo = {
-                                executor_batch.submit(_buscar_proventos_ativo, ativo, data_inicio): ativo
-                                for ativo in carteira
-                            }
-
-                            for future in as_completed(future_to_ativo):
-                                if cliente_desconectado():
-                                    client_gone_batch = True
-                                    print(f"[ABORT] /batch (proventos): cliente desconectou. "
-                                          f"Processados {len(resultado)}/{len(future_to_ativo)} ativos.")
-                                    break
-
-                                try:
-                                    resultado_ativo = future.result()
-                                    if resultado_ativo:
-                                        resultado.append(resultado_ativo)
-                                except Exception as e:
-                                    print(f"Erro ao buscar proventos: {e}")
-                                    continue
-                        finally:
-                            if client_gone_batch:
-                                try:
-                                    executor_batch.shutdown(wait=False, cancel_futures=True)
-                                except TypeError:
-                                    executor_batch.shutdown(wait=False)
-                            else:
-                                executor_batch.shutdown(wait=True)
-
-                        results[endpoint] = resultado
+                    results[endpoint] = _calcular_proventos_recebidos(periodo, cliente_desconectado)[0]
                 
                 elif endpoint == '/carteira/historico' and method == 'GET':
                     periodo = params.get('periodo', 'mensal')
@@ -4293,26 +4387,15 @@ def api_adicionar_ativo():
             tipo_lc = (tipo or '').strip().lower()
             is_rv = any(k in tipo_lc for k in ['ação','acoes','acao','fii','bdr'])
             if (preco_inicial is None or preco_inicial == '' or float(preco_inicial) == 0.0) and data_aplicacao and is_rv and not indexador:
-                t = (ticker or '').strip().upper()
-                t_yf = t + '.SA' if ('-' not in t and '.' not in t and len(t) <= 6) else t
-                from datetime import datetime, timedelta
+                from datetime import datetime
                 try:
                     base_date = datetime.strptime(str(data_aplicacao)[:10], '%Y-%m-%d').date()
                 except Exception:
                     base_date = datetime.utcnow().date()
-                start = base_date - timedelta(days=14)
-                end = base_date + timedelta(days=1)
                 try:
-                    hist = yf.Ticker(t_yf).history(start=start.isoformat(), end=end.isoformat())
-                    if hist is not None and not hist.empty:
-                        close_val = None
-                        for idx, row in hist[::-1].iterrows():
-                            d = idx.date()
-                            if d <= base_date:
-                                close_val = float(row.get('Close') or row.get('Adj Close') or 0)
-                                break
-                        if close_val and close_val > 0:
-                            preco_inicial = close_val
+                    res = precos_em_datas([(ticker, base_date)], janela_dias=14)[0]
+                    if res and res["preco"] > 0:
+                        preco_inicial = res["preco"]
                 except Exception:
                     pass
         except Exception:
@@ -4458,29 +4541,11 @@ def api_rebalance_history():
 @server.route("/api/indicadores", methods=["GET"])
 def api_indicadores():
     try:
-
-        def sgs_last(series_id, use_range=False):
-            if use_range:
-                end_date = datetime.now()
-                start_date = end_date - timedelta(days=90)
-                url = (f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados?"
-                       f"formato=json&dataInicial={start_date.strftime('%d/%m/%Y')}"
-                       f"&dataFinal={end_date.strftime('%d/%m/%Y')}")
-                r = requests.get(url, timeout=10)
-                r.raise_for_status()
-                arr = r.json()
-                return arr[-1] if arr else None
-            else:
-                url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados/ultimos/1?formato=json"
-                r = requests.get(url, timeout=10)
-                r.raise_for_status()
-                arr = r.json()
-                return arr[0] if arr else None
-
-        selic = sgs_last(432, use_range=True)
-        ipca_mensal = sgs_last(433)
+        # Último ponto de cada série, servido pelo store local de séries SGS
+        selic = ultimo_ponto_bcb(432)
+        ipca_mensal = ultimo_ponto_bcb(433)
         # Série 13522 = IPCA variação acumulada em 12 meses (% a.a. já divulgado pelo IBGE/BCB).
-        ipca_12m = sgs_last(13522)
+        ipca_12m = ultimo_ponto_bcb(13522)
 
         # Mantém compatibilidade: campo "ipca" passa a priorizar 12m.
         if ipca_12m:
@@ -4819,108 +4884,29 @@ def api_get_proventos():
         if not tickers:
             return jsonify([])
         
+        # Dividendos vêm do store local (sincronizado de forma incremental), não de um yf.Ticker por ticker
+        eventos = obter_proventos_tickers(tickers, _data_inicio_periodo_proventos(periodo), cliente_desconectado)
+        client_gone = cliente_desconectado()
+        por_ticker = {t: g for t, g in eventos.groupby('ticker', sort=False)}
         resultado = []
-        
-
-        data_inicio = None
-        if periodo != 'total':
-            hoje = datetime.now()
-            if periodo == 'mes':
-                data_inicio = hoje.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == '6meses':
-                data_inicio = hoje - timedelta(days=180)
-                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == '1ano':
-                data_inicio = hoje - timedelta(days=365)
-                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == '5anos':
-                data_inicio = hoje - timedelta(days=365*5)
-                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Paralelização: busca proventos de todos os tickers simultaneamente
-        def _buscar_proventos_ticker(ticker):
-            """Função auxiliar para buscar proventos de um ticker"""
-            try:
-                if not ticker.endswith('.SA') and not '.' in ticker:
-                    ticker_normalizado = f"{ticker}.SA"
-                else:
-                    ticker_normalizado = ticker
-
-                ativo = yf.Ticker(ticker_normalizado)
-                dividendos = ativo.dividends
-                
-                if dividendos is not None and not dividendos.empty:
-                    proventos = []
-                    for data, valor in dividendos.items():
-                        data_sem_timezone = data.replace(tzinfo=None)
-
-                        if data_inicio is None or data_sem_timezone >= data_inicio:
-                            proventos.append({
-                                'data': data.strftime('%Y-%m-%d'),
-                                'valor': float(valor),
-                                'tipo': 'Dividendo'
-                            })
-
-                    info = ativo.info
-                    nome = info.get('longName', ticker_normalizado)
-                    
-                    return {
-                        'ticker': ticker,
-                        'nome': nome,
-                        'proventos': proventos
-                    }
-                else:
-                    return {
-                        'ticker': ticker,
-                        'nome': ticker,
-                        'proventos': [],
-                        'erro': 'Nenhum provento encontrado'
-                    }
-            except Exception as e:
-                return {
+        for ticker in tickers:
+            grupo = por_ticker.get(ticker)
+            if grupo is None:
+                resultado.append({
                     'ticker': ticker,
                     'nome': ticker,
                     'proventos': [],
-                    'erro': f'Erro ao buscar dados: {str(e)}'
-                }
-        
-        # OTIMIZAÇÃO: Reduzido de 10 para 5 workers para evitar sobrecarga de RAM no Render
-        max_workers = min(len(tickers), 200)  # Até 200 workers simultâneos
-        client_gone = False
-
-        executor = ThreadPoolExecutor(max_workers=max_workers)
-        try:
-            future_to_ticker = {
-                executor.submit(_buscar_proventos_ticker, ticker): ticker
-                for ticker in tickers
-            }
-
-            for future in as_completed(future_to_ticker):
-                if cliente_desconectado():
-                    client_gone = True
-                    print(f"[ABORT] /carteira/proventos: cliente desconectou. "
-                          f"Processados {len(resultado)}/{len(future_to_ticker)} tickers.")
-                    break
-
-                try:
-                    resultado_ativo = future.result()
-                    resultado.append(resultado_ativo)
-                except Exception as e:
-                    ticker = future_to_ticker[future]
-                    resultado.append({
-                        'ticker': ticker,
-                        'nome': ticker,
-                        'proventos': [],
-                        'erro': f'Erro ao processar: {str(e)}'
-                    })
-        finally:
-            if client_gone:
-                try:
-                    executor.shutdown(wait=False, cancel_futures=True)
-                except TypeError:
-                    executor.shutdown(wait=False)
-            else:
-                executor.shutdown(wait=True)
+                    'erro': 'Nenhum provento encontrado'
+                })
+                continue
+            resultado.append({
+                'ticker': ticker,
+                'nome': obter_nome_ativo_yf(ticker),
+                'proventos': [
+                    {'data': d.strftime('%Y-%m-%d'), 'valor': float(v), 'tipo': 'Dividendo'}
+                    for d, v in zip(grupo['data_ex'], grupo['valor'])
+                ]
+            })
 
         if client_gone:
             return jsonify(resultado), 499
@@ -4930,73 +4916,16 @@ def api_get_proventos():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-def _buscar_proventos_ativo(ativo, data_inicio):
+def _calcular_proventos_recebidos(periodo, should_cancel=None):
     """
-    Função auxiliar para buscar proventos de um ativo.
-    Usada para paralelização no endpoint /api/carteira/proventos-recebidos.
+    Proventos recebidos pela carteira do usuário atual no período.
+    Retorna (resultado, interrompido): interrompido=True quando
+    `should_cancel()` (cliente desconectou / job cancelado) parou a busca.
     """
-    try:
-        ticker = ativo['ticker']
-        quantidade = ativo['quantidade']
-        data_aquisicao = ativo.get('data_adicao')
-        
-        if not ticker.endswith('.SA') and not '.' in ticker:
-            ticker_normalizado = f"{ticker}.SA"
-        else:
-            ticker_normalizado = ticker
-        
-        ativo_yf = yf.Ticker(ticker_normalizado)
-        dividendos = ativo_yf.dividends
-        
-        if dividendos is not None and not dividendos.empty:
-            proventos_recebidos = []
-            for data, valor in dividendos.items():
-                # Converter para datetime sem timezone para comparação
-                data_sem_timezone = data.replace(tzinfo=None)
-                
-                # Só considerar dividendos pagos após a data de aquisição
-                if data_aquisicao:
-                    try:
-                        data_aquisicao_dt = datetime.strptime(data_aquisicao, '%Y-%m-%d %H:%M:%S')
-                        if data_sem_timezone < data_aquisicao_dt:
-                            continue  # Pular dividendos pagos antes da aquisição
-                    except ValueError:
-                        # Se não conseguir fazer o parse, tentar só a data
-                        try:
-                            data_aquisicao_dt = datetime.strptime(data_aquisicao, '%Y-%m-%d')
-                            if data_sem_timezone < data_aquisicao_dt:
-                                continue  # Pular dividendos pagos antes da aquisição
-                        except ValueError:
-                            # Se ainda não conseguir, ignorar a data de aquisição
-                            pass
-                
-                if data_inicio is None or data_sem_timezone >= data_inicio:
-                    valor_recebido = float(valor) * quantidade
-                    proventos_recebidos.append({
-                        'data': data.strftime('%Y-%m-%d'),
-                        'valor_unitario': float(valor),
-                        'quantidade': quantidade,
-                        'valor_recebido': valor_recebido,
-                        'tipo': 'Dividendo'
-                    })
-            
-            if proventos_recebidos:
-                info = ativo_yf.info
-                nome = info.get('longName', ticker_normalizado)
-                
-                return {
-                    'ticker': ticker,
-                    'nome': nome,
-                    'quantidade_carteira': quantidade,
-                    'data_aquisicao': data_aquisicao,
-                    'proventos_recebidos': proventos_recebidos,
-                    'total_recebido': sum(p['valor_recebido'] for p in proventos_recebidos)
-                }
-        
-        return None
-    except Exception as e:
-        print(f"Erro ao processar proventos para {ativo.get('ticker', 'desconhecido')}: {str(e)}")
-        return None
+    resultado, interrompido = calcular_proventos_recebidos(periodo, should_cancel)
+    if interrompido:
+        print("[ABORT] /proventos-recebidos: busca interrompida (cliente desconectou ou job cancelado).")
+    return resultado, interrompido
 
 @server.route("/api/carteira/proventos-recebidos", methods=["GET"])
 def api_get_proventos_recebidos():
@@ -5007,78 +4936,7 @@ def api_get_proventos_recebidos():
             return erro[0], erro[1]
         
         periodo = request.args.get('periodo', 'total')
-        
-        carteira = obter_carteira()
-        if not carteira:
-            return jsonify([])
-        
-        # Usar data da primeira compra (movimentações) quando existir, para não contar dividendos antes de ser dono do ativo
-        primeiras_compras = obter_data_primeira_compra_por_ticker()
-        for ativo in carteira:
-            ticker = ativo.get('ticker', '')
-            data_primeira = primeiras_compras.get(ticker)
-            if data_primeira:
-                ativo['data_adicao'] = data_primeira
-            # Se não houver compra em movimentações, mantém data_adicao da carteira (quando adicionou o ativo)
-        
-        data_inicio = None
-        if periodo != 'total':
-            hoje = datetime.now()
-            if periodo == 'mes':
-                data_inicio = hoje.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == '6meses':
-                data_inicio = hoje - timedelta(days=180)
-                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == '1ano':
-                data_inicio = hoje - timedelta(days=365)
-                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-            elif periodo == '5anos':
-                data_inicio = hoje - timedelta(days=365*5)
-                data_inicio = data_inicio.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-       
-        resultado = []
-    
-        max_workers = min(len(carteira), 5)
-        client_gone = False
-
-        # Não usamos `with ThreadPoolExecutor(...)` porque o context-manager
-        # chama shutdown(wait=True) e bloquearia o response esperando todas
-        # as tasks. Quando detectamos disconnect, queremos sair imediatamente
-        # com cancel_futures (Python 3.9+). Os futures que JÁ começaram
-        # continuam até terminar (não dá pra interromper yfinance), mas isso
-        # não bloqueia o worker do Gunicorn, que fica livre para a próxima
-        # request — exatamente o ganho que precisamos.
-        executor = ThreadPoolExecutor(max_workers=max_workers)
-        try:
-            future_to_ativo = {
-                executor.submit(_buscar_proventos_ativo, ativo, data_inicio): ativo
-                for ativo in carteira
-            }
-
-            for future in as_completed(future_to_ativo):
-                if cliente_desconectado():
-                    client_gone = True
-                    print(f"[ABORT] /proventos-recebidos: cliente desconectou. "
-                          f"Processados {len(resultado)}/{len(future_to_ativo)} ativos antes de abortar.")
-                    break
-
-                try:
-                    resultado_ativo = future.result()
-                    if resultado_ativo is not None:
-                        resultado.append(resultado_ativo)
-                except Exception as e:
-                    ativo = future_to_ativo[future]
-                    print(f"Erro ao processar proventos para {ativo.get('ticker', 'desconhecido')}: {str(e)}")
-        finally:
-            if client_gone:
-                try:
-                    executor.shutdown(wait=False, cancel_futures=True)
-                except TypeError:
-                    # Python < 3.9 não suporta cancel_futures
-                    executor.shutdown(wait=False)
-            else:
-                executor.shutdown(wait=True)
+        resultado, client_gone = _calcular_proventos_recebidos(periodo, cliente_desconectado)
 
         if client_gone:
             # Cliente já fechou TCP; o response será descartado de qualquer forma.
@@ -5091,6 +4949,142 @@ def api_get_proventos_recebidos():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ==================== JOBS EM SEGUNDO PLANO ====================
+# Versões assíncronas das análises longas: POST /api/jobs devolve um job_id
+# na hora e o frontend consulta GET /api/jobs/<id> (com ?esperar=N para
+# long-poll). Concorrência por tipo, dedup de jobs idênticos e TTL do
+# resultado ficam em job_queue.FilaJobs.
+
+FILA_JOBS.registrar_tipo('analise_ativos', concorrencia=2, ttl_s=1800)
+FILA_JOBS.registrar_tipo('monte_carlo', concorrencia=2, ttl_s=600)
+FILA_JOBS.registrar_tipo('proventos_recebidos', concorrencia=2, ttl_s=600)
+FILA_JOBS.registrar_tipo('historico_carteira', concorrencia=2, ttl_s=300)
+# só pela rota de admin (/api/admin/carteiras/atualizar), fora de _montar_job
+FILA_JOBS.registrar_tipo('refresh_carteiras', concorrencia=1, ttl_s=300, prazo_s=1800)
+
+
+def _montar_job(tipo, params):
+    """(funcao(cancelado), por_usuario) do job; ValueError se o pedido é inválido."""
+    if tipo == 'analise_ativos':
+        tipo_analise = params.get('tipo', 'acoes')
+        filtros = params.get('filtros') or {}
+        if tipo_analise not in ('acoes', 'bdrs', 'fiis'):
+            raise ValueError("Tipo inválido")
+
+        def rodar(cancelado):
+            cache_key_str = _analise_cache_key(tipo_analise, filtros)
+            cached_result = cache.get(cache_key_str)
+            if cached_result is not None:
+                return cached_result
+            dados = _executar_analise_ativos(tipo_analise, filtros, cancelado)
+            if not cancelado():
+                cache.set(cache_key_str, dados, timeout=1800)
+            return dados
+        return rodar, False
+
+    if tipo == 'monte_carlo':
+        n_simulacoes = params.get('nSimulacoes', 10000)
+        periodo_anos = params.get('periodoAnos', 5)
+        confianca = params.get('confianca', 95)
+        aporte_mensal = params.get('aporteMensal', 0)
+
+        def rodar(cancelado):
+            resultado = executar_monte_carlo(n_simulacoes, periodo_anos, confianca, aporte_mensal)
+            if "error" in resultado:
+                raise ValueError(resultado["error"])
+            return resultado
+        return rodar, True
+
+    if tipo == 'proventos_recebidos':
+        periodo = params.get('periodo', 'total')
+
+        def rodar(cancelado):
+            resultado, _ = _calcular_proventos_recebidos(periodo, cancelado)
+            return resultado
+        return rodar, True
+
+    if tipo == 'historico_carteira':
+        periodo = params.get('periodo', 'mensal')
+
+        def rodar(cancelado):
+            dados = obter_historico_carteira_comparado(periodo)
+            return _normalizar_payload_historico_carteira(dados, periodo)
+        return rodar, True
+
+    raise ValueError("Tipo de job inválido")
+
+
+def _job_do_usuario(job):
+    """None se o job pode ser lido pelo usuário da requisição; senão a resposta de erro."""
+    if job is None:
+        return jsonify({"error": "Job não encontrado"}), 404
+    if job.get("usuario"):
+        usuario_atual, erro = validar_usuario_autenticado(validar_token=True)
+        if erro:
+            return erro[0], erro[1]
+        if usuario_atual != job["usuario"]:
+            return jsonify({"error": "Job não encontrado"}), 404
+    return None
+
+
+@server.route("/api/jobs", methods=["POST"])
+def api_jobs_submeter():
+    try:
+        data = request.get_json(silent=True) or {}
+        tipo = data.get('tipo')
+        params = data.get('params') or {}
+        try:
+            rodar, por_usuario = _montar_job(tipo, params)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        usuario = None
+        if por_usuario:
+            usuario, erro = validar_usuario_autenticado(validar_token=True)
+            if erro:
+                return erro[0], erro[1]
+            # o job roda fora da requisição: leva junto o contexto (cookie de sessão -> get_usuario_atual)
+            rodar = copy_current_request_context(rodar)
+
+        chave = json.dumps(params, sort_keys=True, default=str)
+        job = FILA_JOBS.submeter(tipo, chave, rodar, usuario=usuario)
+        job.pop("usuario", None)
+        return jsonify(job), 200 if job["status"] == "concluido" else 202
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@server.route("/api/jobs/<job_id>", methods=["GET"])
+def api_jobs_status(job_id):
+    try:
+        try:
+            esperar = min(max(float(request.args.get('esperar', 0)), 0.0), 25.0)
+        except ValueError:
+            esperar = 0.0
+        job = FILA_JOBS.obter(job_id, incluir_resultado=False)
+        negado = _job_do_usuario(job)
+        if negado is not None:
+            return negado
+        job = FILA_JOBS.esperar(job_id, timeout=esperar)
+        if job is None:
+            return jsonify({"error": "Job não encontrado"}), 404
+        job.pop("usuario", None)
+        return jsonify(job)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@server.route("/api/jobs/<job_id>", methods=["DELETE"])
+def api_jobs_cancelar(job_id):
+    try:
+        job = FILA_JOBS.obter(job_id, incluir_resultado=False)
+        negado = _job_do_usuario(job)
+        if negado is not None:
+            return negado
+        return jsonify({"ok": FILA_JOBS.cancelar(job_id)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # ==================== MARMITAS API ====================
 
 @server.route("/api/marmitas", methods=["GET"])
@@ -5986,7 +5980,7 @@ def api_get_exchange_rate(symbol):
     try:
       
         ticker = yf.Ticker(symbol)
-        historico = ticker.history(period='1d')
+        historico = LIMITADOR.executar('yahoo', lambda: ticker.history(period='1d'))
         
         if historico is not None and not historico.empty:
 
@@ -6261,18 +6255,14 @@ def api_simulador_cenarios():
 @server.route("/api/simulador/monte-carlo", methods=["POST"])
 def api_simulador_monte_carlo():
     """Endpoint para executar simulação Monte Carlo"""
-    adquirido = MONTE_CARLO_SEM.acquire(timeout=540)
-    if not adquirido:
-        return jsonify({
-            "error": "Servidor ocupado executando outra simulação Monte Carlo. Tente novamente em alguns instantes."
-        }), 503
     try:
         data = request.get_json()
         n_simulacoes = data.get('nSimulacoes', 10000)
         periodo_anos = data.get('periodoAnos', 5)
         confianca = data.get('confianca', 95)
+        aporte_mensal = data.get('aporteMensal', 0)
         
-        resultado = executar_monte_carlo(n_simulacoes, periodo_anos, confianca)
+        resultado = executar_monte_carlo(n_simulacoes, periodo_anos, confianca, aporte_mensal)
         
         if "error" in resultado:
             return jsonify(resultado), 400
@@ -6281,11 +6271,6 @@ def api_simulador_monte_carlo():
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        try:
-            MONTE_CARLO_SEM.release()
-        except Exception:
-            pass
 
 
 # ==================== API MERCADOS B3 ====================
@@ -6681,6 +6666,9 @@ def api_obter_lista_ranking():
         return jsonify({"success": False, "message": str(e)}), 500
 
 if __name__ == "__main__":
+    # Sob o gunicorn quem inicia é o post_fork (gunicorn.conf.py)
+    from models import _garantir_refresher_carteiras
+    _garantir_refresher_carteiras()
     # Debug: Listar todas as rotas registradas
     print("\n=== ROTAS REGISTRADAS ===")
     for rule in server.url_map.iter_rules():
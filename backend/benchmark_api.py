@@ -0,0 +1,507 @@
+"""
+Benchmark dos endpoints quentes da API, sem rede (upstreams em reprodução, dados numa pasta temporária).
+Uso: python benchmark_api.py --ativos 40 --movimentacoes 2000 --meses 36 --saida bench.json
+"""
+from __future__ import annotations
+
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+SENHA = "Bench#12345"
+INDICES = ["^BVSP", "BOVA11.SA", "IVVB11.SA", "^IFIX", "XFIX11.SA", "BTC-BRL", "BTC-USD", "BRL=X"]
+SERIES_BCB = {12: 0.04, 11: 0.04, 432: 10.5, 433: 0.4, 188: 0.4, 189: 0.5}
+
+
+def _argumentos(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark dos endpoints quentes da API (sem rede).")
+    p.add_argument("--ativos", type=int, default=30, help="N ativos na carteira")
+    p.add_argument("--movimentacoes", type=int, default=500, help="M movimentações")
+    p.add_argument("--meses", type=int, default=24, help="K meses de controle e de histórico")
+    p.add_argument("--repeticoes", type=int, default=20)
+    p.add_argument("--aquecimento", type=int, default=2)
+    p.add_argument("--fixtures", default=None, help="pasta de fixtures (vazia = gera sintéticas)")
+    p.add_argument("--latencia-ms", type=float, default=0.0)
+    p.add_argument("--jitter-ms", type=float, default=0.0)
+    p.add_argument("--com-cache", action="store_true", help="não limpa o cache do Flask entre chamadas")
+    p.add_argument("--endpoints", default="", help="nomes separados por vírgula (padrão: todos)")
+    p.add_argument("--sem-alocacoes", action="store_true", help="pula a rodada com tracemalloc")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--exigir-planos", action="store_true",
+                   help="sai com erro se alguma consulta por data não usar o índice esperado")
+    p.add_argument("--saida", default="bench_api.json")
+    return p.parse_args(argv)
+
+
+def _preparar_ambiente(args, tmp):
+    """Variáveis lidas no import do models/app: tudo isolado em `tmp`."""
+    for var in ("DATABASE_URL", "USUARIOS_DB_URL"):
+        os.environ.pop(var, None)
+    os.environ["FINMAS_BANCOS_DIR"] = os.path.join(tmp, "bancos_usuarios")
+    os.environ["FINMAS_STORE_DIR"] = os.path.join(tmp, "store")
+    os.environ["FLASK_CACHE_DIR"] = os.path.join(tmp, "cache")
+    os.environ["USUARIOS_DB_PATH"] = os.path.join(tmp, "usuarios.db")
+    os.environ["CARTEIRA_REFRESH_S"] = "0"
+    os.environ["FINMAS_UPSTREAM_MODO"] = "reproduzir"
+    os.environ["FINMAS_FIXTURES_DIR"] = args.fixtures
+    os.environ["FINMAS_REPLAY_LATENCIA_MS"] = str(args.latencia_ms)
+    os.environ["FINMAS_REPLAY_JITTER_MS"] = str(args.jitter_ms)
+    # o limitador é do sistema, mas a taxa de produção (4/s) mediria só as esperas
+    os.environ.setdefault("LIMITE_YAHOO_RPS", "1000")
+    os.environ.setdefault("LIMITE_YAHOO_RAJADA", "1000")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+# ---------------------------------------------------------------------- fixtures
+
+
+def _historico_sintetico(rng, inicio, fim, preco, dividendos=True):
+    import numpy as np
+    import pandas as pd
+
+    idx = pd.bdate_range(inicio, fim, tz="America/Sao_Paulo")
+    retornos = rng.normal(0.0003, 0.015, len(idx))
+    close = preco * np.exp(np.cumsum(retornos))
+    df = pd.DataFrame(
+        {
+            "Open": close * (1 - rng.uniform(0, 0.01, len(idx))),
+            "High": close * (1 + rng.uniform(0, 0.02, len(idx))),
+            "Low": close * (1 - rng.uniform(0, 0.02, len(idx))),
+            "Close": close,
+            "Volume": rng.integers(10_000, 5_000_000, len(idx)).astype(float),
+            "Dividends": 0.0,
+            "Stock Splits": 0.0,
+        },
+        index=idx,
+    )
+    if dividendos and len(idx) > 40:
+        # um provento por trimestre
+        for i in range(20, len(idx), 63):
+            df.iloc[i, df.columns.get_loc("Dividends")] = round(float(close[i]) * 0.015, 4)
+    return df
+
+
+def _info_sintetica(rng, simbolo, preco):
+    setores = ["Financeiro", "Energia", "Materiais", "Utilidade Pública", "Consumo", "Imobiliário"]
+    return {
+        "symbol": simbolo,
+        "longName": f"{simbolo.split('.')[0]} S.A.",
+        "shortName": simbolo.split(".")[0],
+        "sector": setores[int(rng.integers(0, len(setores)))],
+        "industry": "Diversos",
+        "currency": "BRL",
+        "currentPrice": preco,
+        "regularMarketPrice": preco,
+        "previousClose": preco,
+        "dividendYield": round(float(rng.uniform(0, 0.14)), 4),
+        "trailingPE": round(float(rng.uniform(2, 30)), 2),
+        "priceToBook": round(float(rng.uniform(0.3, 4)), 2),
+        "returnOnEquity": round(float(rng.uniform(-0.05, 0.35)), 4),
+        "marketCap": float(rng.integers(10**8, 10**11)),
+        "averageVolume": float(rng.integers(10**4, 10**7)),
+        "enterpriseToEbitda": round(float(rng.uniform(2, 15)), 2),
+        "debtToEquity": round(float(rng.uniform(0, 200)), 2),
+        "totalRevenue": float(rng.integers(10**8, 10**11)),
+    }
+
+
+def gerar_fixtures_sinteticas(pasta, simbolos_carteira, simbolos_universo, meses, seed):
+    """Fixtures determinísticas: mesma `seed` = mesmas respostas."""
+    import numpy as np
+
+    import gravacao_upstream
+
+    g = gravacao_upstream.GravadorUpstream("reproduzir", pasta)
+    rng = np.random.default_rng(seed)
+    hoje = date.today()
+    inicio_longo = hoje - timedelta(days=31 * (meses + 14))
+    for simbolo in sorted(set(simbolos_carteira) | set(INDICES)):
+        preco = float(rng.uniform(5, 120)) if not simbolo.startswith("BTC") else 300_000.0
+        if simbolo == "BRL=X":
+            preco = 5.2
+        df = _historico_sintetico(rng, inicio_longo, hoje, preco, dividendos=simbolo not in INDICES)
+        g.salvar_yf(simbolo, "history", df, kwargs={"period": "max"})
+        g.salvar_yf(simbolo, "info", _info_sintetica(rng, simbolo, float(df["Close"].iloc[-1])))
+    # o Yahoo responde vazio para o ticker da B3 sem ".SA" (alguns caminhos tentam os dois)
+    vazio = _historico_sintetico(rng, hoje, hoje, 1.0).iloc[0:0]
+    for simbolo in sorted(set(simbolos_carteira)):
+        if simbolo.endswith(".SA"):
+            g.salvar_yf(simbolo[:-3], "history", vazio, kwargs={"period": "max"})
+    for simbolo in sorted(set(simbolos_universo) - set(simbolos_carteira)):
+        preco = float(rng.uniform(5, 120))
+        df = _historico_sintetico(rng, hoje - timedelta(days=20), hoje, preco, dividendos=False)
+        g.salvar_yf(simbolo, "history", df, kwargs={"period": "max"})
+        g.salvar_yf(simbolo, "info", _info_sintetica(rng, simbolo, float(df["Close"].iloc[-1])))
+
+    # séries SGS: um ponto por dia útil (diárias) ou por mês (IPCA, INPC, IGP-M)
+    for serie, valor in SERIES_BCB.items():
+        mensal = serie in (433, 188, 189)
+        pontos = []
+        d = date(hoje.year - 11, 1, 1)
+        while d <= hoje:
+            if mensal and d.day == 1 or not mensal and d.weekday() < 5:
+                pontos.append({"data": d.strftime("%d/%m/%Y"), "valor": f"{valor * float(rng.uniform(0.8, 1.2)):.6f}"})
+            d += timedelta(days=1)
+        g.salvar_http("GET", f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{serie}/dados", 200, pontos, params={"formato": "json"})
+        g.salvar_http("GET", f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{serie}/dados/ultimos/1", 200, pontos[-1:])
+
+    g.salvar_http(
+        "GET",
+        "https://api.binance.com/api/v3/ticker/price",
+        200,
+        [{"symbol": "BTCUSDT", "price": "60000.00"}, {"symbol": "ETHUSDT", "price": "3000.00"}],
+    )
+    return g.metricas()["_fixtures"]
+
+
+# ---------------------------------------------------------------------- dados
+
+
+def _tickers_carteira(n):
+    from assets_lists import LISTA_ACOES, LISTA_FIIS
+
+    acoes = [t.split(".")[0].upper() for t in LISTA_ACOES]
+    fiis = [t.split(".")[0].upper() for t in LISTA_FIIS]
+    n_fiis = n // 3
+    return acoes[: n - n_fiis] + fiis[:n_fiis]
+
+
+def semear_usuario(models, username, tickers, n_movimentacoes, meses, seed):
+    """Carteira, movimentações (com o ledger), snapshots e controle de `username`, direto no SQLite."""
+    rng = random.Random(seed)
+    hoje = date.today()
+    inicio = hoje - timedelta(days=31 * meses)
+    dias = max((hoje - inicio).days, 1)
+
+    carteira = sqlite3.connect(models.get_db_path(username, "carteira"))
+    try:
+        movs = []
+        posicoes = {t: [0.0, 0.0, None] for t in tickers}  # quantidade, custo, 1ª compra
+        for i in range(n_movimentacoes):
+            t = tickers[i % len(tickers)]
+            d = inicio + timedelta(days=rng.randrange(dias))
+            preco = round(rng.uniform(5, 120), 2)
+            qtd, custo, primeira = posicoes[t]
+            if qtd > 10 and rng.random() < 0.2:
+                q = float(rng.randint(1, int(qtd // 2)))
+                posicoes[t] = [qtd - q, custo * (qtd - q) / qtd, primeira]
+                movs.append((d.isoformat(), t, t, q, preco, "venda"))
+            else:
+                q = float(rng.randint(1, 100))
+                posicoes[t] = [qtd + q, custo + q * preco, min(filter(None, [primeira, d]))]
+                movs.append((d.isoformat(), t, t, q, preco, "compra"))
+        movs.sort()
+        carteira.executemany(
+            "INSERT INTO movimentacoes (data, ticker, nome_completo, quantidade, preco, tipo) VALUES (?, ?, ?, ?, ?, ?)",
+            movs,
+        )
+        # o INSERT direto não passa por registrar_movimentacao: materializa o ledger de uma vez
+        models._ledger_reconstruir(carteira.cursor(), "?")
+        linhas = []
+        for t, (qtd, custo, primeira) in posicoes.items():
+            qtd = qtd or 10.0
+            preco_medio = round(custo / qtd, 2) if custo else 10.0
+            preco_atual = round(preco_medio * rng.uniform(0.8, 1.3), 2)
+            tipo = "FII" if t.endswith("11") else "Ação"
+            linhas.append((
+                t, t, qtd, preco_atual, preco_atual * qtd, f"{(primeira or inicio).isoformat()} 10:00:00", tipo,
+                round(rng.uniform(0, 0.12), 4), round(rng.uniform(3, 25), 2), round(rng.uniform(0.5, 3), 2),
+                round(rng.uniform(0, 0.3), 4), preco_medio, preco_medio,
+            ))
+        carteira.executemany(
+            "INSERT INTO carteira (ticker, nome_completo, quantidade, preco_atual, valor_total, data_adicao, tipo, "
+            "dy, pl, pvp, roe, preco_medio, preco_compra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            linhas,
+        )
+        total = sum(l[4] for l in linhas)
+        carteira.commit()
+    finally:
+        carteira.close()
+    # um snapshot de patrimônio por pregão (grava também os rollups semanal/mensal)
+    models._gravar_patrimonio_diario(username, [
+        ((inicio + timedelta(days=d)).isoformat(), round(total * (0.6 + 0.4 * d / dias), 2))
+        for d in range(dias)
+        if (inicio + timedelta(days=d)).weekday() < 5
+    ])
+
+    controle = sqlite3.connect(models.get_db_path(username, "controle"))
+    marmitas = sqlite3.connect(models.get_db_path(username, "marmitas"))
+    try:
+        cartoes = []
+        for nome in ("Nubank", "Itaú"):
+            cur = controle.execute(
+                "INSERT INTO cartoes_cadastrados (nome, bandeira, limite, vencimento, cor) VALUES (?, ?, ?, ?, ?)",
+                (nome, "Visa", 10_000.0, 10, "#8a05be"),
+            )
+            cartoes.append(cur.lastrowid)
+        categorias = ["alimentacao", "transporte", "moradia", "lazer", "saude"]
+        receitas, gastos, compras, refeicoes = [], [], [], []
+        for m in range(meses):
+            ano, mes = divmod(hoje.year * 12 + hoje.month - 1 - m, 12)
+            mes += 1
+            receitas.append(("Salário", 8_000.0, f"{ano:04d}-{mes:02d}-05", "salario", "fixa"))
+            receitas.append(("Extra", round(rng.uniform(100, 2_000), 2), f"{ano:04d}-{mes:02d}-20", "outros", "variavel"))
+            for _ in range(10):
+                dia = rng.randint(1, 28)
+                gastos.append((
+                    "Gasto", round(rng.uniform(10, 800), 2), f"{ano:04d}-{mes:02d}-{dia:02d}", rng.choice(categorias), "variavel",
+                ))
+            for _ in range(15):
+                dia = rng.randint(1, 28)
+                compras.append((
+                    rng.choice(cartoes), "Compra", round(rng.uniform(10, 500), 2), f"{ano:04d}-{mes:02d}-{dia:02d}", rng.choice(categorias),
+                ))
+            for dia in range(1, 29, 1):
+                if rng.random() < 0.7:
+                    refeicoes.append((f"{ano:04d}-{mes:02d}-{dia:02d}", 25.0, int(rng.random() < 0.5)))
+        controle.executemany("INSERT INTO receitas (nome, valor, data, categoria, tipo) VALUES (?, ?, ?, ?, ?)", receitas)
+        controle.executemany("INSERT INTO outros_gastos (nome, valor, data, categoria, tipo) VALUES (?, ?, ?, ?, ?)", gastos)
+        controle.executemany(
+            "INSERT INTO compras_cartao (cartao_id, nome, valor, data, categoria) VALUES (?, ?, ?, ?, ?)", compras
+        )
+        marmitas.executemany("INSERT INTO marmitas (data, valor, comprou) VALUES (?, ?, ?)", refeicoes)
+        controle.commit()
+        marmitas.commit()
+    finally:
+        controle.close()
+        marmitas.close()
+
+
+# ---------------------------------------------------------------------- medição
+
+
+def _endpoints():
+    hoje = date.today()
+    mes, ano = f"{hoje.month:02d}", str(hoje.year)
+    return [
+        ("carteira", "GET", "/api/carteira", None),
+        ("home_resumo", "GET", f"/api/home/resumo?mes={mes}&ano={ano}", None),
+        ("carteira_insights", "GET", "/api/carteira/insights", None),
+        ("analise_ativos", "POST", "/api/analise/ativos", {"tipo": "acoes", "filtros": {}}),
+        ("historico_comparado", "GET", "/api/carteira/historico?periodo=mensal", None),
+        ("export_csv", "GET", "/api/relatorios/movimentacoes.csv", None),
+        ("export_pdf", "GET", "/api/relatorios/movimentacoes.pdf", None),
+        ("export_xlsx", "GET", "/api/relatorios/movimentacoes.xlsx", None),
+        ("batch", "POST", "/api/batch", {"requests": [
+            {"endpoint": "/carteira", "method": "GET"},
+            {"endpoint": "/indicadores", "method": "GET"},
+            {"endpoint": "/carteira/historico", "method": "GET", "params": {"periodo": "mensal"}},
+            {"endpoint": "/goals", "method": "GET"},
+            {"endpoint": "/home/resumo", "method": "GET", "params": {"mes": mes, "ano": ano}},
+        ]}),
+    ]
+
+
+def _consultas_planos():
+    """(nome, banco, SQL, parâmetros, índice esperado) das consultas por data dos hot paths."""
+    return [
+        ("movimentacoes_mes", "carteira",
+         "SELECT * FROM movimentacoes WHERE data >= ? AND data < ? ORDER BY data DESC",
+         ("2026-01-01", "2026-02-01"), "idx_movimentacoes_data"),
+        ("movimentacoes_ticker", "carteira",
+         "SELECT data, preco FROM movimentacoes WHERE ticker = ? ORDER BY data ASC",
+         ("PETR4.SA",), "idx_movimentacoes_ticker_data"),
+        ("historico_carteira_periodo", "carteira",
+         "SELECT data, valor_total FROM historico_carteira WHERE data >= ? ORDER BY data",
+         ("2026-01-01",), "idx_historico_carteira_data"),
+        ("posicao_em_data", "carteira",
+         "SELECT quantidade FROM posicoes_ledger WHERE ticker = ? AND data <= ? ORDER BY data DESC LIMIT 1",
+         ("PETR4.SA", "2026-01-01"), "PRIMARY KEY"),
+        ("receitas_mes", "controle",
+         "SELECT * FROM receitas WHERE data >= ? AND data < ? ORDER BY data DESC",
+         ("2026-01-01", "2026-02-01"), "idx_receitas_data"),
+        ("outros_gastos_mes", "controle",
+         "SELECT * FROM outros_gastos WHERE data >= ? AND data < ? ORDER BY data DESC",
+         ("2026-01-01", "2026-02-01"), "idx_outros_data"),
+        ("compras_cartao_mes", "controle",
+         "SELECT * FROM compras_cartao WHERE cartao_id = ? AND data >= ? AND data < ? ORDER BY data DESC",
+         (1, "2026-01-01", "2026-02-01"), "idx_compras_cartao_cartao_data"),
+        ("marmitas_mes", "marmitas",
+         "SELECT * FROM marmitas WHERE data >= ? AND data < ? ORDER BY data DESC",
+         ("2026-01-01", "2026-02-01"), "idx_marmitas_data"),
+        ("marmitas_gastos_mensais", "marmitas",
+         "SELECT substr(data, 1, 7) as AnoMes, SUM(valor) as valor FROM marmitas "
+         "WHERE substr(data, 1, 7) >= ? AND data >= ? GROUP BY substr(data, 1, 7) ORDER BY AnoMes DESC",
+         ("2026-01", "2026-01-15"), "idx_marmitas_mes"),
+    ]
+
+
+def verificar_planos(models, username):
+    """
+    EXPLAIN QUERY PLAN das consultas por data no banco semeado. Uma consulta
+    passa quando busca pelo índice esperado, sem varrer a tabela nem montar
+    B-tree temporária para ordenar/agrupar.
+    """
+    if models._is_postgres():
+        raise SystemExit("[bench] planos de consulta só em SQLite (DATABASE_URL configurada)")
+    planos = {}
+    for nome, banco, sql, params, indice in _consultas_planos():
+        conn = models._sqlite_connect(models.get_db_path(username, banco))
+        try:
+            detalhes = [linha[3] for linha in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        finally:
+            conn.close()
+        ok = (
+            any(d.startswith("SEARCH") and indice in d for d in detalhes)
+            and not any(d.startswith("SCAN") or "TEMP B-TREE" in d for d in detalhes)
+        )
+        planos[nome] = {"ok": ok, "indice_esperado": indice, "plano": detalhes}
+        print(f"[bench] plano {nome:<26} {'ok   ' if ok else 'FALHA'} {' | '.join(detalhes)}")
+    return planos
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p / 100.0
+    i = int(k)
+    j = min(i + 1, len(ordenados) - 1)
+    return ordenados[i] + (ordenados[j] - ordenados[i]) * (k - i)
+
+
+def _chamar(cliente, metodo, caminho, corpo):
+    if metodo == "POST":
+        return cliente.post(caminho, json=corpo)
+    return cliente.get(caminho)
+
+
+def medir(cliente, cache, nome, metodo, caminho, corpo, repeticoes, aquecimento, limpar_cache, alocacoes):
+    def _uma():
+        if limpar_cache:
+            cache.clear()
+        inicio = time.perf_counter()
+        r = _chamar(cliente, metodo, caminho, corpo)
+        _ = r.get_data()
+        return (time.perf_counter() - inicio) * 1000.0, r.status_code, len(r.get_data())
+
+    primeira_ms, status, tamanho = _uma()
+    for _ in range(max(0, aquecimento - 1)):
+        _uma()
+    tempos = []
+    for _ in range(repeticoes):
+        ms, status, tamanho = _uma()
+        tempos.append(ms)
+    out = {
+        "endpoint": caminho,
+        "status": status,
+        "bytes": tamanho,
+        "primeira_ms": round(primeira_ms, 2),
+        "n": len(tempos),
+        "p50_ms": round(_percentil(tempos, 50), 2),
+        "p95_ms": round(_percentil(tempos, 95), 2),
+        "media_ms": round(statistics.fmean(tempos), 2),
+        "min_ms": round(min(tempos), 2),
+        "max_ms": round(max(tempos), 2),
+    }
+    if alocacoes:
+        if limpar_cache:
+            cache.clear()
+        tracemalloc.start()
+        antes = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        _chamar(cliente, metodo, caminho, corpo).get_data()
+        _, pico = tracemalloc.get_traced_memory()
+        depois = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        diff = depois.compare_to(antes, "filename")
+        out["alocacoes"] = {
+            "pico_kib": round((pico - base) / 1024.0, 1),
+            "blocos_retidos": sum(s.count_diff for s in diff if s.count_diff > 0),
+            "kib_retidos": round(sum(s.size_diff for s in diff if s.size_diff > 0) / 1024.0, 1),
+        }
+    print(f"[bench] {nome:<20} p50={out['p50_ms']:>9.2f}ms p95={out['p95_ms']:>9.2f}ms "
+          f"1a={out['primeira_ms']:>9.2f}ms status={status}")
+    return out
+
+
+def main(argv=None):
+    args = _argumentos(argv)
+    tmp = tempfile.mkdtemp(prefix="finmas-bench-")
+    if args.fixtures is None:
+        args.fixtures = os.path.join(tmp, "fixtures")
+    # registrado antes do import do app: roda depois dos atexit do models (last_seen, pools)
+    atexit.register(shutil.rmtree, tmp, True)
+    _preparar_ambiente(args, tmp)
+
+    tickers = _tickers_carteira(args.ativos)
+    precisa_gerar = not any(os.scandir(args.fixtures)) if os.path.isdir(args.fixtures) else True
+    if precisa_gerar:
+        from assets_lists import LISTA_ACOES
+
+        os.makedirs(args.fixtures, exist_ok=True)
+        universo = [t.upper() for t in LISTA_ACOES]
+        n = gerar_fixtures_sinteticas(args.fixtures, [f"{t}.SA" for t in tickers], universo, args.meses, args.seed)
+        print(f"[bench] {n} fixtures sintéticas em {args.fixtures}")
+
+    import app as app_mod
+    import gravacao_upstream
+    import models
+
+    if models._is_postgres():
+        raise SystemExit("[bench] o benchmark roda só em SQLite: remova DATABASE_URL do ambiente")
+
+    cliente = app_mod.server.test_client()
+    username = f"bench_{os.getpid()}"
+    filtro = {n.strip() for n in args.endpoints.split(",") if n.strip()}
+    resultados = {}
+    try:
+        r = cliente.post("/api/auth/registro", json={
+            "nome": "Benchmark", "username": username, "senha": SENHA,
+            "pergunta_seguranca": "bench", "resposta_seguranca": "bench",
+        })
+        if r.status_code >= 400:
+            raise SystemExit(f"registro falhou: {r.status_code} {r.get_data(as_text=True)}")
+        if cliente.post("/api/auth/login", json={"username": username, "senha": SENHA}).status_code != 200:
+            raise SystemExit("login falhou")
+        semear_usuario(models, username, tickers, args.movimentacoes, args.meses, args.seed)
+        planos = verificar_planos(models, username)
+
+        for nome, metodo, caminho, corpo in _endpoints():
+            if filtro and nome not in filtro:
+                continue
+            resultados[nome] = medir(
+                cliente, models.cache, nome, metodo, caminho, corpo,
+                args.repeticoes, args.aquecimento, not args.com_cache, not args.sem_alocacoes,
+            )
+    finally:
+        gravador = gravacao_upstream.ativo()
+        try:
+            models.excluir_conta_usuario(username)
+        except Exception as e:
+            print(f"[bench] aviso: não removeu o usuário {username}: {e}")
+        shutil.rmtree(os.path.join(models._bancos_usuarios_root(), username), ignore_errors=True)
+
+    relatorio = {
+        "gerado_em": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "parametros": {
+            "ativos": args.ativos, "movimentacoes": args.movimentacoes, "meses": args.meses,
+            "repeticoes": args.repeticoes, "aquecimento": args.aquecimento, "com_cache": args.com_cache,
+            "latencia_ms": args.latencia_ms, "jitter_ms": args.jitter_ms, "seed": args.seed,
+            "fixtures": "sinteticas" if precisa_gerar else args.fixtures,
+        },
+        "endpoints": resultados,
+        "planos": planos,
+        "reproducao": gravador.metricas() if gravador else None,
+    }
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+    print(f"[bench] resultado em {args.saida}")
+    falhas = [nome for nome, plano in planos.items() if not plano["ok"]]
+    if falhas and args.exigir_planos:
+        raise SystemExit(f"[bench] consultas sem o índice esperado: {', '.join(falhas)}")
+    return relatorio
+
+
+if __name__ == "__main__":
+    main()
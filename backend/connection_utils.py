@@ -8,7 +8,7 @@ notificação automática quando o cliente fecha a conexão TCP. Se a request
 está dentro de uma chamada bloqueante (ex: yfinance pesado), o servidor
 continua processando até o fim e só descobre que o cliente sumiu quando
 tenta escrever a resposta no socket morto. Isso desperdiça threads e
-slots de semáforo (ex: ANALISE_ATIVOS_SEM, MONTE_CARLO_SEM) — exatamente
+slots de semáforo (ex: ANALISE_ATIVOS_SEM) — exatamente
 o que aparece nos logs como [SLOW] GET ... duracao=200s+ sem ninguém
 para receber.
 
@@ -0,0 +1,123 @@
+"""Tabelas de fator acumulado dos indexadores (CDI, SELIC, IPCA) para reprecificar renda fixa."""
+from __future__ import annotations
+
+import threading
+import time
+from datetime import date, datetime
+from typing import Callable, Optional
+
+import numpy as np
+
+SERIES_INDEXADORES = {"CDI": 12, "SELIC": 11, "IPCA": 433}
+
+
+def _dia(valor) -> np.datetime64:
+    if isinstance(valor, datetime):
+        valor = valor.date()
+    return np.datetime64(valor, "D")
+
+
+class TabelaFatores:
+    def __init__(self, datas: np.ndarray, taxas_pct: np.ndarray, pct: float = 100.0):
+        self.datas = datas
+        self.taxas_pct = taxas_pct
+        self.pct = float(pct)
+        self.acumulado = np.concatenate(([1.0], np.cumprod(1.0 + (self.pct / 100.0) * taxas_pct / 100.0)))
+
+    @classmethod
+    def de_pontos(cls, pontos, pct: float = 100.0) -> "TabelaFatores":
+        """`pontos` no formato de `obter_serie_bcb`: [{'data': 'dd/mm/aaaa', 'valor': float}, ...]."""
+        datas = np.array(
+            [np.datetime64(datetime.strptime(p["data"], "%d/%m/%Y").date(), "D") for p in pontos],
+            dtype="datetime64[D]",
+        )
+        taxas = np.array([float(p["valor"]) for p in pontos], dtype=np.float64)
+        ordem = np.argsort(datas, kind="stable")
+        return cls(datas[ordem], taxas[ordem], pct)
+
+    def com_pct(self, pct: float) -> "TabelaFatores":
+        return TabelaFatores(self.datas, self.taxas_pct, pct)
+
+    def cobre(self, inicio, folga_dias: int = 7) -> bool:
+        """A série começa até `folga_dias` depois de `inicio` (feriados/fins de semana no começo)."""
+        return len(self.datas) > 0 and self.datas[0] <= _dia(inicio) + np.timedelta64(folga_dias, "D")
+
+    def fator(self, inicio, fim, spread_periodo_pct: float = 0.0):
+        """(fator, períodos) dos períodos com data em [inicio, fim)."""
+        i, j = np.searchsorted(self.datas, [_dia(inicio), _dia(fim)], side="left")
+        n = int(max(j - i, 0))
+        if n == 0:
+            return 1.0, 0
+        fator = float(self.acumulado[j] / self.acumulado[i])
+        if spread_periodo_pct:
+            fator *= (1.0 + spread_periodo_pct / 100.0) ** n
+        return fator, n
+
+
+class FatoresIndexadores:
+    def __init__(self, obter_serie: Callable, inicio_anos: int = 11, ttl_s: float = 900.0, series: Optional[dict] = None):
+        """`obter_serie(serie_id, inicio, fim)` devolve a lista de pontos (ex.: `obter_serie_bcb`)."""
+        self._obter_serie = obter_serie
+        self.inicio_anos = int(inicio_anos)
+        self.ttl_s = float(ttl_s)
+        self.series = dict(series or SERIES_INDEXADORES)
+        self._lock = threading.Lock()
+        self._tabelas = {}  # indexador -> {"lida_em", "assinatura", "por_pct": {pct: TabelaFatores}}
+        self._m = {"consultas": 0, "reconstrucoes": 0, "sem_cobertura": 0}
+
+    def _base(self, indexador):
+        agora = time.time()
+        entrada = self._tabelas.get(indexador)
+        if entrada is not None and agora - entrada["lida_em"] < self.ttl_s:
+            return entrada
+        hoje = date.today()
+        pontos = self._obter_serie(self.series[indexador], date(hoje.year - self.inicio_anos, 1, 1), hoje) or []
+        assinatura = (len(pontos), pontos[-1]["data"] if pontos else None)
+        with self._lock:
+            entrada = self._tabelas.get(indexador)
+            if entrada is not None and entrada["assinatura"] == assinatura:
+                entrada["lida_em"] = agora
+                return entrada
+            entrada = {
+                "lida_em": agora,
+                "assinatura": assinatura,
+                "por_pct": {100.0: TabelaFatores.de_pontos(pontos)},
+            }
+            self._tabelas[indexador] = entrada
+            self._m["reconstrucoes"] += 1
+        return entrada
+
+    def tabela(self, indexador: str, pct: float = 100.0) -> TabelaFatores:
+        entrada = self._base(indexador)
+        pct = round(float(pct), 6)
+        tab = entrada["por_pct"].get(pct)
+        if tab is None:
+            tab = entrada["por_pct"][100.0].com_pct(pct)
+            with self._lock:
+                entrada["por_pct"][pct] = tab
+        return tab
+
+    def fator(self, indexador: str, inicio, fim, pct: float = 100.0, spread_periodo_pct: float = 0.0):
+        """
+        (fator, períodos) do indexador entre `inicio` e `fim` (períodos com data
+        em [inicio, fim)), a `pct`% do índice e com spread composto por período.
+        None se a série local não alcança `inicio` (sem dados ainda).
+        """
+        with self._lock:
+            self._m["consultas"] += 1
+        tab = self.tabela(indexador, pct)
+        if not tab.cobre(inicio):
+            with self._lock:
+                self._m["sem_cobertura"] += 1
+            return None
+        return tab.fator(inicio, fim, spread_periodo_pct)
+
+    def metricas(self) -> dict:
+        with self._lock:
+            out = dict(self._m)
+            out["tabelas"] = {k: sorted(v["por_pct"]) for k, v in self._tabelas.items()}
+        return out
+
+    def depois_do_fork_filho(self):
+        self._lock = threading.Lock()
+        self._m = {k: 0 for k in self._m}
@@ -4,6 +4,11 @@ import re
 import time
 from typing import Optional, Dict
 
+try:
+    from .limitador_upstream import chamar, upstream_da_url
+except ImportError:
+    from limitador_upstream import chamar, upstream_da_url
+
 def extrair_portfolio_fundsexplorer(html: str, ticker: str) -> Optional[Dict]:
 
     try:
@@ -115,7 +120,7 @@ def obter_dados_fii_fundsexplorer(ticker: str, include_portfolio: bool = False)
     
     try:
         print(f"[FundsExplorer] Buscando {ticker_limpo}...")
-        response = requests.get(url, headers=headers, timeout=15)
+        response = chamar(upstream_da_url(url), lambda: requests.get(url, headers=headers, timeout=15))
         
         if response.status_code != 200:
             print(f"[ERRO] Status {response.status_code}")
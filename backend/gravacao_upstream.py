@@ -0,0 +1,497 @@
+"""
+Gravação e reprodução das chamadas aos upstreams (yfinance, Binance, BCB, scrapers).
+Ativado pelo models.py via FINMAS_UPSTREAM_MODO=gravar|reproduzir e FINMAS_FIXTURES_DIR.
+"""
+from __future__ import annotations
+
+import base64
+import glob
+import hashlib
+import io
+import json
+import os
+import pickle
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+MODOS = ("gravar", "reproduzir")
+FONTES_HOST = {
+    "api.binance.com": "binance",
+    "api.bcb.gov.br": "bcb",
+}
+# Parâmetros (query HTTP ou kwargs do yfinance, sem diferenciar maiúsculas)
+# que só definem a janela de datas: ficam fora da chave flexível
+PARAMS_DATA = frozenset({
+    "start", "end", "period", "period1", "period2", "range",
+    "starttime", "endtime", "datainicial", "datafinal", "from", "to", "_",
+})
+
+
+def _eh_param_data(nome):
+    return str(nome).lower() in PARAMS_DATA
+
+
+class FixtureAusente(ConnectionError):
+    """Reprodução sem gravação para a requisição."""
+
+
+def _fonte_da_url(url):
+    host = (urlsplit(url).hostname or "desconhecido").lower()
+    return FONTES_HOST.get(host, host)
+
+
+def _url_normalizada(url, params=None):
+    """(URL com a query ordenada, mesma URL sem os parâmetros de data)."""
+    partes = urlsplit(url)
+    query = parse_qsl(partes.query, keep_blank_values=True)
+    if params:
+        itens = params.items() if hasattr(params, "items") else params
+        query += [(str(k), str(v)) for k, v in itens if v is not None]
+    base = f"{partes.scheme}://{partes.netloc}{partes.path}"
+    sem_datas = [(k, v) for k, v in query if not _eh_param_data(k)]
+    completa = (base + "?" + urlencode(sorted(query))) if query else base
+    return completa, (base + "?" + urlencode(sorted(sem_datas))) if sem_datas else base
+
+
+def _hash(texto):
+    return hashlib.sha1(texto.encode("utf-8")).hexdigest()
+
+
+class _FastInfoGravado(dict):
+    """`Ticker.fast_info` reproduzido: acesso por chave ('lastPrice') ou atributo (last_price)."""
+
+    def __getattr__(self, nome):
+        if nome in self:
+            return self[nome]
+        camel = "".join(p if i == 0 else p.capitalize() for i, p in enumerate(nome.split("_")))
+        if camel in self:
+            return self[camel]
+        raise AttributeError(nome)
+
+
+class _RespostaUrllib:
+    """Resposta de `urlopen` servida da gravação (ou já lida na gravação)."""
+
+    def __init__(self, corpo, status, headers, url):
+        self._corpo = io.BytesIO(corpo)
+        self.status = self.code = status
+        self.headers = headers
+        self.url = url
+
+    def read(self, n=-1):
+        return self._corpo.read(n)
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class GravadorUpstream:
+    def __init__(self, modo: str, pasta: str, latencia_ms: float = 0.0, jitter_ms: float = 0.0, estrito: bool = False):
+        if modo not in MODOS:
+            raise ValueError(f"modo inválido: {modo} (use {', '.join(MODOS)})")
+        self.modo = modo
+        self.pasta = os.path.abspath(pasta)
+        self.latencia_ms = float(latencia_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.estrito = bool(estrito)
+        self._lock = threading.Lock()
+        self._exatas = {}  # chave -> caminho do .json
+        self._flexiveis = {}  # chave flexível -> (gravado_em, caminho)
+        self._metodos = {}  # chave flexível (yfinance) -> atributo gravado como método?
+        self._metadados = {}  # caminho -> dict
+        self._m = {}
+        os.makedirs(self.pasta, exist_ok=True)
+        self._indexar()
+
+    # ------------------------------------------------------------------ arquivos
+
+    def _indexar(self):
+        for caminho in glob.glob(os.path.join(self.pasta, "*", "*.json")):
+            try:
+                with open(caminho, encoding="utf-8") as f:
+                    meta = json.load(f)
+            except Exception as e:
+                print(f"[REPLAY] aviso: fixture ilegível {caminho}: {e}")
+                continue
+            self._registrar(caminho, meta)
+
+    def _registrar(self, caminho, meta):
+        if meta.get("tipo") == "http":
+            # recalculada da chave: vale também para gravações de versões anteriores
+            metodo, _, resto = meta["chave"].partition(" ")
+            meta["chave_flexivel"] = f"{metodo} {_url_normalizada(resto.split(' #', 1)[0])[1]}"
+        with self._lock:
+            self._metadados[caminho] = meta
+            self._exatas[meta["chave"]] = caminho
+            if "metodo" in meta:
+                base = self._base_yf(meta["simbolo"], meta["atributo"]) if "atributo" in meta else meta["chave_flexivel"]
+                self._metodos[base] = bool(meta["metodo"])
+            atual = self._flexiveis.get(meta["chave_flexivel"])
+            if atual is None or meta.get("gravado_em", 0) >= atual[0]:
+                self._flexiveis[meta["chave_flexivel"]] = (meta.get("gravado_em", 0), caminho)
+
+    def _salvar(self, fonte, chave, chave_flexivel, meta, valor=None):
+        nome = _hash(chave)[:20]
+        pasta = os.path.join(self.pasta, fonte.replace(os.sep, "_"))
+        os.makedirs(pasta, exist_ok=True)
+        caminho = os.path.join(pasta, nome + ".json")
+        meta = dict(meta, chave=chave, chave_flexivel=chave_flexivel, fonte=fonte, gravado_em=time.time())
+        if valor is not None:
+            # serializa antes de abrir o arquivo: falha no pickle não deixa .pkl pela metade
+            dados = pickle.dumps(valor)
+            with open(os.path.join(pasta, nome + ".pkl"), "wb") as f:
+                f.write(dados)
+        with open(caminho + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=1)
+        os.replace(caminho + ".tmp", caminho)
+        self._registrar(caminho, meta)
+        self._conta(fonte, "gravadas")
+
+    def _achar(self, chave, chave_flexivel):
+        with self._lock:
+            caminho = self._exatas.get(chave)
+            if caminho is None and not self.estrito:
+                achada = self._flexiveis.get(chave_flexivel)
+                caminho = achada[1] if achada else None
+            return (caminho, self._metadados[caminho]) if caminho else (None, None)
+
+    def _valor(self, caminho):
+        with open(caminho[: -len(".json")] + ".pkl", "rb") as f:
+            return pickle.load(f)
+
+    def _reproduzir(self, fonte, chave, chave_flexivel):
+        caminho, meta = self._achar(chave, chave_flexivel)
+        if caminho is None:
+            self._conta(fonte, "ausentes")
+            raise FixtureAusente(f"sem gravação para {chave}")
+        self._conta(fonte, "servidas" if self._exatas.get(chave) == caminho else "servidas_flexivel")
+        self._esperar(chave)
+        return caminho, meta
+
+    def _esperar(self, chave):
+        espera_ms = self.latencia_ms
+        if self.jitter_ms:
+            espera_ms += (int(_hash(chave)[:8], 16) % 1000) / 1000.0 * self.jitter_ms
+        if espera_ms > 0:
+            time.sleep(espera_ms / 1000.0)
+
+    def _conta(self, fonte, campo):
+        with self._lock:
+            m = self._m.setdefault(fonte, {"gravadas": 0, "servidas": 0, "servidas_flexivel": 0, "ausentes": 0})
+            m[campo] += 1
+
+    def metricas(self) -> dict:
+        with self._lock:
+            out = {fonte: dict(m) for fonte, m in self._m.items()}
+            out["_fixtures"] = len(self._exatas)
+        return out
+
+    # ------------------------------------------------------------------ HTTP
+
+    def _chaves_http(self, metodo, url, params=None, corpo=None):
+        completa, base = _url_normalizada(url, params)
+        chave = f"{metodo.upper()} {completa}"
+        if corpo:
+            chave += " #" + _hash(corpo if isinstance(corpo, str) else repr(corpo))[:12]
+        return chave, f"{metodo.upper()} {base}"
+
+    def salvar_http(self, metodo, url, status=200, conteudo=b"", headers=None, params=None, corpo=None):
+        """Grava uma resposta HTTP (fixture sintética ou vinda de `gravar`)."""
+        if isinstance(conteudo, str):
+            conteudo = conteudo.encode("utf-8")
+        elif not isinstance(conteudo, (bytes, bytearray)):
+            conteudo = json.dumps(conteudo).encode("utf-8")
+            headers = dict(headers or {}, **{"Content-Type": "application/json"})
+        chave, flexivel = self._chaves_http(metodo, url, params, corpo)
+        self._salvar(
+            _fonte_da_url(url),
+            chave,
+            flexivel,
+            {
+                "tipo": "http",
+                "url": url,
+                "status": int(status),
+                "headers": dict(headers or {}),
+                "conteudo_b64": base64.b64encode(bytes(conteudo)).decode("ascii"),
+            },
+        )
+
+    def _resposta_http(self, metodo, url, params=None, corpo=None):
+        chave, flexivel = self._chaves_http(metodo, url, params, corpo)
+        _, meta = self._reproduzir(_fonte_da_url(url), chave, flexivel)
+        return meta["status"], meta["headers"], base64.b64decode(meta["conteudo_b64"])
+
+    def requests_request(self, original, sessao, method, url, *args, **kwargs):
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        params, corpo = kwargs.get("params"), kwargs.get("data") or kwargs.get("json")
+        if self.modo == "gravar":
+            resposta = original(sessao, method, url, *args, **kwargs)
+            try:
+                self.salvar_http(method, url, resposta.status_code, resposta.content, dict(resposta.headers), params, corpo)
+            except Exception as e:
+                print(f"[REPLAY] aviso: não gravou {url}: {e}")
+            return resposta
+        status, headers, conteudo = self._resposta_http(method, url, params, corpo)
+        resposta = requests.Response()
+        resposta.status_code = status
+        resposta._content = conteudo
+        resposta.headers = CaseInsensitiveDict(headers)
+        resposta.url = _url_normalizada(url, params)[0]
+        resposta.encoding = requests.utils.get_encoding_from_headers(resposta.headers)
+        resposta.reason = "OK" if status < 400 else "Erro"
+        resposta.request = requests.Request(method, resposta.url).prepare()
+        return resposta
+
+    def urlopen(self, original, url, *args, **kwargs):
+        if isinstance(url, urllib.request.Request):
+            metodo, endereco, corpo = url.get_method(), url.full_url, url.data
+        else:
+            metodo, endereco = ("POST" if (args and args[0]) or kwargs.get("data") else "GET"), str(url)
+            corpo = args[0] if args else kwargs.get("data")
+        if self.modo == "gravar":
+            try:
+                with original(url, *args, **kwargs) as resp:
+                    conteudo, status, headers = resp.read(), resp.status, dict(resp.headers)
+            except urllib.error.HTTPError as e:
+                conteudo, status, headers = e.read(), e.code, dict(e.headers or {})
+            try:
+                self.salvar_http(metodo, endereco, status, conteudo, headers, corpo=corpo)
+            except Exception as e:
+                print(f"[REPLAY] aviso: não gravou {endereco}: {e}")
+        else:
+            status, headers, conteudo = self._resposta_http(metodo, endereco, corpo=corpo)
+        if status >= 400:
+            raise urllib.error.HTTPError(endereco, status, "Erro", headers, io.BytesIO(conteudo))
+        return _RespostaUrllib(conteudo, status, headers, endereco)
+
+    # ------------------------------------------------------------------ yfinance
+
+    @staticmethod
+    def _base_yf(simbolo, atributo):
+        return f"yf {str(simbolo).upper()} {atributo}"
+
+    @classmethod
+    def _chaves_yf(cls, simbolo, atributo, args=(), kwargs=None):
+        base = cls._base_yf(simbolo, atributo)
+        kwargs = kwargs or {}
+        flexiveis = {k: v for k, v in kwargs.items() if not _eh_param_data(k)}
+        if atributo == "history" or str(simbolo) == "download":
+            # history(period, ...) e download(tickers, start, end, ...): os
+            # posicionais são datas; intervalo padrão do yfinance é 1d
+            args_flexiveis = ()
+            flexiveis.setdefault("interval", "1d")
+        else:
+            args_flexiveis = args
+        return (
+            f"{base} {args!r} {sorted(kwargs.items())!r}",
+            f"{base} {args_flexiveis!r} {sorted(flexiveis.items())!r}",
+        )
+
+    def salvar_yf(self, simbolo, atributo, valor, args=(), kwargs=None, metodo=None):
+        """
+        Grava o resultado de `yf.Ticker(simbolo).<atributo>` (ou de
+        `.<atributo>(*args, **kwargs)` quando `metodo`; por padrão, quando há
+        argumentos ou o atributo é `history`). `simbolo="download"` grava `yf.download`.
+        """
+        if metodo is None:
+            metodo = bool(args or kwargs) or atributo in ("history", "download")
+        tipo = "valor"
+        if atributo == "fast_info" and not metodo:
+            tipo, valor = "fast_info", {k: valor[k] for k in valor.keys()} if hasattr(valor, "keys") else dict(valor)
+        chave, flexivel = self._chaves_yf(simbolo, atributo, args, kwargs)
+        meta = {"tipo": tipo, "metodo": metodo, "simbolo": str(simbolo), "atributo": atributo, "nulo": valor is None}
+        self._salvar("yahoo", chave, flexivel, meta, valor)
+
+    def _valor_yf(self, simbolo, atributo, args=(), kwargs=None):
+        chave, flexivel = self._chaves_yf(simbolo, atributo, args, kwargs)
+        caminho, meta = self._reproduzir("yahoo", chave, flexivel)
+        if meta.get("nulo"):
+            return None
+        valor = self._valor(caminho)
+        if meta.get("tipo") == "fast_info":
+            valor = _FastInfoGravado(valor)
+        return valor
+
+    def atributo_eh_metodo(self, simbolo, atributo):
+        with self._lock:
+            return self._metodos.get(self._base_yf(simbolo, atributo), False)
+
+    def download(self, original, tickers, *args, **kwargs):
+        simbolos = " ".join(sorted(str(tickers).replace(",", " ").split())) if isinstance(tickers, str) else " ".join(sorted(map(str, tickers)))
+        kw = {k: v for k, v in kwargs.items() if k not in ("progress", "threads", "session")}
+        if self.modo == "gravar":
+            valor = original(tickers, *args, **kwargs)
+            try:
+                self.salvar_yf("download", simbolos, valor, args, kw, metodo=True)
+            except Exception as e:
+                print(f"[REPLAY] aviso: não gravou yf.download({simbolos}): {e}")
+            return valor
+        chave, flexivel = self._chaves_yf("download", simbolos, args, kw)
+        if not self.estrito and self._achar(chave, flexivel)[0] is None:
+            montado = self._download_montado(simbolos.split(), kw)
+            if montado is not None:
+                return montado
+        return self._valor_yf("download", simbolos, args, kw)
+
+    def _download_montado(self, simbolos, kwargs):
+        """Frame de `yf.download(group_by='column')` juntando o `history` gravado de cada símbolo."""
+        import pandas as pd
+
+        partes = {}
+        intervalo = {"interval": kwargs.get("interval") or "1d"}
+        for simbolo in simbolos:
+            caminho, meta = self._achar(None, self._chaves_yf(simbolo, "history", kwargs=intervalo)[1])
+            if caminho is None or meta.get("nulo"):
+                continue
+            df = self._valor(caminho)
+            if df is None or getattr(df, "empty", True):
+                continue
+            periodo = str(kwargs.get("period") or "")
+            if periodo.endswith("d") and periodo[:-1].isdigit():
+                df = df.tail(int(periodo[:-1]))
+            partes[simbolo] = df[[c for c in ("Open", "High", "Low", "Close", "Volume") if c in df.columns]]
+        if not partes:
+            return None
+        self._conta("yahoo", "servidas_flexivel")
+        self._esperar("yf download " + " ".join(simbolos))
+        return pd.concat(partes, axis=1).swaplevel(0, 1, axis=1).sort_index(axis=1)
+
+
+def _salvar_sem_falhar(g, simbolo, atributo, valor, args=(), kwargs=None, metodo=None):
+    """`salvar_yf` do modo gravar: erro ao gravar não pode derrubar a chamada real."""
+    try:
+        g.salvar_yf(simbolo, atributo, valor, args, kwargs, metodo=metodo)
+    except Exception as e:
+        print(f"[REPLAY] aviso: não gravou yf.Ticker({simbolo}).{atributo}: {e}")
+
+
+class _TickerGravado:
+    """Substituto de `yf.Ticker`: grava/reproduz cada atributo e método usado."""
+
+    def __init__(self, ticker, *args, **kwargs):
+        self.ticker = str(ticker).upper()
+        self._args = (args, kwargs)
+        self._real = None
+
+    def _obj(self):
+        if self._real is None:
+            self._real = _ORIGINAIS["yf.Ticker"](self.ticker, *self._args[0], **self._args[1])
+        return self._real
+
+    def __getattr__(self, nome):
+        if nome.startswith("_"):
+            raise AttributeError(nome)
+        g = _ATIVO
+        if g.modo == "gravar":
+            valor = getattr(self._obj(), nome)
+            if not callable(valor):
+                _salvar_sem_falhar(g, self.ticker, nome, valor, metodo=False)
+                return valor
+
+            def _gravando(*args, **kwargs):
+                resultado = valor(*args, **kwargs)
+                _salvar_sem_falhar(g, self.ticker, nome, resultado, args, kwargs, metodo=True)
+                return resultado
+
+            return _gravando
+        if g.atributo_eh_metodo(self.ticker, nome):
+            return lambda *args, **kwargs: g._valor_yf(self.ticker, nome, args, kwargs)
+        return g._valor_yf(self.ticker, nome)
+
+
+# ---------------------------------------------------------------------- ativação
+
+_ATIVO: Optional[GravadorUpstream] = None
+_ORIGINAIS = {}
+_LOCK = threading.Lock()
+
+
+def _instalar():
+    import requests
+    import yfinance as yf
+
+    if _ORIGINAIS:
+        return
+    _ORIGINAIS["requests"] = requests.Session.request
+    _ORIGINAIS["urlopen"] = urllib.request.urlopen
+    _ORIGINAIS["yf.Ticker"] = yf.Ticker
+    _ORIGINAIS["yf.download"] = yf.download
+
+    def _session_request(sessao, method, url, *args, **kwargs):
+        return _ATIVO.requests_request(_ORIGINAIS["requests"], sessao, method, url, *args, **kwargs)
+
+    def _urlopen(url, *args, **kwargs):
+        return _ATIVO.urlopen(_ORIGINAIS["urlopen"], url, *args, **kwargs)
+
+    def _download(tickers, *args, **kwargs):
+        return _ATIVO.download(_ORIGINAIS["yf.download"], tickers, *args, **kwargs)
+
+    requests.Session.request = _session_request
+    urllib.request.urlopen = _urlopen
+    yf.Ticker = _TickerGravado
+    yf.download = _download
+
+
+def ativar(modo: str, pasta: str, latencia_ms: float = 0.0, jitter_ms: float = 0.0, estrito: bool = False) -> GravadorUpstream:
+    """Liga a gravação ou a reprodução para o processo inteiro e devolve o gravador."""
+    global _ATIVO
+    with _LOCK:
+        _ATIVO = GravadorUpstream(modo, pasta, latencia_ms, jitter_ms, estrito)
+        _instalar()
+    print(f"[REPLAY] upstreams em modo '{modo}' ({pasta}, {len(_ATIVO._exatas)} fixtures)")
+    return _ATIVO
+
+
+def desativar():
+    """Restaura requests, urllib e yfinance originais."""
+    global _ATIVO
+    import requests
+    import yfinance as yf
+
+    with _LOCK:
+        if _ORIGINAIS:
+            requests.Session.request = _ORIGINAIS.pop("requests")
+            urllib.request.urlopen = _ORIGINAIS.pop("urlopen")
+            yf.Ticker = _ORIGINAIS.pop("yf.Ticker")
+            yf.download = _ORIGINAIS.pop("yf.download")
+        _ATIVO = None
+
+
+def ativo() -> Optional[GravadorUpstream]:
+    return _ATIVO
+
+
+def ativar_do_ambiente() -> Optional[GravadorUpstream]:
+    """Ativa conforme FINMAS_UPSTREAM_MODO (vazio = rede normal)."""
+    modo = (os.getenv("FINMAS_UPSTREAM_MODO") or "").strip().lower()
+    if not modo or _ATIVO is not None:
+        return _ATIVO
+    pasta = os.getenv("FINMAS_FIXTURES_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures_upstream")
+    return ativar(
+        modo,
+        pasta,
+        latencia_ms=float(os.getenv("FINMAS_REPLAY_LATENCIA_MS", "0")),
+        jitter_ms=float(os.getenv("FINMAS_REPLAY_JITTER_MS", "0")),
+        estrito=os.getenv("FINMAS_REPLAY_ESTRITO", "").strip().lower() in ("1", "true", "sim"),
+    )
@@ -0,0 +1,8 @@
+"""Hooks do gunicorn: com --preload, as tarefas periódicas de cada worker começam em post_fork."""
+
+
+def post_fork(server, worker):
+    # refresh agendado dos preços das carteiras: a lease no SQLite garante
+    # uma rodada por vez entre os workers
+    from models import _garantir_refresher_carteiras
+    _garantir_refresher_carteiras()
@@ -0,0 +1,315 @@
+"""Fila de jobs em segundo plano (screener, Monte Carlo, proventos, histórico), com estado num SQLite compartilhado pelos workers."""
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+STATUS_FINAIS = ("concluido", "erro", "cancelado")
+INTERVALO_CANCELAMENTO_S = 1.0
+
+
+class _TipoJob:
+    __slots__ = ("nome", "concorrencia", "ttl_s", "prazo_s", "executor")
+
+    def __init__(self, nome, concorrencia, ttl_s, prazo_s):
+        self.nome = nome
+        self.concorrencia = int(concorrencia)
+        self.ttl_s = float(ttl_s)
+        self.prazo_s = float(prazo_s)
+        self.executor = None
+
+
+class FilaJobs:
+    def __init__(self, db_path: str, conectar: Callable):
+        self.db_path = db_path
+        self._conectar = conectar
+        self._lock = threading.Lock()
+        self._tipos = {}
+        self._eventos = {}  # job_id -> threading.Event (fim do job, jobs deste processo)
+        self._cancelados = {}  # job_id -> threading.Event
+        self._pid = os.getpid()
+        self._tabelas_ok = False
+        self._ultima_limpeza = 0.0
+        self._m = {}
+
+    # ------------------------------------------------------------------ SQLite
+
+    def _conn(self):
+        conn = self._conectar(self.db_path)
+        if not self._tabelas_ok:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    tipo TEXT NOT NULL,
+                    chave TEXT NOT NULL,
+                    usuario TEXT,
+                    status TEXT NOT NULL,
+                    criado_em REAL NOT NULL,
+                    iniciado_em REAL,
+                    concluido_em REAL,
+                    prazo_em REAL NOT NULL,
+                    expira_em REAL,
+                    pid INTEGER,
+                    resultado TEXT,
+                    erro TEXT,
+                    cancelar_solicitado INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            try:
+                cur.execute("ALTER TABLE jobs ADD COLUMN cancelar_solicitado INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e).lower():
+                    raise
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_tipo_chave ON jobs(tipo, chave)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_expira ON jobs(expira_em)")
+            conn.commit()
+            self._tabelas_ok = True
+        return conn
+
+    def _atualizar(self, job_id, **campos):
+        sets = ", ".join(f"{k} = ?" for k in campos)
+        conn = self._conn()
+        try:
+            conn.execute(f"UPDATE jobs SET {sets} WHERE id = ?", (*campos.values(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _limpar_expirados(self):
+        agora = time.time()
+        if agora - self._ultima_limpeza < 60.0:
+            return
+        self._ultima_limpeza = agora
+        conn = self._conn()
+        try:
+            conn.execute("DELETE FROM jobs WHERE expira_em IS NOT NULL AND expira_em < ?", (agora,))
+            conn.execute(
+                "UPDATE jobs SET status = 'erro', erro = 'Prazo excedido', concluido_em = ?, expira_em = ? "
+                "WHERE status IN ('fila', 'executando') AND prazo_em < ?",
+                (agora, agora + 300.0, agora),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------ tipos
+
+    def registrar_tipo(self, tipo: str, concorrencia: int = 1, ttl_s: float = 600.0, prazo_s: float = 900.0):
+        with self._lock:
+            self._tipos[tipo] = _TipoJob(tipo, concorrencia, ttl_s, prazo_s)
+
+    def _executor(self, tipo: _TipoJob):
+        self._checar_pid()
+        with self._lock:
+            if tipo.executor is None:
+                tipo.executor = ThreadPoolExecutor(max_workers=tipo.concorrencia, thread_name_prefix=f"job-{tipo.nome}")
+            return tipo.executor
+
+    def _conta(self, tipo, campo, n=1):
+        m = self._m.setdefault(tipo, {"submetidos": 0, "deduplicados": 0, "concluidos": 0, "erros": 0, "cancelados": 0})
+        m[campo] += n
+
+    # ------------------------------------------------------------------ API
+
+    def submeter(self, tipo: str, chave: str, funcao: Callable, usuario: Optional[str] = None) -> dict:
+        """
+        Enfileira `funcao(cancelado)` e devolve o job (dict). Se já existe um
+        job igual (tipo, chave, usuario) em andamento ou com resultado válido,
+        devolve esse.
+        """
+        t = self._tipos[tipo]
+        self._limpar_expirados()
+        agora = time.time()
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                """
+                SELECT id FROM jobs
+                WHERE tipo = ? AND chave = ? AND usuario IS ?
+                  AND ((status IN ('fila', 'executando') AND prazo_em >= ? AND cancelar_solicitado = 0)
+                       OR (status = 'concluido' AND expira_em >= ?))
+                ORDER BY criado_em DESC LIMIT 1
+                """,
+                (tipo, chave, usuario, agora, agora),
+            ).fetchone()
+            if row:
+                conn.commit()
+                with self._lock:
+                    self._conta(tipo, "deduplicados")
+                job_id = row[0]
+            else:
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO jobs (id, tipo, chave, usuario, status, criado_em, prazo_em, pid) VALUES (?, ?, ?, ?, 'fila', ?, ?, ?)",
+                    (job_id, tipo, chave, usuario, agora, agora + t.prazo_s, os.getpid()),
+                )
+                conn.commit()
+        finally:
+            conn.close()
+
+        if not row:
+            with self._lock:
+                self._eventos[job_id] = threading.Event()
+                self._cancelados[job_id] = threading.Event()
+                self._conta(tipo, "submetidos")
+            self._executor(t).submit(self._executar, t, job_id, funcao)
+        return self.obter(job_id)
+
+    def _cancelamento_solicitado(self, job_id: str) -> bool:
+        conn = self._conn()
+        try:
+            row = conn.execute("SELECT cancelar_solicitado FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return bool(row and row[0])
+
+    def _verificador_cancelamento(self, job_id: str, cancelado_ev: threading.Event) -> Callable[[], bool]:
+        """`cancelado()` do job: evento local ou a coluna no SQLite (pedido vindo de outro worker)."""
+        proxima = [0.0]
+
+        def cancelado():
+            if cancelado_ev.is_set():
+                return True
+            agora = time.monotonic()
+            if agora >= proxima[0]:
+                proxima[0] = agora + INTERVALO_CANCELAMENTO_S
+                try:
+                    if self._cancelamento_solicitado(job_id):
+                        cancelado_ev.set()
+                except Exception as e:
+                    print(f"[JOBS] aviso: não foi possível consultar o cancelamento de {job_id}: {e}")
+            return cancelado_ev.is_set()
+
+        return cancelado
+
+    def _executar(self, t: _TipoJob, job_id: str, funcao: Callable):
+        cancelado_ev = self._cancelados.get(job_id) or threading.Event()
+        cancelado = self._verificador_cancelamento(job_id, cancelado_ev)
+        campos = {}
+        try:
+            if cancelado():
+                campos = {"status": "cancelado"}
+                return
+            self._atualizar(job_id, status="executando", iniciado_em=time.time())
+            resultado = funcao(cancelado)
+            if cancelado():
+                campos = {"status": "cancelado"}
+            else:
+                campos = {"status": "concluido", "resultado": json.dumps(resultado, default=str)}
+        except Exception as e:
+            campos = {"status": "erro", "erro": str(e)}
+            print(f"[JOBS] {t.nome} {job_id} falhou: {e}")
+        finally:
+            agora = time.time()
+            campos.setdefault("status", "erro")
+            ttl = t.ttl_s if campos["status"] == "concluido" else min(t.ttl_s, 300.0)
+            try:
+                self._atualizar(job_id, concluido_em=agora, expira_em=agora + ttl, **campos)
+            except Exception as e:
+                print(f"[JOBS] aviso: não foi possível gravar o job {job_id}: {e}")
+            with self._lock:
+                self._conta(t.nome, {"concluido": "concluidos", "erro": "erros", "cancelado": "cancelados"}[campos["status"]])
+                self._cancelados.pop(job_id, None)
+                ev = self._eventos.pop(job_id, None)
+            if ev is not None:
+                ev.set()
+
+    def obter(self, job_id: str, incluir_resultado: bool = True) -> Optional[dict]:
+        conn = self._conn()
+        try:
+            row = conn.execute(
+                "SELECT id, tipo, usuario, status, criado_em, iniciado_em, concluido_em, expira_em, resultado, erro "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        job = {
+            "job_id": row[0],
+            "tipo": row[1],
+            "usuario": row[2],
+            "status": row[3],
+            "criado_em": row[4],
+            "iniciado_em": row[5],
+            "concluido_em": row[6],
+            "expira_em": row[7],
+        }
+        if row[3] == "erro":
+            job["erro"] = row[9]
+        if incluir_resultado and row[3] == "concluido" and row[8] is not None:
+            job["resultado"] = json.loads(row[8])
+        return job
+
+    def esperar(self, job_id: str, timeout: float = 0.0, incluir_resultado: bool = True) -> Optional[dict]:
+        """Como `obter`, mas espera até `timeout` segundos o job terminar."""
+        limite = time.time() + max(0.0, float(timeout))
+        ev = self._eventos.get(job_id)
+        while True:
+            job = self.obter(job_id, incluir_resultado=False)
+            restante = limite - time.time()
+            if job is None or job["status"] in STATUS_FINAIS or restante <= 0:
+                break
+            if ev is not None:
+                ev.wait(restante)
+            else:
+                time.sleep(min(0.5, restante))
+        return self.obter(job_id, incluir_resultado) if job is not None else None
+
+    def cancelar(self, job_id: str) -> bool:
+        """
+        Sinaliza o cancelamento de um job em andamento, em qualquer worker.
+        Job ainda na fila já fica como cancelado; job executando para quando
+        `cancelado()` enxergar o pedido.
+        """
+        ev = self._cancelados.get(job_id)
+        if ev is not None:
+            ev.set()
+        conn = self._conn()
+        try:
+            agora = time.time()
+            cur = conn.execute(
+                "UPDATE jobs SET cancelar_solicitado = 1 WHERE id = ? AND status IN ('fila', 'executando')",
+                (job_id,),
+            )
+            solicitado = cur.rowcount > 0
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelado', concluido_em = ?, expira_em = ? WHERE id = ? AND status = 'fila'",
+                (agora, agora + 300.0, job_id),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        return ev is not None or solicitado
+
+    def metricas(self) -> dict:
+        with self._lock:
+            out = {tipo: dict(m) for tipo, m in self._m.items()}
+            out["_processo"] = {"em_andamento": len(self._eventos)}
+        return out
+
+    # ------------------------------------------------------------------ fork
+
+    def _checar_pid(self):
+        if os.getpid() != self._pid:
+            self.depois_do_fork_filho()
+
+    def depois_do_fork_filho(self):
+        self._lock = threading.Lock()
+        self._eventos = {}
+        self._cancelados = {}
+        self._m = {}
+        self._pid = os.getpid()
+        for t in self._tipos.values():
+            t.executor = None
@@ -0,0 +1,352 @@
+"""Limitador de taxa (token bucket) e circuit breaker por upstream, compartilhado pelos workers via SQLite."""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+LIMITES_PADRAO = {
+    # upstream: (fichas por segundo, rajada)
+    "yahoo": (4.0, 8.0),
+    "binance": (10.0, 20.0),
+    "bcb": (2.0, 4.0),
+}
+LIMITE_SCRAPERS = (1.0, 2.0)
+FATOR_MINIMO = 0.05
+
+
+class UpstreamIndisponivel(Exception):
+    """O limitador não liberou a chamada (espera longa demais ou circuito aberto)."""
+
+
+class CircuitoAberto(UpstreamIndisponivel):
+    pass
+
+
+def _status_http(erro: BaseException) -> Optional[int]:
+    resposta = getattr(erro, "response", None)
+    for status in (getattr(resposta, "status_code", None), getattr(erro, "code", None)):
+        if isinstance(status, int) and 100 <= status <= 599:
+            return status
+    return None
+
+
+def eh_transitoria(erro: BaseException) -> bool:
+    """
+    Falha que indica upstream fora do ar ou sobrecarregado: conexão/timeout,
+    5xx e 429. Ticker inválido, 4xx e erro de parse não contam.
+    """
+    if eh_throttle(erro):
+        return True
+    status = _status_http(erro)
+    if status is not None:
+        return status >= 500
+    if isinstance(erro, ValueError):
+        # JSONDecodeError (inclusive o do requests), URL inválida, parse
+        return False
+    if isinstance(erro, (ConnectionError, TimeoutError)):
+        return True
+    nome = type(erro).__name__
+    if "Timeout" in nome or "ConnectionError" in nome:
+        # requests / curl_cffi / urllib3 (nem todos herdam de ConnectionError)
+        return True
+    # URLError e erros de socket; HTTPError já caiu no status acima
+    return isinstance(erro, OSError) and not nome.endswith("HTTPError")
+
+
+def eh_throttle(erro: BaseException) -> bool:
+    """429 do upstream (requests, urllib ou yfinance)."""
+    resposta = getattr(erro, "response", None)
+    if getattr(resposta, "status_code", None) == 429 or getattr(erro, "code", None) == 429:
+        return True
+    texto = f"{type(erro).__name__} {erro}"
+    return "429" in texto or "Too Many Requests" in texto or "RateLimit" in texto
+
+
+class LimitadorUpstream:
+    def __init__(
+        self,
+        db_path: str,
+        conectar: Callable,
+        limites: Optional[dict] = None,
+        max_espera_s: float = 20.0,
+        falhas_para_abrir: int = 5,
+        aberto_s: float = 30.0,
+    ):
+        self.db_path = db_path
+        self._conectar = conectar
+        self.limites = dict(LIMITES_PADRAO)
+        self.limites.update(limites or {})
+        self.max_espera_s = float(max_espera_s)
+        self.falhas_para_abrir = int(falhas_para_abrir)
+        self.aberto_s = float(aberto_s)
+        self._lock = threading.Lock()
+        self._tabelas_ok = False
+        self._visto = {}  # upstream -> (fator, falhas, aberto_ate) da última leitura
+        self._m = {}
+
+    # ------------------------------------------------------------------ SQLite
+
+    def _conn(self):
+        conn = self._conectar(self.db_path)
+        if not self._tabelas_ok:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS limitador (
+                    upstream TEXT PRIMARY KEY,
+                    fichas REAL NOT NULL,
+                    atualizado_em REAL NOT NULL,
+                    fator REAL NOT NULL DEFAULT 1.0,
+                    falhas INTEGER NOT NULL DEFAULT 0,
+                    aberto_ate REAL NOT NULL DEFAULT 0
+                )
+                """
+            )
+            conn.commit()
+            self._tabelas_ok = True
+        return conn
+
+    def _limite(self, upstream):
+        return self.limites.get(upstream, LIMITE_SCRAPERS)
+
+    def _tentar_ficha(self, upstream):
+        """
+        (espera, sonda): espera 0 se pegou a ficha, senão segundos até a
+        próxima; sonda=True se esta chamada é a sonda do circuito meio-aberto.
+        Levanta CircuitoAberto.
+        """
+        taxa, rajada = self._limite(upstream)
+        agora = time.time()
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT fichas, atualizado_em, fator, falhas, aberto_ate FROM limitador WHERE upstream = ?",
+                (upstream,),
+            ).fetchone()
+            fichas, atualizado_em, fator, falhas, aberto_ate = row or (rajada, agora, 1.0, 0, 0.0)
+            self._visto[upstream] = (fator, falhas, aberto_ate)
+            if aberto_ate > agora:
+                conn.commit()
+                raise CircuitoAberto(f"{upstream}: circuito aberto por mais {aberto_ate - agora:.0f}s")
+            fichas = min(rajada, fichas + max(0.0, agora - atualizado_em) * taxa * fator)
+            espera = 0.0
+            sonda = False
+            if fichas >= 1.0:
+                fichas -= 1.0
+                if falhas >= self.falhas_para_abrir:
+                    # meio-aberto: esta chamada testa o upstream; as demais
+                    # recebem CircuitoAberto até ela voltar (ou por aberto_s)
+                    sonda = True
+                    aberto_ate = agora + self.aberto_s
+            else:
+                espera = (1.0 - fichas) / (taxa * fator)
+            conn.execute(
+                "INSERT OR REPLACE INTO limitador (upstream, fichas, atualizado_em, fator, falhas, aberto_ate) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (upstream, fichas, agora, fator, falhas, aberto_ate),
+            )
+            conn.commit()
+            if sonda:
+                self._visto[upstream] = (fator, falhas, aberto_ate)
+            return espera, sonda
+        finally:
+            conn.close()
+
+    def _registrar(self, upstream, resultado, sonda=False):
+        """
+        Ajusta fator/falhas conforme o desfecho: 'ok', 'vazio', 'throttle',
+        'erro' (transitório) ou 'neutro' (erro que não diz nada sobre a saúde
+        do upstream). Com o circuito aberto, falhas e prazo só mudam pelo
+        desfecho da sonda; chamadas que começaram antes da abertura não fecham
+        nem reabrem o circuito.
+        """
+        fator_visto, falhas_vistas, _ = self._visto.get(upstream, (1.0, 0, 0.0))
+        if resultado == "ok" and fator_visto >= 1.0 and not falhas_vistas:
+            return  # nada a mudar: evita uma escrita por chamada bem-sucedida
+        if resultado == "neutro" and not sonda:
+            return
+        agora = time.time()
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT fichas, atualizado_em, fator, falhas, aberto_ate FROM limitador WHERE upstream = ?",
+                (upstream,),
+            ).fetchone()
+            if row is None:
+                conn.commit()
+                return
+            fichas, atualizado_em, fator, falhas, aberto_ate = row
+            circuito_aberto = falhas >= self.falhas_para_abrir
+            if resultado == "ok":
+                fator = min(1.0, fator + 0.05)
+                if sonda or not circuito_aberto:
+                    if sonda:
+                        print(f"[LIMITADOR] {upstream}: sonda ok, circuito fechado")
+                    falhas, aberto_ate = 0, 0.0
+            elif resultado == "vazio":
+                fator = max(FATOR_MINIMO, fator * 0.8)
+            elif resultado == "neutro":
+                aberto_ate = 0.0  # a sonda não decidiu: a próxima chamada testa de novo
+            else:
+                if resultado == "throttle":
+                    fator = max(FATOR_MINIMO, fator * 0.5)
+                if sonda or not circuito_aberto:
+                    falhas += 1
+                    if falhas >= self.falhas_para_abrir:
+                        aberto_ate = agora + self.aberto_s
+                        with self._lock:
+                            self._conta(upstream, "aberturas_circuito")
+                        print(f"[LIMITADOR] {upstream}: {falhas} falhas seguidas, circuito aberto por {self.aberto_s:.0f}s")
+            conn.execute(
+                "UPDATE limitador SET fator = ?, falhas = ?, aberto_ate = ? WHERE upstream = ?",
+                (fator, falhas, aberto_ate, upstream),
+            )
+            conn.commit()
+            self._visto[upstream] = (fator, falhas, aberto_ate)
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------ API
+
+    def _conta(self, upstream, campo, n=1):
+        m = self._m.setdefault(
+            upstream,
+            {
+                "chamadas": 0, "esperas": 0, "espera_ms_total": 0.0, "em_fila": 0, "fila_max": 0,
+                "rejeitadas": 0, "throttles": 0, "vazias": 0, "erros": 0, "aberturas_circuito": 0,
+                "sondas": 0,
+            },
+        )
+        m[campo] += n
+        if campo == "em_fila":
+            m["fila_max"] = max(m["fila_max"], m["em_fila"])
+
+    def adquirir(self, upstream: str, max_espera_s: Optional[float] = None) -> bool:
+        """
+        Espera uma ficha de `upstream`. Levanta UpstreamIndisponivel se não
+        der. Devolve True se a chamada é a sonda do circuito meio-aberto.
+        """
+        limite = time.time() + (self.max_espera_s if max_espera_s is None else float(max_espera_s))
+        inicio = time.time()
+        with self._lock:
+            self._conta(upstream, "em_fila")
+        sonda = False
+        try:
+            while True:
+                try:
+                    espera, sonda = self._tentar_ficha(upstream)
+                except UpstreamIndisponivel:
+                    with self._lock:
+                        self._conta(upstream, "rejeitadas")
+                    raise
+                except Exception as e:
+                    print(f"[LIMITADOR] aviso: {upstream} sem controle de taxa ({e})")
+                    return False
+                if espera <= 0:
+                    break
+                if time.time() + espera > limite:
+                    with self._lock:
+                        self._conta(upstream, "rejeitadas")
+                    raise UpstreamIndisponivel(f"{upstream}: fila do limitador excedeu {self.max_espera_s:.0f}s")
+                time.sleep(espera)
+        finally:
+            with self._lock:
+                self._conta(upstream, "em_fila", -1)
+                esperou = time.time() - inicio
+                if esperou > 0.01:
+                    self._conta(upstream, "esperas")
+                    self._conta(upstream, "espera_ms_total", esperou * 1000.0)
+                if sonda:
+                    self._conta(upstream, "sondas")
+        return sonda
+
+    def executar(self, upstream: str, funcao: Callable, vazio: Optional[Callable] = None, max_espera_s: Optional[float] = None):
+        """
+        `funcao()` sob o limite de `upstream`. `vazio(resultado)` diz se a
+        resposta veio vazia (sinal de throttling silencioso do Yahoo).
+        """
+        sonda = self.adquirir(upstream, max_espera_s)
+        with self._lock:
+            self._conta(upstream, "chamadas")
+        try:
+            resultado = funcao()
+        except Exception as e:
+            throttle = eh_throttle(e)
+            if throttle:
+                desfecho = "throttle"
+            elif eh_transitoria(e):
+                desfecho = "erro"
+            else:
+                desfecho = "neutro"
+            with self._lock:
+                self._conta(upstream, "throttles" if throttle else "erros")
+            try:
+                self._registrar(upstream, desfecho, sonda)
+            except Exception:
+                pass
+            raise
+        desfecho = "ok"
+        status = getattr(resultado, "status_code", None)
+        if status == 429:
+            # requests não levanta exceção em 429: o Response volta para quem chamou tratar
+            desfecho = "throttle"
+        elif isinstance(status, int) and status >= 500:
+            desfecho = "erro"
+        elif vazio is not None:
+            try:
+                if vazio(resultado):
+                    desfecho = "vazio"
+            except Exception:
+                pass
+        if desfecho != "ok":
+            with self._lock:
+                self._conta(upstream, {"vazio": "vazias", "throttle": "throttles", "erro": "erros"}[desfecho])
+        try:
+            self._registrar(upstream, desfecho, sonda)
+        except Exception:
+            pass
+        return resultado
+
+    def metricas(self) -> dict:
+        agora = time.time()
+        with self._lock:
+            out = {}
+            for upstream, m in self._m.items():
+                m = dict(m)
+                espera_ms_total = m.pop("espera_ms_total")
+                m["espera_ms_media"] = round(espera_ms_total / m["esperas"], 1) if m["esperas"] else None
+                fator, falhas, aberto_ate = self._visto.get(upstream, (1.0, 0, 0.0))
+                taxa, rajada = self._limite(upstream)
+                m["taxa_efetiva"] = round(taxa * fator, 3)
+                m["circuito_aberto"] = aberto_ate > agora
+                out[upstream] = m
+        return out
+
+    def depois_do_fork_filho(self):
+        self._lock = threading.Lock()
+        self._visto = {}
+        self._m = {}
+
+
+# Limitador do processo, configurado por models.py. Os scrapers não importam
+# models (evita import circular) e usam `chamar` / `upstream_da_url` daqui.
+_PADRAO: Optional[LimitadorUpstream] = None
+
+
+def configurar_padrao(limitador: Optional[LimitadorUpstream]):
+    global _PADRAO
+    _PADRAO = limitador
+
+
+def chamar(upstream: str, funcao: Callable, vazio: Optional[Callable] = None):
+    """`LimitadorUpstream.executar` no limitador do processo (ou chamada direta se não houver)."""
+    if _PADRAO is None:
+        return funcao()
+    return _PADRAO.executar(upstream, funcao, vazio)
+
+
+def upstream_da_url(url: str) -> str:
+    return (urlparse(url).hostname or "desconhecido").lower()
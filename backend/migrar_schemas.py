@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Aplica as migrações de schema pendentes de todos os usuários, fora do caminho das requisições.
+Uso no deploy (a partir de backend/): python migrar_schemas.py
+"""
+
+import sys
+import time
+
+from models import migrar_schemas_todos_usuarios
+
+
+def main() -> int:
+    inicio = time.time()
+    resumo = migrar_schemas_todos_usuarios()
+    duracao = time.time() - inicio
+
+    print(f"[INFO] Usuários verificados: {resumo['usuarios']}")
+    print(f"[INFO] Usuários na última versão: {resumo['ok']}")
+    for falha in resumo["falhas"]:
+        print(f"[ERRO] {falha['usuario']}: falha em {', '.join(falha['bancos'])}")
+    print(f"[OK] Migrações concluídas em {duracao:.1f}s")
+    return 1 if resumo["falhas"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
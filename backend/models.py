@@ -1,4 +1,5 @@
 import threading
+import queue
 import pandas as pd
 import yfinance as yf
 from flask import Flask
@@ -14,17 +15,49 @@ import secrets
 import re
 import unicodedata
 import urllib.request
+import atexit
 from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, as_completed
 try:
     import psycopg
 except Exception:
     psycopg = None
+try:
+    from .pg_pool import PgPool, ConexaoPooled
+    from .sqlite_pool import SqlitePool
+    from .quote_store import QuoteStore
+    from .screener_colunar import TabelaColunar
+    from .job_queue import FilaJobs
+    from .ohlcv_store import OhlcvStore
+    from .series_bcb import SeriesBcb
+    from .fatores_indexadores import FatoresIndexadores
+    from . import monte_carlo
+    from . import limitador_upstream
+    from .limitador_upstream import LimitadorUpstream
+    from . import gravacao_upstream
+except ImportError:
+    from pg_pool import PgPool, ConexaoPooled
+    from sqlite_pool import SqlitePool
+    from quote_store import QuoteStore
+    from screener_colunar import TabelaColunar
+    from job_queue import FilaJobs
+    from ohlcv_store import OhlcvStore
+    from series_bcb import SeriesBcb
+    from fatores_indexadores import FatoresIndexadores
+    import monte_carlo
+    import limitador_upstream
+    from limitador_upstream import LimitadorUpstream
+    import gravacao_upstream
 
 # Concorrência para requisições ao yfinance (evita rate limit; 5-8 estável)
 YF_MAX_CONCURRENT = 3
+# Threads de pools que podem ir a upstreams (a taxa real é controlada pelo LIMITADOR)
+UPSTREAM_MAX_THREADS = int(os.getenv('UPSTREAM_MAX_THREADS', '16'))
 
 USUARIO_ATUAL = None  
 SESSION_LOCK = threading.Lock()
+# Usuário das rotinas de fundo (refresh agendado da carteira): get_usuario_atual()
+# devolve este valor na thread que o definiu, fora de qualquer requisição.
+_USUARIO_THREAD = threading.local()
 
 # ==================== ADAPTADOR DE BANCO (SQLite local x Postgres em produção) ====================
 
@@ -54,19 +87,55 @@ def _is_postgres() -> bool:
     print(f"_is_postgres: DATABASE_URL={bool(DATABASE_URL)}, psycopg={psycopg is not None}, resultado={is_pg}")
     return is_pg
 
+_PG_POOL = None
+_PG_POOL_LOCK = threading.Lock()
+
+def _configurar_conexao_pg(raw):
+    raw.autocommit = True
+
+def _pg_pool():
+    global _PG_POOL
+    if _PG_POOL is None:
+        with _PG_POOL_LOCK:
+            if _PG_POOL is None:
+                _PG_POOL = PgPool(
+                    DATABASE_URL,
+                    tamanho=int(os.getenv("PG_POOL_SIZE", "8")),
+                    overflow=int(os.getenv("PG_POOL_MAX_OVERFLOW", "16")),
+                    timeout=float(os.getenv("PG_POOL_TIMEOUT", "30")),
+                    max_ocioso_s=float(os.getenv("PG_POOL_MAX_IDLE", "300")),
+                    configurar=_configurar_conexao_pg,
+                    # DROP/RENAME de schema feito por outro worker (ver _esquecer_dados_locais)
+                    conferir=lambda: _conferir_versao_storage(),
+                )
+    return _PG_POOL
+
+def _pg_pool_antes_do_fork():
+    if _PG_POOL is not None:
+        _PG_POOL.antes_do_fork()
+
+def _pg_pool_depois_do_fork():
+    if _PG_POOL is not None:
+        _PG_POOL.depois_do_fork_filho()
+
+# gunicorn --preload: o master usa o banco no import e depois faz fork dos workers
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_pg_pool_antes_do_fork, after_in_child=_pg_pool_depois_do_fork)
+atexit.register(_pg_pool_antes_do_fork)
+
+def obter_metricas_pool_pg():
+    if _PG_POOL is None:
+        return {"ativo": False}
+    m = _PG_POOL.metricas()
+    m["ativo"] = True
+    return m
+
 def _get_pg_conn():
-    print(f"_get_pg_conn: Conectando ao PostgreSQL")
+    """Conexão do pool com search_path default (tabelas public.*)."""
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        print(f"_get_pg_conn: Conexão estabelecida")
-        try:
-            conn.autocommit = True
-            print(f"_get_pg_conn: Autocommit configurado")
-        except Exception as e:
-            print(f"_get_pg_conn: Erro ao configurar autocommit: {e}")
-        return conn
+        return _pg_pool().conexao()
     except Exception as e:
-        print(f"_get_pg_conn: Erro ao conectar ao PostgreSQL: {e}")
+        print(f"_get_pg_conn: Erro ao obter conexão do pool PostgreSQL: {e}")
         raise
 
 def _pg_schema_for_user(username: str) -> str:
@@ -74,107 +143,66 @@ def _pg_schema_for_user(username: str) -> str:
     if not base:
         base = "anon"
     schema = f"u_{base}"
-    print(f"_pg_schema_for_user: Schema gerado para usuário {username}: {schema}")
     
     # Verificar se o schema é válido para PostgreSQL
     if len(schema) > 63:  # Limite do PostgreSQL para identificadores
         schema = schema[:63]
-        print(f"_pg_schema_for_user: Schema truncado para {schema}")
     
     return schema
 
 def _pg_use_schema(conn, username: str):
     schema = _pg_schema_for_user(username)
-    print(f"_pg_use_schema: Usando schema {schema} para usuário {username}")
+    if isinstance(conn, ConexaoPooled):
+        conn.vincular_schema(schema)
+        return schema
     with conn.cursor() as cur:
-        try:
-            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
-            print(f"_pg_use_schema: Schema {schema} criado/verificado")
-        except Exception as e:
-            print(f"_pg_use_schema: Erro ao criar schema {schema}: {e}")
-            raise
-        
-        try:
-            cur.execute(f"SET search_path TO {schema}")
-            print(f"_pg_use_schema: Search path configurado para {schema}")
-        except Exception as e:
-            print(f"_pg_use_schema: Erro ao configurar search_path: {e}")
-            raise
-            
-        # Verificar se o schema foi criado corretamente
-        try:
-            cur.execute("SELECT current_schema()")
-            current_schema = cur.fetchone()[0]
-            print(f"_pg_use_schema: Schema atual: {current_schema}")
-        except Exception as e:
-            print(f"_pg_use_schema: Erro ao verificar schema atual: {e}")
-            raise
-            
-    print(f"_pg_use_schema: Schema {schema} configurado com sucesso")
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+        cur.execute(f"SET search_path TO {schema}")
     return schema
 
 def _pg_conn_for_user(username: str):
-    print(f"_pg_conn_for_user: Conectando para usuário {username}")
-    conn = _get_pg_conn()
+    """Conexão do pool já vinculada ao schema u_<usuario> (CREATE SCHEMA só na 1ª vez)."""
+    schema = _pg_schema_for_user(username)
     try:
-        _pg_use_schema(conn, username)
-        print(f"_pg_conn_for_user: Conexão estabelecida para usuário {username}")
-        return conn
+        return _pg_pool().conexao(schema)
     except Exception as e:
-        print(f"_pg_conn_for_user: Erro ao configurar schema para usuário {username}: {e}")
-        try:
-            conn.close()
-        except:
-            pass
+        print(f"_pg_conn_for_user: Erro ao obter conexão para usuário {username}: {e}")
         raise
 
+def _pg_esquecer_schema_usuario(username: str):
+    """Depois de DROP/RENAME do schema: esquece neste processo e publica para os outros workers."""
+    schema = _pg_schema_for_user(username)
+    if _PG_POOL is not None:
+        _PG_POOL.esquecer_schema(schema)
+    _invalidar_cache_versao_schema()
+    try:
+        _publicar_invalidacao_dados('pg:' + schema)
+    except Exception as e:
+        print(f"[storage] aviso: invalidação do schema {schema} não publicada: {e}")
+
+def _sqlite_adicionar_coluna(cur, tabela, definicao):
+    """ALTER TABLE ... ADD COLUMN no SQLite, ignorando só o erro de coluna já existente.
+
+    O SQLite não tem ADD COLUMN IF NOT EXISTS. Qualquer outro erro sobe para
+    `garantir_schema_usuario` não gravar o passo como aplicado.
+    """
+    try:
+        cur.execute(f"ALTER TABLE {tabela} ADD COLUMN {definicao}")
+    except sqlite3.OperationalError as e:
+        if "duplicate column" not in str(e).lower():
+            raise
+
 def _ensure_rebalance_schema():
+    garantir_schema_usuario(get_usuario_atual(), 'carteira')
 
-    usuario = get_usuario_atual()
-    if not usuario:
-        return
+def _mig_carteira_rebalance(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
             with conn.cursor() as c:
-                try:
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS rebalance_config (
-                            id SERIAL PRIMARY KEY,
-                            periodo TEXT NOT NULL,
-                            targets_json TEXT NOT NULL,
-                            start_date TEXT,
-                            last_rebalance_date TEXT,
-                            updated_at TEXT NOT NULL
-                        )
-                    ''')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE rebalance_config ADD COLUMN IF NOT EXISTS last_rebalance_date TEXT')
-                except Exception:
-                    pass
-                try:
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS rebalance_history (
-                            id SERIAL PRIMARY KEY,
-                            data TEXT NOT NULL,
-                            created_at TEXT NOT NULL
-                        )
-                    ''')
-                except Exception:
-                    pass
-        finally:
-            conn.close()
-    else:
-        db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-        try:
-            cur = conn.cursor()
-            try:
-                cur.execute('''
+                c.execute('''
                     CREATE TABLE IF NOT EXISTS rebalance_config (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        id SERIAL PRIMARY KEY,
                         periodo TEXT NOT NULL,
                         targets_json TEXT NOT NULL,
                         start_date TEXT,
@@ -182,30 +210,47 @@ def _ensure_rebalance_schema():
                         updated_at TEXT NOT NULL
                     )
                 ''')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE rebalance_config ADD COLUMN IF NOT EXISTS last_rebalance_date TEXT')
-            except Exception:
-                pass
-            try:
-                cur.execute('''
+                c.execute('ALTER TABLE rebalance_config ADD COLUMN IF NOT EXISTS last_rebalance_date TEXT')
+                c.execute('''
                     CREATE TABLE IF NOT EXISTS rebalance_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        id SERIAL PRIMARY KEY,
                         data TEXT NOT NULL,
                         created_at TEXT NOT NULL
                     )
                 ''')
-            except Exception:
-                pass
+        finally:
+            conn.close()
+    else:
+        db_path = get_db_path(usuario, "carteira")
+        conn = _sqlite_connect(db_path)
+        try:
+            cur = conn.cursor()
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS rebalance_config (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    periodo TEXT NOT NULL,
+                    targets_json TEXT NOT NULL,
+                    start_date TEXT,
+                    last_rebalance_date TEXT,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            _sqlite_adicionar_coluna(cur, 'rebalance_config', 'last_rebalance_date TEXT')
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS rebalance_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    data TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
             conn.commit()
         finally:
             conn.close()
 
 def _ensure_asset_types_schema():
-    usuario = get_usuario_atual()
-    if not usuario:
-        return
+    garantir_schema_usuario(get_usuario_atual(), 'carteira')
+
+def _mig_carteira_asset_types(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -221,7 +266,7 @@ def _ensure_asset_types_schema():
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('''
@@ -250,7 +295,7 @@ def list_asset_types():
         finally:
             conn.close()
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         cur.execute('SELECT nome FROM asset_types ORDER BY nome ASC')
@@ -260,119 +305,48 @@ def list_asset_types():
         conn.close()
 
 def _ensure_indexador_schema():
+    garantir_schema_usuario(get_usuario_atual(), 'carteira')
 
-    usuario = get_usuario_atual()
-    if not usuario:
-        return
+def _mig_carteira_indexador(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
             with conn.cursor() as c:
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador TEXT')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_pct NUMERIC')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_base_preco NUMERIC')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_base_data TEXT')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_medio NUMERIC')
-                except Exception:
-                    pass
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador TEXT')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_pct NUMERIC')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_base_preco NUMERIC')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_base_data TEXT')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_medio NUMERIC')
                 # Campos adicionais de Renda Fixa
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS data_aplicacao TEXT')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS vencimento TEXT')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS isento_ir BOOLEAN')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS liquidez_diaria BOOLEAN')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_compra DECIMAL(10,2)')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS emissor_rf TEXT')
-                except Exception:
-                    pass
-                try:
-                    c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS tipo_renda_fixa TEXT')
-                except Exception:
-                    pass
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS data_aplicacao TEXT')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS vencimento TEXT')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS isento_ir BOOLEAN')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS liquidez_diaria BOOLEAN')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_compra DECIMAL(10,2)')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS emissor_rf TEXT')
+                c.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS tipo_renda_fixa TEXT')
         finally:
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN indexador TEXT')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN indexador_pct REAL')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN indexador_base_preco REAL')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN indexador_base_data TEXT')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN preco_medio REAL')
-            except Exception:
-                pass
+            _sqlite_adicionar_coluna(cur, 'carteira', 'indexador TEXT')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'indexador_pct REAL')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'indexador_base_preco REAL')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'indexador_base_data TEXT')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'preco_medio REAL')
             
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN data_aplicacao TEXT')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN vencimento TEXT')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN isento_ir INTEGER')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN liquidez_diaria INTEGER')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN preco_compra REAL')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN emissor_rf TEXT')
-            except Exception:
-                pass
-            try:
-                cur.execute('ALTER TABLE carteira ADD COLUMN tipo_renda_fixa TEXT')
-            except Exception:
-                pass
+            _sqlite_adicionar_coluna(cur, 'carteira', 'data_aplicacao TEXT')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'vencimento TEXT')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'isento_ir INTEGER')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'liquidez_diaria INTEGER')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'preco_compra REAL')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'emissor_rf TEXT')
+            _sqlite_adicionar_coluna(cur, 'carteira', 'tipo_renda_fixa TEXT')
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_carteira_indexador ON carteira(indexador)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_carteira_vencimento ON carteira(vencimento)")
             conn.commit()
         finally:
             conn.close()
@@ -394,7 +368,7 @@ def create_asset_type(nome: str):
             conn.close()
         return {"success": True}
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         try:
@@ -424,7 +398,7 @@ def rename_asset_type(old: str, new: str):
             conn.close()
         return {"success": True}
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         cur.execute('UPDATE asset_types SET nome=? WHERE nome=?', (new.strip(), old))
@@ -499,15 +473,13 @@ def _validate_rf_catalog_item(item: dict):
     return { 'valid': True, 'data': data }
 
 def _ensure_rf_catalog_schema():
-    print("DEBUG: _ensure_rf_catalog_schema chamada")
-
     usuario = get_usuario_atual()
     if not usuario:
         print("_ensure_rf_catalog_schema: Usuário não autenticado")
         return False
-    
-    print(f"DEBUG: _ensure_rf_catalog_schema: Usuário {usuario} autenticado")
-    
+    return garantir_schema_usuario(usuario, 'carteira')
+
+def _mig_carteira_rf_catalog(usuario):
 
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
@@ -565,7 +537,7 @@ def _ensure_rf_catalog_schema():
                 pass
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
           
@@ -683,7 +655,7 @@ def rf_catalog_list():
                 pass
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('''
@@ -806,7 +778,7 @@ def rf_catalog_create(item: dict):
                 pass
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -888,7 +860,7 @@ def rf_catalog_update(id_: int, item: dict):
                 pass
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -949,7 +921,7 @@ def rf_catalog_delete(id_: int):
                 pass
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             print(f"rf_catalog_delete: Removendo item {id_} SQLite para usuário {usuario}")
@@ -988,7 +960,7 @@ def delete_asset_type(nome: str):
             conn.close()
         return {"success": True}
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         cur.execute('SELECT COUNT(1) FROM carteira WHERE tipo=?', (nome,))
@@ -1008,6 +980,9 @@ def set_usuario_atual(username):
         USUARIO_ATUAL = username
 
 def _create_sessions_table_if_needed():
+    global _SESSOES_TABELA_OK
+    if _SESSOES_TABELA_OK:
+        return
     if _is_postgres():
         conn = _get_pg_conn()
         try:
@@ -1021,10 +996,11 @@ def _create_sessions_table_if_needed():
                     )
                     """
                 )
+            _SESSOES_TABELA_OK = True
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             c.execute(
@@ -1035,6 +1011,7 @@ def _create_sessions_table_if_needed():
                 )'''
             )
             conn.commit()
+            _SESSOES_TABELA_OK = True
         finally:
             conn.close()
 
@@ -1052,7 +1029,7 @@ def criar_sessao(username: str, duracao_segundos: int = 3600) -> str:
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             c.execute('INSERT OR REPLACE INTO sessoes (token, username, expira_em) VALUES (?, ?, ?)', (token, username, expira_em))
@@ -1077,7 +1054,7 @@ def invalidar_sessoes_usuario(username: str) -> None:
             finally:
                 conn.close()
         else:
-            conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
             try:
                 c = conn.cursor()
                 c.execute('DELETE FROM sessoes WHERE username = ?', (u,))
@@ -1087,6 +1064,7 @@ def invalidar_sessoes_usuario(username: str) -> None:
         print(f"[SEGURANÇA] Sessões removidas para usuário: {u}")
     except Exception as e:
         print(f"[AVISO] Erro ao invalidar sessões de {u}: {e}")
+    _sessao_cache_invalidar(username=u)
 
 
 def invalidar_sessao(token: str) -> None:
@@ -1099,7 +1077,7 @@ def invalidar_sessao(token: str) -> None:
             finally:
                 conn.close()
         else:
-            conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
             c = conn.cursor()
             c.execute('DELETE FROM sessoes WHERE token = ?', (token,))
             conn.commit()
@@ -1110,6 +1088,7 @@ def invalidar_sessao(token: str) -> None:
             conn.close()
         except Exception:
             pass
+    _sessao_cache_invalidar(token=token)
 
 def invalidar_todas_sessoes() -> None:
     
@@ -1123,7 +1102,7 @@ def invalidar_todas_sessoes() -> None:
             finally:
                 conn.close()
         else:
-            conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
             c = conn.cursor()
             c.execute('DELETE FROM sessoes')
             conn.commit()
@@ -1134,8 +1113,199 @@ def invalidar_todas_sessoes() -> None:
             conn.close()
         except Exception:
             pass
+    _sessao_cache_invalidar(todas=True)
+# ==================== CACHE DE SESSÕES (token -> usuário) ====================
+# get_usuario_atual() roda em quase todo endpoint. Depois da primeira validação
+# no banco o token fica em memória por SESSION_CACHE_TTL segundos (limitado ao
+# expira_em da sessão); o last_seen_at é acumulado e gravado em lote por uma
+# thread. Em regime, autenticar uma requisição não toca o banco.
+# Invalidações (logout, bloqueio, troca de username) limpam o cache local e
+# tocam um arquivo marcador no diretório compartilhado (_STORE_DIR): os outros
+# workers comparam o mtime dele no máximo 1x/s e descartam o próprio cache.
+
+_SESSAO_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', '60'))
+_SESSAO_CACHE = {}  # token -> (username, expira_em, valido_ate_monotonic)
+_SESSAO_CACHE_LOCK = threading.Lock()
+_SESSAO_GERACAO = 0  # incrementa a cada invalidação: leitura do banco anterior não entra no cache
+_SESSAO_MARCA_VISTA = None
+_SESSAO_MARCA_CHECADA_EM = 0.0
+_SESSOES_TABELA_OK = False
+
+_LAST_SEEN_FLUSH_S = float(os.getenv('LAST_SEEN_FLUSH_INTERVAL', '30'))
+_LAST_SEEN_PENDENTES = {}  # username -> 'YYYY-mm-dd HH:MM:SS'
+_LAST_SEEN_LOCK = threading.Lock()
+_LAST_SEEN_THREAD_PID = None
+
+def _sessao_marca_path():
+    return os.path.join(_STORE_DIR, 'sessoes.invalidadas')
+
+def _sessao_cache_sincronizar():
+    """Descarta o cache se outro processo sinalizou invalidação (stat no máximo 1x/s)."""
+    global _SESSAO_MARCA_VISTA, _SESSAO_MARCA_CHECADA_EM
+    agora = time.monotonic()
+    if agora - _SESSAO_MARCA_CHECADA_EM < 1.0:
+        return
+    _SESSAO_MARCA_CHECADA_EM = agora
+    try:
+        marca = os.stat(_sessao_marca_path()).st_mtime_ns
+    except OSError:
+        marca = 0
+    if marca != _SESSAO_MARCA_VISTA:
+        if _SESSAO_MARCA_VISTA is not None:
+            _sessao_cache_limpar_local()
+        _SESSAO_MARCA_VISTA = marca
+
+def _sessao_cache_obter(token):
+    _sessao_cache_sincronizar()
+    entrada = _SESSAO_CACHE.get(token)
+    if entrada is None:
+        return None
+    username, expira_em, valido_ate = entrada
+    if time.monotonic() > valido_ate or int(expira_em) < int(time.time()):
+        with _SESSAO_CACHE_LOCK:
+            _SESSAO_CACHE.pop(token, None)
+        return None
+    return username, expira_em
+
+def _sessao_cache_guardar(token, username, expira_em, geracao):
+    if _SESSAO_CACHE_TTL <= 0:
+        return
+    with _SESSAO_CACHE_LOCK:
+        if geracao != _SESSAO_GERACAO:
+            return
+        _SESSAO_CACHE[token] = (username, int(expira_em), time.monotonic() + _SESSAO_CACHE_TTL)
+
+def _sessao_cache_limpar_local():
+    global _SESSAO_GERACAO
+    with _SESSAO_CACHE_LOCK:
+        _SESSAO_GERACAO += 1
+        _SESSAO_CACHE.clear()
+
+def _sessao_cache_invalidar(token=None, username=None, todas=False):
+    """Remove tokens do cache local e avisa os outros workers."""
+    global _SESSAO_GERACAO
+    with _SESSAO_CACHE_LOCK:
+        _SESSAO_GERACAO += 1
+        if todas:
+            _SESSAO_CACHE.clear()
+        else:
+            if token:
+                _SESSAO_CACHE.pop(token, None)
+            if username:
+                for t in [t for t, e in _SESSAO_CACHE.items() if e[0] == username]:
+                    del _SESSAO_CACHE[t]
+    try:
+        path = _sessao_marca_path()
+        with open(path, 'a'):
+            pass
+        os.utime(path, None)
+    except OSError as e:
+        print(f"[sessao] aviso: não foi possível sinalizar invalidação: {e}")
+
+def validar_token_sessao(token, username):
+    """True se o token pertence a `username` e não expirou (cache; banco só em miss)."""
+    if not token or not username:
+        return False
+    entrada = _sessao_cache_obter(token)
+    if entrada is not None:
+        return entrada[0] == username
+    _create_sessions_table_if_needed()
+    if _is_postgres():
+        conn = _get_pg_conn()
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT username, expira_em FROM public.sessoes WHERE token = %s', (token,))
+                row = c.fetchone()
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
+        try:
+            c = conn.cursor()
+            c.execute('SELECT username, expira_em FROM sessoes WHERE token = ?', (token,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+    return bool(row and row[0] == username and int(row[1]) >= int(time.time()))
+
+def _registrar_last_seen(username):
+    """Write-behind de atualizar_last_seen: só marca; a thread grava em lote."""
+    if not username:
+        return
+    with _LAST_SEEN_LOCK:
+        _LAST_SEEN_PENDENTES[username] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    _garantir_flusher_last_seen()
+
+def flush_last_seen():
+    """Grava os last_seen_at pendentes numa única transação. Retorna quantos."""
+    with _LAST_SEEN_LOCK:
+        if not _LAST_SEEN_PENDENTES:
+            return 0
+        pendentes = [(ts, u) for u, ts in _LAST_SEEN_PENDENTES.items()]
+        _LAST_SEEN_PENDENTES.clear()
+    try:
+        if _is_postgres():
+            conn = _get_pg_conn()
+            try:
+                with conn.cursor() as c:
+                    c.executemany('UPDATE public.usuarios SET last_seen_at = %s WHERE username = %s', pendentes)
+            finally:
+                conn.close()
+        else:
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
+            try:
+                conn.executemany('UPDATE usuarios SET last_seen_at = ? WHERE username = ?', pendentes)
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"[last_seen] erro ao gravar lote ({len(pendentes)}): {e}")
+        with _LAST_SEEN_LOCK:
+            for ts, u in pendentes:
+                _LAST_SEEN_PENDENTES.setdefault(u, ts)
+        return 0
+    return len(pendentes)
+
+def _loop_flush_last_seen():
+    while True:
+        time.sleep(_LAST_SEEN_FLUSH_S)
+        flush_last_seen()
+
+def _garantir_flusher_last_seen():
+    global _LAST_SEEN_THREAD_PID
+    pid = os.getpid()
+    if _LAST_SEEN_THREAD_PID == pid:
+        return
+    with _LAST_SEEN_LOCK:
+        if _LAST_SEEN_THREAD_PID == pid:
+            return
+        _LAST_SEEN_THREAD_PID = pid
+    threading.Thread(target=_loop_flush_last_seen, name='last-seen-flush', daemon=True).start()
+
+def _sessao_depois_do_fork():
+    global _SESSAO_CACHE_LOCK, _LAST_SEEN_LOCK, _LAST_SEEN_THREAD_PID
+    _SESSAO_CACHE_LOCK = threading.Lock()
+    _LAST_SEEN_LOCK = threading.Lock()
+    _SESSAO_CACHE.clear()
+    _LAST_SEEN_PENDENTES.clear()
+    _LAST_SEEN_THREAD_PID = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_sessao_depois_do_fork)
+atexit.register(flush_last_seen)
+
+def obter_metricas_sessoes():
+    with _SESSAO_CACHE_LOCK:
+        n = len(_SESSAO_CACHE)
+    with _LAST_SEEN_LOCK:
+        pend = len(_LAST_SEEN_PENDENTES)
+    return {"tokens_em_cache": n, "ttl_s": _SESSAO_CACHE_TTL, "last_seen_pendentes": pend}
+
 def get_usuario_atual():
     print("DEBUG: get_usuario_atual chamada")
+    usuario_thread = getattr(_USUARIO_THREAD, "usuario", None)
+    if usuario_thread:
+        return usuario_thread
    
     try:
         from flask import request, g
@@ -1161,6 +1331,17 @@ def get_usuario_atual():
                 except Exception:
                     pass
             return None
+        em_cache = _sessao_cache_obter(token)
+        if em_cache is not None:
+            username = em_cache[0]
+            _registrar_last_seen(username)
+            if g is not None:
+                try:
+                    setattr(g, "_usuario_atual_cached", username)
+                except Exception:
+                    pass
+            return username
+        geracao = _SESSAO_GERACAO
         _create_sessions_table_if_needed()
         if _is_postgres():
             conn = _get_pg_conn()
@@ -1202,10 +1383,7 @@ def get_usuario_atual():
                             except Exception:
                                 pass
                         return None
-                    try:
-                        atualizar_last_seen(username)
-                    except Exception:
-                        pass
+                    _registrar_last_seen(username)
                     perfil_sessao = obter_perfil_usuario(username) or {}
                     email_sessao = (perfil_sessao.get('email') or '').strip()
                     username_sessao = username
@@ -1220,6 +1398,7 @@ def get_usuario_atual():
                             print(f"[sessao] token unificado: {username_sessao} -> {username}")
                         except Exception as e:
                             print(f"[sessao] aviso ao unificar username: {e}")
+                    _sessao_cache_guardar(token, username, expira_em, geracao)
                     if g is not None:
                         try:
                             setattr(g, "_usuario_atual_cached", username)
@@ -1233,7 +1412,7 @@ def get_usuario_atual():
                 except Exception:
                     pass
         else:
-            conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
             try:
                 c = conn.cursor()
                 c.execute('SELECT username, expira_em FROM sessoes WHERE token = ?', (token,))
@@ -1273,10 +1452,7 @@ def get_usuario_atual():
                         except Exception:
                             pass
                     return None
-                try:
-                    atualizar_last_seen(username)
-                except Exception:
-                    pass
+                _registrar_last_seen(username)
                 perfil_sessao = obter_perfil_usuario(username) or {}
                 email_sessao = (perfil_sessao.get('email') or '').strip()
                 username_sessao = username
@@ -1291,6 +1467,7 @@ def get_usuario_atual():
                         print(f"[sessao] token unificado: {username_sessao} -> {username}")
                     except Exception as e:
                         print(f"[sessao] aviso ao unificar username: {e}")
+                _sessao_cache_guardar(token, username, expira_em, geracao)
                 if g is not None:
                     try:
                         setattr(g, "_usuario_atual_cached", username)
@@ -1375,6 +1552,9 @@ def limpar_cache_usuario(username):
             except Exception:
                 pass
         
+        # Resolução usuário -> pasta/schema de dados (get_db_path)
+        _invalidar_cache_storage_usuario()
+        
         # Limpar cache do Flask g (request-scoped, mas por segurança)
         try:
             from flask import g
@@ -1408,7 +1588,7 @@ def limpar_sessoes_expiradas():
             finally:
                 conn.close()
         else:
-            conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
             c = conn.cursor()
             c.execute('DELETE FROM sessoes WHERE expira_em < ?', (agora,))
             conn.commit()
@@ -1424,13 +1604,12 @@ def _sqlite_controle_tem_registros(folder_name: str) -> bool:
     """Verifica se a pasta do usuário tem despesas/receitas no controle.db (SQLite local)."""
     if not folder_name:
         return False
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    db_path = os.path.join(current_dir, "bancos_usuarios", folder_name, "controle.db")
+    db_path = os.path.join(_bancos_usuarios_root(), folder_name, "controle.db")
     if not os.path.isfile(db_path):
         return False
     conn = None
     try:
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         c = conn.cursor()
         total = 0
         c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='outros_gastos'")
@@ -1497,16 +1676,19 @@ def atualizar_email_conta(username, email):
                     'UPDATE public.usuarios SET email = %s WHERE username = %s',
                     (email_val, username),
                 )
+            conn.commit()
         finally:
             conn.close()
-        return
-    conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
-    try:
-        c = conn.cursor()
-        c.execute('UPDATE usuarios SET email = ? WHERE username = ?', (email_val, username))
-        conn.commit()
-    finally:
-        conn.close()
+    else:
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
+        try:
+            c = conn.cursor()
+            c.execute('UPDATE usuarios SET email = ? WHERE username = ?', (email_val, username))
+            conn.commit()
+        finally:
+            conn.close()
+    # depois do commit: antes dele outra requisição recolocaria o mapeamento antigo no cache
+    _invalidar_cache_storage_usuario(propagar=True)
 
 
 def canonical_account_username(username, email=None):
@@ -1561,7 +1743,7 @@ def resolver_storage_username(username, email=None):
         return usuario
     if _is_postgres():
         return usuario
-    bancos_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bancos_usuarios")
+    bancos_root = _bancos_usuarios_root()
     if not os.path.isdir(bancos_root):
         return usuario
     key = usuario.lower()
@@ -1609,20 +1791,209 @@ def _usuario_para_dados(usuario=None):
     return storage
 
 
-def get_db_path(usuario, tipo_db):
-
-    if not usuario:
-        raise ValueError("Usuário não especificado")
-
-    usuario = _usuario_para_dados(usuario)
+# usuário (lower) -> (storage, expira_em). Evita refazer perfil/e-mail/listdir a cada get_db_path.
+# Mudança de e-mail (que muda o mapeamento) incrementa storage_versao no banco
+# de usuários; cada processo relê esse carimbo no máximo a cada
+# _STORAGE_VERSAO_TTL_SEC e descarta o cache quando ele muda (vale entre workers).
+# O mesmo carimbo numera as invalidações de dados (dados_invalidados): restore de
+# backup, rename e exclusão de conta gravam a pasta SQLite / schema PG afetado, e
+# os outros workers fecham as conexões e esquecem os caches daquele alvo.
+_STORAGE_USUARIO_CACHE = {}
+_STORAGE_USUARIO_CACHE_TTL_SEC = 120
+_STORAGE_VERSAO_TTL_SEC = 1.0
+_STORAGE_USUARIO_LOCK = threading.Lock()
+_STORAGE_ESTADO = {"geracao": 0, "versao": None, "versao_lida_em": 0.0}
+# Pastas de bancos_usuarios já garantidas neste processo (pula os.makedirs)
+_PASTAS_DB_CRIADAS = set()
+
+def _invalidar_cache_storage_usuario(propagar=False):
+    """
+    Esquece o mapeamento usuário -> storage deste processo. Com `propagar=True`
+    (depois do commit que mudou o e-mail) incrementa o carimbo compartilhado,
+    para os outros workers descartarem o cache deles também.
+    """
+    if propagar:
+        try:
+            _incrementar_versao_storage()
+        except Exception as e:
+            print(f"[storage] aviso: carimbo de versão não atualizado: {e}")
+    with _STORAGE_USUARIO_LOCK:
+        _STORAGE_USUARIO_CACHE.clear()
+        _PASTAS_DB_CRIADAS.clear()
+        _STORAGE_ESTADO["geracao"] += 1
+        _STORAGE_ESTADO["versao_lida_em"] = 0.0
+
+def _ler_versao_storage():
+    if _is_postgres():
+        conn = _get_pg_conn()
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT versao FROM public.storage_versao WHERE id = 1')
+                row = c.fetchone()
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
+        try:
+            row = conn.execute('SELECT versao FROM storage_versao WHERE id = 1').fetchone()
+        finally:
+            conn.close()
+    return int(row[0]) if row else 0
+
+def _incrementar_versao_storage():
+    sql = (
+        "INSERT INTO {tabela} (id, versao) VALUES (1, 1) "
+        "ON CONFLICT (id) DO UPDATE SET versao = {tabela}.versao + 1"
+    )
+    if _is_postgres():
+        conn = _get_pg_conn()
+        try:
+            with conn.cursor() as c:
+                c.execute(sql.format(tabela='public.storage_versao'))
+            conn.commit()
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
+        try:
+            conn.execute(sql.format(tabela='storage_versao'))
+            conn.commit()
+        finally:
+            conn.close()
+
+def _publicar_invalidacao_dados(chave):
+    """
+    Incrementa o carimbo compartilhado e grava `chave` ('sqlite:<pasta>' ou
+    'pg:<schema>') com a nova versão, na mesma transação.
+    """
+    sql_versao = (
+        "INSERT INTO {tabela} (id, versao) VALUES (1, 1) "
+        "ON CONFLICT (id) DO UPDATE SET versao = {tabela}.versao + 1"
+    )
+    sql_chave = (
+        "INSERT INTO {tabela} (chave, geracao) VALUES ({ph}, {ph}) "
+        "ON CONFLICT (chave) DO UPDATE SET geracao = excluded.geracao"
+    )
+    if _is_postgres():
+        conn = _get_pg_conn()
+        try:
+            with conn.transaction(), conn.cursor() as c:
+                c.execute(sql_versao.format(tabela='public.storage_versao'))
+                c.execute('SELECT versao FROM public.storage_versao WHERE id = 1')
+                versao = c.fetchone()[0]
+                c.execute(sql_chave.format(tabela='public.dados_invalidados', ph='%s'), (chave, versao))
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
+        try:
+            conn.execute(sql_versao.format(tabela='storage_versao'))
+            versao = conn.execute('SELECT versao FROM storage_versao WHERE id = 1').fetchone()[0]
+            conn.execute(sql_chave.format(tabela='dados_invalidados', ph='?'), (chave, versao))
+            conn.commit()
+        finally:
+            conn.close()
+
+def _ler_dados_invalidados(desde):
+    """Chaves invalidadas depois da versão `desde` do carimbo."""
+    if _is_postgres():
+        conn = _get_pg_conn()
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT chave FROM public.dados_invalidados WHERE geracao > %s', (desde,))
+                rows = c.fetchall()
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
+        try:
+            rows = conn.execute('SELECT chave FROM dados_invalidados WHERE geracao > ?', (desde,)).fetchall()
+        finally:
+            conn.close()
+    return [r[0] for r in rows]
+
+def _sob_pasta(caminho, base):
+    p = os.path.normcase(os.path.abspath(caminho))
+    return p == base or p.startswith(base + os.sep)
+
+def _esquecer_dados_locais(chave):
+    """Neste processo: fecha conexões e esquece caches da pasta SQLite ('sqlite:<pasta>') ou do schema ('pg:<schema>')."""
+    tipo, _, alvo = str(chave).partition(':')
+    if tipo == 'sqlite':
+        _SQLITE_POOL.fechar_sob(alvo)
+        base = os.path.normcase(os.path.abspath(alvo))
+        with _STORAGE_USUARIO_LOCK:
+            _PASTAS_DB_CRIADAS.difference_update([p for p in _PASTAS_DB_CRIADAS if _sob_pasta(p, base)])
+        with _SCHEMA_VERSAO_LOCK:
+            for k in [k for k in _SCHEMA_VERSAO_CACHE if k[0] == 'sqlite' and _sob_pasta(k[1], base)]:
+                del _SCHEMA_VERSAO_CACHE[k]
+    elif tipo == 'pg':
+        if _PG_POOL is not None:
+            _PG_POOL.esquecer_schema(alvo)
+        with _SCHEMA_VERSAO_LOCK:
+            for k in [k for k in _SCHEMA_VERSAO_CACHE if k[0] == 'pg' and k[1] == alvo]:
+                del _SCHEMA_VERSAO_CACHE[k]
+
+def _conferir_versao_storage(agora=None):
+    """
+    Descarta o cache local se outro processo mudou algum mapeamento e aplica as
+    invalidações de dados publicadas desde a última leitura (no máximo uma
+    leitura por TTL).
+    """
+    agora = time.time() if agora is None else agora
+    with _STORAGE_USUARIO_LOCK:
+        if agora - _STORAGE_ESTADO["versao_lida_em"] < _STORAGE_VERSAO_TTL_SEC:
+            return
+        # marcado antes de ler: a própria leitura abre conexão e passaria por aqui
+        _STORAGE_ESTADO["versao_lida_em"] = agora
+        anterior = _STORAGE_ESTADO["versao"]
+    try:
+        versao = _ler_versao_storage()
+    except Exception:
+        return  # tabela ainda não criada: fica só o TTL do cache
+    if anterior is not None and versao > anterior:
+        try:
+            for chave in _ler_dados_invalidados(anterior):
+                _esquecer_dados_locais(chave)
+        except Exception as e:
+            print(f"[storage] aviso: invalidações de dados não lidas: {e}")
+            return  # relê na próxima conferência, a partir da mesma versão
+    with _STORAGE_USUARIO_LOCK:
+        if anterior is not None and versao != anterior:
+            _STORAGE_USUARIO_CACHE.clear()
+            _STORAGE_ESTADO["geracao"] += 1
+        _STORAGE_ESTADO["versao"] = versao
+
+def _storage_usuario_cached(usuario):
+    chave = str(usuario).strip().lower()
+    agora = time.time()
+    _conferir_versao_storage(agora)
+    with _STORAGE_USUARIO_LOCK:
+        hit = _STORAGE_USUARIO_CACHE.get(chave)
+        if hit and hit[1] > agora:
+            return hit[0]
+        geracao = _STORAGE_ESTADO["geracao"]
+    storage = _usuario_para_dados(usuario)
+    if storage:
+        with _STORAGE_USUARIO_LOCK:
+            # uma invalidação durante o cálculo torna o resultado suspeito: não guarda
+            if _STORAGE_ESTADO["geracao"] == geracao:
+                _STORAGE_USUARIO_CACHE[chave] = (storage, agora + _STORAGE_USUARIO_CACHE_TTL_SEC)
+    return storage
+
+def get_db_path(usuario, tipo_db):
+
     if not usuario:
         raise ValueError("Usuário não especificado")
 
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-
+    usuario = _storage_usuario_cached(usuario)
+    if not usuario:
+        raise ValueError("Usuário não especificado")
 
-    db_dir = os.path.join(current_dir, "bancos_usuarios", usuario)
-    os.makedirs(db_dir, exist_ok=True)
+    db_dir = os.path.join(_bancos_usuarios_root(), usuario)
+    if db_dir not in _PASTAS_DB_CRIADAS:
+        os.makedirs(db_dir, exist_ok=True)
+        _PASTAS_DB_CRIADAS.add(db_dir)
     
     db_path = os.path.join(db_dir, f"{tipo_db}.db")
     return db_path
@@ -1630,8 +2001,11 @@ def get_db_path(usuario, tipo_db):
 
 
 _base_dir = os.path.dirname(os.path.abspath(__file__))
+# Pasta dos bancos SQLite por usuário (e do _auth/usuarios.db padrão).
+# FINMAS_BANCOS_DIR troca a base (benchmark e testes usam uma pasta temporária).
+BANCOS_USUARIOS_DIR = os.getenv("FINMAS_BANCOS_DIR") or os.path.join(_base_dir, "bancos_usuarios")
 _legacy_path = os.path.join(_base_dir, "usuarios.db")  
-_auth_dir = os.path.join(_base_dir, "bancos_usuarios", "_auth")
+_auth_dir = os.path.join(BANCOS_USUARIOS_DIR, "_auth")
 try:
     os.makedirs(_auth_dir, exist_ok=True)
 except Exception:
@@ -1672,6 +2046,14 @@ cache = Cache(config={
     'CACHE_THRESHOLD': 5000,
 })
 
+# Dados compartilhados entre workers que não podem morar no _CACHE_DIR (o
+# FileSystemCache apaga qualquer arquivo de lá ao podar/limpar).
+_STORE_DIR = os.getenv('FINMAS_STORE_DIR') or (_CACHE_DIR.rstrip('/\\') + '-store')
+try:
+    os.makedirs(_STORE_DIR, exist_ok=True)
+except Exception:
+    pass
+
 _SQLITE_STARTUP_PRAGMAS = (
     "PRAGMA journal_mode=WAL;",
     "PRAGMA synchronous=NORMAL;",
@@ -1679,6 +2061,324 @@ _SQLITE_STARTUP_PRAGMAS = (
     "PRAGMA temp_store=MEMORY;",
 )
 
+# Conexões SQLite ficam abertas entre chamadas (ver sqlite_pool.py); os
+# PRAGMAs acima são aplicados uma vez por conexão, na abertura. Toda retirada
+# confere o carimbo de invalidações (restore/rename/exclusão em outro worker).
+_SQLITE_POOL = SqlitePool(
+    pragmas=_SQLITE_STARTUP_PRAGMAS,
+    max_ociosas=int(os.getenv("SQLITE_POOL_MAX_IDLE_CONNS", "64")),
+    max_ocioso_s=float(os.getenv("SQLITE_POOL_MAX_IDLE", "300")),
+    timeout=30,
+    conferir=lambda: _conferir_versao_storage(),
+)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_SQLITE_POOL.antes_do_fork, after_in_child=_SQLITE_POOL.depois_do_fork_filho)
+atexit.register(_SQLITE_POOL.antes_do_fork)
+
+def _sqlite_connect(db_path):
+    return _SQLITE_POOL.conectar(db_path)
+
+def fechar_conexoes_sqlite(diretorio=None):
+    """
+    Fecha conexões SQLite em cache sob `diretorio` antes de copiar/apagar/restaurar
+    arquivos, e publica a invalidação para os outros workers. Chame de novo depois
+    de trocar os arquivos: outro worker pode ter reaberto a pasta no intervalo.
+    """
+    n = _SQLITE_POOL.fechar_sob(diretorio)
+    _invalidar_cache_storage_usuario()
+    _invalidar_cache_versao_schema()
+    if diretorio:
+        try:
+            _publicar_invalidacao_dados('sqlite:' + os.path.abspath(diretorio))
+        except Exception as e:
+            print(f"[storage] aviso: invalidação de {diretorio} não publicada: {e}")
+    return n
+
+def obter_metricas_pool_sqlite():
+    return _SQLITE_POOL.metricas()
+
+# Token bucket + circuit breaker por upstream, compartilhado pelos workers (ver limitador_upstream.py)
+LIMITADOR = LimitadorUpstream(
+    os.path.join(_STORE_DIR, 'limitador.db'),
+    conectar=_sqlite_connect,
+    limites={
+        'yahoo': (float(os.getenv('LIMITE_YAHOO_RPS', '4')), float(os.getenv('LIMITE_YAHOO_RAJADA', '8'))),
+    },
+)
+limitador_upstream.configurar_padrao(LIMITADOR)
+# Testes/benchmarks sem rede: FINMAS_UPSTREAM_MODO=gravar|reproduzir (ver gravacao_upstream.py)
+gravacao_upstream.ativar_do_ambiente()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=LIMITADOR.depois_do_fork_filho)
+
+def obter_metricas_limitador():
+    return LIMITADOR.metricas()
+
+# Cotações/fundamentos compartilhados entre endpoints, usuários e workers (ver quote_store.py)
+QUOTE_STORE = QuoteStore(
+    os.path.join(_STORE_DIR, 'cotacoes.db'),
+    conectar=_sqlite_connect,
+    ttl_grupos={
+        'preco': float(os.getenv('QUOTE_TTL_PRECO', '60')),
+        'fundamentos': float(os.getenv('QUOTE_TTL_FUNDAMENTOS', '21600')),
+        'cadastro': float(os.getenv('QUOTE_TTL_CADASTRO', '604800')),
+    },
+)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=QUOTE_STORE.depois_do_fork_filho)
+
+def obter_info_yf(symbol, grupo='preco'):
+    """`yf.Ticker(symbol).info` via QUOTE_STORE. grupo: 'preco' | 'fundamentos' | 'cadastro'."""
+    symbol = (symbol or '').strip().upper()
+    if not symbol:
+        return {}
+    return QUOTE_STORE.obter(
+        'yfinance', symbol,
+        lambda: LIMITADOR.executar('yahoo', lambda: yf.Ticker(symbol).info or {}, vazio=lambda info: not info),
+        grupo,
+    )
+
+def obter_metricas_cotacoes():
+    return QUOTE_STORE.metricas()
+
+# Jobs em segundo plano (análises longas); estado/resultado compartilhados entre workers (ver job_queue.py)
+FILA_JOBS = FilaJobs(os.path.join(_STORE_DIR, 'jobs.db'), conectar=_sqlite_connect)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=FILA_JOBS.depois_do_fork_filho)
+
+def obter_metricas_jobs():
+    return FILA_JOBS.metricas()
+
+def _baixar_historico_yf(ticker, inicio, fim):
+    acao = yf.Ticker(ticker)
+    if inicio is None:
+        return LIMITADOR.executar('yahoo', lambda: acao.history(period="max"))
+    return LIMITADOR.executar('yahoo', lambda: acao.history(start=inicio.isoformat(), end=fim.isoformat()))
+
+# Barras diárias por ticker, baixadas de forma incremental (ver ohlcv_store.py)
+OHLCV_STORE = OhlcvStore(
+    os.path.join(_STORE_DIR, 'ohlcv.db'),
+    conectar=_sqlite_connect,
+    baixar=_baixar_historico_yf,
+    ttl_cauda_s=float(os.getenv('OHLCV_TTL_CAUDA', '900')),
+)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=OHLCV_STORE.depois_do_fork_filho)
+
+def obter_historico_diario(ticker, inicio=None, fim=None):
+    """Equivalente a `yf.Ticker(ticker).history(start=inicio, end=fim)` (sem inicio = period="max"), servido pelo OHLCV_STORE."""
+    return OHLCV_STORE.historico(ticker, inicio, fim)
+
+def obter_metricas_ohlcv():
+    m = OHLCV_STORE.metricas()
+    m["proventos_tickers_sincronizados"] = len(_PROVENTOS_TICKERS)
+    return m
+
+def _baixar_serie_bcb(serie_id, inicio, fim):
+    import requests
+    r = LIMITADOR.executar('bcb', lambda: requests.get(
+        f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{serie_id}/dados",
+        params={
+            "formato": "json",
+            "dataInicial": inicio.strftime("%d/%m/%Y"),
+            "dataFinal": fim.strftime("%d/%m/%Y"),
+        },
+        timeout=30,
+    ))
+    if r.status_code == 404:
+        # o SGS responde 404 quando não há valores no intervalo
+        return []
+    r.raise_for_status()
+    dados = r.json()
+    if not isinstance(dados, list):
+        return []
+    return [(item["data"], item["valor"]) for item in dados if item.get("data") and item.get("valor") is not None]
+
+# Séries do BCB SGS persistidas por série, baixando só os dias que faltam (ver series_bcb.py)
+SERIES_BCB = SeriesBcb(
+    os.path.join(_STORE_DIR, 'series_bcb.db'),
+    conectar=_sqlite_connect,
+    baixar=_baixar_serie_bcb,
+    ttl_cauda_s=float(os.getenv('BCB_TTL_CAUDA', '21600')),
+)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=SERIES_BCB.depois_do_fork_filho)
+
+def ultimo_ponto_bcb(serie_id, janela_dias=120):
+    """Último valor publicado da série (mesmo formato de `/dados/ultimos/1`: {'data', 'valor' texto}) ou None."""
+    return SERIES_BCB.ultimo(serie_id, janela_dias)
+
+def obter_metricas_series_bcb():
+    return SERIES_BCB.metricas()
+
+# ==================== PROVENTOS (eventos locais) ====================
+# Dividendos vêm da tabela `proventos` do OHLCV_STORE (mesma fonte do
+# `Ticker.dividends`), atualizada de forma incremental pela cauda das barras.
+# Os tickers já consultados neste processo são mantidos em dia por uma thread
+# (PROVENTOS_SYNC_S); o cálculo por usuário é um merge_asof contra as posições
+# reconstruídas das movimentações, sem ir à rede por requisição.
+
+_PROVENTOS_SYNC_S = float(os.getenv('PROVENTOS_SYNC_S', '21600'))
+_PROVENTOS_TICKERS = set()
+_PROVENTOS_THREAD_PID = None
+_PROVENTOS_THREAD_LOCK = threading.Lock()
+
+def _loop_sync_proventos():
+    while True:
+        time.sleep(_PROVENTOS_SYNC_S)
+        for ticker in sorted(_PROVENTOS_TICKERS):
+            OHLCV_STORE.sincronizar(ticker)
+
+def _garantir_sync_proventos():
+    global _PROVENTOS_THREAD_PID
+    pid = os.getpid()
+    if _PROVENTOS_THREAD_PID == pid:
+        return
+    with _PROVENTOS_THREAD_LOCK:
+        if _PROVENTOS_THREAD_PID == pid:
+            return
+        _PROVENTOS_THREAD_PID = pid
+    threading.Thread(target=_loop_sync_proventos, name='proventos-sync', daemon=True).start()
+
+def obter_proventos_tickers(tickers, data_inicio=None, should_cancel=None):
+    """
+    DataFrame (ticker, data_ex, valor) com os dividendos de `tickers` (como
+    vieram, ex.: 'PETR4'), a partir de `data_inicio`. Sincroniza antes só o
+    que estiver desatualizado no store (histórico completo na 1ª vez).
+    """
+    por_yf = {}
+    for t in tickers or []:
+        if t and not is_crypto_ticker(t):
+            por_yf.setdefault(_ticker_yf_b3(t).strip().upper(), []).append(t)
+    if not por_yf:
+        return pd.DataFrame(columns=["ticker", "data_ex", "valor"])
+    _PROVENTOS_TICKERS.update(por_yf)
+    _garantir_sync_proventos()
+    max_workers = min(len(por_yf), YF_MAX_CONCURRENT)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    cancelado = False
+    try:
+        futures = [executor.submit(OHLCV_STORE.sincronizar, t) for t in por_yf]
+        for fut in as_completed(futures):
+            if callable(should_cancel) and should_cancel():
+                cancelado = True
+                break
+    finally:
+        # no cancelamento, as sincronizações ainda na fila não chegam a rodar
+        executor.shutdown(wait=not cancelado, cancel_futures=cancelado)
+    if cancelado:
+        return pd.DataFrame(columns=["ticker", "data_ex", "valor"])
+    eventos = OHLCV_STORE.proventos(list(por_yf), data_inicio)
+    # volta para o ticker original (um ticker yf pode vir escrito de mais de um jeito)
+    eventos["ticker"] = eventos["ticker"].map(por_yf)
+    return eventos.explode("ticker", ignore_index=True)
+
+def obter_nome_ativo_yf(ticker):
+    """longName do yfinance (grupo 'cadastro' do QUOTE_STORE, 7 dias)."""
+    ticker_yf = _ticker_yf_b3(ticker)
+    try:
+        return obter_info_yf(ticker_yf, 'cadastro').get('longName') or ticker_yf
+    except Exception:
+        return ticker_yf
+
+def _data_inicio_periodo_proventos(periodo):
+    if periodo == 'total':
+        return None
+    hoje = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if periodo == 'mes':
+        return hoje.replace(day=1)
+    dias = {'6meses': 180, '1ano': 365, '5anos': 365 * 5}.get(periodo)
+    return hoje - timedelta(days=dias) if dias else None
+
+def _posicoes_movimentacoes():
+    """DataFrame (ticker, data, quantidade) com a posição ao fim de cada dia com movimentação (ledger de posições)."""
+    df = pd.DataFrame(_ler_posicoes_ledger(), columns=['data', 'ticker', 'quantidade'])
+    if df.empty:
+        return pd.DataFrame(columns=['ticker', 'data']).assign(quantidade=pd.Series(dtype=float))
+    df['data'] = pd.to_datetime(df['data'].astype(str).str[:10])
+    df['quantidade'] = df['quantidade'].astype(float).clip(lower=0)
+    return df[['ticker', 'data', 'quantidade']]
+
+def calcular_proventos_recebidos(periodo='total', should_cancel=None):
+    """
+    Proventos recebidos pela carteira do usuário atual no período.
+
+    Para tickers com movimentações, a quantidade de cada provento é a posição
+    na véspera da data ex (merge_asof contra as posições acumuladas); para os
+    que só existem na carteira, a quantidade atual a partir da data de
+    adição. Retorna (resultado, interrompido) — interrompido=True quando
+    `should_cancel()` parou a sincronização.
+    """
+    carteira = obter_carteira()
+    if not carteira:
+        return [], False
+    data_inicio = _data_inicio_periodo_proventos(periodo)
+    ativos = {a.get('ticker'): a for a in carteira if a.get('ticker')}
+    eventos = obter_proventos_tickers(list(ativos), data_inicio, should_cancel)
+    if callable(should_cancel) and should_cancel():
+        return [], True
+    if eventos.empty:
+        return [], False
+
+    posicoes = _posicoes_movimentacoes()
+    com_mov = set(posicoes['ticker']) if not posicoes.empty else set()
+    eventos = eventos.sort_values('data_ex', kind='stable')
+
+    partes = []
+    ev_mov = eventos[eventos['ticker'].isin(com_mov)]
+    if not ev_mov.empty:
+        ev_mov = pd.merge_asof(
+            ev_mov, posicoes, left_on='data_ex', right_on='data', by='ticker',
+            direction='backward', allow_exact_matches=False,
+        )
+        partes.append(ev_mov[['ticker', 'data_ex', 'valor', 'quantidade']])
+    ev_cart = eventos[~eventos['ticker'].isin(com_mov)].copy()
+    if not ev_cart.empty:
+        adicao = pd.to_datetime(
+            ev_cart['ticker'].map(lambda t: str(ativos[t].get('data_adicao') or '')[:10]), errors='coerce'
+        )
+        qtd = ev_cart['ticker'].map(lambda t: float(ativos[t].get('quantidade') or 0))
+        ev_cart['quantidade'] = qtd.where(adicao.isna() | (ev_cart['data_ex'] >= adicao), 0.0)
+        partes.append(ev_cart[['ticker', 'data_ex', 'valor', 'quantidade']])
+
+    recebidos = pd.concat(partes, ignore_index=True) if partes else eventos.iloc[0:0]
+    recebidos = recebidos[recebidos['quantidade'].fillna(0) > 0]
+    if recebidos.empty:
+        return [], False
+    recebidos = recebidos.assign(valor_recebido=recebidos['valor'] * recebidos['quantidade'])
+
+    primeira_compra = {}
+    if not posicoes.empty:
+        primeira_compra = posicoes.groupby('ticker')['data'].min().dt.strftime('%Y-%m-%d').to_dict()
+    resultado = []
+    for ticker, grupo in recebidos.groupby('ticker', sort=False):
+        ativo = ativos[ticker]
+        proventos = [
+            {
+                'data': d.strftime('%Y-%m-%d'),
+                'valor_unitario': float(v),
+                'quantidade': float(q),
+                'valor_recebido': float(r),
+                'tipo': 'Dividendo',
+            }
+            for d, v, q, r in zip(grupo['data_ex'], grupo['valor'], grupo['quantidade'], grupo['valor_recebido'])
+        ]
+        resultado.append({
+            'ticker': ticker,
+            'nome': obter_nome_ativo_yf(ticker),
+            'quantidade_carteira': ativo.get('quantidade'),
+            'data_aquisicao': primeira_compra.get(ticker) or ativo.get('data_adicao'),
+            'proventos_recebidos': proventos,
+            'total_recebido': float(grupo['valor_recebido'].sum()),
+        })
+    return resultado, False
+
 def _aplicar_pragmas_sqlite(db_path):
     try:
         conn = sqlite3.connect(db_path, timeout=30)
@@ -1703,7 +2403,7 @@ def ativar_wal_em_todos_os_bancos():
         if USUARIOS_DB_PATH and os.path.exists(USUARIOS_DB_PATH):
             if _aplicar_pragmas_sqlite(USUARIOS_DB_PATH):
                 contagem += 1
-        bancos_dir = os.path.join(_base_dir, "bancos_usuarios")
+        bancos_dir = _bancos_usuarios_root()
         if os.path.isdir(bancos_dir):
             for root, _dirs, files in os.walk(bancos_dir):
                 for fname in files:
@@ -1797,10 +2497,9 @@ def obter_preco_historico(ticker, data, max_retentativas=3):
             ticker_yf = ticker.strip().upper()
             if '-' not in ticker_yf and '.' not in ticker_yf and len(ticker_yf) <= 6:
                 ticker_yf += '.SA'
-            acao = yf.Ticker(ticker_yf)
             start_date = data_obj - timedelta(days=30)
             end_date = data_obj + timedelta(days=1)
-            historico = acao.history(start=start_date.isoformat(), end=end_date.isoformat())
+            historico = obter_historico_diario(ticker_yf, start_date, end_date)
             if historico is None or historico.empty:
                 print(f"[ERRO] Nenhum historico encontrado para {ticker}")
                 return None
@@ -1839,6 +2538,84 @@ def obter_preco_historico(ticker, data, max_retentativas=3):
     
     return None
 
+def _ticker_yf_b3(ticker):
+    t = (ticker or '').strip().upper()
+    if '-' not in t and '.' not in t and len(t) <= 6:
+        t += '.SA'
+    return t
+
+def precos_em_datas(pares, janela_dias=30):
+    """
+    Último fechamento em ou antes de cada data, para muitos (ticker, data) de uma vez.
+
+    Os pedidos são agrupados por ticker: uma leitura do OHLCV_STORE cobrindo
+    [menor data - janela_dias, maior data] por ticker e, para cada data, um
+    `searchsorted` no índice ordenado. Fechamentos a mais de `janela_dias`
+    antes da data não contam (mesma janela de obter_preco_historico).
+    Cripto continua em obter_preco_historico (Binance + BRL=X).
+
+    Retorna uma lista alinhada com `pares`: dict como o de
+    obter_preco_historico ({"preco", "data_historico", "data_solicitada",
+    "ticker"}) ou None.
+    """
+    import numpy as np
+
+    pares = list(pares or [])
+    resultados = [None] * len(pares)
+    por_ticker = {}
+    for i, (ticker, data) in enumerate(pares):
+        if isinstance(data, datetime):
+            data_obj = data.date()
+        elif hasattr(data, 'year'):
+            data_obj = data
+        else:
+            try:
+                data_obj = datetime.strptime(str(data)[:10], '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                continue
+        if not ticker:
+            continue
+        por_ticker.setdefault(str(ticker).strip(), []).append((i, data_obj))
+
+    def resolver(ticker, pedidos):
+        if is_crypto_ticker(ticker):
+            return [(i, obter_preco_historico(ticker, d.isoformat())) for i, d in pedidos]
+        datas = [d for _, d in pedidos]
+        hist = obter_historico_diario(_ticker_yf_b3(ticker), min(datas) - timedelta(days=janela_dias), max(datas) + timedelta(days=1))
+        if hist is None or hist.empty or 'Close' not in hist.columns:
+            return [(i, None) for i, _ in pedidos]
+        fechamentos = hist['Close'].to_numpy(dtype=float)
+        validos = np.isfinite(fechamentos) & (fechamentos > 0)
+        fechamentos = fechamentos[validos]
+        dias = hist.index.to_numpy(dtype='datetime64[D]')[validos]
+        alvos = np.array(datas, dtype='datetime64[D]')
+        pos = np.searchsorted(dias, alvos, side='right') - 1
+        saida = []
+        for (i, d), p, alvo in zip(pedidos, pos, alvos):
+            if p < 0 or (alvo - dias[p]).astype(int) > janela_dias:
+                saida.append((i, None))
+                continue
+            saida.append((i, {
+                "preco": float(fechamentos[p]),
+                "data_historico": str(dias[p]),
+                "data_solicitada": d.isoformat(),
+                "ticker": ticker,
+            }))
+        return saida
+
+    if not por_ticker:
+        return resultados
+    max_workers = min(len(por_ticker), YF_MAX_CONCURRENT)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(resolver, t, pedidos): t for t, pedidos in por_ticker.items()}
+        for fut in as_completed(futures):
+            try:
+                for i, res in fut.result():
+                    resultados[i] = res
+            except Exception as e:
+                print(f"[AVISO] precos_em_datas: {futures[fut]} falhou: {e}")
+    return resultados
+
 def obter_preco_atual(ticker, max_retentativas=3):
 
     tentativas = 0
@@ -1863,8 +2640,7 @@ def obter_preco_atual(ticker, max_retentativas=3):
             ticker_yf = ticker.strip().upper()
             if '-' not in ticker_yf and '.' not in ticker_yf and len(ticker_yf) <= 6:
                 ticker_yf += '.SA'
-            acao = yf.Ticker(ticker_yf)
-            info = acao.info
+            info = obter_info_yf(ticker_yf)
             if not info:
                 return None
             preco_atual = info.get("currentPrice")
@@ -1909,8 +2685,7 @@ def obter_informacoes(ticker, tipo_ativo):
 
     try:
         print(f"[YF] Buscando informacoes para {ticker}...")
-        acao = yf.Ticker(ticker)
-        info = acao.info
+        info = obter_info_yf(ticker, 'fundamentos')
 
         if not info:
             return None
@@ -1973,37 +2748,37 @@ def obter_informacoes(ticker, tipo_ativo):
     except Exception as e:
         print(f" Erro ao obter informações para {ticker}: {e}")
         return None
-def aplicar_filtros_acoes(dados):
+# Filtros do screener como "spec" de screener_colunar: lista de (coluna, operador, valor).
+# Os pisos (`x or 0`) repetem o comportamento original: sem dy_min ainda exige dy > 0 etc.
+def spec_filtros_acoes(roe_min, dy_min, pl_min, pl_max, pvp_max, liq_min=None, setor=None):
+    return [
+        ('roe', '>=', roe_min or 0),
+        ('dividend_yield', '>', dy_min or 0),
+        ('pl', 'entre', (pl_min or 0, pl_max or float('inf'))),
+        ('pvp', '<=', pvp_max or float('inf')),
+        ('liquidez_diaria', '>', liq_min or 0),
+        ('setor', '==', setor),
+    ]
 
-    return sorted([
-        ativo for ativo in dados if (
-            ativo['roe'] >= 15 and
-            ativo['dividend_yield'] > 12 and
-            1 <= ativo['pl'] <= 15 and
-            ativo['pvp'] <= 2
-        )
-    ], key=lambda x: x['dividend_yield'], reverse=True)[:10]
+def spec_filtros_fiis(dy_min, dy_max, liq_min):
+    return [
+        ('dividend_yield', 'entre', (dy_min or 0, dy_max or float('inf'))),
+        ('liquidez_diaria', '>', liq_min or 0),
+    ]
 
+def aplicar_filtros_acoes(dados):
+    spec = [('roe', '>=', 15), ('dividend_yield', '>', 12), ('pl', 'entre', (1, 15)), ('pvp', '<=', 2)]
+    return TabelaColunar.de_registros(dados).filtrar(spec, 'dividend_yield', limite=10)
 
-def aplicar_filtros_bdrs(dados):
 
-    return sorted([
-        ativo for ativo in dados if (
-            ativo['roe'] >= 15 and
-            ativo['dividend_yield'] > 3 and
-            1 <= ativo['pl'] <= 15 and
-            ativo['pvp'] <= 3
-        )
-    ], key=lambda x: x['dividend_yield'], reverse=True)[:10]
+def aplicar_filtros_bdrs(dados):
+    spec = [('roe', '>=', 15), ('dividend_yield', '>', 3), ('pl', 'entre', (1, 15)), ('pvp', '<=', 3)]
+    return TabelaColunar.de_registros(dados).filtrar(spec, 'dividend_yield', limite=10)
 
 
 def aplicar_filtros_fiis(dados):
-    return sorted([
-        ativo for ativo in dados if (
-            12 <= ativo['dividend_yield'] <= 15 and
-            ativo.get("liquidez_diaria", 0) > 1000_000
-        )
-    ], key=lambda x: x['dividend_yield'], reverse=True)[:10]
+    spec = [('dividend_yield', 'entre', (12, 15)), ('liquidez_diaria', '>', 1000_000)]
+    return TabelaColunar.de_registros(dados).filtrar(spec, 'dividend_yield', limite=10)
 
 
 
@@ -2077,8 +2852,8 @@ def obter_todas_informacoes(ticker):
     try:
         acao = yf.Ticker(ticker)
         print(f"Obtendo informações brutas para {ticker}...")
-        info = acao.info
-        historico = acao.history(period="max")
+        info = obter_info_yf(ticker, 'fundamentos')
+        historico = LIMITADOR.executar('yahoo', lambda: acao.history(period="max"))
 
         return {
             "info": info if info else {},
@@ -2148,11 +2923,15 @@ def criar_tabela_usuarios():
                     c.execute('ALTER TABLE public.usuarios ADD COLUMN IF NOT EXISTS allowed_screens TEXT')
                 except Exception:
                     pass
+                # Carimbo do mapeamento usuário -> storage (ver _invalidar_cache_storage_usuario)
+                c.execute('CREATE TABLE IF NOT EXISTS public.storage_versao (id INTEGER PRIMARY KEY, versao INTEGER NOT NULL)')
+                c.execute('CREATE TABLE IF NOT EXISTS public.dados_invalidados (chave TEXT PRIMARY KEY, geracao INTEGER NOT NULL)')
+                c.execute('CREATE INDEX IF NOT EXISTS idx_dados_invalidados_geracao ON public.dados_invalidados(geracao)')
                 conn.commit()
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS usuarios (
@@ -2203,6 +2982,11 @@ def criar_tabela_usuarios():
             conn.commit()
         except sqlite3.OperationalError:
             pass
+        # Carimbo do mapeamento usuário -> storage (ver _invalidar_cache_storage_usuario)
+        c.execute('CREATE TABLE IF NOT EXISTS storage_versao (id INTEGER PRIMARY KEY, versao INTEGER NOT NULL)')
+        c.execute('CREATE TABLE IF NOT EXISTS dados_invalidados (chave TEXT PRIMARY KEY, geracao INTEGER NOT NULL)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_dados_invalidados_geracao ON dados_invalidados(geracao)')
+        conn.commit()
 
         conn.close()
 
@@ -2239,7 +3023,7 @@ def cadastrar_usuario(nome, username, senha, pergunta_seguranca=None, resposta_s
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             c.execute('''INSERT INTO usuarios (nome, username, senha_hash, pergunta_seguranca, resposta_seguranca_hash, data_cadastro, email, role, auth_provider, allowed_screens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
@@ -2281,7 +3065,7 @@ def buscar_usuario_por_username(username):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         # Buscar todos os campos, incluindo role, email e auth_provider
         c.execute('''
@@ -2349,7 +3133,7 @@ def listar_usuarios_por_email(email):
                 return [_usuario_dict_from_row(r) for r in rows]
         finally:
             conn.close()
-    conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(USUARIOS_DB_PATH)
     try:
         c = conn.cursor()
         c.execute('''
@@ -2391,10 +3175,12 @@ def vincular_email_usuario(username, email):
                     ''',
                     (email_val, username),
                 )
+            conn.commit()
         finally:
             conn.close()
+        _invalidar_cache_storage_usuario(propagar=True)
         return
-    conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(USUARIOS_DB_PATH)
     try:
         c = conn.cursor()
         c.execute(
@@ -2413,6 +3199,7 @@ def vincular_email_usuario(username, email):
         conn.commit()
     finally:
         conn.close()
+    _invalidar_cache_storage_usuario(propagar=True)
 
 
 def criar_usuario_google(nome, email, google_id=None):
@@ -2454,7 +3241,7 @@ def criar_usuario_google(nome, email, google_id=None):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             c.execute('''INSERT INTO usuarios (nome, username, senha_hash, pergunta_seguranca, resposta_seguranca_hash, data_cadastro, email, role, auth_provider, allowed_screens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
@@ -2499,7 +3286,7 @@ def alterar_senha_direta(username, nova_senha):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             c.execute('UPDATE usuarios SET senha_hash = ? WHERE username = ?', (nova_senha_hash, username))
@@ -2527,7 +3314,7 @@ def atualizar_pergunta_seguranca(username, pergunta, resposta):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             resposta_hash = bcrypt.hashpw(resposta.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -2541,31 +3328,137 @@ def atualizar_pergunta_seguranca(username, pergunta, resposta):
         finally:
             conn.close()
 
-def processar_ativos_com_filtros_geral(
-    lista_ativos,
-    tipo_ativo,
-    roe_min,
-    dy_min,
-    pl_min,
-    pl_max,
-    pvp_max,
-    liq_min=None,
-    setor=None,
-    should_cancel=None,
-):
-    """Processa lista de ativos com filtros. Requisições em paralelo ao yfinance para evitar timeout (504); retorna todos os ativos filtrados."""
-    if not lista_ativos:
-        return []
+# ==================== UNIVERSO DO SCREENER (snapshot) ====================
+# /api/analise/ativos buscava o .info de TODAS as ações/BDRs/FIIs das listas a
+# cada combinação de filtros, só para filtrar em Python depois. Agora cada
+# lista tem um snapshot (ticker, roe, dy, pl, pvp, liquidez, setor, tipo, ...)
+# no SQLite compartilhado (_STORE_DIR/universo.db), espelhado em memória em
+# cada worker. Uma thread renova o snapshot a cada UNIVERSO_REFRESH_S; uma
+# "lease" na tabela de snapshots garante um único worker recalculando por vez.
+# Filtrar vira uma varredura em memória de algumas centenas de dicts.
+
+_UNIVERSO_TIPOS = {'Ação': 'acoes', 'BDR': 'bdrs', 'FII': 'fiis'}
+_UNIVERSO_DB = os.path.join(_STORE_DIR, 'universo.db')
+_UNIVERSO_REFRESH_S = float(os.getenv('UNIVERSO_REFRESH_S', '3600'))
+_UNIVERSO_LEASE_S = 900.0
+_UNIVERSO_MEM = {}  # lista -> (versao, [ativos], TabelaColunar)
+_UNIVERSO_MEM_CHECADO = {}  # lista -> time.monotonic() da última checagem de versão
+_UNIVERSO_LOCKS = {lista: threading.Lock() for lista in _UNIVERSO_TIPOS.values()}
+_UNIVERSO_TABELAS_OK = False
+_UNIVERSO_THREAD_PID = None
+_UNIVERSO_THREAD_LOCK = threading.Lock()
+
+def _universo_tickers(lista):
+    return {'acoes': LISTA_ACOES, 'bdrs': LISTA_BDRS, 'fiis': LISTA_FIIS}[lista]
+
+def _universo_tipo_ativo(lista):
+    return next(t for t, l in _UNIVERSO_TIPOS.items() if l == lista)
+
+def _universo_conn():
+    global _UNIVERSO_TABELAS_OK
+    conn = _sqlite_connect(_UNIVERSO_DB)
+    if not _UNIVERSO_TABELAS_OK:
+        cur = conn.cursor()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS universo_ativos (
+                lista TEXT NOT NULL,
+                ticker TEXT NOT NULL,
+                tipo TEXT,
+                setor TEXT,
+                roe REAL,
+                dy REAL,
+                pl REAL,
+                pvp REAL,
+                liquidez REAL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (lista, ticker)
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS universo_snapshots (
+                lista TEXT PRIMARY KEY,
+                versao REAL NOT NULL DEFAULT 0,
+                n_ativos INTEGER,
+                duracao_s REAL,
+                lease_pid INTEGER,
+                lease_expira REAL
+            )
+        ''')
+        conn.commit()
+        _UNIVERSO_TABELAS_OK = True
+    return conn
 
-    # Paralelizar para concluir em tempo hábil (evitar 504 em proxy/load balancer)
+def _universo_versao(lista):
+    conn = _universo_conn()
+    try:
+        row = conn.execute('SELECT versao FROM universo_snapshots WHERE lista = ?', (lista,)).fetchone()
+    finally:
+        conn.close()
+    return float(row[0]) if row and row[0] else None
+
+def _universo_carregar(lista, forcar=False):
+    """(versao, ativos) do snapshot; relê o SQLite só se outro worker publicou versão nova (checa a cada 5s)."""
+    agora = time.monotonic()
+    mem = _UNIVERSO_MEM.get(lista)
+    if mem and not forcar and agora - _UNIVERSO_MEM_CHECADO.get(lista, 0.0) < 5.0:
+        return mem
+    versao = _universo_versao(lista)
+    _UNIVERSO_MEM_CHECADO[lista] = agora
+    if versao is None:
+        return None
+    if mem and mem[0] == versao:
+        return mem
+    conn = _universo_conn()
+    try:
+        rows = conn.execute('SELECT payload FROM universo_ativos WHERE lista = ?', (lista,)).fetchall()
+    finally:
+        conn.close()
+    ativos = [json.loads(r[0]) for r in rows]
+    mem = (versao, ativos, TabelaColunar.de_registros(ativos))
+    _UNIVERSO_MEM[lista] = mem
+    return mem
+
+def _universo_pegar_lease(lista):
+    agora = time.time()
+    conn = _universo_conn()
+    try:
+        conn.execute('INSERT OR IGNORE INTO universo_snapshots (lista, versao) VALUES (?, 0)', (lista,))
+        cur = conn.execute(
+            '''UPDATE universo_snapshots SET lease_pid = ?, lease_expira = ?
+               WHERE lista = ? AND (lease_expira IS NULL OR lease_expira < ?)''',
+            (os.getpid(), agora + _UNIVERSO_LEASE_S, lista, agora),
+        )
+        conn.commit()
+        return cur.rowcount > 0
+    finally:
+        conn.close()
+
+def _universo_soltar_lease(lista):
+    conn = _universo_conn()
+    try:
+        conn.execute(
+            'UPDATE universo_snapshots SET lease_pid = NULL, lease_expira = NULL WHERE lista = ? AND lease_pid = ?',
+            (lista, os.getpid()),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def _buscar_informacoes_paralelo(tickers, tipo_ativo, should_cancel=None, ao_concluir=None):
+    """
+    obter_informacoes de cada ticker em paralelo. Retorna None se cancelado.
+    `ao_concluir(resultado, processados, total)` é chamado a cada ticker
+    concluído (resultado None quando o ticker falhou ou foi ignorado).
+    """
     dados = []
-    max_workers = min(len(lista_ativos), 40)
+    processados = 0
+    max_workers = min(len(tickers), UPSTREAM_MAX_THREADS)
     client_gone = False
     executor = ThreadPoolExecutor(max_workers=max_workers)
     try:
         future_to_ticker = {
             executor.submit(obter_informacoes, ticker, tipo_ativo): ticker
-            for ticker in lista_ativos
+            for ticker in tickers
         }
         pending = set(future_to_ticker.keys())
         while pending:
@@ -2574,6 +3467,7 @@ def processar_ativos_com_filtros_geral(
                 break
             done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
             for future in done:
+                resultado = None
                 try:
                     resultado = future.result()
                     if resultado is not None:
@@ -2581,6 +3475,9 @@ def processar_ativos_com_filtros_geral(
                 except Exception as e:
                     ticker = future_to_ticker[future]
                     print(f"Erro ao processar {ticker}: {str(e)}")
+                processados += 1
+                if ao_concluir is not None:
+                    ao_concluir(resultado, processados, len(future_to_ticker))
     finally:
         if client_gone:
             try:
@@ -2589,19 +3486,154 @@ def processar_ativos_com_filtros_geral(
                 executor.shutdown(wait=False)
         else:
             executor.shutdown(wait=True)
+    return None if client_gone else dados
+
+def _sobrepor_fechamentos(dados, fechamentos):
+    """Preço e liquidez do último fechamento em lote por cima do fetch por ticker."""
+    for d in dados:
+        preco = fechamentos.get(str(d['ticker']).upper())
+        if preco:
+            d['preco_atual'] = preco
+            d['liquidez_diaria'] = preco * (d.get('volume_medio') or 0)
+
+def atualizar_universo_screener(lista, should_cancel=None, ao_concluir=None, fechamentos=None):
+    """
+    Recalcula e publica o snapshot de `lista` ('acoes' | 'bdrs' | 'fiis').
+    Retorna o nº de ativos, ou None se outro worker já está recalculando ou
+    se `should_cancel()` interrompeu. `ao_concluir` segue para
+    _buscar_informacoes_paralelo (progresso do cálculo). `fechamentos`
+    ({TICKER: preço}) evita buscar de novo os fechamentos que o chamador já tem.
+    """
+    if not _universo_pegar_lease(lista):
+        return None
+    try:
+        inicio = time.time()
+        tipo_ativo = _universo_tipo_ativo(lista)
+        tickers = _universo_tickers(lista)
+        dados = _buscar_informacoes_paralelo(tickers, tipo_ativo, should_cancel, ao_concluir)
+        if dados is None:
+            return None
+        # Fundamentos podem vir do QUOTE_STORE com até QUOTE_TTL_FUNDAMENTOS de idade;
+        # preço e liquidez saem do último fechamento, em lote
+        if fechamentos is None:
+            fechamentos = _ultimos_fechamentos_yf(sorted({str(d['ticker']).upper() for d in dados}))
+        _sobrepor_fechamentos(dados, fechamentos)
+        versao = time.time()
+        conn = _universo_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM universo_ativos WHERE lista = ?', (lista,))
+            cur.executemany(
+                '''INSERT INTO universo_ativos (lista, ticker, tipo, setor, roe, dy, pl, pvp, liquidez, payload)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                [
+                    (lista, d['ticker'], d.get('tipo'), d.get('setor'), d.get('roe'), d.get('dividend_yield'),
+                     d.get('pl'), d.get('pvp'), d.get('liquidez_diaria'), json.dumps(d, default=str))
+                    for d in dados
+                ],
+            )
+            cur.execute(
+                '''UPDATE universo_snapshots SET versao = ?, n_ativos = ?, duracao_s = ?, lease_pid = NULL, lease_expira = NULL
+                   WHERE lista = ?''',
+                (versao, len(dados), round(versao - inicio, 1), lista),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        _UNIVERSO_MEM[lista] = (versao, dados, TabelaColunar.de_registros(dados))
+        _UNIVERSO_MEM_CHECADO[lista] = time.monotonic()
+        print(f"[universo] {lista}: {len(dados)}/{len(tickers)} ativos em {versao - inicio:.1f}s")
+        return len(dados)
+    finally:
+        try:
+            _universo_soltar_lease(lista)
+        except Exception:
+            pass
+
+def _loop_refresh_universo():
+    while True:
+        time.sleep(60)
+        for lista in _UNIVERSO_TIPOS.values():
+            try:
+                versao = _universo_versao(lista)
+                # só listas já usadas (com snapshot) são mantidas quentes
+                if versao and time.time() - versao > _UNIVERSO_REFRESH_S:
+                    atualizar_universo_screener(lista)
+            except Exception as e:
+                print(f"[universo] erro ao renovar {lista}: {e}")
+
+def _garantir_refresher_universo():
+    global _UNIVERSO_THREAD_PID
+    pid = os.getpid()
+    if _UNIVERSO_THREAD_PID == pid:
+        return
+    with _UNIVERSO_THREAD_LOCK:
+        if _UNIVERSO_THREAD_PID == pid:
+            return
+        _UNIVERSO_THREAD_PID = pid
+    threading.Thread(target=_loop_refresh_universo, name='universo-refresh', daemon=True).start()
+
+def _universo_snapshot(tipo_ativo, should_cancel=None):
+    lista = _UNIVERSO_TIPOS[tipo_ativo]
+    _garantir_refresher_universo()
+    mem = _universo_carregar(lista)
+    if mem:
+        return mem
+    with _UNIVERSO_LOCKS[lista]:
+        while True:
+            mem = _universo_carregar(lista, forcar=True)
+            if mem:
+                return mem
+            if callable(should_cancel) and should_cancel():
+                return (None, [], TabelaColunar.de_registros([]))
+            if atualizar_universo_screener(lista, should_cancel) is None:
+                time.sleep(1.0)
+
+def obter_universo_screener(tipo_ativo, should_cancel=None):
+    """
+    Ativos do snapshot de `tipo_ativo` ('Ação' | 'BDR' | 'FII'). Os dicts são
+    compartilhados: copie antes de alterar. Na primeira vez (sem snapshot) o
+    cálculo roda nesta chamada, ou espera o worker que já está calculando.
+    """
+    return _universo_snapshot(tipo_ativo, should_cancel)[1]
+
+def obter_tabela_universo(tipo_ativo, should_cancel=None):
+    """Mesmo snapshot de obter_universo_screener, em colunas (screener_colunar.TabelaColunar)."""
+    return _universo_snapshot(tipo_ativo, should_cancel)[2]
+
+def obter_metricas_universo():
+    out = {}
+    for lista in _UNIVERSO_TIPOS.values():
+        mem = _UNIVERSO_MEM.get(lista)
+        out[lista] = {
+            "ativos": len(mem[1]) if mem else 0,
+            "idade_s": round(time.time() - mem[0], 1) if mem else None,
+        }
+    return out
+
+def processar_ativos_com_filtros_geral(
+    lista_ativos,
+    tipo_ativo,
+    roe_min,
+    dy_min,
+    pl_min,
+    pl_max,
+    pvp_max,
+    liq_min=None,
+    setor=None,
+    should_cancel=None,
+):
+    """Filtra o snapshot do universo (obter_universo_screener); retorna todos os ativos filtrados."""
+    if not lista_ativos:
+        return []
+
+    if tipo_ativo in _UNIVERSO_TIPOS:
+        tabela = obter_tabela_universo(tipo_ativo, should_cancel)
+    else:
+        tabela = TabelaColunar.de_registros(_buscar_informacoes_paralelo(lista_ativos, tipo_ativo, should_cancel) or [])
 
-    filtrados = [
-        ativo for ativo in dados if (
-            ativo['roe'] >= (roe_min or 0) and
-            ativo['dividend_yield'] > (dy_min or 0) and
-            (pl_min or 0) <= ativo['pl'] <= (pl_max or float('inf')) and
-            ativo['pvp'] <= (pvp_max or float('inf')) and
-            (ativo.get('liquidez_diaria', 0) > (liq_min or 0)) and
-            (not setor or ativo.get('setor', '').strip() == setor.strip())
-        )
-    ]
     # Retornar todos os ativos filtrados (lista completa), ordenados por dividend_yield
-    return sorted(filtrados, key=lambda x: x['dividend_yield'], reverse=True)
+    return tabela.filtrar(spec_filtros_acoes(roe_min, dy_min, pl_min, pl_max, pvp_max, liq_min, setor), 'dividend_yield')
 
 def processar_ativos_acoes_com_filtros(
     roe_min,
@@ -2653,97 +3685,178 @@ def processar_ativos_bdrs_com_filtros(
         should_cancel=should_cancel,
     )
 
-def processar_ativos_fiis_com_filtros(dy_min, dy_max, liq_min, tipo_fii=None, segmento_fii=None, should_cancel=None):
-    """Processa lista de FIIs com filtros. Requisições em paralelo ao yfinance; retorna todos os FIIs filtrados."""
-    fiis = LISTA_FIIS
-    if not fiis:
-        return []
-
-    dados = []
-    max_workers = min(len(fiis), 40)
-    client_gone = False
-    executor = ThreadPoolExecutor(max_workers=max_workers)
+def _aplicar_metadata_fii(ativo, tipo_fii, segmento_fii, metadata_por_ticker=None):
+    """
+    Preenche tipo_fii/segmento_fii (FundsExplorer) em `ativo` e diz se ele passa
+    nos filtros de tipo/segmento. `metadata_por_ticker` evita buscar o mesmo
+    FII duas vezes na mesma análise.
+    """
+    ticker = ativo.get('ticker', '')
     try:
-        future_to_ticker = {
-            executor.submit(obter_informacoes, ticker, 'FII'): ticker
-            for ticker in fiis
-        }
-        pending = set(future_to_ticker.keys())
-        while pending:
-            if callable(should_cancel) and should_cancel():
-                client_gone = True
-                break
-            done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
-            for future in done:
-                try:
-                    resultado = future.result()
-                    if resultado is not None:
-                        dados.append(resultado)
-                except Exception as e:
-                    ticker = future_to_ticker[future]
-                    print(f"Erro ao processar FII {ticker}: {str(e)}")
-    finally:
-        if client_gone:
-            try:
-                executor.shutdown(wait=False, cancel_futures=True)
-            except TypeError:
-                executor.shutdown(wait=False)
+        if metadata_por_ticker is not None and ticker in metadata_por_ticker:
+            metadata = metadata_por_ticker[ticker]
         else:
-            executor.shutdown(wait=True)
+            from fii_scraper import obter_dados_fii_fundsexplorer
+            metadata = obter_dados_fii_fundsexplorer(ticker)
+            if metadata_por_ticker is not None:
+                metadata_por_ticker[ticker] = metadata
+    except Exception:
+        metadata = None
 
-    filtrados = [
-        ativo for ativo in dados if (
-            ativo['dividend_yield'] >= (dy_min or 0) and
-            ativo['dividend_yield'] <= (dy_max or float('inf')) and
-            ativo.get('liquidez_diaria', 0) > (liq_min or 0)
-        )
-    ]
+    if metadata:
+        ativo_tipo = metadata.get('tipo')
+        ativo_segmento = metadata.get('segmento')
 
-    if tipo_fii or segmento_fii:
-        filtrados_final = []
-        for ativo in filtrados:
-            ticker = ativo.get('ticker', '')
+        if tipo_fii and ativo_tipo != tipo_fii:
+            return False
 
-            try:
-                from fii_scraper import obter_dados_fii_fundsexplorer
-                metadata = obter_dados_fii_fundsexplorer(ticker)
+        if segmento_fii and ativo_segmento != segmento_fii:
+            return False
+
+        # Adicionar metadados ao ativo
+        ativo['tipo_fii'] = ativo_tipo
+        ativo['segmento_fii'] = ativo_segmento
+        return True
 
-                if metadata:
-                    ativo_tipo = metadata.get('tipo')
-                    ativo_segmento = metadata.get('segmento')
+    # Sem metadados (ou erro): incluir apenas se não há filtros específicos
+    if not tipo_fii and not segmento_fii:
+        ativo['tipo_fii'] = None
+        ativo['segmento_fii'] = None
+        return True
+    return False
 
-                    if tipo_fii and ativo_tipo != tipo_fii:
-                        continue
+def processar_ativos_fiis_com_filtros(dy_min, dy_max, liq_min, tipo_fii=None, segmento_fii=None, should_cancel=None):
+    """Filtra o snapshot de FIIs (obter_universo_screener); retorna todos os FIIs filtrados."""
+    fiis = LISTA_FIIS
+    if not fiis:
+        return []
 
-                    if segmento_fii and ativo_segmento != segmento_fii:
-                        continue
+    tabela = obter_tabela_universo('FII', should_cancel)
+    filtrados = tabela.filtrar(spec_filtros_fiis(dy_min, dy_max, liq_min), 'dividend_yield')
 
-                    # Adicionar metadados ao ativo
-                    ativo['tipo_fii'] = ativo_tipo
-                    ativo['segmento_fii'] = ativo_segmento
+    if tipo_fii or segmento_fii:
+        filtrados = [ativo for ativo in filtrados if _aplicar_metadata_fii(ativo, tipo_fii, segmento_fii)]
+
+    # Retornar todos os FIIs filtrados (lista completa), já ordenados por dividend_yield
+    return filtrados
+
+_TIPOS_ANALISE = {'acoes': 'Ação', 'bdrs': 'BDR', 'fiis': 'FII'}
+
+def spec_filtros_analise(tipo, filtros):
+    """Spec de screener_colunar para o corpo de /api/analise/ativos (mesmos defaults do endpoint)."""
+    filtros = filtros or {}
+    if tipo == 'fiis':
+        return spec_filtros_fiis(filtros.get('dy_min', 0), filtros.get('dy_max', float('inf')), filtros.get('liq_min', 0))
+    return spec_filtros_acoes(
+        filtros.get('roe_min', 0),
+        filtros.get('dy_min', 0),
+        filtros.get('pl_min', 0),
+        filtros.get('pl_max', float('inf')),
+        filtros.get('pvp_max', float('inf')),
+        int(filtros.get('liq_min') or 0),
+        filtros.get('setor'),
+    )
 
-                else:
-                    # Se não conseguiu obter metadados, incluir apenas se não há filtros específicos
-                    if not tipo_fii and not segmento_fii:
-                        ativo['tipo_fii'] = None
-                        ativo['segmento_fii'] = None
-                    else:
-                        continue
+def stream_ativos_com_filtros(tipo, filtros, should_cancel=None):
+    """
+    Versão incremental de processar_ativos_*_com_filtros: gera eventos (dicts)
+    conforme os ativos ficam prontos.
+
+      {"tipo": "progresso", "processados", "total", "aprovados"}
+      {"tipo": "ativo", "ativo": {...}}          # passou nos filtros
+      {"tipo": "fim", "ativos": [...]}           # lista final, ordenada por DY
+      {"tipo": "cancelado"}                      # should_cancel() ficou True
+
+    Com o snapshot do universo pronto tudo sai de uma vez. Sem snapshot, o
+    cálculo roda numa thread e cada ticker aprovado é emitido assim que o
+    fetch volta; o "fim" vem do snapshot publicado, igual à resposta de
+    /api/analise/ativos. Os fechamentos em lote são buscados antes do fetch
+    por ticker, e cada ativo recebe o mesmo preço/liquidez do snapshot antes
+    de passar pelos filtros: as linhas de "ativo" batem com as do "fim".
+    """
+    tipo_ativo = _TIPOS_ANALISE.get(tipo)
+    if tipo_ativo is None:
+        raise ValueError("Tipo inválido")
+    lista = _UNIVERSO_TIPOS[tipo_ativo]
+    filtros = filtros or {}
+    spec = spec_filtros_analise(tipo, filtros)
+    tipo_fii = filtros.get('tipo_fii') if tipo == 'fiis' else None
+    segmento_fii = filtros.get('segmento_fii') if tipo == 'fiis' else None
+    metadata_fii = {}
+    cancelado = should_cancel if callable(should_cancel) else (lambda: False)
+
+    def aprovado(ativo):
+        if not TabelaColunar.de_registros([ativo]).mascara(spec)[0]:
+            return False
+        if tipo_fii or segmento_fii:
+            return _aplicar_metadata_fii(ativo, tipo_fii, segmento_fii, metadata_fii)
+        return True
 
-            except Exception:
-                # Em caso de erro, incluir apenas se não há filtros específicos
-                if not tipo_fii and not segmento_fii:
-                    ativo['tipo_fii'] = None
-                    ativo['segmento_fii'] = None
-                else:
-                    continue
+    _garantir_refresher_universo()
+    mem = _universo_carregar(lista)
+    emitidos = False
+    if mem is None:
+        eventos = queue.Queue()
+        fechamentos = {}
 
-            filtrados_final.append(ativo)
+        def ao_concluir(resultado, processados, total):
+            if resultado is not None:
+                resultado = dict(resultado)
+                _sobrepor_fechamentos([resultado], fechamentos)
+            eventos.put(('ativo', resultado, processados, total))
 
-        filtrados = filtrados_final
+        def calcular():
+            try:
+                tickers = _universo_tickers(lista)
+                fechamentos.update(_ultimos_fechamentos_yf(sorted({str(t).upper() for t in tickers})))
+                eventos.put(('fim', atualizar_universo_screener(lista, cancelado, ao_concluir, fechamentos), 0, 0))
+            except Exception as e:
+                eventos.put(('erro', e, 0, 0))
 
-    # Retornar todos os FIIs filtrados (lista completa)
-    return sorted(filtrados, key=lambda x: x['dividend_yield'], reverse=True)
+        threading.Thread(target=calcular, name=f'universo-{lista}', daemon=True).start()
+        total = len(_universo_tickers(lista))
+        processados = aprovados = 0
+        while True:
+            try:
+                evento, valor, processados_ev, total_ev = eventos.get(timeout=1.0)
+            except queue.Empty:
+                if cancelado():
+                    yield {"tipo": "cancelado"}
+                    return
+                yield {"tipo": "progresso", "processados": processados, "total": total, "aprovados": aprovados}
+                continue
+            if evento == 'erro':
+                raise valor
+            if evento == 'fim':
+                break
+            processados, total = processados_ev, total_ev
+            if valor is not None and aprovado(valor):
+                aprovados += 1
+                emitidos = True
+                yield {"tipo": "ativo", "ativo": valor}
+            yield {"tipo": "progresso", "processados": processados, "total": total, "aprovados": aprovados}
+        # outro worker pode estar calculando: espera a publicação dele
+        while True:
+            if cancelado():
+                yield {"tipo": "cancelado"}
+                return
+            mem = _universo_carregar(lista, forcar=True)
+            if mem:
+                break
+            yield {"tipo": "progresso", "processados": processados, "total": total, "aprovados": aprovados}
+            time.sleep(1.0)
+
+    ativos = mem[2].filtrar(spec, 'dividend_yield')
+    if tipo_fii or segmento_fii:
+        ativos = [a for a in ativos if _aplicar_metadata_fii(a, tipo_fii, segmento_fii, metadata_fii)]
+    if cancelado():
+        yield {"tipo": "cancelado"}
+        return
+    if not emitidos:
+        yield {"tipo": "progresso", "processados": len(mem[1]), "total": len(mem[1]), "aprovados": len(ativos)}
+        for ativo in ativos:
+            yield {"tipo": "ativo", "ativo": ativo}
+    yield {"tipo": "fim", "ativos": ativos}
 
 # ==================== FUNÇÕES DE CARTEIRA ====================
 
@@ -2753,6 +3866,9 @@ def init_carteira_db(usuario=None):
         usuario = get_usuario_atual()
         if not usuario:
             raise ValueError("Usuário não especificado")
+    garantir_schema_usuario(usuario, 'carteira', levantar=True)
+
+def _mig_carteira_base(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -2772,21 +3888,18 @@ def init_carteira_db(usuario=None):
                         pvp NUMERIC,
                         roe NUMERIC
                     )
-                ''')
-                # Garantir colunas adicionais usadas pelos selects da carteira
-                try:
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_compra NUMERIC')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_medio NUMERIC')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador TEXT')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_pct NUMERIC')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS data_aplicacao TEXT')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS vencimento TEXT')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS isento_ir BOOLEAN')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS liquidez_diaria BOOLEAN')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS emissor_rf TEXT')
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS tipo_renda_fixa TEXT')
-                except Exception as _:
-                    pass
+                ''')
+                # Garantir colunas adicionais usadas pelos selects da carteira
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_compra NUMERIC')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_medio NUMERIC')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador TEXT')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_pct NUMERIC')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS data_aplicacao TEXT')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS vencimento TEXT')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS isento_ir BOOLEAN')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS liquidez_diaria BOOLEAN')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS emissor_rf TEXT')
+                cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS tipo_renda_fixa TEXT')
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS historico_carteira (
                         id SERIAL PRIMARY KEY,
@@ -2851,7 +3964,7 @@ def init_carteira_db(usuario=None):
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         # Tabela de carteira
         cursor.execute('''
@@ -2909,8 +4022,8 @@ def init_carteira_db(usuario=None):
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_carteira_ticker ON carteira(ticker)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_carteira_tipo ON carteira(tipo)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_carteira_data_adicao ON carteira(data_adicao)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_carteira_indexador ON carteira(indexador)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_carteira_vencimento ON carteira(vencimento)")
+        # idx_carteira_indexador/idx_carteira_vencimento: criados em _mig_carteira_indexador,
+        # depois do ADD COLUMN (a tabela base do SQLite não tem essas colunas)
         # Configuração de rebalanceamento (uma linha por usuário)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS rebalance_config (
@@ -2935,7 +4048,7 @@ def init_carteira_db(usuario=None):
 def obter_cotacao_dolar():
 
     try:
-        cotacao = yf.Ticker("BRL=X").info.get("regularMarketPrice")
+        cotacao = obter_info_yf("BRL=X", 'preco').get("regularMarketPrice")
         return cotacao if cotacao else 5.0
     except:
         return 5.0
@@ -2979,8 +4092,7 @@ def obter_informacoes_ativo(ticker):
                 preco_atual = None
             # Nome/tipo via yfinance (só metadata)
             normalized = _normalize_ticker_for_yf(ticker)
-            acao = yf.Ticker(normalized)
-            info = acao.info or {}
+            info = obter_info_yf(normalized, 'cadastro')
             return {
                 "ticker": ticker.upper(),
                 "nome_completo": info.get("longName", ticker.upper()),
@@ -2993,12 +4105,10 @@ def obter_informacoes_ativo(ticker):
             }
 
         normalized = _normalize_ticker_for_yf(ticker)
-        acao = yf.Ticker(normalized)
-        info = acao.info or {}
+        info = obter_info_yf(normalized)
         
         if not info and normalized != ticker:
-            acao = yf.Ticker(ticker)
-            info = acao.info or {}
+            info = obter_info_yf(ticker)
         preco_atual = info.get("currentPrice") or info.get("regularMarketPrice") or info.get("previousClose")
         
         tipo_map = {
@@ -3037,33 +4147,17 @@ def obter_informacoes_ativo(ticker):
 def obter_taxas_indexadores():
     """Obtém as taxas atuais dos indexadores (SELIC, CDI, IPCA)"""
     try:
-        import requests
-        from datetime import datetime, timedelta
         from math import pow
         
-        def sgs_last(series_id, use_range=False):
+        def sgs_last(series_id):
             try:
-                if use_range:
-                    end_date = datetime.now()
-                    start_date = end_date - timedelta(days=90)
-                    url = (f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados?"
-                           f"formato=json&dataInicial={start_date.strftime('%d/%m/%Y')}"
-                           f"&dataFinal={end_date.strftime('%d/%m/%Y')}")
-                    r = requests.get(url, timeout=10)
-                    r.raise_for_status()
-                    arr = r.json()
-                    return float(arr[-1]['valor']) if arr else None
-                else:
-                    url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{series_id}/dados/ultimos/1?formato=json"
-                    r = requests.get(url, timeout=10)
-                    r.raise_for_status()
-                    arr = r.json()
-                    return float(arr[0]['valor']) if arr else None
+                ponto = ultimo_ponto_bcb(series_id)
+                return float(ponto['valor']) if ponto else None
             except Exception:
                 return None
         
         # SELIC (série 432) - fonte principal
-        selic = sgs_last(432, use_range=True)
+        selic = sgs_last(432)
         # IPCA mensal (série 433) e acumulado 12m (série 13522 — não usar 4449, que é preços monitorados)
         ipca_mensal = sgs_last(433)
         ipca_12m = sgs_last(13522)
@@ -3132,61 +4226,37 @@ INDICES_CORRECAO_MONETARIA = [
 def obter_serie_bcb(serie_id, data_inicio, data_fim):
     """Busca série histórica no BCB SGS. data_inicio/data_fim são date. Retorna lista de {data: str, valor: float}."""
     try:
-        import requests
-        url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{serie_id}/dados"
-        params = {
-            "formato": "json",
-            "dataInicial": data_inicio.strftime("%d/%m/%Y"),
-            "dataFinal": data_fim.strftime("%d/%m/%Y"),
-        }
-        r = requests.get(url, params=params, timeout=30)
-        r.raise_for_status()
-        dados = r.json()
-        if not dados:
-            return []
-        out = []
-        for item in dados:
-            try:
-                data_str = item.get("data", "")
-                valor = float(item.get("valor", 0))
-                out.append({"data": data_str, "valor": valor})
-            except (ValueError, TypeError):
-                continue
-        return out
+        return SERIES_BCB.serie(serie_id, data_inicio, data_fim)
     except Exception as e:
         print(f"Erro ao obter série BCB {serie_id}: {e}")
         return []
 
 
-_SERIE_BCB_CACHE = {}
-_SERIE_BCB_CACHE_TTL_SEC = 6 * 3600
 BCB_SERIE_IPCA_MENSAL = 433
 BCB_SERIE_IPCA_12M = 13522
 
+# Fator acumulado de CDI/SELIC/IPCA por produto prefixado (ver fatores_indexadores.py);
+# lê as séries do store local, então reprecificar renda fixa não vai à rede
+FATORES_INDEXADORES = FatoresIndexadores(
+    lambda serie_id, inicio, fim: obter_serie_bcb(serie_id, inicio, fim),
+    ttl_s=float(os.getenv('FATORES_INDEXADORES_TTL', '900')),
+)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=FATORES_INDEXADORES.depois_do_fork_filho)
 
-def _obter_serie_bcb_cached(serie_id, data_inicio, data_fim):
-    """Cache leve para evitar múltiplas chamadas ao BCB na mesma atualização de carteira."""
-    import time
-    key = (serie_id, data_inicio.isoformat(), data_fim.isoformat())
-    now = time.time()
-    cached = _SERIE_BCB_CACHE.get(key)
-    if cached and (now - cached["ts"]) < _SERIE_BCB_CACHE_TTL_SEC:
-        return cached["data"]
-    serie = obter_serie_bcb(serie_id, data_inicio, data_fim)
-    _SERIE_BCB_CACHE[key] = {"ts": now, "data": serie}
-    return serie
+def obter_metricas_fatores_indexadores():
+    return FATORES_INDEXADORES.metricas()
 
 
 def _calcular_fator_ipca_historico(data_inicio_dt, multiplicador_ipca=1.0, spread_mensal_pct=0.0):
     """
     Compõe IPCA mês a mês com a série 433 do BCB desde a data de aplicação.
     multiplicador_ipca: fator sobre o IPCA (ex.: 1.0 = 100%, 1.1 = IPCA+10%).
-    spread_mensal_pct: taxa fixa mensal adicional em % (IPCA+).
+    spread_mensal_pct: taxa fixa mensal adicional em % (IPCA+), composta mês a mês.
     Retorna (fator, meses) ou (None, 0) se não houver série.
     """
     try:
-        from datetime import datetime
-
         if isinstance(data_inicio_dt, datetime):
             data_inicio = data_inicio_dt.date()
         else:
@@ -3195,22 +4265,13 @@ def _calcular_fator_ipca_historico(data_inicio_dt, multiplicador_ipca=1.0, sprea
         if data_inicio >= data_fim:
             return 1.0, 0
 
-        serie = _obter_serie_bcb_cached(BCB_SERIE_IPCA_MENSAL, data_inicio, data_fim)
-        if not serie:
+        res = FATORES_INDEXADORES.fator(
+            'IPCA', data_inicio, data_fim + timedelta(days=1),
+            pct=float(multiplicador_ipca) * 100.0, spread_periodo_pct=float(spread_mensal_pct),
+        )
+        if res is None or res[1] == 0:
             return None, 0
-
-        fator = 1.0
-        meses = 0
-        for item in serie:
-            try:
-                ipca_mes = float(item.get("valor"))
-            except (TypeError, ValueError):
-                continue
-            taxa_mensal = ipca_mes * float(multiplicador_ipca) + float(spread_mensal_pct)
-            fator *= 1.0 + (taxa_mensal / 100.0)
-            meses += 1
-
-        return fator, meses
+        return res
     except Exception as e:
         print(f"Erro ao calcular fator IPCA histórico: {e}")
         return None, 0
@@ -3224,7 +4285,6 @@ def calcular_correcao_monetaria(indice_id, data_inicio_str, data_fim_str, valor_
     Retorna { fator, valor_corrigido, meses, indices_usados, erro }.
     """
     try:
-        import requests
         indice = next((i for i in INDICES_CORRECAO_MONETARIA if i["id"] == indice_id), None)
         if not indice:
             return {"erro": "Índice não encontrado", "fator": None, "valor_corrigido": None, "meses": 0, "indices_usados": []}
@@ -3281,9 +4341,7 @@ def calcular_correcao_monetaria(indice_id, data_inicio_str, data_fim_str, valor_
 def _obter_taxa_media_historica(indexador, data_inicio):
     """Obtém a taxa média histórica de um indexador desde uma data específica"""
     try:
-        import requests
-        from datetime import datetime, timedelta
-        
+
         # Determinar série do indexador
         if indexador == "CDI":
             serie_id = 12
@@ -3299,18 +4357,9 @@ def _obter_taxa_media_historica(indexador, data_inicio):
         if dias_periodo <= 0:
             return 13.0
         
-        # Buscar dados históricos do Banco Central
+        # Dados históricos do Banco Central (store local de séries SGS)
         try:
-            url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{serie_id}/dados"
-            params = {
-                'formato': 'json',
-                'dataInicial': data_inicio.strftime('%d/%m/%Y'),
-                'dataFinal': data_fim.strftime('%d/%m/%Y')
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            dados = response.json()
+            dados = obter_serie_bcb(serie_id, data_inicio, data_fim)
             
             if not dados:
                 print(f"DEBUG: Nenhum dado histórico encontrado para {indexador}")
@@ -3351,21 +4400,9 @@ def _obter_taxa_media_historica(indexador, data_inicio):
 def _obter_ipca_medio_historico(data_inicio):
     """Obtém o IPCA médio mensal histórico desde uma data específica"""
     try:
-        import requests
-        from datetime import datetime
-        
-        # Buscar IPCA mensal (série 433)
+        # IPCA mensal (série 433)
         try:
-            url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.433/dados"
-            params = {
-                'formato': 'json',
-                'dataInicial': data_inicio.strftime('%d/%m/%Y'),
-                'dataFinal': datetime.now().strftime('%d/%m/%Y')
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            dados = response.json()
+            dados = obter_serie_bcb(BCB_SERIE_IPCA_MENSAL, data_inicio, datetime.now())
             
             if not dados:
                 print("DEBUG: Nenhum dado histórico de IPCA encontrado")
@@ -3419,12 +4456,10 @@ def _obter_taxa_atual_indexador(indexador):
         else:
             return 13.0  # Taxa padrão se não reconhecer
         
-        # Buscar dados atuais do Banco Central
+        # Último valor do Banco Central (store local de séries SGS)
         try:
-            url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{serie_id}/dados/ultimos/1?formato=json"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            dados = response.json()
+            ponto = ultimo_ponto_bcb(serie_id)
+            dados = [ponto] if ponto else []
             
             if not dados:
                 print(f"DEBUG: Nenhum dado atual encontrado para {indexador}")
@@ -3462,30 +4497,31 @@ def _obter_taxa_atual_indexador(indexador):
         print(f"DEBUG: Erro geral ao obter taxa atual: {e}")
         return 13.0 if indexador in ["CDI", "SELIC"] else 0.5
 
-def calcular_preco_com_indexador(preco_inicial, indexador, indexador_pct, data_adicao):
-    """Calcula o preço atual baseado no indexador e percentual - USANDO ABORDAGEM QUE JÁ FUNCIONA"""
-    from math import isfinite
+def _normalizar_indexador_pct(idx, pct):
+    """Percentual do indexador em %, aceitando os formatos legados; None se ausente/inválido."""
+    if pct is None:
+        return None
     try:
-        def _normalizar_indexador_pct(idx, pct):
-            if pct is None:
-                return None
-            try:
-                pct = float(pct)
-            except (ValueError, TypeError):
-                return None
-            if pct <= 0:
-                return None
+        pct = float(pct)
+    except (ValueError, TypeError):
+        return None
+    if pct <= 0:
+        return None
 
-            # Indexadores-base: dados legados podem vir como fator (1.2 = 120%)
-            if idx in ["CDI", "SELIC", "IPCA"] and pct <= 3:
-                return pct * 100.0
+    # Indexadores-base: dados legados podem vir como fator (1.2 = 120%)
+    if idx in ["CDI", "SELIC", "IPCA"] and pct <= 3:
+        return pct * 100.0
 
-            # Taxas fixas/plus: dados legados podem vir em decimal anual (0.12 = 12%)
-            if idx in ["PREFIXADO", "CDI+", "IPCA+"] and pct <= 1:
-                return pct * 100.0
+    # Taxas fixas/plus: dados legados podem vir em decimal anual (0.12 = 12%)
+    if idx in ["PREFIXADO", "CDI+", "IPCA+"] and pct <= 1:
+        return pct * 100.0
 
-            return pct
+    return pct
 
+def calcular_preco_com_indexador(preco_inicial, indexador, indexador_pct, data_adicao):
+    """Calcula o preço atual baseado no indexador e percentual - USANDO ABORDAGEM QUE JÁ FUNCIONA"""
+    from math import isfinite
+    try:
         # CONVERSÃO EXPLÍCITA E VALIDAÇÃO CRÍTICA DE TIPOS (fix para PostgreSQL)
         # PostgreSQL pode retornar NUMERIC como Decimal ou string, precisamos garantir float
         try:
@@ -3579,8 +4615,24 @@ def calcular_preco_com_indexador(preco_inicial, indexador, indexador_pct, data_a
             print(f"[ERRO CRITICO] Fator percentual invalido: {fator_percentual} (indexador_pct={indexador_pct})")
             return preco_inicial
 
-        # USAR A MESMA ABORDAGEM QUE JÁ FUNCIONA NA TELA DE DETALHES
+        # Janela efetiva (respeita o limite de 10 anos acima) e fim exclusivo (amanhã)
+        hoje_data = datetime.now().date()
+        inicio_fator = hoje_data - timedelta(days=dias_totais)
+        fim_fator = hoje_data + timedelta(days=1)
+
+        # CDI/SELIC/CDI+: fator histórico da tabela acumulada (série diária do BCB)
+        res_tabela = None
         if indexador in ["SELIC", "CDI"]:
+            res_tabela = FATORES_INDEXADORES.fator(indexador, inicio_fator, fim_fator, pct=indexador_pct)
+        elif indexador == "CDI+":
+            spread_diario_pct = ((1 + (indexador_pct or 0) / 100) ** (1 / 252) - 1) * 100
+            res_tabela = FATORES_INDEXADORES.fator("CDI", inicio_fator, fim_fator, spread_periodo_pct=spread_diario_pct)
+
+        if res_tabela is not None and res_tabela[1] > 0:
+            fator_correcao = res_tabela[0]
+
+        # Sem série local: aproxima pela taxa atual, como antes
+        elif indexador in ["SELIC", "CDI"]:
             # Usar a mesma lógica da função obter_historico_carteira_comparado
             taxa_anual = _obter_taxa_atual_indexador(indexador)
             print(f"DEBUG: Taxa atual {indexador}: {taxa_anual}% a.a.")
@@ -3609,7 +4661,7 @@ def calcular_preco_com_indexador(preco_inicial, indexador, indexador_pct, data_a
         elif indexador == "IPCA":
             # IPCA: compor mês a mês com série histórica 433 (cada mês com taxa real do BCB)
             fator_correcao, meses_ipca = _calcular_fator_ipca_historico(
-                data_adicao_dt, multiplicador_ipca=fator_percentual
+                inicio_fator, multiplicador_ipca=fator_percentual
             )
             if fator_correcao is None:
                 ipca_atual_mensal = _obter_taxa_atual_indexador("IPCA")
@@ -3624,7 +4676,7 @@ def calcular_preco_com_indexador(preco_inicial, indexador, indexador_pct, data_a
             # IPCA+: IPCA histórico mês a mês + spread fixo mensal (taxa anual / 12)
             taxa_fixa_mensal = (indexador_pct or 0) / 12
             fator_correcao, meses_ipca = _calcular_fator_ipca_historico(
-                data_adicao_dt, multiplicador_ipca=1.0, spread_mensal_pct=taxa_fixa_mensal
+                inicio_fator, multiplicador_ipca=1.0, spread_mensal_pct=taxa_fixa_mensal
             )
             if fator_correcao is None:
                 ipca_atual_mensal = _obter_taxa_atual_indexador("IPCA")
@@ -3688,7 +4740,7 @@ def obter_taxa_usd_brl():
         
         # Buscar taxa USD/BRL usando yfinance
         usd_brl = yf.Ticker("BRL=X")
-        info = usd_brl.info
+        info = obter_info_yf("BRL=X", 'preco')
         
         if info and 'currentPrice' in info and info['currentPrice']:
             taxa = float(info['currentPrice'])
@@ -3696,7 +4748,7 @@ def obter_taxa_usd_brl():
             return taxa
         else:
             # Fallback: usar histórico mais recente
-            hist = usd_brl.history(period="1d")
+            hist = LIMITADOR.executar('yahoo', lambda: usd_brl.history(period="1d"))
             if not hist.empty:
                 taxa = float(hist['Close'].iloc[-1])
                 print(f" Taxa USD/BRL (histórico): {taxa:.4f}")
@@ -3735,12 +4787,16 @@ def obter_preco_cripto_binance_usd(ticker):
         symbol = _ticker_para_simbolo_binance(ticker)
         if not symbol:
             return None
-        req = urllib.request.Request(
-            BINANCE_TICKER_URL + "?symbol=" + symbol,
-            headers={"User-Agent": "Finmas/1.0"},
-        )
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            data = json.loads(resp.read().decode())
+
+        def _buscar():
+            req = urllib.request.Request(
+                BINANCE_TICKER_URL + "?symbol=" + symbol,
+                headers={"User-Agent": "Finmas/1.0"},
+            )
+            with LIMITADOR.executar('binance', lambda: urllib.request.urlopen(req, timeout=10)) as resp:
+                return json.loads(resp.read().decode())
+
+        data = QUOTE_STORE.obter('binance', symbol, _buscar)
         return float(data.get("price", 0))
     except Exception as e:
         print(f"[AVISO] Binance preço {ticker}: {e}")
@@ -3758,7 +4814,7 @@ def obter_precos_cripto_binance_usd(tickers):
             BINANCE_TICKER_URL,
             headers={"User-Agent": "Finmas/1.0"},
         )
-        with urllib.request.urlopen(req, timeout=15) as resp:
+        with LIMITADOR.executar('binance', lambda: urllib.request.urlopen(req, timeout=15)) as resp:
             lista = json.loads(resp.read().decode())
         # lista = [ {"symbol": "BTCUSDT", "price": "97234.50"}, ... ]
         binance_prices = {item["symbol"]: float(item["price"]) for item in lista}
@@ -3790,7 +4846,7 @@ def obter_preco_cripto_binance_historico_usd(ticker, data):
         end_ts = start_ts + 86400 * 1000
         url = f"{BINANCE_KLINES_URL}?symbol={symbol}&interval=1d&startTime={start_ts}&endTime={end_ts}&limit=1"
         req = urllib.request.Request(url, headers={"User-Agent": "Finmas/1.0"})
-        with urllib.request.urlopen(req, timeout=10) as resp:
+        with LIMITADOR.executar('binance', lambda: urllib.request.urlopen(req, timeout=10)) as resp:
             arr = json.loads(resp.read().decode())
         if not arr:
             return None
@@ -3849,8 +4905,8 @@ def _obter_preco_um_ticker(ticker, taxa_usd_brl):
             if not symbol:
                 continue
             try:
-                ticker_obj = yf.Ticker(symbol)
-                info = ticker_obj.info or {}
+                info = obter_info_yf(symbol)
+                ticker_obj = None
 
                 # Ordem de fallback para preço (mais robusta em B3/BDR/FII).
                 preco_candidato = (
@@ -3860,15 +4916,18 @@ def _obter_preco_um_ticker(ticker, taxa_usd_brl):
                 )
 
                 if preco_candidato is None:
+                    ticker_obj = yf.Ticker(symbol)
                     try:
                         fi = getattr(ticker_obj, 'fast_info', None)
                         if fi:
-                            preco_candidato = fi.get('lastPrice') or fi.get('regularMarketPreviousClose')
+                            preco_candidato = LIMITADOR.executar(
+                                'yahoo', lambda: fi.get('lastPrice') or fi.get('regularMarketPreviousClose')
+                            )
                     except Exception:
                         pass
 
                 if preco_candidato is None:
-                    hist = ticker_obj.history(period="5d")
+                    hist = LIMITADOR.executar('yahoo', lambda: ticker_obj.history(period="5d"))
                     if not hist.empty:
                         preco_candidato = float(hist['Close'].dropna().iloc[-1])
 
@@ -3894,39 +4953,283 @@ def _obter_preco_um_ticker(ticker, taxa_usd_brl):
         return None
 
 
+YF_DOWNLOAD_LOTE = int(os.getenv('YF_DOWNLOAD_BATCH', '50'))
+
+def _ultimos_fechamentos_yf(symbols):
+    """Último Close válido de cada símbolo via yf.download em lotes (uma chamada por lote)."""
+    fechamentos = {}
+    for i in range(0, len(symbols), YF_DOWNLOAD_LOTE):
+        lote = symbols[i:i + YF_DOWNLOAD_LOTE]
+        try:
+            df = LIMITADOR.executar('yahoo', lambda: yf.download(
+                lote, period='5d', interval='1d', auto_adjust=False,
+                group_by='column', threads=True, progress=False,
+            ), vazio=lambda df: df is None or df.empty)
+        except Exception as e:
+            print(f"[AVISO] yf.download falhou para lote de {len(lote)}: {e}")
+            continue
+        if df is None or df.empty or 'Close' not in df.columns.get_level_values(0):
+            continue
+        close = df['Close']
+        if isinstance(close, pd.Series):
+            close = close.to_frame(lote[0])
+        ultimos = close.ffill().iloc[-1]
+        for symbol, valor in ultimos.items():
+            if pd.notna(valor) and float(valor) > 0:
+                fechamentos[str(symbol).upper()] = float(valor)
+    return fechamentos
+
 def obter_precos_batch(tickers):
     """
-    Obtém preços de múltiplos tickers com até YF_MAX_CONCURRENT requisições simultâneas ao yfinance.
+    Preços e indicadores de vários tickers: {ticker: {preco_atual, dy, pl, pvp, roe}}.
+
+    - Criptos: uma requisição à Binance para todos os pares (+ BRL=X).
+    - Demais: último fechamento via yf.download em lotes de YF_DOWNLOAD_BATCH;
+      dy/pl/pvp/roe vêm do QUOTE_STORE e só vão ao yfinance se estiverem velhos.
+    - O que faltar cai no caminho por ticker (_obter_preco_um_ticker).
     """
     if not tickers:
         return {}
     
     try:
-        print(f"🔄 Buscando preços (até {YF_MAX_CONCURRENT} simultâneos) para {len(tickers)} tickers...")
+        inicio = time.time()
+        tickers = list(dict.fromkeys(t for t in tickers if t))
+        cripto = [t for t in tickers if is_crypto_ticker(t)]
+        outros = [t for t in tickers if not is_crypto_ticker(t)]
+        print(f"🔄 Buscando preços em lote para {len(tickers)} tickers ({len(cripto)} cripto)...")
         
         taxa_usd_brl = None
-        if any(is_crypto_ticker(t) for t in tickers):
-            taxa_usd_brl = obter_taxa_usd_brl()
-        
         precos_totais = {}
-        max_workers = min(len(tickers), YF_MAX_CONCURRENT)
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(_obter_preco_um_ticker, ticker, taxa_usd_brl): ticker
-                for ticker in tickers
-            }
-            for future in as_completed(futures):
-                resultado = future.result()
-                if resultado:
-                    ticker, dados = resultado
-                    precos_totais[ticker] = dados
+        if cripto:
+            taxa_usd_brl = obter_taxa_usd_brl()
+            for ticker, preco_usd in obter_precos_cripto_binance_usd(cripto).items():
+                precos_totais[ticker] = {
+                    'preco_atual': converter_crypto_usd_para_brl(preco_usd, taxa_usd_brl),
+                    'dy': None,
+                    'pl': None,
+                    'pvp': None,
+                    'roe': None
+                }
+
+        simbolos = {t: _normalize_ticker_for_yf(t) for t in outros}
+        fechamentos = _ultimos_fechamentos_yf(sorted(set(simbolos.values()))) if outros else {}
+        com_preco = [t for t in outros if simbolos[t] in fechamentos]
+
+        def _fundamentos(ticker):
+            try:
+                return ticker, obter_info_yf(simbolos[ticker], 'fundamentos')
+            except Exception as e:
+                print(f"[AVISO] Fundamentos de {ticker} indisponíveis: {e}")
+                return ticker, {}
+
+        if com_preco:
+            with ThreadPoolExecutor(max_workers=min(len(com_preco), YF_MAX_CONCURRENT)) as executor:
+                for ticker, info in executor.map(_fundamentos, com_preco):
+                    precos_totais[ticker] = {
+                        'preco_atual': fechamentos[simbolos[ticker]],
+                        'dy': info.get('dividendYield'),
+                        'pl': info.get('trailingPE'),
+                        'pvp': info.get('priceToBook'),
+                        'roe': info.get('returnOnEquity')
+                    }
+
+        faltando = [t for t in tickers if t not in precos_totais]
+        if faltando:
+            print(f" {len(faltando)} ticker(s) sem preço no lote, buscando individualmente...")
+            if taxa_usd_brl is None and any(is_crypto_ticker(t) for t in faltando):
+                taxa_usd_brl = obter_taxa_usd_brl()
+            with ThreadPoolExecutor(max_workers=min(len(faltando), YF_MAX_CONCURRENT)) as executor:
+                futures = [executor.submit(_obter_preco_um_ticker, ticker, taxa_usd_brl) for ticker in faltando]
+                for future in as_completed(futures):
+                    resultado = future.result()
+                    if resultado:
+                        ticker, dados = resultado
+                        precos_totais[ticker] = dados
         
-        print(f"[OK] Concluido: {len(precos_totais)} precos obtidos de {len(tickers)} tickers")
+        print(f"[OK] Concluido: {len(precos_totais)} precos obtidos de {len(tickers)} tickers "
+              f"({len(com_preco)} via lote, {len(faltando)} individuais) em {time.time() - inicio:.1f}s")
         return precos_totais
     except Exception as e:
         print(f"[ERRO] Erro no batch de precos: {e}")
         return {}
 
+_SQL_CARTEIRA_PRECOS = (
+    'SELECT id, ticker, quantidade, preco_atual, data_adicao, indexador, indexador_pct, indexador_base_preco, '
+    'indexador_base_data, preco_compra, preco_medio, data_aplicacao, dy, pl, pvp, roe FROM carteira'
+)
+
+def _indexador_pct_linha(valor, ticker):
+    # CONVERSÃO ROBUSTA (Postgres pode devolver Decimal, string, etc)
+    if valor is None:
+        return None
+    try:
+        if isinstance(valor, (int, float)):
+            pct = float(valor)
+        elif isinstance(valor, str):
+            pct = float(valor.replace(',', '.'))
+        else:
+            pct = float(str(valor))
+    except (ValueError, TypeError, AttributeError) as e:
+        print(f"[ERRO] Erro ao converter indexador_pct para {ticker}: {valor} (tipo: {type(valor).__name__}) - {e}")
+        return None
+    # Validação: mantém faixa ampla e deixa normalização fina para o cálculo
+    if pct <= 0 or pct > 1000:
+        print(f"[ERRO] Indexador_pct fora do range: {pct}% para {ticker}. Usando None.")
+        return None
+    return pct
+
+def _nova_cotacao_linha_carteira(row, precos_batch, primeira_compra):
+    """
+    Parâmetros do UPDATE (preco_atual, valor_total, dy, pl, pvp, roe, id) de
+    uma linha de `_SQL_CARTEIRA_PRECOS`, ou None para não mexer na linha.
+    `primeira_compra(ticker)` devolve o preço da 1ª movimentação (ou None).
+    """
+    _id, _ticker, _qtd = row[0], str(row[1] or ''), float(row[2] or 0)
+    if not _ticker:
+        return None
+    _preco_atual = float(row[3] or 0)
+    _data_adicao = row[4]
+    _indexador = row[5]
+    _indexador_pct = _indexador_pct_linha(row[6], _ticker)
+    base_preco = float(row[7]) if row[7] is not None else None
+    base_data = row[8]
+    _preco_compra = float(row[9]) if row[9] is not None else None
+    _preco_medio = float(row[10]) if row[10] is not None else None
+    _data_aplicacao = row[11] or None
+    _dy_atual = float(row[12]) if row[12] is not None else None
+    _pl_atual = float(row[13]) if row[13] is not None else None
+    _pvp_atual = float(row[14]) if row[14] is not None else None
+    _roe_atual = float(row[15]) if row[15] is not None else None
+
+    # CORREÇÃO CRÍTICA: Se tem indexador, calcular SEMPRE (mesmo que não esteja no batch)
+    if _indexador:
+        print(f"DEBUG: Ativo {_ticker} tem indexador {_indexador} com {_indexador_pct}%")
+        # Preço base - ORDEM DE PRIORIDADE CRÍTICA:
+        # 1. indexador_base_preco (se configurado explicitamente)
+        # 2. preco_compra (preço de compra original)
+        # 3. preco_medio (preço médio ponderado)
+        # 4. Primeira movimentação (último recurso)
+        # NUNCA usar preco_atual como base!
+        if base_preco is not None and base_data:
+            preco_inicial = base_preco
+            # Preferir data_aplicacao quando existir (evita superacumulação
+            # por base_data legado desatualizado).
+            data_base_calculo = _data_aplicacao or base_data
+            print(f"DEBUG: Usando indexador_base_preco: {preco_inicial}")
+        elif _preco_compra is not None and _preco_compra > 0:
+            preco_inicial = _preco_compra
+            data_base_calculo = _data_aplicacao or _data_adicao
+            print(f"DEBUG: Usando preco_compra: {preco_inicial}")
+        elif _preco_medio is not None and _preco_medio > 0:
+            preco_inicial = _preco_medio
+            data_base_calculo = _data_aplicacao or _data_adicao
+            print(f"DEBUG: Usando preco_medio: {preco_inicial}")
+        else:
+            preco_inicial = primeira_compra(_ticker)
+            if not preco_inicial or preco_inicial <= 0:
+                # Se não encontrou nada, pular este ativo (não atualizar)
+                print(f"[ERRO CRITICO] Nao foi possivel determinar preco inicial para {_ticker} com indexador. Pulando atualizacao.")
+                return None
+            data_base_calculo = _data_aplicacao or _data_adicao
+            print(f"DEBUG: Usando primeira movimentação: {preco_inicial}")
+
+        print(f"DEBUG: Preço inicial encontrado: {preco_inicial}, data base: {data_base_calculo}")
+
+        # VALIDAÇÃO PRÉ-CÁLCULO: Garantir que preco_inicial é válido
+        if preco_inicial is None or preco_inicial <= 0 or not isinstance(preco_inicial, (int, float)):
+            print(f"[ERRO CRITICO] Preco inicial invalido para {_ticker}: {preco_inicial}. Pulando atualizacao.")
+            return None
+
+        preco_atual = calcular_preco_com_indexador(preco_inicial, _indexador, _indexador_pct, data_base_calculo)
+
+        if preco_atual is None or not isinstance(preco_atual, (int, float)) or preco_atual <= 0:
+            print(f"[ERRO CRITICO] Preco calculado invalido (None/zero/nao-numerico) para {_ticker}: {preco_atual}. Mantendo preco inicial.")
+            preco_atual = preco_inicial
+        elif preco_atual < preco_inicial * 0.2 or preco_atual > preco_inicial * 20.0:
+            print(f"[ERRO CRITICO] Preco calculado absurdo para {_ticker}: inicial={preco_inicial}, calculado={preco_atual} (fator={preco_atual/preco_inicial:.4f}x). Mantendo preco inicial para evitar corrupcao.")
+            preco_atual = preco_inicial  # CORREÇÃO: Manter preço inicial, não o atual (que pode estar corrompido)
+        else:
+            print(f"DEBUG: Preço calculado com indexador: {preco_atual} (inicial: {preco_inicial}, fator: {preco_atual/preco_inicial:.4f}x)")
+        # Preservar indicadores já existentes para ativos com indexador.
+        dy = _dy_atual; pl = _pl_atual; pvp = _pvp_atual; roe = _roe_atual
+    elif _ticker in precos_batch:
+        # Se não tem indexador, usar preços do batch (yfinance)
+        dados_preco = precos_batch[_ticker]
+        preco_atual = dados_preco.get('preco_atual', _preco_atual)
+        dy = dados_preco.get('dy')
+        pl = dados_preco.get('pl')
+        pvp = dados_preco.get('pvp')
+        roe = dados_preco.get('roe')
+    else:
+        # Fallback individual para reduzir falsos negativos do batch.
+        info_fallback = obter_informacoes_ativo(_ticker)
+        if info_fallback and info_fallback.get('preco_atual') not in (None, 0):
+            preco_atual = float(info_fallback.get('preco_atual') or _preco_atual)
+            dy = info_fallback.get('dy', _dy_atual)
+            pl = info_fallback.get('pl', _pl_atual)
+            pvp = info_fallback.get('pvp', _pvp_atual)
+            roe = info_fallback.get('roe', _roe_atual)
+            print(f"[INFO] Preco recuperado via fallback individual para {_ticker}")
+            # deixa no batch: outra carteira com o mesmo ticker não repete a busca
+            precos_batch[_ticker] = {'preco_atual': preco_atual, 'dy': dy, 'pl': pl, 'pvp': pvp, 'roe': roe}
+        else:
+            # Se não tem indexador e não está no batch, manter preço e indicadores atuais
+            print(f"[AVISO] Preco nao encontrado em batch para {_ticker}, mantendo preco atual")
+            preco_atual = _preco_atual
+            dy = _dy_atual; pl = _pl_atual; pvp = _pvp_atual; roe = _roe_atual
+
+    return (preco_atual, preco_atual * _qtd, dy, pl, pvp, roe, _id)
+
+def _ler_carteira_para_precos(usuario):
+    """Linhas de `_SQL_CARTEIRA_PRECOS` da carteira de `usuario`."""
+    garantir_schema_usuario(usuario, 'carteira')
+    if _is_postgres():
+        conn = _pg_conn_for_user(usuario)
+        try:
+            with conn.cursor() as c:
+                c.execute(_SQL_CARTEIRA_PRECOS)
+                return c.fetchall()
+        finally:
+            conn.close()
+    conn = _sqlite_connect(get_db_path(usuario, "carteira"))
+    try:
+        return conn.execute(_SQL_CARTEIRA_PRECOS).fetchall()
+    finally:
+        conn.close()
+
+def _gravar_precos_carteira(usuario, rows, precos_batch):
+    """
+    Reprecifica as `rows` da carteira de `usuario` com `precos_batch`
+    (`obter_precos_batch`) e grava tudo num único executemany. Devolve o
+    número de linhas atualizadas.
+    """
+    pg = _is_postgres()
+    ph = '%s' if pg else '?'
+    conn = _pg_conn_for_user(usuario) if pg else _sqlite_connect(get_db_path(usuario, "carteira"))
+    try:
+        cur = conn.cursor()
+
+        def _primeira_compra(ticker):
+            # Último recurso para renda fixa sem preço base: primeira movimentação
+            cur.execute(f'SELECT preco FROM movimentacoes WHERE ticker = {ph} ORDER BY data ASC LIMIT 1', (ticker,))
+            mov_row = cur.fetchone()
+            return float(mov_row[0]) if mov_row and mov_row[0] and float(mov_row[0]) > 0 else None
+
+        parametros = []
+        for row in rows:
+            linha = _nova_cotacao_linha_carteira(row, precos_batch, _primeira_compra)
+            if linha is not None:
+                parametros.append(linha)
+        if parametros:
+            cur.executemany(
+                f'UPDATE carteira SET preco_atual = {ph}, valor_total = {ph}, dy = {ph}, pl = {ph}, pvp = {ph}, roe = {ph} WHERE id = {ph}',
+                parametros,
+            )
+        conn.commit()
+        return len(parametros)
+    finally:
+        conn.close()
+
 def atualizar_precos_indicadores_carteira():
   
     try:
@@ -3936,318 +5239,283 @@ def atualizar_precos_indicadores_carteira():
         
         print(f"DEBUG: Iniciando atualização de preços para usuário {usuario}")
         _ensure_indexador_schema()
-        atualizados = 0
         erros = []
         
         # NOVA ABORDAGEM: Batch de preços
-        tickers_para_buscar = []
-        if _is_postgres():
-            conn = _pg_conn_for_user(usuario)
-            try:
-                with conn.cursor() as c:
-                    c.execute('SELECT id, ticker, quantidade, preco_atual, data_adicao, indexador, indexador_pct, indexador_base_preco, indexador_base_data, preco_compra, preco_medio, data_aplicacao, dy, pl, pvp, roe FROM carteira')
-                    rows = c.fetchall()
-                    
-                    # Coletar todos os tickers únicos
-                    for row in rows:
-                        _ticker = str(row[1] or '')
-                        if _ticker and _ticker not in tickers_para_buscar:
-                            tickers_para_buscar.append(_ticker)
-                    
-                    # Buscar todos os preços de uma vez
-                    print(f" Buscando preços em batch para {len(tickers_para_buscar)} tickers...")
-                    precos_batch = obter_precos_batch(tickers_para_buscar)
-                    
-                    # Processar cada ativo com os preços já obtidos
-                    for row in rows:
-                        _id, _ticker, _qtd = row[0], str(row[1] or ''), float(row[2] or 0)
-                        _preco_atual = float(row[3] or 0)
-                        _data_adicao = row[4]
-                        _indexador = row[5]
-                        # CONVERSÃO ROBUSTA para PostgreSQL (pode vir como Decimal, string, etc)
-                        _indexador_pct_raw = row[6]
-                        if _indexador_pct_raw is not None:
-                            try:
-                                # Tentar converter para float diretamente
-                                if isinstance(_indexador_pct_raw, (int, float)):
-                                    _indexador_pct = float(_indexador_pct_raw)
-                                elif isinstance(_indexador_pct_raw, str):
-                                    _indexador_pct = float(_indexador_pct_raw.replace(',', '.'))
-                                else:
-                                    # Para Decimal ou outros tipos do PostgreSQL
-                                    _indexador_pct = float(str(_indexador_pct_raw))
-                                
-                                # Validação: mantém faixa ampla e deixa normalização fina para o cálculo
-                                if _indexador_pct <= 0 or _indexador_pct > 1000:
-                                    print(f"[ERRO] Indexador_pct fora do range: {_indexador_pct}% para {_ticker}. Usando None.")
-                                    _indexador_pct = None
-                            except (ValueError, TypeError, AttributeError) as e:
-                                print(f"[ERRO] Erro ao converter indexador_pct para {_ticker}: {_indexador_pct_raw} (tipo: {type(_indexador_pct_raw).__name__}) - {e}")
-                                _indexador_pct = None
-                        else:
-                            _indexador_pct = None
-                        base_preco = float(row[7]) if (len(row) > 7 and row[7] is not None) else None
-                        base_data = row[8] if (len(row) > 8) else None
-                        _preco_compra = float(row[9]) if (len(row) > 9 and row[9] is not None) else None
-                        _preco_medio = float(row[10]) if (len(row) > 10 and row[10] is not None) else None
-                        _data_aplicacao = row[11] if (len(row) > 11 and row[11]) else None
-                        _dy_atual = float(row[12]) if (len(row) > 12 and row[12] is not None) else None
-                        _pl_atual = float(row[13]) if (len(row) > 13 and row[13] is not None) else None
-                        _pvp_atual = float(row[14]) if (len(row) > 14 and row[14] is not None) else None
-                        _roe_atual = float(row[15]) if (len(row) > 15 and row[15] is not None) else None
-                        
-                        if not _ticker:
-                            continue
-                        
-                        # Determinar novo preco_atual e métricas
-                        # CORREÇÃO CRÍTICA: Se tem indexador, calcular SEMPRE (mesmo que não esteja no batch)
-                        if _indexador:
-                            print(f"DEBUG: Ativo {_ticker} tem indexador {_indexador} com {_indexador_pct}%")
-                            # Preço base - ORDEM DE PRIORIDADE CRÍTICA:
-                            # 1. indexador_base_preco (se configurado explicitamente)
-                            # 2. preco_compra (preço de compra original)
-                            # 3. preco_medio (preço médio ponderado)
-                            # 4. Primeira movimentação (último recurso)
-                            # NUNCA usar preco_atual como base!
-                            if base_preco is not None and base_data:
-                                preco_inicial = base_preco
-                                # Preferir data_aplicacao quando existir (evita superacumulação
-                                # por base_data legado desatualizado).
-                                data_base_calculo = _data_aplicacao or base_data
-                                print(f"DEBUG: Usando indexador_base_preco: {preco_inicial}")
-                            elif _preco_compra is not None and _preco_compra > 0:
-                                preco_inicial = _preco_compra
-                                data_base_calculo = _data_aplicacao or _data_adicao
-                                print(f"DEBUG: Usando preco_compra: {preco_inicial}")
-                            elif _preco_medio is not None and _preco_medio > 0:
-                                preco_inicial = _preco_medio
-                                data_base_calculo = _data_aplicacao or _data_adicao
-                                print(f"DEBUG: Usando preco_medio: {preco_inicial}")
-                            else:
-                                # Último recurso: buscar primeira movimentação
-                                c.execute('SELECT preco FROM movimentacoes WHERE ticker = %s ORDER BY data ASC LIMIT 1', (_ticker,))
-                                mov_row = c.fetchone()
-                                if mov_row and mov_row[0] and float(mov_row[0]) > 0:
-                                    preco_inicial = float(mov_row[0])
-                                    data_base_calculo = _data_aplicacao or _data_adicao
-                                    print(f"DEBUG: Usando primeira movimentação: {preco_inicial}")
-                                else:
-                                    # Se não encontrou nada, pular este ativo (não atualizar)
-                                    print(f"[ERRO CRITICO] Nao foi possivel determinar preco inicial para {_ticker} com indexador. Pulando atualizacao.")
-                                    continue
-                            
-                            print(f"DEBUG: Preço inicial encontrado: {preco_inicial}, data base: {data_base_calculo}")
-                            
-                            # VALIDAÇÃO PRÉ-CÁLCULO: Garantir que preco_inicial é válido
-                            if preco_inicial is None or preco_inicial <= 0 or not isinstance(preco_inicial, (int, float)):
-                                print(f"[ERRO CRITICO] Preco inicial invalido para {_ticker}: {preco_inicial}. Pulando atualizacao.")
-                                continue
-                            
-                            preco_atual = calcular_preco_com_indexador(preco_inicial, _indexador, _indexador_pct, data_base_calculo)
-                            
-
-                            if preco_atual is None or not isinstance(preco_atual, (int, float)) or preco_atual <= 0:
-                                print(f"[ERRO CRITICO] Preco calculado invalido (None/zero/nao-numerico) para {_ticker}: {preco_atual}. Mantendo preco inicial.")
-                                preco_atual = preco_inicial
-                            elif preco_atual < preco_inicial * 0.2 or preco_atual > preco_inicial * 20.0:
-                                print(f"[ERRO CRITICO] Preco calculado absurdo para {_ticker}: inicial={preco_inicial}, calculado={preco_atual} (fator={preco_atual/preco_inicial:.4f}x). Mantendo preco inicial para evitar corrupcao.")
-                                preco_atual = preco_inicial  # CORREÇÃO: Manter preço inicial, não o atual (que pode estar corrompido)
-                            else:
-                                print(f"DEBUG: Preço calculado com indexador: {preco_atual} (inicial: {preco_inicial}, fator: {preco_atual/preco_inicial:.4f}x)")
-                            # Preservar indicadores já existentes para ativos com indexador.
-                            dy = _dy_atual; pl = _pl_atual; pvp = _pvp_atual; roe = _roe_atual
-                        elif _ticker in precos_batch:
-                            # Se não tem indexador, usar preços do batch (yfinance)
-                            dados_preco = precos_batch[_ticker]
-                            preco_atual = dados_preco.get('preco_atual', _preco_atual)
-                            dy = dados_preco.get('dy')
-                            pl = dados_preco.get('pl')
-                            pvp = dados_preco.get('pvp')
-                            roe = dados_preco.get('roe')
-                        else:
-                            # Fallback individual para reduzir falsos negativos do batch.
-                            info_fallback = obter_informacoes_ativo(_ticker)
-                            if info_fallback and info_fallback.get('preco_atual') not in (None, 0):
-                                preco_atual = float(info_fallback.get('preco_atual') or _preco_atual)
-                                dy = info_fallback.get('dy', _dy_atual)
-                                pl = info_fallback.get('pl', _pl_atual)
-                                pvp = info_fallback.get('pvp', _pvp_atual)
-                                roe = info_fallback.get('roe', _roe_atual)
-                                print(f"[INFO] Preco recuperado via fallback individual para {_ticker}")
-                            else:
-                                # Se não tem indexador e não está no batch, manter preço e indicadores atuais
-                                print(f"[AVISO] Preco nao encontrado em batch para {_ticker}, mantendo preco atual")
-                                preco_atual = _preco_atual
-                                dy = _dy_atual; pl = _pl_atual; pvp = _pvp_atual; roe = _roe_atual
+        rows = _ler_carteira_para_precos(usuario)
+        tickers_para_buscar = list(dict.fromkeys(str(r[1]) for r in rows if r[1] and not r[5]))
+        print(f" Buscando preços em batch para {len(tickers_para_buscar)} tickers...")
+        precos_batch = obter_precos_batch(tickers_para_buscar)
+        atualizados = _gravar_precos_carteira(usuario, rows, precos_batch)
+        
+        print(f"DEBUG: Atualização concluída. {atualizados} ativos atualizados, {len(erros)} erros")
+        try:
+            registrar_snapshot_patrimonio_carteira(usuario)
+        except Exception as snap_err:
+            print(f"[patrimonio] aviso snapshot após atualizar preços: {snap_err}")
+        return {"success": True, "updated": atualizados, "errors": erros}
+    except Exception as e:
+        return {"success": False, "message": f"Erro ao atualizar carteira: {str(e)}"}
 
-                        # Persistir atualização
-                        valor_total = preco_atual * _qtd
-                        c.execute(
-                            'UPDATE carteira SET preco_atual=%s, valor_total=%s, dy=%s, pl=%s, pvp=%s, roe=%s WHERE id=%s',
-                            (preco_atual, valor_total, dy, pl, pvp, roe, _id)
-                        )
-                        atualizados += 1
-                conn.commit()
-            finally:
-                conn.close()
-        else:
-            db_path = get_db_path(usuario, "carteira")
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-            try:
-                cur = conn.cursor()
-                cur.execute('SELECT id, ticker, quantidade, preco_atual, data_adicao, indexador, indexador_pct, indexador_base_preco, indexador_base_data, preco_compra, preco_medio, data_aplicacao, dy, pl, pvp, roe FROM carteira')
-                rows = cur.fetchall()
-                
-                # Coletar todos os tickers únicos para SQLite também
-                tickers_para_buscar = []
-                for row in rows:
-                    _ticker = str(row[1] or '')
-                    if _ticker and _ticker not in tickers_para_buscar:
-                        tickers_para_buscar.append(_ticker)
-                
-                # Buscar todos os preços de uma vez
-                print(f"🔄 Buscando preços em batch para {len(tickers_para_buscar)} tickers (SQLite)...")
-                precos_batch = obter_precos_batch(tickers_para_buscar)
-                
-                for row in rows:
-                    _id, _ticker, _qtd = row[0], str(row[1] or ''), float(row[2] or 0)
-                    _preco_atual = float(row[3] or 0)
-                    _data_adicao = row[4]
-                    _indexador = row[5]
-                    # CONVERSÃO ROBUSTA para SQLite (consistência com PostgreSQL)
-                    _indexador_pct_raw = row[6]
-                    if _indexador_pct_raw is not None:
-                        try:
-                            if isinstance(_indexador_pct_raw, (int, float)):
-                                _indexador_pct = float(_indexador_pct_raw)
-                            elif isinstance(_indexador_pct_raw, str):
-                                _indexador_pct = float(_indexador_pct_raw.replace(',', '.'))
-                            else:
-                                _indexador_pct = float(str(_indexador_pct_raw))
-                            
-                            # Validação: mantém faixa ampla e deixa normalização fina para o cálculo
-                            if _indexador_pct <= 0 or _indexador_pct > 1000:
-                                print(f"[ERRO] Indexador_pct fora do range: {_indexador_pct}% para {_ticker}. Usando None.")
-                                _indexador_pct = None
-                        except (ValueError, TypeError, AttributeError) as e:
-                            print(f"[ERRO] Erro ao converter indexador_pct para {_ticker}: {_indexador_pct_raw} (tipo: {type(_indexador_pct_raw).__name__}) - {e}")
-                            _indexador_pct = None
-                    else:
-                        _indexador_pct = None
-                    base_preco = float(row[7]) if (len(row) > 7 and row[7] is not None) else None
-                    base_data = row[8] if (len(row) > 8) else None
-                    _preco_compra = float(row[9]) if (len(row) > 9 and row[9] is not None) else None
-                    _preco_medio = float(row[10]) if (len(row) > 10 and row[10] is not None) else None
-                    _data_aplicacao = row[11] if (len(row) > 11 and row[11]) else None
-                    _dy_atual = float(row[12]) if (len(row) > 12 and row[12] is not None) else None
-                    _pl_atual = float(row[13]) if (len(row) > 13 and row[13] is not None) else None
-                    _pvp_atual = float(row[14]) if (len(row) > 14 and row[14] is not None) else None
-                    _roe_atual = float(row[15]) if (len(row) > 15 and row[15] is not None) else None
-                    
-                    if not _ticker:
-                        continue
-                    
-                    # CORREÇÃO CRÍTICA: Se tem indexador, calcular SEMPRE (mesmo que não esteja no batch)
-                    if _indexador:
-                        print(f"DEBUG: Ativo {_ticker} tem indexador {_indexador} com {_indexador_pct}%")
-                        
 
-                        if base_preco is not None and base_data:
-                            preco_inicial = base_preco
-                            # Preferir data_aplicacao quando existir (evita superacumulação
-                            # por base_data legado desatualizado).
-                            data_base_calculo = _data_aplicacao or base_data
-                            print(f"DEBUG: Usando indexador_base_preco: {preco_inicial}")
-                        elif _preco_compra is not None and _preco_compra > 0:
-                            preco_inicial = _preco_compra
-                            data_base_calculo = _data_aplicacao or _data_adicao
-                            print(f"DEBUG: Usando preco_compra: {preco_inicial}")
-                        elif _preco_medio is not None and _preco_medio > 0:
-                            preco_inicial = _preco_medio
-                            data_base_calculo = _data_aplicacao or _data_adicao
-                            print(f"DEBUG: Usando preco_medio: {preco_inicial}")
-                        else:
-                            # Último recurso: buscar primeira movimentação
-                            cur.execute('SELECT preco FROM movimentacoes WHERE ticker = ? ORDER BY data ASC LIMIT 1', (_ticker,))
-                            mov_row = cur.fetchone()
-                            if mov_row and mov_row[0] and float(mov_row[0]) > 0:
-                                preco_inicial = float(mov_row[0])
-                                data_base_calculo = _data_aplicacao or _data_adicao
-                                print(f"DEBUG: Usando primeira movimentação: {preco_inicial}")
-                            else:
-                                # Se não encontrou nada, pular este ativo (não atualizar)
-                                print(f"[ERRO CRITICO] Nao foi possivel determinar preco inicial para {_ticker} com indexador. Pulando atualizacao.")
-                                continue
-                        
-                        print(f"DEBUG: Preço inicial encontrado: {preco_inicial}, data base: {data_base_calculo}")
-                        
-                        # VALIDAÇÃO PRÉ-CÁLCULO: Garantir que preco_inicial é válido
-                        if preco_inicial is None or preco_inicial <= 0 or not isinstance(preco_inicial, (int, float)):
-                            print(f"[ERRO CRITICO] Preco inicial invalido para {_ticker}: {preco_inicial}. Pulando atualizacao.")
-                            continue
-                        
-                        preco_atual = calcular_preco_com_indexador(preco_inicial, _indexador, _indexador_pct, data_base_calculo)
-                        
+# ==================== REFRESH AGENDADO DAS CARTEIRAS ====================
+# Antes, a carteira só era reprecificada quando o usuário pedia (refresh em
+# /api/carteira, /api/carteira/refresh ou /api/batch) e ele esperava a rede.
+# Agora uma thread por worker acorda a cada minuto durante o pregão da B3; o
+# worker que pegar a lease (carteira_refresh.db) e achar a última rodada mais
+# velha que CARTEIRA_REFRESH_S reprecifica todas as carteiras de uma vez
+# (modo entre usuários): as carteiras vêm dos schemas u_* (Postgres) ou das
+# pastas de bancos_usuarios (SQLite), os tickers distintos de todas elas vão
+# uma única vez ao obter_precos_batch e o resultado é espalhado para cada
+# carteira num UPDATE em lote, com o snapshot do dia. Cada rodada grava um
+# relatório (razão de deduplicação e tempos) que aparece nas métricas.
+# As páginas só leem o banco; o refresh manual continua disponível e o admin
+# pode disparar uma rodada em POST /api/admin/carteiras/atualizar.
+
+_CARTEIRA_REFRESH_DB = os.path.join(_STORE_DIR, 'carteira_refresh.db')
+_CARTEIRA_REFRESH_S = float(os.getenv('CARTEIRA_REFRESH_S', '900'))  # 0 desliga
+_CARTEIRA_REFRESH_LEASE_S = 1800.0
+# Pregão da B3 em horário de Brasília (sem horário de verão desde 2019). O fim
+# passa do call de fechamento para a última rodada gravar o preço de fechamento.
+_FUSO_B3 = timezone(timedelta(hours=-3))
+_PREGAO_B3 = ((10, 0), (18, 15))
+_CARTEIRA_REFRESH_TABELAS_OK = False
+_CARTEIRA_REFRESH_THREAD_PID = None
+_CARTEIRA_REFRESH_THREAD_LOCK = threading.Lock()
+_CARTEIRA_REFRESH_M = {"rodadas": 0, "erros": 0}
+
+def _pregao_b3_aberto(agora=None):
+    agora = agora or datetime.now(_FUSO_B3)
+    if agora.weekday() >= 5:
+        return False
+    return _PREGAO_B3[0] <= (agora.hour, agora.minute) < _PREGAO_B3[1]
+
+def _carteira_refresh_conn():
+    global _CARTEIRA_REFRESH_TABELAS_OK
+    conn = _sqlite_connect(_CARTEIRA_REFRESH_DB)
+    if not _CARTEIRA_REFRESH_TABELAS_OK:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS carteira_refresh (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                ultima_execucao REAL NOT NULL DEFAULT 0,
+                duracao_s REAL,
+                usuarios INTEGER,
+                tickers INTEGER,
+                linhas INTEGER,
+                erros INTEGER,
+                lease_pid INTEGER,
+                lease_expira REAL,
+                relatorio TEXT
+            )
+        ''')
+        try:
+            conn.execute('ALTER TABLE carteira_refresh ADD COLUMN relatorio TEXT')
+        except Exception:
+            pass
+        conn.commit()
+        _CARTEIRA_REFRESH_TABELAS_OK = True
+    return conn
 
-                        if preco_atual is None or not isinstance(preco_atual, (int, float)) or preco_atual <= 0:
-                            print(f"[ERRO CRITICO] Preco calculado invalido (None/zero/nao-numerico) para {_ticker}: {preco_atual}. Mantendo preco inicial.")
-                            preco_atual = preco_inicial
-                        elif preco_atual < preco_inicial * 0.2 or preco_atual > preco_inicial * 20.0:
-                            print(f"[ERRO CRITICO] Preco calculado absurdo para {_ticker}: inicial={preco_inicial}, calculado={preco_atual} (fator={preco_atual/preco_inicial:.4f}x). Mantendo preco inicial para evitar corrupcao.")
-                            preco_atual = preco_inicial  # CORREÇÃO: Manter preço inicial, não o atual (que pode estar corrompido)
-                        else:
-                            print(f"DEBUG: Preço calculado com indexador: {preco_atual} (inicial: {preco_inicial}, fator: {preco_atual/preco_inicial:.4f}x)")
-                        
-                        # Preservar indicadores já existentes para ativos com indexador.
-                        dy = _dy_atual
-                        pl = _pl_atual
-                        pvp = _pvp_atual
-                        roe = _roe_atual
-                    elif _ticker in precos_batch:
-                        # Se não tem indexador, usar preços do batch (yfinance)
-                        dados_preco = precos_batch[_ticker]
-                        preco_atual = dados_preco.get('preco_atual', _preco_atual)
-                        dy = dados_preco.get('dy')
-                        pl = dados_preco.get('pl')
-                        pvp = dados_preco.get('pvp')
-                        roe = dados_preco.get('roe')
-                    else:
-                        # Fallback individual para reduzir falsos negativos do batch.
-                        info_fallback = obter_informacoes_ativo(_ticker)
-                        if info_fallback and info_fallback.get('preco_atual') not in (None, 0):
-                            preco_atual = float(info_fallback.get('preco_atual') or _preco_atual)
-                            dy = info_fallback.get('dy', _dy_atual)
-                            pl = info_fallback.get('pl', _pl_atual)
-                            pvp = info_fallback.get('pvp', _pvp_atual)
-                            roe = info_fallback.get('roe', _roe_atual)
-                            print(f"[INFO] Preco recuperado via fallback individual para {_ticker}")
-                        else:
-                            # Se não tem indexador e não está no batch, manter preço e indicadores atuais
-                            print(f"[AVISO] Preco nao encontrado em batch para {_ticker}, mantendo preco atual")
-                            preco_atual = _preco_atual
-                            dy = _dy_atual
-                            pl = _pl_atual
-                            pvp = _pvp_atual
-                            roe = _roe_atual
-                    
-                    valor_total = preco_atual * _qtd
-                    cur.execute(
-                        'UPDATE carteira SET preco_atual = ?, valor_total = ?, dy = ?, pl = ?, pvp = ?, roe = ? WHERE id = ?',
-                        (preco_atual, valor_total, dy, pl, pvp, roe, _id)
-                    )
-                    atualizados += 1
-                conn.commit()
-            finally:
-                conn.close()
-        
-        print(f"DEBUG: Atualização PostgreSQL concluída. {atualizados} ativos atualizados, {len(erros)} erros")
+def _carteira_refresh_pegar_lease(forcar=False):
+    """True se este worker deve rodar agora (intervalo vencido, ou `forcar`, e ninguém rodando)."""
+    agora = time.time()
+    conn = _carteira_refresh_conn()
+    try:
+        conn.execute('INSERT OR IGNORE INTO carteira_refresh (id, ultima_execucao) VALUES (1, 0)')
+        cur = conn.execute(
+            '''UPDATE carteira_refresh SET lease_pid = ?, lease_expira = ?
+               WHERE id = 1 AND ultima_execucao <= ? AND (lease_expira IS NULL OR lease_expira < ?)''',
+            (os.getpid(), agora + _CARTEIRA_REFRESH_LEASE_S, agora if forcar else agora - _CARTEIRA_REFRESH_S, agora),
+        )
+        conn.commit()
+        return cur.rowcount > 0
+    finally:
+        conn.close()
+
+def _carteira_refresh_concluir(inicio, relatorio):
+    relatorio = relatorio or {}
+    conn = _carteira_refresh_conn()
+    try:
+        conn.execute(
+            '''UPDATE carteira_refresh SET ultima_execucao = ?, duracao_s = ?, usuarios = ?, tickers = ?,
+                      linhas = ?, erros = ?, relatorio = ?, lease_pid = NULL, lease_expira = NULL
+               WHERE id = 1''',
+            (inicio, round(time.time() - inicio, 1), relatorio.get('usuarios'), relatorio.get('tickers_distintos'),
+             relatorio.get('linhas'), len(relatorio['erros']) if 'erros' in relatorio else None,
+             json.dumps(relatorio, default=str) if relatorio else None),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def _armazenamento_carteira(usuario):
+    """Schema (Postgres) ou pasta (SQLite) onde fica a carteira de `usuario`."""
+    return _pg_schema_for_user(usuario) if _is_postgres() else _storage_usuario_cached(usuario)
+
+def _carteiras_armazenadas():
+    """Schemas u_* com tabela carteira (Postgres) ou pastas de bancos_usuarios com carteira.db (SQLite)."""
+    if _is_postgres():
+        conn = _get_pg_conn()
+        try:
+            with conn.cursor() as c:
+                c.execute(
+                    "SELECT table_schema FROM information_schema.tables "
+                    "WHERE table_name = 'carteira' AND table_schema LIKE 'u\\_%'"
+                )
+                return {r[0] for r in c.fetchall()}
+        finally:
+            conn.close()
+    base = _bancos_usuarios_root()
+    if not os.path.isdir(base):
+        return set()
+    return {nome for nome in os.listdir(base) if os.path.isfile(os.path.join(base, nome, "carteira.db"))}
+
+def atualizar_precos_carteiras_usuarios():
+    """
+    Reprecifica todas as carteiras de uma vez. Percorre os schemas/pastas que
+    têm carteira (cada um uma vez, mesmo com mais de um login apontando para
+    ele; usuários bloqueados ficam de fora), busca os tickers distintos de
+    todas num único obter_precos_batch e grava cada carteira em lote, com o
+    snapshot do dia e a limpeza do cache.
+
+    Devolve o relatório da rodada: carteiras, pares (carteira, ticker),
+    tickers distintos, `razao_dedup` (pares / distintos: quantas buscas a
+    rodada economizou em relação ao refresh usuário a usuário), linhas
+    gravadas, erros e os tempos de leitura, busca, gravação e total.
+    """
+    inicio = time.time()
+    armazenadas = _carteiras_armazenadas()
+    carteiras = {}
+    erros = []
+    for u in listar_usuarios():
+        usuario = u.get('username')
+        if not usuario or u.get('blocked'):
+            continue
+        try:
+            chave = _armazenamento_carteira(usuario)
+            if chave not in armazenadas or chave in carteiras:
+                continue
+            rows = _ler_carteira_para_precos(usuario)
+        except Exception as e:
+            erros.append(f"{usuario}: {e}")
+            continue
+        if rows:
+            carteiras[chave] = (usuario, rows)
+    lidas_em = time.time()
+
+    por_carteira = [
+        {str(r[1]) for r in rows if r[1] and not r[5]} for _, rows in carteiras.values()
+    ]
+    tickers = sorted(set().union(*por_carteira)) if por_carteira else []
+    pares = sum(len(t) for t in por_carteira)
+    precos_batch = obter_precos_batch(tickers) if tickers else {}
+    buscados_em = time.time()
+
+    linhas = 0
+    for usuario, rows in carteiras.values():
+        # registrar_snapshot_patrimonio_carteira lê a carteira via get_usuario_atual()
+        _USUARIO_THREAD.usuario = usuario
+        try:
+            linhas += _gravar_precos_carteira(usuario, rows, precos_batch)
+            registrar_snapshot_patrimonio_carteira(usuario)
+            if cache:
+                cache.delete(f"carteira:{usuario}")
+                cache.delete(f"carteira_insights:{usuario}")
+        except Exception as e:
+            erros.append(f"{usuario}: {e}")
+        finally:
+            _USUARIO_THREAD.usuario = None
+    fim = time.time()
+
+    relatorio = {
+        "usuarios": len(carteiras),
+        "pares_carteira_ticker": pares,
+        "tickers_distintos": len(tickers),
+        "tickers_com_preco": sum(1 for t in tickers if t in precos_batch),
+        "razao_dedup": round(pares / len(tickers), 2) if tickers else None,
+        "buscas_evitadas": pares - len(tickers),
+        "linhas": linhas,
+        "erros": erros,
+        "leitura_s": round(lidas_em - inicio, 2),
+        "busca_s": round(buscados_em - lidas_em, 2),
+        "gravacao_s": round(fim - buscados_em, 2),
+        "tempo_total_s": round(fim - inicio, 2),
+    }
+    print(f"[carteiras] {relatorio['usuarios']} carteiras, {pares} pares -> {len(tickers)} tickers "
+          f"(dedup {relatorio['razao_dedup']}x), {linhas} linhas em {relatorio['tempo_total_s']}s "
+          f"({len(erros)} erros)")
+    return relatorio
+
+def executar_refresh_carteiras(forcar=False):
+    """
+    Uma rodada de `atualizar_precos_carteiras_usuarios` sob a lease. Sem
+    `forcar`, só roda se o intervalo venceu. Devolve o relatório, ou None se
+    não era hora ou outra rodada está em andamento.
+    """
+    if not _carteira_refresh_pegar_lease(forcar):
+        return None
+    inicio = time.time()
+    relatorio = None
+    try:
+        relatorio = atualizar_precos_carteiras_usuarios()
+        _CARTEIRA_REFRESH_M["rodadas"] += 1
+        return relatorio
+    except Exception:
+        _CARTEIRA_REFRESH_M["erros"] += 1
+        raise
+    finally:
+        try:
+            _carteira_refresh_concluir(inicio, relatorio)
+        except Exception as e:
+            print(f"[carteiras] aviso: não foi possível registrar a rodada: {e}")
+
+def _loop_refresh_carteiras():
+    while True:
+        time.sleep(60)
+        try:
+            if _pregao_b3_aberto():
+                executar_refresh_carteiras()
+        except Exception as e:
+            print(f"[carteiras] erro no refresh agendado: {e}")
+
+def _garantir_refresher_carteiras():
+    global _CARTEIRA_REFRESH_THREAD_PID
+    if _CARTEIRA_REFRESH_S <= 0:
+        return
+    pid = os.getpid()
+    if _CARTEIRA_REFRESH_THREAD_PID == pid:
+        return
+    with _CARTEIRA_REFRESH_THREAD_LOCK:
+        if _CARTEIRA_REFRESH_THREAD_PID == pid:
+            return
+        _CARTEIRA_REFRESH_THREAD_PID = pid
+    threading.Thread(target=_loop_refresh_carteiras, name='carteiras-refresh', daemon=True).start()
+
+def obter_metricas_refresh_carteiras():
+    out = {
+        "intervalo_s": _CARTEIRA_REFRESH_S,
+        "pregao_aberto": _pregao_b3_aberto(),
+        "thread_ativa": _CARTEIRA_REFRESH_THREAD_PID == os.getpid(),
+        "processo": dict(_CARTEIRA_REFRESH_M),
+    }
+    try:
+        conn = _carteira_refresh_conn()
         try:
-            registrar_snapshot_patrimonio_carteira(usuario)
-        except Exception as snap_err:
-            print(f"[patrimonio] aviso snapshot após atualizar preços: {snap_err}")
-        return {"success": True, "updated": atualizados, "errors": erros}
-    except Exception as e:
-        return {"success": False, "message": f"Erro ao atualizar carteira: {str(e)}"}
+            row = conn.execute(
+                'SELECT ultima_execucao, duracao_s, usuarios, tickers, linhas, erros, lease_pid, relatorio FROM carteira_refresh WHERE id = 1'
+            ).fetchone()
+        finally:
+            conn.close()
+    except Exception:
+        row = None
+    if row:
+        out.update({
+            "ultima_execucao": datetime.fromtimestamp(row[0]).isoformat(timespec='seconds') if row[0] else None,
+            "duracao_s": row[1], "usuarios": row[2], "tickers": row[3], "linhas": row[4], "erros": row[5],
+            "em_execucao_pid": row[6],
+            "ultimo_relatorio": json.loads(row[7]) if row[7] else None,
+        })
+    return out
 
 def _calcular_status_vencimento(vencimento):
 
@@ -4324,18 +5592,9 @@ def _determinar_preco_compra(ticker, preco_inicial, data_aplicacao, tipo):
                         return close_val_brl
                     except Exception as e:
                         print(f"DEBUG: Erro ao converter preço histórico cripto {ticker}: {e}")
-            start = base_date - timedelta(days=14)
-            end = base_date + timedelta(days=1)
-            t = ticker.strip().upper()
-            t_yf = t + '.SA' if ('-' not in t and '.' not in t and len(t) <= 6) else t
-            hist = yf.Ticker(t_yf).history(start=start.isoformat(), end=end.isoformat())
-            if hist is not None and not hist.empty:
-                close_val = None
-                for idx, row in hist[::-1].iterrows():
-                    d = idx.date()
-                    if d <= base_date:
-                        close_val = float(row.get('Close') or row.get('Adj Close') or 0)
-                        break
+            if not is_crypto_ticker(ticker):
+                res = precos_em_datas([(ticker, base_date)], janela_dias=14)[0]
+                close_val = res["preco"] if res else None
                 if close_val and close_val > 0:
                     print(f"DEBUG: Usando preço histórico para {ticker} em {data_aplicacao}: {close_val}")
                     return close_val
@@ -4436,27 +5695,11 @@ def adicionar_ativo_carteira(ticker, quantidade, tipo=None, preco_inicial=None,
             return {"success": False, "message": "Usuário não autenticado"}
         # Ensure schema and tables exist in the user schema
         init_carteira_db(usuario)
-        _ensure_indexador_schema()
         
         if _is_postgres():
             conn = _pg_conn_for_user(usuario)
             try:
                 with conn.cursor() as cursor:
-                    
-                    try:
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_compra NUMERIC')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador TEXT')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS indexador_pct NUMERIC')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS data_aplicacao TEXT')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS vencimento TEXT')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS isento_ir BOOLEAN')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS liquidez_diaria BOOLEAN')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS preco_medio NUMERIC')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS emissor_rf TEXT')
-                        cursor.execute('ALTER TABLE carteira ADD COLUMN IF NOT EXISTS tipo_renda_fixa TEXT')
-                    except Exception as e:
-                        print(f"DEBUG: Erro ao adicionar colunas (pode ser normal se já existirem): {e}")
-                    
                     cursor.execute(
                         'SELECT id, quantidade, ticker, nome_completo, indexador, indexador_pct FROM carteira WHERE ticker = %s',
                         (info["ticker"],)
@@ -4627,7 +5870,7 @@ def adicionar_ativo_carteira(ticker, quantidade, tipo=None, preco_inicial=None,
                 conn.close()
         else:
             db_path = get_db_path(usuario, "carteira")
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(db_path)
             cursor = conn.cursor()
             
           
@@ -4749,14 +5992,6 @@ def adicionar_ativo_carteira(ticker, quantidade, tipo=None, preco_inicial=None,
                     ''', (nova_quantidade, novo_valor_total, info["preco_atual"], info.get("dy"), info.get("pl"), info.get("pvp"), info.get("roe"), preco_medio_novo, id_existente))
                     mensagem = f"Aporte realizado em {ticker_mov}: {quantidade_existente} + {quantidade} = {nova_quantidade}"
             else:
-               
- 
-                try:
-                    cursor.execute('ALTER TABLE carteira ADD COLUMN preco_compra REAL')
-                except Exception:
-                    pass  
-                
-
                 preco_compra = preco_compra_definitivo
                 
                 cursor.execute('''
@@ -4816,7 +6051,7 @@ def remover_ativo_carteira(id):
                 print(f"[patrimonio] aviso snapshot após remover ativo: {snap_err}")
             return {"success": True, "message": "Ativo removido com sucesso"}
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         cursor.execute('SELECT ticker, nome_completo, quantidade, preco_atual FROM carteira WHERE id = ?', (id,))
         ativo = cursor.fetchone()
@@ -4929,7 +6164,7 @@ def atualizar_ativo_carteira(id, quantidade=None, preco_atual=None, preco_compra
                 print(f"[patrimonio] aviso snapshot após atualizar ativo: {snap_err}")
             return {"success": True, "message": "Ativo atualizado com sucesso"}
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('SELECT ticker, nome_completo, preco_atual, quantidade, indexador, indexador_pct FROM carteira WHERE id = ?', (id,))
@@ -5012,9 +6247,9 @@ def atualizar_ativo_carteira(id, quantidade=None, preco_atual=None, preco_compra
         return {"success": False, "message": f"Erro ao atualizar ativo: {str(e)}"}
 
 def _ensure_goals_schema():
-    usuario = get_usuario_atual()
-    if not usuario:
-        return
+    garantir_schema_usuario(get_usuario_atual(), 'carteira')
+
+def _mig_carteira_goals(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -5035,7 +6270,7 @@ def _ensure_goals_schema():
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('''
@@ -5075,7 +6310,7 @@ def get_goals():
         finally:
             conn.close()
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         cur.execute('SELECT id, tipo, alvo, horizonte_meses, aporte_mensal, premissas, created_at, updated_at FROM goals ORDER BY id DESC LIMIT 1')
@@ -5118,7 +6353,7 @@ def save_goals(payload: dict):
         finally:
             conn.close()
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         cur.execute('DELETE FROM goals')
@@ -5191,10 +6426,10 @@ def compute_goals_projection(goal: dict):
 # ==================== METAS DE APORTES ====================
 
 def _ensure_metas_aportes_schema():
+    garantir_schema_usuario(get_usuario_atual(), 'carteira')
+
+def _mig_carteira_metas_aportes(usuario):
     """Cria schema para tabela de metas de aportes"""
-    usuario = get_usuario_atual()
-    if not usuario:
-        return
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -5220,7 +6455,7 @@ def _ensure_metas_aportes_schema():
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('''
@@ -5327,7 +6562,7 @@ def get_metas_aportes():
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('''
@@ -5403,7 +6638,7 @@ def save_meta_aporte(payload: dict):
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             if meta_id:
@@ -5442,7 +6677,7 @@ def delete_meta_aporte(meta_id: int):
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('UPDATE metas_aportes SET ativo=0, updated_at=? WHERE id=?', (now, meta_id))
@@ -5839,7 +7074,7 @@ def migrar_preco_compra_existente():
                 conn.close()
         else:
             db_path = get_db_path(usuario, "carteira")
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(db_path)
             try:
                 cursor = conn.cursor()
                 # Buscar ativos sem preco_compra
@@ -5956,7 +7191,7 @@ def obter_carteira_com_metadados_fii():
                 ativos.append(ativo)
             return ativos
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         cursor.execute('''
             SELECT id, ticker, nome_completo, quantidade, preco_atual, preco_compra, valor_total,
@@ -6015,6 +7250,7 @@ def obter_carteira():
         usuario = get_usuario_atual()
         if not usuario:
             return {"success": False, "message": "Usuário não autenticado"}
+        _garantir_refresher_carteiras()
 
         
         try:
@@ -6079,7 +7315,7 @@ def obter_carteira():
                 ativos.append(ativo)
             return ativos
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         cursor.execute('''
             SELECT id, ticker, nome_completo, quantidade, preco_atual, preco_compra, valor_total,
@@ -6166,10 +7402,9 @@ def obter_valorizacao_periodo(periodo):
             data_inicio = hoje.replace(month=1, day=1)
         else:
             return []
-        data_inicio_str = data_inicio.isoformat()
-        max_workers = min(len(carteira), YF_MAX_CONCURRENT, 12)
+        precos_inicio = precos_em_datas([((a.get("ticker") or "").strip(), data_inicio) for a in carteira])
 
-        def item_para_ativo(ativo):
+        def item_para_ativo(ativo, res):
             ticker = (ativo.get("ticker") or "").strip()
             qtd = float(ativo.get("quantidade") or 0)
             preco_atual = float(ativo.get("preco_atual") or 0)
@@ -6183,7 +7418,6 @@ def obter_valorizacao_periodo(periodo):
                     "valorizacao_reais": None,
                     "valorizacao_pct": None,
                 }
-            res = obter_preco_historico(ticker, data_inicio_str)
             preco_inicio = float(res["preco"]) if res and res.get("preco") is not None else None
             if preco_inicio is None or preco_inicio <= 0:
                 return {
@@ -6207,15 +7441,13 @@ def obter_valorizacao_periodo(periodo):
                 "valorizacao_pct": valorizacao_pct,
             }
 
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(item_para_ativo, ativo): ativo for ativo in carteira}
-            resultados = []
-            for fut in as_completed(futures):
-                try:
-                    resultados.append(fut.result())
-                except Exception as e:
-                    print(f"Erro ao calcular valorização por período: {e}")
-            return resultados
+        resultados = []
+        for ativo, res in zip(carteira, precos_inicio):
+            try:
+                resultados.append(item_para_ativo(ativo, res))
+            except Exception as e:
+                print(f"Erro ao calcular valorização por período: {e}")
+        return resultados
     except Exception as e:
         print(f"Erro em obter_valorizacao_periodo: {e}")
         return []
@@ -6250,7 +7482,7 @@ def save_rebalance_config(periodo: str, targets: dict, last_rebalance_date: str
         return {"success": True}
     # sqlite
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         c = conn.cursor()
         c.execute('SELECT id, start_date FROM rebalance_config LIMIT 1')
@@ -6292,7 +7524,7 @@ def get_rebalance_config():
         finally:
             conn.close()
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         c = conn.cursor()
         c.execute('SELECT periodo, targets_json, start_date, last_rebalance_date, updated_at FROM rebalance_config LIMIT 1')
@@ -6414,7 +7646,7 @@ def registrar_rebalance_event(date_str: str | None = None):
             conn.close()
     else:
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             cur.execute('INSERT INTO rebalance_history (data, created_at) VALUES (?, ?)', (event_date, now))
@@ -6438,7 +7670,7 @@ def get_rebalance_history():
         finally:
             conn.close()
     db_path = get_db_path(usuario, "carteira")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         cur.execute('SELECT data FROM rebalance_history ORDER BY id DESC')
@@ -6446,6 +7678,166 @@ def get_rebalance_history():
     finally:
         conn.close()
 
+# ==================== LEDGER DE POSIÇÕES ====================
+# posicoes_ledger guarda, por (ticker, dia), o estado da posição ao fim do dia:
+# quantidade acumulada, custo total/médio, lucro realizado acumulado e a data da
+# primeira compra. registrar_movimentacao atualiza a linha do dia na mesma
+# transação do INSERT; movimentação retroativa (dia anterior à última linha do
+# ticker) reconstrói só aquele ticker a partir de movimentacoes.
+# Regras: compra soma e recompõe o custo médio; venda baixa pelo custo médio e
+# realiza (preço - médio) * quantidade. 'atualizado' (sobrescrever um ativo que já
+# existe) não mexe na posição, como no replay de proventos. O replay do histórico
+# comparado somava essas linhas à quantidade; lido do ledger, a curva da carteira
+# deixa de contar a sobrescrita como compra.
+# A quantidade não é truncada em zero: quem lê decide (q > 0).
+# No PostgreSQL (conexões em autocommit) o INSERT + ledger e a reconstrução rodam
+# em conn.transaction(); no SQLite o DELETE já abre a transação implícita, e em
+# ambos quem lê continua vendo o ledger anterior até o commit.
+
+def _ledger_passo(estado, quantidade, preco, tipo, dia):
+    """Aplica uma movimentação a (quantidade, custo_total, lucro_realizado, primeira_compra)."""
+    qtd, custo, lucro, primeira = estado
+    q = float(quantidade or 0)
+    p = float(preco or 0)
+    tipo = str(tipo or '').strip().lower()
+    if tipo == 'compra':
+        qtd, custo = qtd + q, custo + q * p
+        primeira = primeira or dia
+    elif tipo == 'venda':
+        medio = custo / qtd if qtd > 0 else 0.0
+        lucro += q * (p - medio) if qtd > 0 else 0.0
+        qtd -= q
+        custo = custo - q * medio if qtd > 0 else 0.0
+    return qtd, custo, lucro, primeira
+
+def _ledger_linha(ticker, dia, estado):
+    qtd, custo, lucro, primeira = estado
+    return (ticker, dia, qtd, custo, (custo / qtd) if qtd > 0 else 0.0, lucro, primeira)
+
+_SQL_LEDGER_UPSERT = '''
+    INSERT INTO posicoes_ledger (ticker, data, quantidade, custo_total, custo_medio, lucro_realizado, primeira_compra)
+    VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+    ON CONFLICT (ticker, data) DO UPDATE SET quantidade = excluded.quantidade, custo_total = excluded.custo_total,
+        custo_medio = excluded.custo_medio, lucro_realizado = excluded.lucro_realizado,
+        primeira_compra = excluded.primeira_compra
+'''
+
+def _ledger_reconstruir(c, ph, ticker=None):
+    """Refaz o ledger (de um ticker ou de todos) a partir de movimentacoes, no cursor `c`."""
+    if ticker is None:
+        c.execute('DELETE FROM posicoes_ledger')
+        c.execute('SELECT ticker, data, quantidade, preco, tipo FROM movimentacoes ORDER BY ticker, data, id')
+    else:
+        c.execute(f'DELETE FROM posicoes_ledger WHERE ticker = {ph}', (ticker,))
+        c.execute(
+            f'SELECT ticker, data, quantidade, preco, tipo FROM movimentacoes WHERE ticker = {ph} ORDER BY data, id',
+            (ticker,),
+        )
+    linhas = {}
+    estados = {}
+    for tk, data, quantidade, preco, tipo in c.fetchall():
+        dia = str(data)[:10]
+        estados[tk] = _ledger_passo(estados.get(tk, (0.0, 0.0, 0.0, None)), quantidade, preco, tipo, dia)
+        linhas[(tk, dia)] = _ledger_linha(tk, dia, estados[tk])
+    if linhas:
+        c.executemany(_SQL_LEDGER_UPSERT.format(ph=ph), list(linhas.values()))
+    return len(linhas)
+
+def _ledger_aplicar(c, ph, data, ticker, quantidade, preco, tipo):
+    """Atualização incremental depois do INSERT em movimentacoes (mesmo cursor/transação)."""
+    dia = str(data)[:10]
+    c.execute(
+        f'SELECT MAX(data) FROM posicoes_ledger WHERE ticker = {ph}',
+        (ticker,),
+    )
+    ultimo = c.fetchone()[0]
+    if ultimo is not None and str(ultimo) > dia:
+        _ledger_reconstruir(c, ph, ticker)
+        return
+    estado = (0.0, 0.0, 0.0, None)
+    if ultimo is not None:
+        c.execute(
+            f'''SELECT quantidade, custo_total, lucro_realizado, primeira_compra FROM posicoes_ledger
+                WHERE ticker = {ph} AND data = {ph}''',
+            (ticker, ultimo),
+        )
+        row = c.fetchone()
+        estado = (float(row[0] or 0), float(row[1] or 0), float(row[2] or 0), row[3])
+    estado = _ledger_passo(estado, quantidade, preco, tipo, dia)
+    c.execute(_SQL_LEDGER_UPSERT.format(ph=ph), _ledger_linha(ticker, dia, estado))
+
+def _mig_carteira_posicoes_ledger(usuario):
+    pg = _is_postgres()
+    ph = '%s' if pg else '?'
+    conn = _pg_conn_for_user(usuario) if pg else _sqlite_connect(get_db_path(usuario, 'carteira'))
+    try:
+        c = conn.cursor()
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS posicoes_ledger (
+                ticker TEXT NOT NULL,
+                data TEXT NOT NULL,
+                quantidade {'NUMERIC' if pg else 'REAL'} NOT NULL,
+                custo_total {'NUMERIC' if pg else 'REAL'} NOT NULL,
+                custo_medio {'NUMERIC' if pg else 'REAL'} NOT NULL,
+                lucro_realizado {'NUMERIC' if pg else 'REAL'} NOT NULL,
+                primeira_compra TEXT,
+                PRIMARY KEY (ticker, data)
+            ){'' if pg else ' WITHOUT ROWID'}
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_posicoes_ledger_data ON posicoes_ledger(data)")
+        if pg:
+            with conn.transaction():
+                n = _ledger_reconstruir(c, ph)
+        else:
+            n = _ledger_reconstruir(c, ph)
+        conn.commit()
+        if n:
+            print(f"[ledger] {n} linhas de posição geradas das movimentações de {usuario}")
+    finally:
+        conn.close()
+
+def _consultar_banco_carteira(sql, params=(), usuario=None):
+    """Executa `sql` (placeholders como {ph}) no banco de carteira do usuário e devolve as linhas."""
+    usuario = usuario or get_usuario_atual()
+    if not usuario:
+        return []
+    garantir_schema_usuario(usuario, 'carteira')
+    pg = _is_postgres()
+    conn = _pg_conn_for_user(usuario) if pg else _sqlite_connect(get_db_path(usuario, 'carteira'))
+    try:
+        c = conn.cursor()
+        c.execute(sql.format(ph='%s' if pg else '?'), params)
+        return c.fetchall()
+    finally:
+        conn.close()
+
+def _ler_posicoes_ledger(usuario=None, colunas='data, ticker, quantidade'):
+    """Todas as linhas do ledger do usuário, em ordem de data (uma leitura, sem replay)."""
+    return _consultar_banco_carteira(f'SELECT {colunas} FROM posicoes_ledger ORDER BY data, ticker', usuario=usuario)
+
+def obter_posicao_em_data(ticker, data, usuario=None):
+    """
+    Posição de `ticker` ao fim do dia `data` ('YYYY-MM-DD'): dict com quantidade,
+    custo_medio, custo_total, lucro_realizado e primeira_compra, ou None se não
+    havia movimentação até lá. Uma busca na PK (ticker, data).
+    """
+    rows = _consultar_banco_carteira(
+        '''SELECT quantidade, custo_medio, custo_total, lucro_realizado, primeira_compra FROM posicoes_ledger
+           WHERE ticker = {ph} AND data <= {ph} ORDER BY data DESC LIMIT 1''',
+        (ticker, str(data)[:10]),
+        usuario,
+    )
+    if not rows:
+        return None
+    row = rows[0]
+    return {
+        "quantidade": float(row[0] or 0),
+        "custo_medio": float(row[1] or 0),
+        "custo_total": float(row[2] or 0),
+        "lucro_realizado": float(row[3] or 0),
+        "primeira_compra": row[4],
+    }
+
 def registrar_movimentacao(data, ticker, nome_completo, quantidade, preco, tipo, conn=None):
 
     try:
@@ -6458,69 +7850,42 @@ def registrar_movimentacao(data, ticker, nome_completo, quantidade, preco, tipo,
         if _is_postgres():
             # Se uma conexão foi passada, usar ela; senão criar nova
             if conn is not None:
-                with conn.cursor() as cursor:
-                    cursor.execute('''
-                        CREATE TABLE IF NOT EXISTS movimentacoes (
-                            id SERIAL PRIMARY KEY,
-                            data TEXT NOT NULL,
-                            ticker TEXT NOT NULL,
-                            nome_completo TEXT,
-                            quantidade NUMERIC NOT NULL,
-                            preco NUMERIC NOT NULL,
-                            tipo TEXT NOT NULL
-                        )
-                    ''')
+                with conn.transaction(), conn.cursor() as cursor:
                     cursor.execute(
                         'INSERT INTO movimentacoes (data, ticker, nome_completo, quantidade, preco, tipo) VALUES (%s, %s, %s, %s, %s, %s)',
                         (data, ticker, nome_completo, quantidade, preco, tipo)
                     )
-                    # CRÍTICO: Commit da movimentação no PostgreSQL
-                    conn.commit()
+                    _ledger_aplicar(cursor, '%s', data, ticker, quantidade, preco, tipo)
+                # CRÍTICO: Commit da movimentação no PostgreSQL
+                conn.commit()
             else:
+                garantir_schema_usuario(usuario, 'carteira')
                 pg_conn = _pg_conn_for_user(usuario)
                 try:
-                    with pg_conn.cursor() as cursor:
-                        cursor.execute('''
-                            CREATE TABLE IF NOT EXISTS movimentacoes (
-                                id SERIAL PRIMARY KEY,
-                                data TEXT NOT NULL,
-                                ticker TEXT NOT NULL,
-                                nome_completo TEXT,
-                                quantidade NUMERIC NOT NULL,
-                                preco NUMERIC NOT NULL,
-                                tipo TEXT NOT NULL
-                            )
-                        ''')
+                    with pg_conn.transaction(), pg_conn.cursor() as cursor:
                         cursor.execute(
                             'INSERT INTO movimentacoes (data, ticker, nome_completo, quantidade, preco, tipo) VALUES (%s, %s, %s, %s, %s, %s)',
                             (data, ticker, nome_completo, quantidade, preco, tipo)
                         )
-                        pg_conn.commit()
+                        _ledger_aplicar(cursor, '%s', data, ticker, quantidade, preco, tipo)
                 finally:
                     pg_conn.close()
         else:
             if conn is None:
+                # Com conexão do chamador o schema já foi garantido por ele (e uma
+                # segunda conexão aqui esperaria o lock de escrita da transação dele)
+                garantir_schema_usuario(usuario, 'carteira')
                 db_path = get_db_path(usuario, "carteira")
-                local_conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+                local_conn = _sqlite_connect(db_path)
                 should_close = True
             else:
                 should_close = False
             cursor = (conn or local_conn).cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS movimentacoes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    data TEXT NOT NULL,
-                    ticker TEXT NOT NULL,
-                    nome_completo TEXT,
-                    quantidade REAL NOT NULL,
-                    preco REAL NOT NULL,
-                    tipo TEXT NOT NULL
-                )
-            ''')
             cursor.execute('''
                 INSERT INTO movimentacoes (data, ticker, nome_completo, quantidade, preco, tipo)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (data, ticker, nome_completo, quantidade, preco, tipo))
+            _ledger_aplicar(cursor, '?', data, ticker, quantidade, preco, tipo)
             if should_close and local_conn:
                 local_conn.commit()
                 local_conn.close()
@@ -6567,7 +7932,7 @@ def obter_movimentacoes(mes=None, ano=None):
                 conn.close()
         else:
             db_path = get_db_path(usuario, "carteira")
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(db_path)
             cursor = conn.cursor()
             if mes and ano:
                 mes_int = int(mes)
@@ -6607,78 +7972,242 @@ def obter_movimentacoes(mes=None, ano=None):
 
 
 def obter_data_primeira_compra_por_ticker():
-    """Retorna um dicionário { ticker: data_primeira_compra } com a data da primeira compra de cada ticker (movimentações). Usado para filtrar proventos recebidos (só considerar dividendos após ser dono do ativo)."""
+    """Retorna um dicionário { ticker: data_primeira_compra } com a data da primeira compra de cada ticker (ledger de posições). Usado para filtrar proventos recebidos (só considerar dividendos após ser dono do ativo)."""
     try:
-        usuario = get_usuario_atual()
-        if not usuario:
-            return {}
-        if _is_postgres():
-            conn = _pg_conn_for_user(usuario)
-            try:
-                with conn.cursor() as cursor:
-                    cursor.execute(
-                        "SELECT ticker, MIN(data) FROM movimentacoes WHERE LOWER(TRIM(tipo)) = 'compra' GROUP BY ticker"
-                    )
-                    rows = cursor.fetchall()
-                return {row[0]: (row[1].strftime('%Y-%m-%d') if hasattr(row[1], 'strftime') else str(row[1])[:10]) for row in rows} if rows else {}
-            finally:
-                conn.close()
-        db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT ticker, MIN(data) FROM movimentacoes WHERE LOWER(TRIM(tipo)) = 'compra' GROUP BY ticker"
+        rows = _consultar_banco_carteira(
+            'SELECT ticker, MIN(primeira_compra) FROM posicoes_ledger WHERE primeira_compra IS NOT NULL GROUP BY ticker'
         )
-        rows = cursor.fetchall()
-        conn.close()
-        return {row[0]: (str(row[1])[:10] if row[1] else None) for row in rows} if rows else {}
+        return {tk: str(primeira)[:10] for tk, primeira in rows if primeira}
     except Exception as e:
         print(f"Erro ao obter data da primeira compra por ticker: {e}")
         return {}
 
 
-def _ler_snapshots_patrimonio_carteira(usuario=None):
-    """Lê snapshots diários gravados em historico_carteira (valor_total real do banco)."""
+# ==================== SNAPSHOTS DIÁRIOS DO PATRIMÔNIO ====================
+# Uma linha por pregão em patrimonio_diario (PK data 'YYYY-MM-DD'), com o detalhe
+# por ativo/classe em patrimonio_diario_ativos. Cada gravação recalcula a semana
+# e o mês do dia em patrimonio_semanal / patrimonio_mensal (abertura, fechamento,
+# mínimo, máximo), então o histórico com `agregacao` lê a série já agregada numa
+# única consulta por intervalo na PK. historico_carteira fica só como legado:
+# a migração copia as linhas dela e nada mais grava lá.
+
+# agregacao do histórico comparado -> série de patrimônio lida
+_PATRIMONIO_SERIE_POR_AGREGACAO = {
+    'mensal': 'diario',
+    'trimestral': 'diario',
+    'semestral': 'semanal',
+    'anual': 'semanal',
+    'semanal': 'semanal',
+    'maximo': 'mensal',
+}
+
+def _dia_pregao_b3(agora=None):
+    """Pregão de referência ('YYYY-MM-DD', horário de Brasília): sábado e domingo contam como a sexta."""
+    agora = agora or datetime.now(_FUSO_B3)
+    dia = agora.date() if isinstance(agora, datetime) else agora
+    if dia.weekday() >= 5:
+        dia = dia - timedelta(days=dia.weekday() - 4)
+    return dia.strftime('%Y-%m-%d')
+
+def _periodos_patrimonio(dia):
+    """(segunda-feira da semana, domingo da semana, 'YYYY-MM') de `dia` ('YYYY-MM-DD')."""
+    d = datetime.strptime(dia[:10], '%Y-%m-%d')
+    segunda = d - timedelta(days=d.weekday())
+    return segunda.strftime('%Y-%m-%d'), (segunda + timedelta(days=6)).strftime('%Y-%m-%d'), dia[:7]
+
+def _mig_carteira_patrimonio_diario(usuario):
+    if _is_postgres():
+        conn = _pg_conn_for_user(usuario)
+        try:
+            with conn.cursor() as c:
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS patrimonio_diario (
+                        data TEXT PRIMARY KEY,
+                        valor_total NUMERIC NOT NULL,
+                        atualizado_em TEXT NOT NULL
+                    )
+                ''')
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS patrimonio_diario_ativos (
+                        data TEXT NOT NULL,
+                        ticker TEXT NOT NULL,
+                        tipo TEXT,
+                        quantidade NUMERIC,
+                        preco NUMERIC,
+                        valor_total NUMERIC NOT NULL,
+                        PRIMARY KEY (data, ticker)
+                    )
+                ''')
+                c.execute("CREATE INDEX IF NOT EXISTS idx_patrimonio_ativos_ticker_data ON patrimonio_diario_ativos(ticker, data)")
+                c.execute("CREATE INDEX IF NOT EXISTS idx_patrimonio_ativos_tipo_data ON patrimonio_diario_ativos(tipo, data)")
+                for tabela, chave in (('patrimonio_semanal', 'inicio'), ('patrimonio_mensal', 'mes')):
+                    c.execute(f'''
+                        CREATE TABLE IF NOT EXISTS {tabela} (
+                            {chave} TEXT PRIMARY KEY,
+                            fim TEXT NOT NULL,
+                            abertura NUMERIC NOT NULL,
+                            fechamento NUMERIC NOT NULL,
+                            minimo NUMERIC NOT NULL,
+                            maximo NUMERIC NOT NULL,
+                            dias INTEGER NOT NULL
+                        )
+                    ''')
+                c.execute('SELECT data, valor_total FROM historico_carteira ORDER BY id ASC')
+                legado = c.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(get_db_path(usuario, 'carteira'))
+        try:
+            c = conn.cursor()
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS patrimonio_diario (
+                    data TEXT PRIMARY KEY,
+                    valor_total REAL NOT NULL,
+                    atualizado_em TEXT NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS patrimonio_diario_ativos (
+                    data TEXT NOT NULL,
+                    ticker TEXT NOT NULL,
+                    tipo TEXT,
+                    quantidade REAL,
+                    preco REAL,
+                    valor_total REAL NOT NULL,
+                    PRIMARY KEY (data, ticker)
+                ) WITHOUT ROWID
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_patrimonio_ativos_ticker_data ON patrimonio_diario_ativos(ticker, data)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_patrimonio_ativos_tipo_data ON patrimonio_diario_ativos(tipo, data)")
+            for tabela, chave in (('patrimonio_semanal', 'inicio'), ('patrimonio_mensal', 'mes')):
+                c.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {tabela} (
+                        {chave} TEXT PRIMARY KEY,
+                        fim TEXT NOT NULL,
+                        abertura REAL NOT NULL,
+                        fechamento REAL NOT NULL,
+                        minimo REAL NOT NULL,
+                        maximo REAL NOT NULL,
+                        dias INTEGER NOT NULL
+                    ) WITHOUT ROWID
+                ''')
+            c.execute('SELECT data, valor_total FROM historico_carteira ORDER BY id ASC')
+            legado = c.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+    # snapshots antigos: o último de cada pregão vale
+    por_dia = {}
+    for data, valor in legado or []:
+        try:
+            por_dia[_dia_pregao_b3(datetime.strptime(str(data)[:10], '%Y-%m-%d'))] = float(valor or 0)
+        except (TypeError, ValueError):
+            continue
+    if por_dia:
+        _gravar_patrimonio_diario(usuario, sorted(por_dia.items()))
+        print(f"[patrimonio] {len(por_dia)} snapshots de historico_carteira copiados para {usuario}")
+
+def _atualizar_rollups_patrimonio(c, ph, dias):
+    """Recalcula as semanas e meses de `dias` a partir de patrimonio_diario (consulta por intervalo na PK)."""
+    semanas, meses = set(), set()
+    for dia in dias:
+        segunda, domingo, mes = _periodos_patrimonio(dia)
+        semanas.add((segunda, domingo))
+        meses.add(mes)
+    alvos = [('patrimonio_semanal', 'inicio', ini, ini, fi) for ini, fi in semanas]
+    alvos += [('patrimonio_mensal', 'mes', mes, f"{mes}-01", f"{mes}-31") for mes in meses]
+    for tabela, chave, valor_chave, ini, fi in alvos:
+        c.execute(
+            f'SELECT data, valor_total FROM patrimonio_diario WHERE data >= {ph} AND data <= {ph} ORDER BY data',
+            (ini, fi),
+        )
+        rows = [(r[0], float(r[1])) for r in c.fetchall()]
+        if not rows:
+            c.execute(f'DELETE FROM {tabela} WHERE {chave} = {ph}', (valor_chave,))
+            continue
+        valores = [v for _, v in rows]
+        c.execute(
+            f'''INSERT INTO {tabela} ({chave}, fim, abertura, fechamento, minimo, maximo, dias)
+                VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+                ON CONFLICT ({chave}) DO UPDATE SET fim = excluded.fim, abertura = excluded.abertura,
+                    fechamento = excluded.fechamento, minimo = excluded.minimo, maximo = excluded.maximo,
+                    dias = excluded.dias''',
+            (valor_chave, rows[-1][0], valores[0], valores[-1], min(valores), max(valores), len(valores)),
+        )
+
+def _gravar_patrimonio_diario(usuario, pontos, ativos=None):
+    """
+    Upsert de [(dia, valor_total), ...] em patrimonio_diario e recálculo das
+    semanas/meses afetados. `ativos` ({ticker: (tipo, quantidade, preco, valor)})
+    substitui o detalhe por ativo do último dia de `pontos`.
+    """
+    if not pontos:
+        return
+    agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    pg = _is_postgres()
+    ph = '%s' if pg else '?'
+    conn = _pg_conn_for_user(usuario) if pg else _sqlite_connect(get_db_path(usuario, 'carteira'))
+    try:
+        c = conn.cursor()
+        c.executemany(
+            f'''INSERT INTO patrimonio_diario (data, valor_total, atualizado_em) VALUES ({ph}, {ph}, {ph})
+                ON CONFLICT (data) DO UPDATE SET valor_total = excluded.valor_total, atualizado_em = excluded.atualizado_em''',
+            [(dia, float(valor), agora) for dia, valor in pontos],
+        )
+        if ativos is not None:
+            dia = pontos[-1][0]
+            c.execute(f'DELETE FROM patrimonio_diario_ativos WHERE data = {ph}', (dia,))
+            c.executemany(
+                f'''INSERT INTO patrimonio_diario_ativos (data, ticker, tipo, quantidade, preco, valor_total)
+                    VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})''',
+                [(dia, tk, tipo, qtd, preco, valor) for tk, (tipo, qtd, preco, valor) in ativos.items()],
+            )
+        _atualizar_rollups_patrimonio(c, ph, [dia for dia, _ in pontos])
+        conn.commit()
+    finally:
+        conn.close()
+
+def _ler_snapshots_patrimonio_carteira(usuario=None, inicio=None, fim=None, serie='diario'):
+    """
+    Snapshots do patrimônio entre `inicio` e `fim` ('YYYY-MM-DD', inclusivos):
+    [(dia, valor), ...]. `serie` 'semanal' / 'mensal' lê o rollup: um ponto por
+    período, na data do último pregão dele, com o valor de fechamento.
+    """
     usuario = usuario or get_usuario_atual()
     if not usuario:
         return []
+    inicio = inicio or '0000-01-01'
+    fim = fim or '9999-12-31'
     try:
-        if _is_postgres():
-            conn = _pg_conn_for_user(usuario)
-            try:
-                with conn.cursor() as c:
-                    c.execute(
-                        'SELECT data, valor_total FROM historico_carteira ORDER BY data ASC'
-                    )
-                    rows = c.fetchall()
-            finally:
-                conn.close()
+        garantir_schema_usuario(usuario, 'carteira')
+        pg = _is_postgres()
+        ph = '%s' if pg else '?'
+        if serie == 'semanal':
+            sql = f'SELECT fim, fechamento FROM patrimonio_semanal WHERE inicio >= {ph} AND inicio <= {ph} ORDER BY inicio'
+            params = (_periodos_patrimonio(inicio)[0] if inicio > '0000-01-01' else inicio, fim)
+        elif serie == 'mensal':
+            sql = f'SELECT fim, fechamento FROM patrimonio_mensal WHERE mes >= {ph} AND mes <= {ph} ORDER BY mes'
+            params = (inicio[:7], fim[:7])
         else:
-            db_path = get_db_path(usuario, 'carteira')
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-            try:
-                c = conn.cursor()
-                c.execute(
-                    'SELECT data, valor_total FROM historico_carteira ORDER BY data ASC'
-                )
-                rows = c.fetchall()
-            finally:
-                conn.close()
-        out = []
-        for data, valor in rows or []:
-            dt = str(data)[:10]
-            try:
-                out.append((dt, float(valor or 0)))
-            except (TypeError, ValueError):
-                continue
-        return out
+            sql = f'SELECT data, valor_total FROM patrimonio_diario WHERE data >= {ph} AND data <= {ph} ORDER BY data'
+            params = (inicio, fim)
+        conn = _pg_conn_for_user(usuario) if pg else _sqlite_connect(get_db_path(usuario, 'carteira'))
+        try:
+            c = conn.cursor()
+            c.execute(sql, params)
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        return [(str(d)[:10], float(v or 0)) for d, v in rows or [] if inicio <= str(d)[:10] <= fim]
     except Exception as e:
-        print(f"[patrimonio] erro ao ler historico_carteira: {e}")
+        print(f"[patrimonio] erro ao ler snapshots: {e}")
         return []
 
 
 def registrar_snapshot_patrimonio_carteira(usuario=None):
-    """Grava snapshot diário do patrimônio (soma valor_total da carteira no banco)."""
+    """Grava o snapshot do pregão (soma valor_total da carteira no banco, com o detalhe por ativo)."""
     usuario = usuario or get_usuario_atual()
     if not usuario:
         return
@@ -6687,197 +8216,77 @@ def registrar_snapshot_patrimonio_carteira(usuario=None):
         if not isinstance(carteira, list):
             return
         valor = sum(float(a.get('valor_total') or 0) for a in carteira)
-        hoje = datetime.now().strftime('%Y-%m-%d')
-        if _is_postgres():
-            conn = _pg_conn_for_user(usuario)
-            try:
-                with conn.cursor() as c:
-                    c.execute('''
-                        CREATE TABLE IF NOT EXISTS historico_carteira (
-                            id SERIAL PRIMARY KEY,
-                            data TEXT NOT NULL,
-                            valor_total NUMERIC NOT NULL
-                        )
-                    ''')
-                    c.execute(
-                        "SELECT id FROM historico_carteira WHERE SUBSTRING(data, 1, 10) = %s LIMIT 1",
-                        (hoje,),
-                    )
-                    row = c.fetchone()
-                    if row:
-                        c.execute(
-                            'UPDATE historico_carteira SET data = %s, valor_total = %s WHERE id = %s',
-                            (hoje, valor, row[0]),
-                        )
-                    else:
-                        c.execute(
-                            'INSERT INTO historico_carteira (data, valor_total) VALUES (%s, %s)',
-                            (hoje, valor),
-                        )
-                conn.commit()
-            finally:
-                conn.close()
-        else:
-            db_path = get_db_path(usuario, 'carteira')
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-            try:
-                c = conn.cursor()
-                c.execute('''
-                    CREATE TABLE IF NOT EXISTS historico_carteira (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        data TEXT NOT NULL,
-                        valor_total REAL NOT NULL
-                    )
-                ''')
-                c.execute(
-                    "SELECT id FROM historico_carteira WHERE SUBSTR(data, 1, 10) = ? LIMIT 1",
-                    (hoje,),
-                )
-                row = c.fetchone()
-                if row:
-                    c.execute(
-                        'UPDATE historico_carteira SET data = ?, valor_total = ? WHERE id = ?',
-                        (hoje, valor, row[0]),
-                    )
-                else:
-                    c.execute(
-                        'INSERT INTO historico_carteira (data, valor_total) VALUES (?, ?)',
-                        (hoje, valor),
-                    )
-                conn.commit()
-            finally:
-                conn.close()
+        ativos = {}
+        for a in carteira:
+            tk = (a.get('ticker') or '').strip()
+            if not tk:
+                continue
+            tipo, qtd, preco, total = ativos.get(tk, (a.get('tipo'), 0.0, None, 0.0))
+            ativos[tk] = (
+                tipo,
+                qtd + float(a.get('quantidade') or 0),
+                float(a.get('preco_atual') or 0) or preco,
+                total + float(a.get('valor_total') or 0),
+            )
+        garantir_schema_usuario(usuario, 'carteira')
+        _gravar_patrimonio_diario(usuario, [(_dia_pregao_b3(), valor)], ativos)
     except Exception as e:
         print(f"[patrimonio] erro ao registrar snapshot: {e}")
 
 
-def _obter_patrimonio_historico_banco(usuario, carteira_atual_list, data_ini, data_fim):
+def _obter_patrimonio_historico_banco(usuario, carteira_atual_list, data_ini, data_fim, serie='diario'):
     """
-    Patrimônio histórico fiel ao banco: apenas snapshots gravados (historico_carteira)
-  e o valor atual (soma valor_total da carteira).
+    Patrimônio histórico fiel ao banco: apenas snapshots gravados (patrimonio_diario
+    ou os rollups semanal/mensal) e o valor atual (soma valor_total da carteira).
     NÃO usa movimentacoes — esse log mistura compra/venda/atualizado e infla o patrimônio.
     """
-    from collections import OrderedDict
-
-    merged = OrderedDict()
-    for dt, val in _ler_snapshots_patrimonio_carteira(usuario):
-        merged[str(dt)[:10]] = float(val)
+    ini = data_ini.strftime('%Y-%m-%d') if isinstance(data_ini, datetime) else str(data_ini)[:10]
+    fim = data_fim.strftime('%Y-%m-%d') if isinstance(data_fim, datetime) else str(data_fim)[:10]
+    pontos = _ler_snapshots_patrimonio_carteira(usuario, ini, fim, serie)
 
-    hoje = datetime.now().strftime('%Y-%m-%d')
+    hoje = _dia_pregao_b3()
     valor_hoje = sum(float(a.get('valor_total') or 0) for a in (carteira_atual_list or []))
-    if valor_hoje > 0:
-        merged[hoje] = valor_hoje
-
-    if not merged:
-        return [], []
-
-    ini = data_ini.replace(hour=0, minute=0, second=0, microsecond=0) if isinstance(data_ini, datetime) else data_ini
-    fim = data_fim.replace(hour=23, minute=59, second=59, microsecond=999999) if isinstance(data_fim, datetime) else data_fim
-
-    datas = []
-    valores = []
-    for dt, val in sorted(merged.items(), key=lambda x: x[0]):
-        try:
-            d = datetime.strptime(dt[:10], '%Y-%m-%d')
-        except Exception:
-            continue
-        if d < ini or d > fim:
-            continue
-        datas.append(dt[:10])
-        valores.append(float(val))
-
-    if not datas and valor_hoje > 0 and ini <= datetime.now() <= fim:
-        datas = [hoje]
-        valores = [valor_hoje]
+    if valor_hoje > 0 and ini <= hoje <= fim:
+        # o valor atual substitui o ponto do período de hoje (dia, semana ou mês)
+        periodo = {'semanal': lambda d: _periodos_patrimonio(d)[0], 'mensal': lambda d: d[:7]}.get(serie, lambda d: d)
+        if pontos and periodo(pontos[-1][0]) == periodo(hoje):
+            pontos.pop()
+        pontos.append((hoje, valor_hoje))
 
-    return datas, valores
+    return [d for d, _ in pontos], [v for _, v in pontos]
 
 
 def obter_historico_carteira(periodo='mensal'):
-    
+    """
+    Contrato legado (usado pelo /api/batch): um item por movimentação, em ordem
+    de data, [{'data': 'YYYY-MM-DD', 'valor_total': float}, ...], com
+    valor_total = soma das quantidades positivas acumuladas (sem olhar o tipo)
+    x preço daquela movimentação. A soma das quantidades positivas é mantida
+    corrente em vez de percorrer todas as posições a cada linha.
+    """
     try:
-        print(f"DEBUG: obter_historico_carteira chamada com período: {periodo}")
         usuario = get_usuario_atual()
         if not usuario:
             print("DEBUG: Usuário não encontrado")
             return []
-            
-        if _is_postgres():
-            conn = _pg_conn_for_user(usuario)
-            try:
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        SELECT data, ticker, quantidade, preco, tipo 
-                        FROM movimentacoes 
-                        ORDER BY data ASC
-                    """)
-                    movimentacoes = cursor.fetchall()
-            finally:
-                conn.close()
-        else:
-            db_path = get_db_path(usuario, "carteira")
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT data, ticker, quantidade, preco, tipo 
-                FROM movimentacoes 
-                ORDER BY data ASC
-            """)
-            movimentacoes = cursor.fetchall()
-        
-        print(f"DEBUG: Encontradas {len(movimentacoes)} movimentações para usuário {usuario}")
-        
-        if not movimentacoes:
-            print("DEBUG: Nenhuma movimentação encontrada")
-            return []
-        
 
-        print("DEBUG: Primeiras 3 movimentações:")
-        for i, mov in enumerate(movimentacoes[:3]):
-            print(f"  {i+1}. Data: '{mov[0]}', Ticker: {mov[1]}, Qtd: {mov[2]}, Preço: {mov[3]}")
-        
-      
+        movimentacoes = _consultar_banco_carteira(
+            'SELECT data, ticker, quantidade, preco FROM movimentacoes ORDER BY data ASC, id ASC',
+            usuario=usuario,
+        )
+        print(f"DEBUG: obter_historico_carteira({periodo}): {len(movimentacoes)} movimentações para {usuario}")
+
         historico = []
-        posicoes = {}  
-        
-      
-        for mov in movimentacoes:
-            data_mov = mov[0]
-            ticker = mov[1]
-            quantidade = float(mov[2])
-            preco = float(mov[3])
-            
-    
- 
-            
-
-            if ticker in posicoes:
-                posicoes[ticker] += quantidade
-            else:
-                posicoes[ticker] = quantidade
-            
-            
-            patrimonio_total = 0
-            for ticker_pos, qtd in posicoes.items():
-                if qtd > 0:
-                    
-                    patrimonio_total += qtd * preco
-            
-          
-            item_historico = {
-                'data': data_mov[:10],  
-                'valor_total': patrimonio_total
-            }
-            historico.append(item_historico)
-            print(f"DEBUG: Adicionado ao histórico: {item_historico}")
-        
-        print(f"DEBUG: Total de {len(historico)} itens no histórico")
-        print("DEBUG: Primeiros 3 itens do histórico:")
-        for i, item in enumerate(historico[:3]):
-            print(f"  {i+1}. {item}")
-        
+        posicoes = {}
+        soma_positivas = 0.0
+        for data_mov, ticker, quantidade, preco in movimentacoes:
+            anterior = posicoes.get(ticker, 0.0)
+            atual = anterior + float(quantidade)
+            posicoes[ticker] = atual
+            soma_positivas += (atual if atual > 0 else 0.0) - (anterior if anterior > 0 else 0.0)
+            historico.append({'data': str(data_mov)[:10], 'valor_total': soma_positivas * float(preco)})
         return historico
-        
+
     except Exception as e:
         print(f"Erro ao obter histórico da carteira: {e}")
         import traceback
@@ -6908,6 +8317,75 @@ def _gerar_pontos_tempo(gran: str, data_inicio: datetime, data_fim: datetime) ->
         pontos.append(_month_end(atual))
         atual = (atual.replace(day=28) + timedelta(days=4)).replace(day=1)
     return pontos
+
+
+# Motor matricial do histórico comparado: quantidades (pontos x tickers) por soma
+# acumulada das movimentações e preços por busca binária no histórico diário.
+
+def _precos_nos_pontos(hist, pontos_ns):
+    """Close do último pregão <= cada ponto; NaN antes do 1º pregão ou sem histórico."""
+    import numpy as np
+    if hist is None or hist.empty or 'Close' not in hist.columns:
+        return np.full(len(pontos_ns), np.nan)
+    idx = hist.index.values.astype('datetime64[ns]')
+    close = hist['Close'].to_numpy(dtype=float)
+    if len(idx) > 1 and (idx[1:] < idx[:-1]).any():
+        ordem = np.argsort(idx, kind='stable')
+        idx, close = idx[ordem], close[ordem]
+    pos = np.searchsorted(idx, pontos_ns, side='right') - 1
+    return np.where(pos >= 0, close[np.clip(pos, 0, None)], np.nan)
+
+
+def _matriz_quantidades(posicoes, carteira_map, tickers, pontos_ns):
+    """
+    Quantidade de cada ticker em cada ponto. Com movimentações: a do ledger
+    (`posicoes` = [(data, ticker, quantidade)]) no último dia <= ponto. Sem
+    movimentações: quantidade atual da carteira a partir da data de adição.
+    """
+    import numpy as np
+    col = {tk: j for j, tk in enumerate(tickers)}
+    qtd = np.zeros((len(pontos_ns), len(tickers)))
+    com_mov = np.zeros(len(tickers), dtype=bool)
+    if posicoes:
+        datas = np.array([str(p[0])[:10] for p in posicoes], dtype='datetime64[D]').astype('datetime64[ns]')
+        colunas = np.array([col[p[1]] for p in posicoes], dtype=np.intp)
+        com_mov[colunas] = True
+        dias, linha = np.unique(datas, return_inverse=True)
+        niveis = np.full((len(dias), len(tickers)), np.nan)
+        niveis[linha, colunas] = [float(p[2] or 0.0) for p in posicoes]
+        niveis = pd.DataFrame(niveis).ffill().fillna(0.0).to_numpy()
+        pos = np.searchsorted(dias, pontos_ns, side='right') - 1
+        qtd = np.where((pos >= 0)[:, None], niveis[np.clip(pos, 0, None)], 0.0)
+    for tk, info in carteira_map.items():
+        j = col.get(tk)
+        if j is None or com_mov[j]:
+            continue
+        dt_adic = info.get('data_adicao')
+        q = info.get('quantidade') or 0.0
+        if dt_adic is None:
+            qtd[:, j] = q
+        else:
+            qtd[:, j] = np.where(pontos_ns >= np.datetime64(dt_adic, 'ns'), q, 0.0)
+    return qtd
+
+
+def _rebase_serie(valores):
+    """Série em base 100 a partir do primeiro valor positivo (None onde não há valor positivo)."""
+    import numpy as np
+    arr = np.array([np.nan if v is None else v for v in valores], dtype=float)
+    positivos = arr > 0
+    if not positivos.any():
+        return [None for _ in valores]
+    base = arr[positivos][0]
+    return [float(v) if ok else None for v, ok in zip(arr / base * 100.0, positivos)]
+
+
+def _fatores_acumulados(fatores, base=100.0):
+    """base * produto acumulado de `fatores` (mesma ordem de multiplicação do laço)."""
+    import numpy as np
+    return np.cumprod(np.concatenate(([base], np.asarray(fatores, dtype=float))))[1:]
+
+
 def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
     
     try:
@@ -6915,28 +8393,8 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
         if not usuario:
             return {"datas": [], "carteira": [], "ibov": [], "ivvb11": [], "ifix": [], "ipca": [], "cdi": [], "btc": [], "carteira_valor": [], "patrimonio_datas": [], "carteira_price": []}
 
-        if _is_postgres():
-            conn = _pg_conn_for_user(usuario)
-            try:
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        SELECT data, ticker, quantidade, preco, tipo 
-                        FROM movimentacoes 
-                        ORDER BY data ASC
-                    """)
-                    movimentos = cursor.fetchall()
-            finally:
-                conn.close()
-        else:
-            db_path = get_db_path(usuario, "carteira")
-            conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT data, ticker, quantidade, preco, tipo 
-                FROM movimentacoes 
-                ORDER BY data ASC
-            """)
-            movimentos = cursor.fetchall()
+        # Posição de cada ticker ao fim de cada dia com movimentação (ledger)
+        posicoes = _ler_posicoes_ledger(usuario)
 
         # Carteira atual: incluir TODOS os ativos (não só os que têm movimentações) para refletir saldo real
         carteira_atual_list = obter_carteira()
@@ -6961,9 +8419,8 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
                 carteira_map[tk]['preco_atual'] = preco_atual
 
         data_fim = datetime.now()
-        if movimentos:
-            datas_mov = [datetime.strptime(m[0][:10], '%Y-%m-%d') for m in movimentos]
-            data_primeira = min(datas_mov)
+        if posicoes:
+            data_primeira = datetime.strptime(str(posicoes[0][0])[:10], '%Y-%m-%d')
         else:
             data_primeira = data_fim - timedelta(days=365)
             if carteira_map:
@@ -6998,7 +8455,7 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
         pontos = _gerar_pontos_tempo(gran, data_ini, data_fim)
 
         # Tickers = união dos que têm movimentações e dos que estão na carteira atual (para refletir saldo real)
-        tickers_from_mov = {m[1] for m in movimentos} if movimentos else set()
+        tickers_from_mov = {p[1] for p in posicoes}
         tickers_from_carteira = set(carteira_map.keys())
         tickers = sorted(list(tickers_from_mov | tickers_from_carteira))
         if not tickers:
@@ -7010,8 +8467,7 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
         def _buscar_historico_ticker(tk):
             """Função auxiliar para buscar histórico de um ticker"""
             try:
-                yf_ticker = yf.Ticker(tk)
-                hist = yf_ticker.history(start=data_ini - timedelta(days=5), end=data_fim + timedelta(days=5))
+                hist = obter_historico_diario(tk, data_ini - timedelta(days=5), data_fim + timedelta(days=5))
                
                 try:
                     if hasattr(hist.index, 'tz') and hist.index.tz is not None:
@@ -7024,7 +8480,7 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
         
         if tickers:
             
-            max_workers = min(len(tickers), 200)  # Até 200 workers simultâneos
+            max_workers = min(len(tickers), UPSTREAM_MAX_THREADS)
             with ThreadPoolExecutor(max_workers=max_workers) as executor:
                 # Submete todas as tarefas
                 future_to_ticker = {
@@ -7042,72 +8498,23 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
                         ticker_to_hist[tk] = None
 
 
-        def price_on_or_before(hist_df, dt):
-            if hist_df is None or hist_df.empty:
-                return None
-            
-            try:
-                sub = hist_df[hist_df.index <= dt]
-                if sub.empty:
-                    return None
-                return float(sub['Close'].iloc[-1])
-            except Exception:
-                return None
-
-
-        mov_by_ticker = {}
-        if movimentos:
-            for data_str, tk, qtd, preco, tipo in movimentos:
-                dt = datetime.strptime(data_str[:10], '%Y-%m-%d')
-                mov_by_ticker.setdefault(tk, []).append((dt, float(qtd if qtd is not None else 0.0), str(tipo)))
-
-        def quantity_until(tk, dt):
-            if tk in mov_by_ticker:
-                q = 0.0
-                for mdt, mq, mtype in mov_by_ticker.get(tk, []):
-                    if mdt <= dt:
-                        tipo_norm = str(mtype or '').strip().lower()
-                        if tipo_norm == 'venda':
-                            q -= mq
-                        else:
-                            q += mq
-                return q
-            # Ativo só na carteira (sem movimentações): quantidade atual a partir da data de adição
-            info = carteira_map.get(tk)
-            if not info:
-                return 0.0
-            dt_adic = info.get('data_adicao')
-            if dt_adic is not None and dt < dt_adic:
-                return 0.0
-            return info.get('quantidade') or 0.0
-
-        def price_at_point(tk, pt):
-            p = price_on_or_before(ticker_to_hist.get(tk), pt)
-            if p is not None:
-                return p
-            # Sem histórico yf (ex.: renda fixa): usar preço atual da carteira como aproximação
-            info = carteira_map.get(tk)
-            if info and (info.get('preco_atual') or 0) > 0:
-                return float(info['preco_atual'])
-            return None
+        import numpy as np
+        pontos_ns = np.array(pontos, dtype='datetime64[ns]')
+        qtd = _matriz_quantidades(posicoes, carteira_map, tickers, pontos_ns)
+        precos = np.column_stack([_precos_nos_pontos(ticker_to_hist.get(tk), pontos_ns) for tk in tickers])
+        # Sem histórico yf (ex.: renda fixa): preço atual da carteira como aproximação
+        for j, tk in enumerate(tickers):
+            preco_atual = (carteira_map.get(tk) or {}).get('preco_atual') or 0
+            if preco_atual > 0:
+                precos[:, j] = np.where(np.isnan(precos[:, j]), float(preco_atual), precos[:, j])
+        com_preco = ~np.isnan(precos)
+        posicao = (qtd > 0) & com_preco
+        carteira_vals = np.where(posicao, qtd * np.where(com_preco, precos, 0.0), 0.0).sum(axis=1).tolist()
 
-        carteira_vals = []
-        datas_labels = []
-        for pt in pontos:
-            total = 0.0
-            for tk in tickers:
-                q = quantity_until(tk, pt)
-                if q <= 0:
-                    continue
-                price = price_at_point(tk, pt)
-                if price is None:
-                    continue
-                total += q * price
-            carteira_vals.append(total)
-            if gran == 'semanal':
-                datas_labels.append(pt.strftime('%Y-%m-%d'))
-            else:
-                datas_labels.append(pt.strftime('%Y-%m'))
+        if gran == 'semanal':
+            datas_labels = [pt.strftime('%Y-%m-%d') for pt in pontos]
+        else:
+            datas_labels = [pt.strftime('%Y-%m') for pt in pontos]
 
         try:
             registrar_snapshot_patrimonio_carteira(usuario)
@@ -7115,7 +8522,8 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
             print(f"[patrimonio] aviso snapshot ao montar histórico: {snap_err}")
 
         patrimonio_datas, patrimonio_vals = _obter_patrimonio_historico_banco(
-            usuario, carteira_atual_list, data_ini, data_fim
+            usuario, carteira_atual_list, data_ini, data_fim,
+            _PATRIMONIO_SERIE_POR_AGREGACAO.get(agregacao, 'mensal'),
         )
 
         indices_map = {
@@ -7131,7 +8539,7 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
            
             for cand in candidates:
                 try:
-                    h = yf.Ticker(cand).history(start=data_ini - timedelta(days=5), end=data_fim + timedelta(days=5))
+                    h = obter_historico_diario(cand, data_ini - timedelta(days=5), data_fim + timedelta(days=5))
                     if h is not None and not h.empty:
                         try:
                             if hasattr(h.index, 'tz') and h.index.tz is not None:
@@ -7145,7 +8553,7 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
         
 
         indices_hist = {}
-        with ThreadPoolExecutor(max_workers=200) as executor:  
+        with ThreadPoolExecutor(max_workers=len(indices_map)) as executor:
             future_to_key = {
                 executor.submit(_buscar_indice_historico, key, candidates): key 
                 for key, candidates in indices_map.items()
@@ -7161,19 +8569,14 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
         
 
         for key in indices_map.keys():
-            hist = indices_hist.get(key)
-            for pt in pontos:
-                price = price_on_or_before(hist, pt) if hist is not None else None
-                indices_vals[key].append(float(price) if price is not None else None)
+            vals = _precos_nos_pontos(indices_hist.get(key), pontos_ns)
+            indices_vals[key] = [None if np.isnan(v) else float(v) for v in vals]
 
 
         ipca_series = []
         try:
-            import requests
-            url = 'https://api.bcb.gov.br/dados/serie/bcdata.sgs.433/dados?formato=json'
-            resp = requests.get(url, timeout=10)
-            if resp.ok:
-                dados = resp.json()
+            dados = obter_serie_bcb(BCB_SERIE_IPCA_MENSAL, data_ini.replace(day=1), data_fim)
+            if dados:
 
                 ipca_map = {}
                 for item in dados:
@@ -7182,78 +8585,39 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
                     chave = f"{ano}-{mes}"
                     ipca_map[chave] = float(item['valor'])
 
-                base = 100.0
-                for lab in datas_labels:
-                    chave = lab[:7] if len(lab) >= 7 else lab  # YYYY-MM-DD -> YYYY-MM
-                    var = ipca_map.get(chave)
-                    if var is not None:
-                        base *= (1.0 + var/100.0)
-                    ipca_series.append(base)
+                # YYYY-MM-DD -> YYYY-MM; mês sem IPCA divulgado mantém o acumulado
+                fatores = [1.0 + ipca_map[lab[:7]] / 100.0 if lab[:7] in ipca_map else 1.0 for lab in datas_labels]
+                ipca_series = _fatores_acumulados(fatores).tolist()
         except Exception:
             ipca_series = [None for _ in datas_labels]
 
 
         cdi_series = []
         try:
-            import requests
-            start_date = data_ini.strftime('%d/%m/%Y')
-            end_date = data_fim.strftime('%d/%m/%Y')
-            url_cdi = (
-                f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.12/dados?formato=json"
-                f"&dataInicial={start_date}&dataFinal={end_date}"
-            )
-            r = requests.get(url_cdi, timeout=10)
-            if r.ok:
-                arr = r.json() or []
-                
-                def _parse_br_date(d):
-                    try:
-                        dd, mm, yy = d.split('/')
-                        return datetime(int(yy), int(mm), int(dd))
-                    except Exception:
-                        return None
-                arr_sorted = sorted(
-                    [( _parse_br_date(it.get('data')), it.get('valor') ) for it in arr if it.get('data') and it.get('valor')],
-                    key=lambda x: (x[0] or datetime.min)
-                )
-                base = 100.0
-                last_by_month = {}
-                for dt, valor in arr_sorted:
-                    if dt is None:
+            arr = obter_serie_bcb(12, data_ini, data_fim)
+            if arr:
+                pontos_cdi = []
+                for it in arr:
+                    if not it.get('data') or it.get('valor') is None:
                         continue
                     try:
-                        taxa_aa = float(str(valor).replace(',', '.'))
+                        dd, mm, yy = it['data'].split('/')
+                        pontos_cdi.append((datetime(int(yy), int(mm), int(dd)), float(str(it['valor']).replace(',', '.'))))
                     except Exception:
                         continue
-                    
-                    try:
-                        daily_factor = (1.0 + taxa_aa/100.0) ** (1.0/252.0)
-                    except Exception:
-                        daily_factor = 1.0
-                    base *= daily_factor
-                    lab = f"{dt.year}-{str(dt.month).zfill(2)}"
-                    last_by_month[lab] = base
-                
-                for i, lab in enumerate(datas_labels):
-                    chave = lab[:7] if len(lab) >= 7 else lab  # YYYY-MM-DD -> YYYY-MM
-                    if chave in last_by_month:
-                        cdi_series.append(last_by_month[chave])
-                    else:
-                        cdi_series.append(cdi_series[-1] if cdi_series else None)
+                pontos_cdi.sort(key=lambda x: x[0])
+                # taxa % a.a. -> fator diário (252 dias úteis), acumulado em base 100
+                taxas = np.array([taxa for _, taxa in pontos_cdi], dtype=float)
+                acumulado = _fatores_acumulados((1.0 + taxas / 100.0) ** (1.0 / 252.0))
+                last_by_month = dict(zip((f"{dt.year}-{str(dt.month).zfill(2)}" for dt, _ in pontos_cdi), acumulado.tolist()))
+                cdi_series = pd.Series([last_by_month.get(lab[:7]) for lab in datas_labels], dtype=float).ffill()
+                cdi_series = [None if pd.isna(v) else float(v) for v in cdi_series]
             else:
                 cdi_series = [None for _ in datas_labels]
         except Exception:
             cdi_series = [None for _ in datas_labels]
 
 
-        def rebase(series):
-            vals = [v for v in series if v is not None and v > 0]
-            if not vals:
-                return [None for _ in series]
-            base = vals[0]
-            return [ (v / base * 100.0) if (v is not None and v > 0) else None for v in series ]
-
-
         def reduce_by_granularity(labels, series_dict, gran):
 
             if gran in ('mensal', 'maximo', 'semanal'):
@@ -7294,48 +8658,25 @@ def obter_historico_carteira_comparado(agregacao: str = 'mensal'):
         }
         # Não reduzir por granularidade: manter todos os pontos para o gráfico mostrar subidas e quedas reais
 
+        # Índice de preço da carteira: retorno de cada intervalo com as quantidades do início dele
         carteira_price_base = []
         if pontos:
-            base_val = 100.0
-            carteira_price_base.append(base_val)
-            for i in range(1, len(pontos)):
-                prev_pt = pontos[i-1]
-                cur_pt = pontos[i]
-                V_prev = 0.0
-                V_cur = 0.0
-                for tk in tickers:
-                    q_prev = quantity_until(tk, prev_pt)
-                    if q_prev <= 0:
-                        continue
-                    p_prev = price_at_point(tk, prev_pt)
-                    p_cur = price_at_point(tk, cur_pt)
-                    if p_prev is None or p_cur is None:
-                        continue
-                    V_prev += q_prev * p_prev
-                    V_cur += q_prev * p_cur
-                if V_prev and V_prev > 0:
-                    sub_return = V_cur / V_prev
-                    base_val = base_val * sub_return
-               
-                carteira_price_base.append(base_val)
-
-        if gran == 'semanal':
-            labels_full = [pt.strftime('%Y-%m-%d') for pt in pontos]
-        else:
-            labels_full = [pt.strftime('%Y-%m') for pt in pontos]
-      
-        carteira_price_series = []
-        label_to_price = {labels_full[i]: carteira_price_base[i] for i in range(len(labels_full))} if pontos else {}
-        for lab in datas_labels:
-            carteira_price_series.append(label_to_price.get(lab, None))
-
-        carteira_rebased = rebase(series_dict['carteira'])
-        ibov_rebased = rebase(series_dict['ibov'])
-        ivvb_rebased = rebase(series_dict['ivvb11'])
-        ifix_rebased = rebase(series_dict['ifix'])
-        ipca_rebased = rebase(series_dict['ipca']) if series_dict['ipca'] else [None for _ in datas_labels]
-        cdi_rebased = rebase(series_dict['cdi']) if series_dict['cdi'] else [None for _ in datas_labels]
-        btc_rebased = rebase(series_dict['btc'])
+            ativos = (qtd[:-1] > 0) & com_preco[:-1] & com_preco[1:]
+            v_prev = np.where(ativos, qtd[:-1] * np.where(com_preco[:-1], precos[:-1], 0.0), 0.0).sum(axis=1)
+            v_cur = np.where(ativos, qtd[:-1] * np.where(com_preco[1:], precos[1:], 0.0), 0.0).sum(axis=1)
+            retornos = np.divide(v_cur, v_prev, out=np.ones_like(v_prev), where=v_prev > 0)
+            carteira_price_base = [100.0] + _fatores_acumulados(retornos).tolist()
+
+        label_to_price = dict(zip(datas_labels, carteira_price_base))
+        carteira_price_series = [label_to_price.get(lab) for lab in datas_labels]
+
+        carteira_rebased = _rebase_serie(series_dict['carteira'])
+        ibov_rebased = _rebase_serie(series_dict['ibov'])
+        ivvb_rebased = _rebase_serie(series_dict['ivvb11'])
+        ifix_rebased = _rebase_serie(series_dict['ifix'])
+        ipca_rebased = _rebase_serie(series_dict['ipca']) if series_dict['ipca'] else [None for _ in datas_labels]
+        cdi_rebased = _rebase_serie(series_dict['cdi']) if series_dict['cdi'] else [None for _ in datas_labels]
+        btc_rebased = _rebase_serie(series_dict['btc'])
 
         return {
             "datas": datas_labels,
@@ -7363,7 +8704,9 @@ def init_controle_db(usuario=None):
         usuario = get_usuario_atual()
         if not usuario:
             raise ValueError("Usuário não especificado")
-    
+    garantir_schema_usuario(usuario, 'controle', levantar=True)
+
+def _mig_controle_base(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -7486,22 +8829,10 @@ def init_controle_db(usuario=None):
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_compras_cartao_id ON compras_cartao(cartao_id)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_compras_cartao_data ON compras_cartao(data)")
                 # Adicionar colunas de pagamento se não existirem
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN pago BOOLEAN DEFAULT FALSE")
-                except Exception:
-                    pass  # Coluna já existe
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN mes_pagamento INTEGER")
-                except Exception:
-                    pass  # Coluna já existe
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN ano_pagamento INTEGER")
-                except Exception:
-                    pass  # Coluna já existe
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN data_pagamento TIMESTAMP")
-                except Exception:
-                    pass  # Coluna já existe
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS pago BOOLEAN DEFAULT FALSE')
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS mes_pagamento INTEGER')
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS ano_pagamento INTEGER')
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS data_pagamento TIMESTAMP')
                 
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_cartoes_cadastrados_ativo ON cartoes_cadastrados(ativo)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_cartoes_cadastrados_pago ON cartoes_cadastrados(pago)")
@@ -7511,7 +8842,7 @@ def init_controle_db(usuario=None):
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     
 
@@ -7632,6 +8963,9 @@ def _upgrade_controle_schema(usuario=None):
         usuario = get_usuario_atual()
         if not usuario:
             return
+    garantir_schema_usuario(usuario, 'controle')
+
+def _mig_controle_upgrade(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -7648,10 +8982,7 @@ def _upgrade_controle_schema(usuario=None):
                 ]
                 for t in tables:
                     for col, coltype in add_columns:
-                        try:
-                            cursor.execute(f"ALTER TABLE {t} ADD COLUMN IF NOT EXISTS {col} {coltype}")
-                        except Exception:
-                            pass
+                        cursor.execute(f"ALTER TABLE {t} ADD COLUMN IF NOT EXISTS {col} {coltype}")
             conn.commit()
         finally:
             conn.close()
@@ -7689,22 +9020,10 @@ def _upgrade_controle_schema(usuario=None):
                     )
                 ''')
                 # Adicionar colunas de pagamento se não existirem
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN pago BOOLEAN DEFAULT FALSE")
-                except Exception:
-                    pass  # Coluna já existe
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN mes_pagamento INTEGER")
-                except Exception:
-                    pass  # Coluna já existe
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN ano_pagamento INTEGER")
-                except Exception:
-                    pass  # Coluna já existe
-                try:
-                    cursor.execute("ALTER TABLE cartoes_cadastrados ADD COLUMN data_pagamento TIMESTAMP")
-                except Exception:
-                    pass  # Coluna já existe
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS pago BOOLEAN DEFAULT FALSE')
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS mes_pagamento INTEGER')
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS ano_pagamento INTEGER')
+                cursor.execute('ALTER TABLE cartoes_cadastrados ADD COLUMN IF NOT EXISTS data_pagamento TIMESTAMP')
                 
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_cartoes_cadastrados_ativo ON cartoes_cadastrados(ativo)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_cartoes_cadastrados_pago ON cartoes_cadastrados(pago)")
@@ -7726,7 +9045,7 @@ def _upgrade_controle_schema(usuario=None):
             conn.close()
     else:
         db_path = get_db_path(usuario, "controle")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cur = conn.cursor()
             tables = ['receitas','cartoes','outros_gastos']
@@ -7744,16 +9063,13 @@ def _upgrade_controle_schema(usuario=None):
                 existing = {row[1] for row in cur.fetchall()}
                 for col, coltype in add_columns:
                     if col not in existing:
-                        try:
-                            cur.execute(f"ALTER TABLE {t} ADD COLUMN {col} {coltype}")
-                        except Exception:
-                            pass
+                        _sqlite_adicionar_coluna(cur, t, f"{col} {coltype}")
             conn.commit()
         finally:
             conn.close()
         
         # Criar tabelas de cartões cadastrados se não existirem
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cursor = conn.cursor()
             cursor.execute('''
@@ -7786,10 +9102,7 @@ def _upgrade_controle_schema(usuario=None):
             
             for col_name, col_type in colunas_pagamento:
                 if col_name not in existing_columns:
-                    try:
-                        cursor.execute(f"ALTER TABLE cartoes_cadastrados ADD COLUMN {col_name} {col_type}")
-                    except Exception:
-                        pass  # Coluna já existe ou erro ao adicionar
+                    _sqlite_adicionar_coluna(cursor, 'cartoes_cadastrados', f"{col_name} {col_type}")
             
             conn.commit()
             
@@ -7985,17 +9298,9 @@ def _migrate_controle_categorias_columns(cursor, pg=False):
             'icon_key TEXT',
             'sort_order INTEGER DEFAULT 0',
         ):
-            try:
-                cursor.execute(
-                    f'ALTER TABLE controle_categorias ADD COLUMN IF NOT EXISTS {frag}'
-                )
-            except Exception:
-                try:
-                    cursor.execute(
-                        f'ALTER TABLE controle_categorias ADD COLUMN {frag}'
-                    )
-                except Exception:
-                    pass
+            cursor.execute(
+                f'ALTER TABLE controle_categorias ADD COLUMN IF NOT EXISTS {frag}'
+            )
         cols = _pg_controle_categorias_columns_lower(cursor)
         for src in ('nome', 'titulo', 'name'):
             if src not in cols:
@@ -8067,12 +9372,7 @@ def _migrate_controle_categorias_columns(cursor, pg=False):
         ('sort_order', 'INTEGER DEFAULT 0'),
     ):
         if col not in existing:
-            try:
-                cursor.execute(
-                    f'ALTER TABLE controle_categorias ADD COLUMN {col} {coltype}'
-                )
-            except Exception:
-                pass
+            _sqlite_adicionar_coluna(cursor, 'controle_categorias', f'{col} {coltype}')
             existing = table_cols()
 
     existing = table_cols()
@@ -8132,6 +9432,11 @@ def _ensure_controle_categorias_table(usuario):
     """Garante a tabela mesmo se _upgrade_controle_schema falhar antes do CREATE."""
     if not usuario:
         return
+    if garantir_schema_usuario(usuario, 'controle'):
+        return
+    _mig_controle_categorias(usuario)
+
+def _mig_controle_categorias(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -8155,7 +9460,7 @@ def _ensure_controle_categorias_table(usuario):
         return
 
     db_path = get_db_path(usuario, 'controle')
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cur = conn.cursor()
         cur.execute(
@@ -8345,7 +9650,7 @@ def seed_controle_categorias_if_empty(usuario=None):
         return
 
     db_path = get_db_path(usuario, 'controle')
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM controle_categorias')
@@ -8403,7 +9708,7 @@ def listar_controle_categorias(usuario=None):
         return out
 
     db_path = get_db_path(usuario, 'controle')
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cursor = conn.cursor()
         cursor.execute(
@@ -8471,7 +9776,7 @@ def adicionar_controle_categoria(label, cor, icon_key=None, usuario=None):
         return {'success': True, 'id': int(new_id), 'slug': slug}
 
     db_path = get_db_path(usuario, 'controle')
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cursor = conn.cursor()
         n = 2
@@ -8571,7 +9876,7 @@ def atualizar_controle_categoria(cid, usuario=None, **updates):
         return {'success': True}
 
     db_path = get_db_path(usuario, 'controle')
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cursor = conn.cursor()
         vals_sq.append(cid)
@@ -8624,7 +9929,7 @@ def remover_controle_categoria(cid, usuario=None):
         return {'success': True}
 
     db_path = get_db_path(usuario, 'controle')
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cursor = conn.cursor()
         cursor.execute('SELECT slug FROM controle_categorias WHERE id=?', (cid,))
@@ -8674,7 +9979,7 @@ def salvar_receita(nome, valor, data=None, categoria=None, tipo=None, recorrenci
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO receitas 
@@ -8712,7 +10017,7 @@ def atualizar_receita(id_registro, nome=None, valor=None, data=None, categoria=N
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE receitas SET 
@@ -8746,7 +10051,7 @@ def _remover_registro_generico(tabela, id_registro, banco="controle"):
             conn.close()
         return
     db_path = get_db_path(usuario, banco)
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute(f'DELETE FROM {tabela} WHERE id = ?', (id_registro,))
     conn.commit()
@@ -8789,12 +10094,8 @@ def carregar_receitas_mes_ano(mes, ano, pessoa=None, usuario=None):
         finally:
             conn.close()
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
-        try:
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_receitas_data ON receitas(data)")
-        except Exception:
-            pass
         if pessoa:
             query = '''
                 SELECT * FROM receitas 
@@ -8833,7 +10134,7 @@ def adicionar_cartao(nome, valor, pago, data=None, categoria=None, tipo=None, re
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO cartoes 
@@ -8870,7 +10171,7 @@ def carregar_cartoes_mes_ano(mes, ano):
             conn.close()
         return df.to_dict('records')
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         query = '''
             SELECT * FROM cartoes 
@@ -8911,7 +10212,7 @@ def atualizar_cartao(id_registro, nome=None, valor=None, pago=None, data=None, c
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE cartoes SET 
@@ -8965,7 +10266,7 @@ def adicionar_outro_gasto(nome, valor, data=None, categoria=None, tipo=None, rec
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO outros_gastos 
@@ -9049,7 +10350,7 @@ def carregar_outros_mes_ano(mes, ano, usuario=None):
             conn.close()
         return df.to_dict('records')
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         query = '''
             SELECT * FROM outros_gastos 
@@ -9080,7 +10381,7 @@ def carregar_outros_por_intervalo(mes, ano, qtd_meses=1):
             conn.close()
         return df.to_dict('records')
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         query = '''
             SELECT * FROM outros_gastos
@@ -9114,7 +10415,7 @@ def carregar_compras_cartao_por_intervalo(mes, ano, qtd_meses=1, usuario=None):
         finally:
             conn.close()
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         SELECT * FROM compras_cartao
@@ -9212,7 +10513,7 @@ def atualizar_outro_gasto(id_registro, nome=None, valor=None, data=None, categor
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE outros_gastos SET 
@@ -9245,7 +10546,9 @@ def init_marmitas_db(usuario=None):
         usuario = get_usuario_atual()
         if not usuario:
             raise ValueError("Usuário não especificado")
-    
+    garantir_schema_usuario(usuario, 'marmitas', levantar=True)
+
+def _mig_marmitas_base(usuario):
     if _is_postgres():
         conn = _pg_conn_for_user(usuario)
         try:
@@ -9264,7 +10567,7 @@ def init_marmitas_db(usuario=None):
             conn.close()
         return
     db_path = get_db_path(usuario, "marmitas")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS marmitas (
@@ -9285,6 +10588,224 @@ def init_marmitas_db(usuario=None):
     conn.commit()
     conn.close()
 
+# ==================== ÍNDICES DE DATA ====================
+# As datas são TEXT ISO ('YYYY-MM-DD' ou 'YYYY-MM-DD HH:MM:SS') e as consultas
+# por período usam faixa (data >= ? AND data < ?), que o índice em `data`
+# resolve. O agrupamento por mês (gastos_mensais) usa o prefixo 'YYYY-MM'; em
+# vez de uma coluna a mais (que apareceria nos SELECT * e nos dumps), o índice
+# é de expressão sobre o mesmo prefixo da consulta, com data e valor junto
+# para a leitura sair só do índice. Índices que viraram prefixo de um composto
+# são removidos (cada um custa uma escrita a mais por INSERT).
+_INDICES_DATAS = {
+    'carteira': [
+        ('idx_movimentacoes_data', 'movimentacoes', 'data', 'data'),
+        ('idx_movimentacoes_ticker_data', 'movimentacoes', 'ticker, data', 'ticker, data'),
+        ('idx_historico_carteira_data', 'historico_carteira', 'data', 'data'),
+    ],
+    'controle': [
+        ('idx_receitas_data', 'receitas', 'data', 'data'),
+        ('idx_outros_data', 'outros_gastos', 'data', 'data'),
+        ('idx_compras_cartao_cartao_data', 'compras_cartao', 'cartao_id, data', 'cartao_id, data'),
+    ],
+    'marmitas': [
+        ('idx_marmitas_data', 'marmitas', 'data', 'data'),
+        ('idx_marmitas_mes', 'marmitas', 'substr(data, 1, 7), data, valor', '(left(data, 7)), data, valor'),
+    ],
+}
+_INDICES_REDUNDANTES = {
+    'carteira': ['idx_movimentacoes_ticker'],
+    'controle': ['idx_compras_cartao_cartao_id', 'idx_compras_cartao_id', 'idx_outros_gastos_data'],
+    'marmitas': [],
+}
+
+def _mig_indices_datas(usuario, banco):
+    pg = _is_postgres()
+    conn = _pg_conn_for_user(usuario) if pg else _sqlite_connect(get_db_path(usuario, banco))
+    try:
+        c = conn.cursor()
+        for nome, tabela, colunas_sqlite, colunas_pg in _INDICES_DATAS[banco]:
+            c.execute(f"CREATE INDEX IF NOT EXISTS {nome} ON {tabela}({colunas_pg if pg else colunas_sqlite})")
+        for nome in _INDICES_REDUNDANTES[banco]:
+            c.execute(f"DROP INDEX IF EXISTS {nome}")
+        conn.commit()
+    finally:
+        conn.close()
+
+def _mig_carteira_indices_datas(usuario):
+    _mig_indices_datas(usuario, 'carteira')
+
+def _mig_controle_indices_datas(usuario):
+    _mig_indices_datas(usuario, 'controle')
+
+def _mig_marmitas_indices_datas(usuario):
+    _mig_indices_datas(usuario, 'marmitas')
+
+# ==================== MIGRAÇÕES DE SCHEMA POR USUÁRIO ====================
+# Cada banco do usuário tem uma lista ordenada de passos idempotentes. A versão
+# aplicada fica em schema_version (SQLite: no próprio .db; Postgres: no schema
+# u_<usuario>, uma linha por banco). Depois da primeira verificação o processo
+# guarda "storage X está na versão N" em memória: os _ensure_*_schema() e
+# init_*_db() chamados nos hot paths viram um lookup em dict.
+# Para evoluir um schema: acrescente um passo no fim da lista (nunca renumere).
+
+_MIGRACOES_SCHEMA = {
+    'carteira': [
+        (1, 'base', _mig_carteira_base),
+        (2, 'indexador_renda_fixa', _mig_carteira_indexador),
+        (3, 'rebalance', _mig_carteira_rebalance),
+        (4, 'asset_types', _mig_carteira_asset_types),
+        (5, 'rf_catalog', _mig_carteira_rf_catalog),
+        (6, 'goals', _mig_carteira_goals),
+        (7, 'metas_aportes', _mig_carteira_metas_aportes),
+        (8, 'patrimonio_diario', _mig_carteira_patrimonio_diario),
+        (9, 'posicoes_ledger', _mig_carteira_posicoes_ledger),
+        (10, 'indices_datas', _mig_carteira_indices_datas),
+    ],
+    'controle': [
+        (1, 'base', _mig_controle_base),
+        (2, 'categorias_parcelas_cartoes', _mig_controle_upgrade),
+        (3, 'indices_datas', _mig_controle_indices_datas),
+    ],
+    'marmitas': [
+        (1, 'base', _mig_marmitas_base),
+        (2, 'indices_datas', _mig_marmitas_indices_datas),
+    ],
+}
+
+_SCHEMA_VERSAO_CACHE = {}
+_SCHEMA_VERSAO_LOCK = threading.Lock()
+_SCHEMA_VERSAO_LOCKS_CHAVE = {}
+
+def _chave_schema_usuario(usuario, banco):
+    if _is_postgres():
+        return ('pg', _pg_schema_for_user(usuario), banco)
+    return ('sqlite', get_db_path(usuario, banco), banco)
+
+def _invalidar_cache_versao_schema():
+    """
+    Esquece as versões conhecidas neste processo (rename/exclusão de conta,
+    restore de backup). Os outros workers esquecem pelas invalidações publicadas
+    em fechar_conexoes_sqlite / _pg_esquecer_schema_usuario.
+    """
+    with _SCHEMA_VERSAO_LOCK:
+        _SCHEMA_VERSAO_CACHE.clear()
+
+def _ler_versao_schema(usuario, banco):
+    if _is_postgres():
+        conn = _pg_conn_for_user(usuario)
+        try:
+            with conn.cursor() as c:
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        banco TEXT PRIMARY KEY,
+                        versao INTEGER NOT NULL,
+                        atualizado_em TEXT NOT NULL
+                    )
+                ''')
+                c.execute('SELECT versao FROM schema_version WHERE banco = %s', (banco,))
+                row = c.fetchone()
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(get_db_path(usuario, banco))
+        try:
+            c = conn.cursor()
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    banco TEXT PRIMARY KEY,
+                    versao INTEGER NOT NULL,
+                    atualizado_em TEXT NOT NULL
+                )
+            ''')
+            c.execute('SELECT versao FROM schema_version WHERE banco = ?', (banco,))
+            row = c.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+    return int(row[0]) if row else 0
+
+def _gravar_versao_schema(usuario, banco, versao):
+    agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if _is_postgres():
+        conn = _pg_conn_for_user(usuario)
+        try:
+            with conn.cursor() as c:
+                c.execute(
+                    '''INSERT INTO schema_version (banco, versao, atualizado_em) VALUES (%s, %s, %s)
+                       ON CONFLICT (banco) DO UPDATE SET versao = EXCLUDED.versao, atualizado_em = EXCLUDED.atualizado_em''',
+                    (banco, versao, agora),
+                )
+        finally:
+            conn.close()
+    else:
+        conn = _sqlite_connect(get_db_path(usuario, banco))
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO schema_version (banco, versao, atualizado_em) VALUES (?, ?, ?)',
+                (banco, versao, agora),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+def garantir_schema_usuario(usuario, banco, levantar=False):
+    """
+    Aplica as migrações pendentes de `banco` ('carteira' | 'controle' | 'marmitas')
+    para o usuário. Retorna True quando o schema está na última versão.
+
+    Um passo que levanta exceção (ou retorna False) interrompe a sequência; a
+    versão fica no último passo aplicado e a próxima chamada tenta de novo.
+    Com `levantar=True` o erro é repassado ao chamador.
+    """
+    if not usuario:
+        return False
+    # schema/pasta recriado por outro worker (DROP, restore, exclusão) tira a versão do cache
+    _conferir_versao_storage()
+    passos = _MIGRACOES_SCHEMA[banco]
+    alvo = passos[-1][0]
+    chave = _chave_schema_usuario(usuario, banco)
+    if _SCHEMA_VERSAO_CACHE.get(chave) == alvo:
+        return True
+    with _SCHEMA_VERSAO_LOCK:
+        lock = _SCHEMA_VERSAO_LOCKS_CHAVE.setdefault(chave, threading.RLock())
+    with lock:
+        if _SCHEMA_VERSAO_CACHE.get(chave) == alvo:
+            return True
+        try:
+            versao = _ler_versao_schema(usuario, banco)
+            for numero, nome, passo in passos:
+                if numero <= versao:
+                    continue
+                if passo(usuario) is False:
+                    raise RuntimeError(f"passo {nome} retornou falha")
+                _gravar_versao_schema(usuario, banco, numero)
+                versao = numero
+                print(f"[migracoes] {banco} v{numero} ({nome}) aplicada para {usuario}")
+        except Exception as e:
+            print(f"[migracoes] falha ao migrar {banco} de {usuario}: {e}")
+            if levantar:
+                raise
+            return False
+        with _SCHEMA_VERSAO_LOCK:
+            _SCHEMA_VERSAO_CACHE[chave] = versao
+        return True
+
+def migrar_schemas_todos_usuarios():
+    """
+    Job offline (deploy): leva todos os usuários cadastrados à última versão de
+    cada banco. Usado por migrar_schemas.py; seguro de rodar mais de uma vez.
+    """
+    criar_tabela_usuarios()
+    usuarios = [u.get('username') for u in (listar_usuarios() or []) if u.get('username')]
+    resumo = {'usuarios': len(usuarios), 'ok': 0, 'falhas': []}
+    for usuario in usuarios:
+        falhou = [banco for banco in _MIGRACOES_SCHEMA if not garantir_schema_usuario(usuario, banco)]
+        if falhou:
+            resumo['falhas'].append({'usuario': usuario, 'bancos': falhou})
+        else:
+            resumo['ok'] += 1
+    return resumo
+
 def consultar_marmitas(mes=None, ano=None):
     """Consultar marmitas com filtros opcionais"""
     usuario = get_usuario_atual()
@@ -9311,7 +10832,7 @@ def consultar_marmitas(mes=None, ano=None):
         finally:
             conn.close()
     db_path = get_db_path(usuario, "marmitas")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     if mes and ano:
         mes_int = int(mes)
@@ -9344,7 +10865,7 @@ def adicionar_marmita(data, valor, comprou):
             conn.close()
         return
     db_path = get_db_path(usuario, "marmitas")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('INSERT INTO marmitas (data, valor, comprou) VALUES (?, ?, ?)', 
                   (data, valor, comprou))
@@ -9380,7 +10901,7 @@ def atualizar_marmita(id_registro, data=None, valor=None, comprou=None):
             conn.close()
     else:
         db_path = get_db_path(usuario, "marmitas")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         try:
             # Primeiro, buscar os dados atuais
@@ -9416,7 +10937,7 @@ def remover_marmita(id_registro):
             conn.close()
         return
     db_path = get_db_path(usuario, "marmitas")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('DELETE FROM marmitas WHERE id = ?', (id_registro,))
     conn.commit()
@@ -9444,26 +10965,27 @@ def gastos_mensais(periodo='6m'):
             query = '''
                 SELECT left(data, 7) as "AnoMes", SUM(valor) as valor
                 FROM marmitas
-                WHERE data >= %s
-                GROUP BY 1
+                WHERE left(data, 7) >= %s AND data >= %s
+                GROUP BY left(data, 7)
                 ORDER BY 1 DESC
             '''
-            df = pd.read_sql_query(query, conn, params=(data_inicio.strftime('%Y-%m-%d'),))
+            df = pd.read_sql_query(query, conn, params=(data_inicio.strftime('%Y-%m'), data_inicio.strftime('%Y-%m-%d')))
         finally:
             conn.close()
         return df
     db_path = get_db_path(usuario, "marmitas")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     query = '''
         SELECT 
             substr(data, 1, 7) as AnoMes,
             SUM(valor) as valor
         FROM marmitas 
-        WHERE data >= ?
+        WHERE substr(data, 1, 7) >= ? AND data >= ?
         GROUP BY substr(data, 1, 7)
         ORDER BY AnoMes DESC
     '''
-    df = pd.read_sql_query(query, conn, params=(data_inicio.strftime('%Y-%m-%d'),))
+    # o filtro pelo mês deixa a faixa no índice idx_marmitas_mes (sem tabela temporária no GROUP BY)
+    df = pd.read_sql_query(query, conn, params=(data_inicio.strftime('%Y-%m'), data_inicio.strftime('%Y-%m-%d')))
     conn.close()
     return df
 
@@ -9471,8 +10993,7 @@ def verificar_e_corrigir_bancos_usuario(usuario):
     """Verifica e corrige bancos de dados do usuário se necessário"""
     try:
         import os
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        bancos_dir = os.path.join(current_dir, "bancos_usuarios", usuario)
+        bancos_dir = os.path.join(_bancos_usuarios_root(), usuario)
         
         if not os.path.exists(bancos_dir):
             print(f"Diretório não existe para {usuario}, criando bancos...")
@@ -9491,7 +11012,7 @@ def verificar_e_corrigir_bancos_usuario(usuario):
         # Verificar se as tabelas do controle existem
         controle_path = os.path.join(bancos_dir, 'controle.db')
         if os.path.exists(controle_path):
-            conn = sqlite3.connect(controle_path, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(controle_path)
             try:
                 cursor = conn.cursor()
                 cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
@@ -9510,7 +11031,7 @@ def verificar_e_corrigir_bancos_usuario(usuario):
         # Verificar se as tabelas de marmitas existem
         marmitas_path = os.path.join(bancos_dir, 'marmitas.db')
         if os.path.exists(marmitas_path):
-            conn = sqlite3.connect(marmitas_path, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(marmitas_path)
             try:
                 cursor = conn.cursor()
                 cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
@@ -9579,7 +11100,7 @@ def calcular_saldo_mes_ano(mes, ano, pessoa=None):
             conn.close()
     else:
         db_path = get_db_path(usuario, "controle")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         
         df_receitas = pd.read_sql_query(
             'SELECT SUM(valor) as total FROM receitas WHERE data >= ? AND data < ?',
@@ -9623,7 +11144,7 @@ def adicionar_cartao_cadastrado(nome, bandeira, limite, vencimento, cor):
             conn.close()
         return
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO cartoes_cadastrados (nome, bandeira, limite, vencimento, cor)
@@ -9657,7 +11178,7 @@ def listar_cartoes_cadastrados():
             conn.close()
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         SELECT * FROM cartoes_cadastrados 
@@ -9694,7 +11215,7 @@ def atualizar_cartao_cadastrado(id_cartao, nome=None, bandeira=None, limite=None
         return
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE cartoes_cadastrados SET 
@@ -9726,7 +11247,7 @@ def remover_cartao_cadastrado(id_cartao):
         return
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE cartoes_cadastrados SET ativo = 0 WHERE id = ?
@@ -9757,7 +11278,7 @@ def adicionar_compra_cartao(cartao_id, nome, valor, data, categoria=None, observ
         return
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO compras_cartao (cartao_id, nome, valor, data, categoria, observacao)
@@ -9803,7 +11324,7 @@ def listar_compras_cartao(cartao_id, mes=None, ano=None):
             conn.close()
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     if mes and ano:
         mes_int = int(mes)
@@ -9854,7 +11375,7 @@ def atualizar_compra_cartao(id_compra, nome=None, valor=None, data=None, categor
         return
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE compras_cartao SET 
@@ -9884,7 +11405,7 @@ def remover_compra_cartao(id_compra):
         return
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     cursor.execute('DELETE FROM compras_cartao WHERE id = ?', (id_compra,))
     conn.commit()
@@ -9924,7 +11445,7 @@ def calcular_total_compras_cartao(cartao_id, mes=None, ano=None):
             conn.close()
     
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     cursor = conn.cursor()
     if mes and ano:
         mes_int = int(mes)
@@ -9995,7 +11516,7 @@ def marcar_cartao_como_pago(cartao_id, mes_pagamento, ano_pagamento):
             conn.close()
     else:
         db_path = get_db_path(usuario, "controle")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cursor = conn.cursor()
             
@@ -10078,7 +11599,7 @@ def desmarcar_cartao_como_pago(cartao_id):
             conn.close()
     else:
         db_path = get_db_path(usuario, "controle")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         try:
             cursor = conn.cursor()
             
@@ -10142,7 +11663,7 @@ def resetar_status_cartoes_novo_mes():
         return
     # SQLite
     db_path = get_db_path(usuario, "controle")
-    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn = _sqlite_connect(db_path)
     try:
         cursor = conn.cursor()
         cursor.execute("""
@@ -10256,83 +11777,176 @@ def obter_cenarios_predefinidos():
         }
     ]
 
-def executar_monte_carlo(n_simulacoes=10000, periodo_anos=5, confianca=95):
+# Teto de simulações por execução; acima disso a simulação é recusada (não truncada)
+MONTE_CARLO_MAX_SIMULACOES = int(os.getenv('MONTE_CARLO_MAX_SIMULACOES', '1000000'))
+MONTE_CARLO_ANOS_HISTORICO = 5
+
+
+def _classe_monte_carlo(ativo):
+    return str(ativo.get('tipo') or 'Outros').strip() or 'Outros'
+
+
+INDEXADORES_MONTE_CARLO = ("CDI", "SELIC", "IPCA", "CDI+", "IPCA+", "PREFIXADO")
+
+
+def _retornos_mensais_indexador(indexador, indexador_pct, meses_idx):
+    """
+    Retornos mensais (simples) de um título com `indexador` a `indexador_pct`,
+    nos meses `meses_idx`, com as mesmas regras de calcular_preco_com_indexador:
+    CDI/SELIC/IPCA a pct% do índice (100% se ausente), CDI+ com o spread anual
+    composto por dia útil sobre o CDI, IPCA+ com taxa/12 ao mês sobre o IPCA e
+    PREFIXADO à taxa anual fixa. NaN nos meses sem série.
+    """
+    import numpy as np
+    if indexador in ("CDI", "SELIC", "IPCA"):
+        pct = _normalizar_indexador_pct(indexador, indexador_pct) or 100.0
+        base, spread = indexador, 0.0
+    else:
+        pct = _normalizar_indexador_pct(indexador, indexador_pct) or 0.0
+        if indexador == "PREFIXADO":
+            return pd.Series((1.0 + pct / 100.0) ** (1.0 / 12.0) - 1.0, index=meses_idx)
+        if indexador == "CDI+":
+            base, spread = "CDI", ((1 + pct / 100) ** (1 / 252) - 1) * 100
+        else:
+            base, spread = "IPCA", pct / 12
+        pct = 100.0
+    tab = FATORES_INDEXADORES.tabela(base, pct)
+    if len(tab.datas) == 0:
+        return pd.Series(np.nan, index=meses_idx)
+    inicios = (meses_idx - pd.offsets.MonthBegin(1)).values.astype('datetime64[D]')
+    fins = (meses_idx + pd.Timedelta(days=1)).values.astype('datetime64[D]')
+    i = np.searchsorted(tab.datas, inicios, side='left')
+    j = np.searchsorted(tab.datas, fins, side='left')
+    ret = tab.acumulado[j] / tab.acumulado[i] * (1.0 + spread / 100.0) ** (j - i) - 1.0
+    ret[(j <= i) | (inicios < tab.datas[0])] = np.nan
+    return pd.Series(ret, index=meses_idx)
+
+
+def _retornos_classes_monte_carlo(carteira):
+    """
+    DataFrame (mês x classe) de log-retornos mensais e o valor atual por classe.
+    Cada posição entra na classe com peso = valor atual: renda variável pelo
+    histórico diário local; renda fixa pelo seu indexador e percentual/taxa
+    (ver _retornos_mensais_indexador). Indexador desconhecido não vira CDI: a
+    posição segue pelo ticker, se houver, ou fica sem série.
+    """
+    import numpy as np
+    hoje = datetime.now().date()
+    inicio = datetime(hoje.year - MONTE_CARLO_ANOS_HISTORICO, hoje.month, 1).date()
+    meses_idx = pd.date_range(inicio, hoje, freq='ME')
+
+    valores = {}
+    membros = {}  # (classe, chave) -> valor; chave = ticker yfinance ou (indexador, pct)
+    for ativo in carteira:
+        valor = float(ativo.get('valor_total') or 0)
+        if valor <= 0:
+            continue
+        classe = _classe_monte_carlo(ativo)
+        valores[classe] = valores.get(classe, 0.0) + valor
+        indexador = str(ativo.get('indexador') or '').strip().upper()
+        if indexador in INDEXADORES_MONTE_CARLO:
+            chave = (indexador, _normalizar_indexador_pct(indexador, ativo.get('indexador_pct')))
+        elif ativo.get('ticker'):
+            chave = _ticker_yf_b3(ativo['ticker'])
+        else:
+            continue
+        membros[(classe, chave)] = membros.get((classe, chave), 0.0) + valor
+
+    def _mensal(tk):
+        try:
+            hist = obter_historico_diario(tk, inicio - timedelta(days=40), hoje + timedelta(days=1))
+            if hist is None or hist.empty or 'Close' not in hist:
+                return tk, None
+            # OHLCV_STORE devolve índice diário sem timezone
+            return tk, hist['Close'].astype(float).resample('ME').last().pct_change().reindex(meses_idx)
+        except Exception as e:
+            print(f"[MonteCarlo] histórico de {tk} indisponível: {e}")
+            return tk, None
+
+    series = {}
+    tickers = sorted({chave for _, chave in membros if isinstance(chave, str)})
+    if tickers:
+        with ThreadPoolExecutor(max_workers=min(len(tickers), UPSTREAM_MAX_THREADS)) as executor:
+            for tk, serie in executor.map(_mensal, tickers):
+                if serie is not None and serie.notna().any():
+                    series[tk] = serie
+    for _, chave in membros:
+        if isinstance(chave, tuple) and chave not in series:
+            serie = _retornos_mensais_indexador(chave[0], chave[1], meses_idx)
+            if serie.notna().any():
+                series[chave] = serie
+
+    retornos = {}
+    for classe in valores:
+        chaves = [k for k in membros if k[0] == classe and k[1] in series]
+        if chaves:
+            r = pd.DataFrame({n: series[k[1]] for n, k in enumerate(chaves)})
+            pesos = pd.DataFrame({n: np.where(r[n].notna(), membros[k], 0.0) for n, k in enumerate(chaves)}, index=r.index)
+            soma = pesos.sum(axis=1)
+            retornos[classe] = np.log1p((r.fillna(0.0) * pesos).sum(axis=1) / soma.where(soma > 0))
+        else:
+            retornos[classe] = pd.Series(np.nan, index=meses_idx)
+    return pd.DataFrame(retornos, index=meses_idx), valores
+
+
+def executar_monte_carlo(n_simulacoes=10000, periodo_anos=5, confianca=95, aporte_mensal=0.0):
     """
-    Executa simulação Monte Carlo para a carteira
+    Simulação Monte Carlo da carteira (ver monte_carlo.py): caminhos mensais
+    por classe de ativo, correlacionados pela covariância do histórico local,
+    com aporte mensal distribuído pelo peso atual de cada classe.
     """
     try:
         import numpy as np
-        import random
-        
+
+        n_simulacoes = int(n_simulacoes)
+        if not 1 <= n_simulacoes <= MONTE_CARLO_MAX_SIMULACOES:
+            return {"error": f"Número de simulações deve estar entre 1 e {MONTE_CARLO_MAX_SIMULACOES:,}".replace(',', '.')}
+        periodo_anos = max(1, int(periodo_anos))
+        aporte_mensal = max(0.0, float(aporte_mensal or 0))
         print(f"Iniciando Monte Carlo: {n_simulacoes} simulações, {periodo_anos} anos")
-        
+
         usuario = get_usuario_atual()
         if not usuario:
             return {"error": "Usuário não autenticado"}
-        
+
         carteira = obter_carteira()
         if not carteira:
             return {"error": "Carteira vazia"}
-        
-        print(f"Carteira encontrada: {len(carteira)} ativos")
-        
-        # Calcular valor atual total
-        valor_atual_total = sum(ativo['valor_total'] for ativo in carteira)
-        print(f"Valor atual total: R$ {valor_atual_total:,.2f}")
-        
-        # Parâmetros para simulação (baseados em dados históricos médios)
-        retorno_medio_anual = 0.12  # 12% ao ano (média histórica do mercado brasileiro)
-        volatilidade_anual = 0.20   # 20% de volatilidade anual
-        
-     
-        cenarios = []
-        
-        for _ in range(n_simulacoes):
-           
-            retorno_anual = np.random.normal(retorno_medio_anual, volatilidade_anual)
-            
-           
-            valor_final = valor_atual_total * ((1 + retorno_anual) ** periodo_anos)
-            cenarios.append(valor_final)
-        
-  
-        cenarios_ordenados = sorted(cenarios)
-        n_cenarios = len(cenarios_ordenados)
-        
-      
-        percentis = {
-            "p5": cenarios_ordenados[int(0.05 * n_cenarios)],
-            "p25": cenarios_ordenados[int(0.25 * n_cenarios)],
-            "p50": cenarios_ordenados[int(0.50 * n_cenarios)],
-            "p75": cenarios_ordenados[int(0.75 * n_cenarios)],
-            "p95": cenarios_ordenados[int(0.95 * n_cenarios)]
-        }
-        
-    
-        valor_esperado = np.mean(cenarios)
-        
-   
-        volatilidade = np.std(cenarios) / valor_esperado
-        
-    
-        cenarios_perda = [c for c in cenarios if c < valor_atual_total]
-        probabilidade_perda = len(cenarios_perda) / n_cenarios * 100
-        
 
-        sharpe = (valor_esperado - valor_atual_total) / (np.std(cenarios) * np.sqrt(periodo_anos))
-        
-        resultado = {
-            "percentis": percentis,
-            "probabilidade_perda": probabilidade_perda,
-            "valor_esperado": valor_esperado,
-            "volatilidade": volatilidade,
-            "sharpe": sharpe,
-            "cenarios": cenarios[:1000]  
-        }
-        
-        print(f"Monte Carlo concluído: Valor esperado R$ {valor_esperado:,.2f}")
+        inicio = time.time()
+        retornos, valores = _retornos_classes_monte_carlo(carteira)
+        if not valores:
+            return {"error": "Carteira sem valor para simular"}
+        classes = list(retornos.columns)
+        valores_iniciais = np.array([valores[c] for c in classes])
+        valor_atual_total = float(valores_iniciais.sum())
+        print(f"Carteira encontrada: {len(carteira)} ativos em {len(classes)} classes, R$ {valor_atual_total:,.2f}")
+
+        mu, cov, meses_hist = monte_carlo.estimar_parametros(retornos)
+        meses = periodo_anos * 12
+        finais = monte_carlo.simular_caminhos(valores_iniciais, mu, cov, meses, n_simulacoes, aporte_mensal)
+        investido = valor_atual_total + aporte_mensal * meses
+
+        resultado = monte_carlo.resumir(finais, investido, confianca)
+        desvio = float(finais.std())
+        resultado["sharpe"] = float((resultado["valor_esperado"] - investido) / (desvio * np.sqrt(periodo_anos))) if desvio else 0.0
+        resultado["valor_investido"] = investido
+        resultado["aporte_mensal"] = aporte_mensal
+        resultado["n_simulacoes"] = n_simulacoes
+        resultado["classes"] = [
+            {
+                "classe": c,
+                "peso": float(valores_iniciais[k] / valor_atual_total),
+                "retorno_anual": float(np.expm1(mu[k] * 12)),
+                "volatilidade_anual": float(np.sqrt(cov[k, k] * 12)),
+                "meses_historico": int(meses_hist[k]),
+            }
+            for k, c in enumerate(classes)
+        ]
+
+        print(f"Monte Carlo concluído em {time.time() - inicio:.2f}s: Valor esperado R$ {resultado['valor_esperado']:,.2f}")
         return resultado
-        
+
     except Exception as e:
         print(f"Erro na simulação Monte Carlo: {e}")
         return {"error": str(e)}
@@ -10378,11 +11992,13 @@ def atualizar_perfil_usuario(username, nome=None, email=None):
                     WHERE username = %s
                 ''', params)
                 conn.commit()
+                if email is not None:
+                    _invalidar_cache_storage_usuario(propagar=True)
                 return True
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             updates = []
@@ -10402,6 +12018,8 @@ def atualizar_perfil_usuario(username, nome=None, email=None):
                 WHERE username = ?
             ''', params)
             conn.commit()
+            if email is not None:
+                _invalidar_cache_storage_usuario(propagar=True)
             return True
         finally:
             conn.close()
@@ -10443,7 +12061,7 @@ def _username_ja_cadastrado(username: str, ignorar: str | None = None) -> bool:
             finally:
                 conn.close()
         else:
-            conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
             try:
                 c = conn.cursor()
                 c.execute(
@@ -10514,11 +12132,14 @@ def _renomear_pasta_dados_sqlite(old_username: str, new_username: str) -> str |
     if os.path.normcase(old_folder) == os.path.normcase(new_path):
         return None
     _liberar_pasta_destino_username(new_path, new_username)
+    fechar_conexoes_sqlite(old_folder)
     shutil.copytree(old_folder, new_path)
     try:
         shutil.rmtree(old_folder)
     except OSError as e:
         print(f"[username] aviso: pasta antiga mantida ({old_folder}): {e}")
+    fechar_conexoes_sqlite(old_folder)
+    fechar_conexoes_sqlite(new_path)
     return new_path
 
 
@@ -10546,6 +12167,8 @@ def _renomear_schema_postgres(old_username: str, new_username: str) -> None:
         conn.commit()
     finally:
         conn.close()
+    _pg_esquecer_schema_usuario(old_username)
+    _pg_esquecer_schema_usuario(new_username)
 
 
 def atualizar_sessao_username(token: str, novo_username: str) -> None:
@@ -10565,13 +12188,14 @@ def atualizar_sessao_username(token: str, novo_username: str) -> None:
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             c.execute('UPDATE sessoes SET username = ? WHERE token = ?', (u, token))
             conn.commit()
         finally:
             conn.close()
+    _sessao_cache_invalidar(token=token)
 
 
 def atualizar_username_usuario(username_atual, novo_username, senha_atual=None):
@@ -10621,7 +12245,7 @@ def atualizar_username_usuario(username_atual, novo_username, senha_atual=None):
             finally:
                 conn.close()
         else:
-            conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+            conn = _sqlite_connect(USUARIOS_DB_PATH)
             try:
                 c = conn.cursor()
                 c.execute('UPDATE usuarios SET username = ? WHERE username = ?', (novo_fmt, atual))
@@ -10631,6 +12255,7 @@ def atualizar_username_usuario(username_atual, novo_username, senha_atual=None):
                 conn.close()
         limpar_cache_usuario(atual)
         limpar_cache_usuario(novo_fmt)
+        _sessao_cache_invalidar(username=atual)
         print(f"[username] renomeado: {atual} -> {novo_fmt}")
         return {'success': True, 'username': novo_fmt, 'message': 'Username atualizado com sucesso'}
     except sqlite3.IntegrityError:
@@ -10670,7 +12295,7 @@ def atualizar_senha_usuario(username, nova_senha):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             c.execute('UPDATE usuarios SET senha_hash = ? WHERE username = ?', (senha_hash, username))
@@ -10701,7 +12326,7 @@ def definir_role_usuario(username, novo_role):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             c.execute('UPDATE usuarios SET role = ? WHERE username = ?', (novo_role, username))
@@ -10727,7 +12352,7 @@ def usuario_bloqueado(username):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             try:
@@ -10748,15 +12373,17 @@ def bloquear_usuario(username, blocked=True):
             with conn.cursor() as c:
                 c.execute('UPDATE public.usuarios SET blocked = %s WHERE username = %s', (bool(blocked), username))
             conn.commit()
+            _sessao_cache_invalidar(username=username)
             return True
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             c.execute('UPDATE usuarios SET blocked = ? WHERE username = ?', (1 if blocked else 0, username))
             conn.commit()
+            _sessao_cache_invalidar(username=username)
             return True
         finally:
             conn.close()
@@ -10785,7 +12412,7 @@ def obter_allowed_screens(username):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             try:
@@ -10815,7 +12442,7 @@ def atualizar_allowed_screens(username, screens):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             c.execute('UPDATE usuarios SET allowed_screens = ? WHERE username = ?', (val, username))
@@ -10839,7 +12466,7 @@ def atualizar_last_seen(username):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             c.execute('UPDATE usuarios SET last_seen_at = ? WHERE username = ?', (now_str, username))
@@ -10870,6 +12497,7 @@ def _is_online(last_seen_at, within_minutes=5):
 def listar_usuarios(admin_only=False):
     """Lista todos os usuários (apenas para admins). Inclui last_seen_at, online, blocked, allowed_screens."""
     import json as _json
+    flush_last_seen()
     def _row_to_user(row, has_extra):
         last = row[6] if has_extra and len(row) > 6 else None
         blocked = False
@@ -10915,7 +12543,7 @@ def listar_usuarios(admin_only=False):
         finally:
             conn.close()
     else:
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         c = conn.cursor()
         try:
             if admin_only:
@@ -10985,7 +12613,7 @@ def obter_carteira_para_admin(target_username):
             finally:
                 conn.close()
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         cursor.execute('''
             SELECT id, ticker, nome_completo, quantidade, preco_atual, preco_compra, valor_total,
@@ -11054,7 +12682,7 @@ def obter_movimentacoes_para_admin(target_username, mes=None, ano=None):
             finally:
                 conn.close()
         db_path = get_db_path(usuario, "carteira")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         if mes and ano:
             mes_int, ano_int = int(mes), int(ano)
@@ -11097,7 +12725,7 @@ def consultar_marmitas_para_admin(target_username, mes=None, ano=None):
             finally:
                 conn.close()
         db_path = get_db_path(usuario, "marmitas")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         if mes and ano:
             mes_int, ano_int = int(mes), int(ano)
@@ -11138,7 +12766,7 @@ def obter_controle_para_admin(target_username, limite=200):
                 conn.close()
             return out
         db_path = get_db_path(usuario, "controle")
-        conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(db_path)
         cursor = conn.cursor()
         for tabela, chave in [("receitas", "receitas"), ("cartoes", "cartoes"), ("outros_gastos", "outros_gastos")]:
             try:
@@ -11155,7 +12783,7 @@ def obter_controle_para_admin(target_username, limite=200):
 
 
 def _bancos_usuarios_root():
-    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "bancos_usuarios")
+    return BANCOS_USUARIOS_DIR
 
 
 def _pastas_dados_usuario(username):
@@ -11194,7 +12822,9 @@ def limpar_pastas_orfas_usuarios():
         if buscar_usuario_por_username(name):
             continue
         try:
+            fechar_conexoes_sqlite(full)
             shutil.rmtree(full, ignore_errors=True)
+            fechar_conexoes_sqlite(full)
             print(f"[orphan] pasta órfã removida: {name}")
             removidas += 1
         except Exception as e:
@@ -11218,8 +12848,11 @@ def apagar_dados_armazenamento_usuario(username):
                 print(f"[excluir] schema PostgreSQL removido: {schema}")
             finally:
                 conn.close()
+            _pg_esquecer_schema_usuario(u)
         for pasta in _pastas_dados_usuario(u):
+            fechar_conexoes_sqlite(pasta)
             shutil.rmtree(pasta, ignore_errors=True)
+            fechar_conexoes_sqlite(pasta)
             print(f"[excluir] pasta de dados removida: {pasta}")
         return True
     except Exception as e:
@@ -11248,7 +12881,7 @@ def excluir_conta_usuario(username):
                 return True
             finally:
                 conn.close()
-        conn = sqlite3.connect(USUARIOS_DB_PATH, check_same_thread=False, timeout=30)
+        conn = _sqlite_connect(USUARIOS_DB_PATH)
         try:
             c = conn.cursor()
             c.execute('DELETE FROM usuarios WHERE username = ?', (u,))
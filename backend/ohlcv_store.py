@@ -0,0 +1,371 @@
+"""Histórico diário (OHLCV) persistido por ticker num SQLite compartilhado, com atualização incremental."""
+from __future__ import annotations
+
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Optional
+
+import pandas as pd
+
+COLUNAS = (
+    ("open", "Open"),
+    ("high", "High"),
+    ("low", "Low"),
+    ("close", "Close"),
+    ("volume", "Volume"),
+    ("dividends", "Dividends"),
+    ("splits", "Stock Splits"),
+)
+
+
+def _como_data(valor) -> Optional[date]:
+    if valor is None:
+        return None
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    if isinstance(valor, pd.Timestamp):
+        return valor.date()
+    return datetime.strptime(str(valor)[:10], "%Y-%m-%d").date()
+
+
+class OhlcvStore:
+    def __init__(self, db_path: str, conectar: Callable, baixar: Callable, ttl_cauda_s: float = 900.0):
+        """
+        `baixar(ticker, inicio, fim)` devolve o DataFrame do `history()` do
+        yfinance para [inicio, fim) — ou o histórico inteiro se inicio for None.
+        """
+        self.db_path = db_path
+        self._conectar = conectar
+        self._baixar = baixar
+        self.ttl_cauda_s = float(ttl_cauda_s)
+        self._lock = threading.Lock()
+        self._locks_ticker = {}
+        self._tabelas_ok = False
+        self._m = {"consultas": 0, "locais": 0, "downloads": 0, "barras_baixadas": 0, "recargas_ajuste": 0, "erros": 0}
+
+    # ------------------------------------------------------------------ SQLite
+
+    def _conn(self):
+        conn = self._conectar(self.db_path)
+        if not self._tabelas_ok:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS barras (
+                    ticker TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    open REAL,
+                    high REAL,
+                    low REAL,
+                    close REAL,
+                    volume REAL,
+                    dividends REAL,
+                    splits REAL,
+                    PRIMARY KEY (ticker, data)
+                ) WITHOUT ROWID
+                """
+            )
+            tinha_proventos = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'proventos'"
+            ).fetchone()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS proventos (
+                    ticker TEXT NOT NULL,
+                    data_ex TEXT NOT NULL,
+                    valor REAL NOT NULL,
+                    PRIMARY KEY (ticker, data_ex)
+                ) WITHOUT ROWID
+                """
+            )
+            if not tinha_proventos:
+                # store criado antes da tabela de proventos: aproveita os dividendos já baixados
+                cur.execute(
+                    "INSERT OR IGNORE INTO proventos (ticker, data_ex, valor) "
+                    "SELECT ticker, data, dividends FROM barras WHERE dividends IS NOT NULL AND dividends != 0"
+                )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS barras_cobertura (
+                    ticker TEXT PRIMARY KEY,
+                    inicio TEXT,
+                    fim TEXT,
+                    desde_max INTEGER NOT NULL DEFAULT 0,
+                    atualizado_em REAL NOT NULL
+                )
+                """
+            )
+            conn.commit()
+            self._tabelas_ok = True
+        return conn
+
+    def _cobertura(self, ticker):
+        conn = self._conn()
+        try:
+            row = conn.execute(
+                "SELECT inicio, fim, desde_max, atualizado_em FROM barras_cobertura WHERE ticker = ?", (ticker,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        return {
+            "inicio": _como_data(row[0]),
+            "fim": _como_data(row[1]),
+            "desde_max": bool(row[2]),
+            "atualizado_em": float(row[3]),
+        }
+
+    def _gravar(self, ticker, df, cobertura, apagar_antes=False):
+        linhas = []
+        if df is not None and not df.empty:
+            for idx, row in df.iterrows():
+                linhas.append(
+                    (ticker, _como_data(idx).isoformat())
+                    + tuple(_float(row.get(col)) for _, col in COLUNAS)
+                )
+        conn = self._conn()
+        try:
+            cur = conn.cursor()
+            if apagar_antes:
+                cur.execute("DELETE FROM barras WHERE ticker = ?", (ticker,))
+                cur.execute("DELETE FROM proventos WHERE ticker = ?", (ticker,))
+            if linhas:
+                cur.executemany(
+                    "INSERT OR REPLACE INTO barras (ticker, data, open, high, low, close, volume, dividends, splits) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    linhas,
+                )
+                # índice de "dividends" em COLUNAS + 2 (ticker, data)
+                cur.executemany(
+                    "INSERT OR REPLACE INTO proventos (ticker, data_ex, valor) VALUES (?, ?, ?)",
+                    [(l[0], l[1], l[7]) for l in linhas if l[7]],
+                )
+            cur.execute(
+                "INSERT OR REPLACE INTO barras_cobertura (ticker, inicio, fim, desde_max, atualizado_em) VALUES (?, ?, ?, ?, ?)",
+                (
+                    ticker,
+                    cobertura["inicio"].isoformat() if cobertura["inicio"] else None,
+                    cobertura["fim"].isoformat() if cobertura["fim"] else None,
+                    1 if cobertura["desde_max"] else 0,
+                    cobertura["atualizado_em"],
+                ),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        return len(linhas)
+
+    def _ler(self, ticker, inicio: Optional[date], fim: Optional[date]) -> pd.DataFrame:
+        sql = "SELECT data, " + ", ".join(c for c, _ in COLUNAS) + " FROM barras WHERE ticker = ?"
+        params = [ticker]
+        if inicio is not None:
+            sql += " AND data >= ?"
+            params.append(inicio.isoformat())
+        if fim is not None:
+            sql += " AND data < ?"
+            params.append(fim.isoformat())
+        sql += " ORDER BY data"
+        conn = self._conn()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        df = pd.DataFrame.from_records(rows, columns=["Date"] + [c for _, c in COLUNAS])
+        df.index = pd.DatetimeIndex(pd.to_datetime(df.pop("Date")), name="Date")
+        return df
+
+    # ------------------------------------------------------------------ download
+
+    def _baixar_df(self, ticker, inicio: Optional[date], fim: Optional[date]):
+        with self._lock:
+            self._m["downloads"] += 1
+        df = self._baixar(ticker, inicio, fim)
+        if df is None or df.empty:
+            return None
+        df = df.copy()
+        try:
+            if getattr(df.index, "tz", None) is not None:
+                df.index = df.index.tz_localize(None)
+        except Exception:
+            pass
+        df = df[~df.index.duplicated(keep="last")]
+        if "Close" in df.columns:
+            df = df[df["Close"].notna()]
+        return df if not df.empty else None
+
+    def _atualizar(self, ticker, inicio: Optional[date], fim: Optional[date]):
+        """Baixa o que falta de [inicio, fim) e atualiza a cobertura. True se foi ao Yahoo."""
+        hoje = date.today()
+        amanha = hoje + timedelta(days=1)
+        agora = time.time()
+        cob = self._cobertura(ticker)
+
+        if cob is None or cob["fim"] is None:
+            # primeira vez (ou só houve respostas vazias): baixa do início pedido até hoje
+            if cob is not None and agora - cob["atualizado_em"] < self.ttl_cauda_s:
+                return False
+            df = self._baixar_df(ticker, inicio, amanha)
+            nova = {
+                "inicio": inicio,
+                "fim": _como_data(df.index.max()) if df is not None else None,
+                "desde_max": inicio is None,
+                "atualizado_em": agora,
+            }
+            n = self._gravar(ticker, df, nova, apagar_antes=True)
+            with self._lock:
+                self._m["barras_baixadas"] += n
+            return True
+
+        n = 0
+        baixou = False
+        # cabeça: pedido começa antes do trecho já coberto
+        if not cob["desde_max"] and (inicio is None or (cob["inicio"] is not None and inicio < cob["inicio"])):
+            df = self._baixar_df(ticker, inicio, (cob["inicio"] or hoje) + timedelta(days=1))
+            cob["inicio"] = inicio
+            cob["desde_max"] = inicio is None
+            n += self._gravar(ticker, df, cob)
+            baixou = True
+
+        # cauda: desde a última barra (inclusive), se o pedido chega até lá
+        if (fim is None or fim > cob["fim"]) and agora - cob["atualizado_em"] >= self.ttl_cauda_s:
+            df = self._baixar_df(ticker, cob["fim"], amanha)
+            baixou = True
+            novos_eventos = df is not None and self._tem_evento_novo(ticker, df)
+            if novos_eventos:
+                # provento/split novo: os preços ajustados antigos mudaram
+                with self._lock:
+                    self._m["recargas_ajuste"] += 1
+                df = self._baixar_df(ticker, None if cob["desde_max"] else cob["inicio"], amanha)
+                cob["fim"] = _como_data(df.index.max()) if df is not None else cob["fim"]
+                cob["atualizado_em"] = agora
+                n += self._gravar(ticker, df, cob, apagar_antes=df is not None)
+            else:
+                if df is not None:
+                    cob["fim"] = max(cob["fim"], _como_data(df.index.max()))
+                cob["atualizado_em"] = agora
+                n += self._gravar(ticker, df, cob)
+        if n:
+            with self._lock:
+                self._m["barras_baixadas"] += n
+        return baixou
+
+    def _tem_evento_novo(self, ticker, df) -> bool:
+        """Dividendo/split em `df` que ainda não está nas barras gravadas."""
+        eventos = {}
+        for idx, row in df.iterrows():
+            div, split = _float(row.get("Dividends")) or 0.0, _float(row.get("Stock Splits")) or 0.0
+            if div or split:
+                eventos[_como_data(idx).isoformat()] = (div, split)
+        if not eventos:
+            return False
+        conn = self._conn()
+        try:
+            gravados = {
+                r[0]: (r[1] or 0.0, r[2] or 0.0)
+                for r in conn.execute(
+                    "SELECT data, dividends, splits FROM barras WHERE ticker = ? AND data >= ?",
+                    (ticker, min(eventos)),
+                ).fetchall()
+            }
+        finally:
+            conn.close()
+        return any(gravados.get(d) != ev for d, ev in eventos.items())
+
+    def _lock_ticker(self, ticker):
+        with self._lock:
+            lock = self._locks_ticker.get(ticker)
+            if lock is None:
+                lock = self._locks_ticker[ticker] = threading.Lock()
+            return lock
+
+    # ------------------------------------------------------------------ API
+
+    def historico(self, ticker: str, inicio=None, fim=None) -> pd.DataFrame:
+        """
+        Barras diárias de `ticker` em [inicio, fim) (None = sem limite), como
+        o `history()` do yfinance. Baixa só o que ainda não está no store.
+        """
+        ticker = (ticker or "").strip().upper()
+        inicio = _como_data(inicio)
+        fim = _como_data(fim)
+        with self._lock:
+            self._m["consultas"] += 1
+        baixou = True
+        try:
+            with self._lock_ticker(ticker):
+                baixou = self._atualizar(ticker, inicio, fim)
+        except Exception as e:
+            # sem rede/Yahoo fora: serve o que já existe localmente
+            with self._lock:
+                self._m["erros"] += 1
+            print(f"[OHLCV] aviso: atualização de {ticker} falhou: {e}")
+        if not baixou:
+            with self._lock:
+                self._m["locais"] += 1
+        return self._ler(ticker, inicio, fim)
+
+    def sincronizar(self, ticker: str, inicio=None, fim=None) -> bool:
+        """Atualiza a cobertura de `ticker` sem ler as barras. True se foi ao Yahoo."""
+        ticker = (ticker or "").strip().upper()
+        try:
+            with self._lock_ticker(ticker):
+                return self._atualizar(ticker, _como_data(inicio), _como_data(fim))
+        except Exception as e:
+            with self._lock:
+                self._m["erros"] += 1
+            print(f"[OHLCV] aviso: atualização de {ticker} falhou: {e}")
+            return False
+
+    def proventos(self, tickers, inicio=None) -> pd.DataFrame:
+        """Eventos (ticker, data_ex, valor) já gravados para `tickers`, ordenados por data."""
+        tickers = sorted({(t or "").strip().upper() for t in tickers if t})
+        if not tickers:
+            return pd.DataFrame(columns=["ticker", "data_ex", "valor"])
+        sql = f"SELECT ticker, data_ex, valor FROM proventos WHERE ticker IN ({','.join('?' * len(tickers))})"
+        params = list(tickers)
+        inicio = _como_data(inicio)
+        if inicio is not None:
+            sql += " AND data_ex >= ?"
+            params.append(inicio.isoformat())
+        sql += " ORDER BY data_ex, ticker"
+        conn = self._conn()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        df = pd.DataFrame.from_records(rows, columns=["ticker", "data_ex", "valor"])
+        df["data_ex"] = pd.to_datetime(df["data_ex"])
+        return df
+
+    def invalidar(self, ticker: str):
+        ticker = (ticker or "").strip().upper()
+        conn = self._conn()
+        try:
+            conn.execute("DELETE FROM barras WHERE ticker = ?", (ticker,))
+            conn.execute("DELETE FROM barras_cobertura WHERE ticker = ?", (ticker,))
+            conn.execute("DELETE FROM proventos WHERE ticker = ?", (ticker,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return dict(self._m)
+
+    def depois_do_fork_filho(self):
+        self._lock = threading.Lock()
+        self._locks_ticker = {}
+        self._m = {k: 0 for k in self._m}
+
+
+def _float(v):
+    try:
+        if v is None or pd.isna(v):
+            return None
+        return float(v)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,374 @@
+"""Pool de conexões PostgreSQL por processo, com vínculo de schema (search_path) por usuário."""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+# Sentinela: conexão recém-aberta, search_path ainda no default do servidor
+_SCHEMA_DEFAULT = None
+
+
+class _Slot:
+    __slots__ = ("raw", "schema", "vinculada_em", "criada_em", "usada_em", "pid", "overflow")
+
+    def __init__(self, raw, overflow: bool):
+        agora = time.monotonic()
+        self.raw = raw
+        self.schema = _SCHEMA_DEFAULT
+        self.vinculada_em = agora
+        self.criada_em = agora
+        self.usada_em = agora
+        self.pid = os.getpid()
+        self.overflow = overflow
+
+
+class ConexaoPooled:
+    """
+    Proxy de uma conexão psycopg emprestada pelo pool.
+
+    Tudo é delegado à conexão real, exceto `close()` (devolve ao pool) e o
+    protocolo de context manager (commit/rollback e devolve, como o psycopg).
+    """
+
+    def __init__(self, pool: "PgPool", slot: _Slot):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_slot", slot)
+
+    def __getattr__(self, name):
+        slot = object.__getattribute__(self, "_slot")
+        if slot is None:
+            raise AttributeError(f"conexão já devolvida ao pool ({name})")
+        return getattr(slot.raw, name)
+
+    def __setattr__(self, name, value):
+        slot = object.__getattribute__(self, "_slot")
+        if slot is None:
+            raise AttributeError(f"conexão já devolvida ao pool ({name})")
+        setattr(slot.raw, name, value)
+
+    @property
+    def closed(self):
+        slot = object.__getattribute__(self, "_slot")
+        return True if slot is None else slot.raw.closed
+
+    @property
+    def schema(self) -> Optional[str]:
+        slot = object.__getattribute__(self, "_slot")
+        return None if slot is None else slot.schema
+
+    def vincular_schema(self, schema: Optional[str]) -> None:
+        slot = object.__getattribute__(self, "_slot")
+        if slot is None:
+            raise RuntimeError("conexão já devolvida ao pool")
+        self._pool._vincular(slot, schema)
+
+    def close(self):
+        slot = object.__getattribute__(self, "_slot")
+        if slot is None:
+            return
+        object.__setattr__(self, "_slot", None)
+        self._pool._devolver(slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        slot = object.__getattribute__(self, "_slot")
+        if slot is not None:
+            try:
+                if exc_type is None:
+                    slot.raw.commit()
+                else:
+                    slot.raw.rollback()
+            except Exception:
+                pass
+        self.close()
+        return False
+
+    def __del__(self):
+        # Rede de segurança para caminhos que esquecem o close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class PgPool:
+    def __init__(
+        self,
+        conninfo: str,
+        tamanho: int = 8,
+        overflow: int = 16,
+        timeout: float = 30.0,
+        max_ocioso_s: float = 300.0,
+        configurar: Optional[Callable] = None,
+        conectar: Optional[Callable] = None,
+        conferir: Optional[Callable[[], None]] = None,
+    ):
+        self._conninfo = conninfo
+        self.tamanho = max(1, int(tamanho))
+        self.overflow = max(0, int(overflow))
+        self.timeout = float(timeout)
+        self.max_ocioso_s = float(max_ocioso_s)
+        self._configurar = configurar
+        self._conectar = conectar
+        # chamado a cada retirada, fora do lock (pode chamar esquecer_schema)
+        self._conferir = conferir
+        self._cond = threading.Condition(threading.Lock())
+        self._ociosas: list = []
+        self._abertas = 0
+        self._schemas_existentes: set = set()
+        # schema -> instante do último esquecer_schema; vínculo anterior a ele é revalidado
+        self._schemas_esquecidos: dict = {}
+        self._pid = os.getpid()
+        self._zerar_metricas()
+
+    # ------------------------------------------------------------------ métricas
+
+    def _zerar_metricas(self):
+        self._m = {
+            "checkouts": 0,
+            "reusos_mesmo_schema": 0,
+            "trocas_schema": 0,
+            "criadas": 0,
+            "descartadas": 0,
+            "overflow_criadas": 0,
+            "esperas": 0,
+            "espera_total_ms": 0.0,
+            "espera_max_ms": 0.0,
+            "timeouts": 0,
+            "schemas_criados": 0,
+        }
+
+    def metricas(self) -> dict:
+        with self._cond:
+            m = dict(self._m)
+            m.update({
+                "pid": self._pid,
+                "tamanho": self.tamanho,
+                "overflow_max": self.overflow,
+                "abertas": self._abertas,
+                "ociosas": len(self._ociosas),
+                "em_uso": self._abertas - len(self._ociosas),
+                "schemas_conhecidos": len(self._schemas_existentes),
+            })
+        m["espera_total_ms"] = round(m["espera_total_ms"], 2)
+        m["espera_max_ms"] = round(m["espera_max_ms"], 2)
+        m["espera_media_ms"] = round(m["espera_total_ms"] / m["esperas"], 2) if m["esperas"] else 0.0
+        return m
+
+    # ------------------------------------------------------------------ fork
+
+    def _checar_pid(self):
+        """Chamado com o lock: descarta (sem fechar) estado herdado de outro processo."""
+        pid = os.getpid()
+        if pid != self._pid:
+            self._ociosas = []
+            self._abertas = 0
+            self._pid = pid
+            self._zerar_metricas()
+
+    def antes_do_fork(self):
+        self.fechar_ociosas()
+
+    def depois_do_fork_filho(self):
+        # O lock pode ter sido copiado travado por outra thread do pai
+        self._cond = threading.Condition(threading.Lock())
+        self._ociosas = []
+        self._abertas = 0
+        self._pid = os.getpid()
+        self._zerar_metricas()
+
+    def fechar_ociosas(self):
+        with self._cond:
+            self._checar_pid()
+            ociosas, self._ociosas = self._ociosas, []
+            self._abertas -= len(ociosas)
+            self._cond.notify_all()
+        for slot in ociosas:
+            self._fechar_raw(slot.raw)
+
+    # ------------------------------------------------------------------ schemas
+
+    def esquecer_schema(self, schema: str):
+        """
+        Invalida o cache de existência (após DROP/RENAME do schema). Conexões
+        vinculadas antes disso, ociosas ou emprestadas, refazem CREATE + SET na
+        próxima retirada.
+        """
+        with self._cond:
+            self._schemas_existentes.discard(schema)
+            self._schemas_esquecidos[schema] = time.monotonic()
+
+    def _vincular(self, slot: _Slot, schema: Optional[str]):
+        if (
+            slot.schema == schema
+            and schema is not None
+            and slot.vinculada_em > self._schemas_esquecidos.get(schema, float("-inf"))
+        ):
+            return
+        if schema is None:
+            if slot.schema is _SCHEMA_DEFAULT:
+                return
+            with slot.raw.cursor() as cur:
+                cur.execute("RESET search_path")
+            slot.schema = _SCHEMA_DEFAULT
+            return
+        with slot.raw.cursor() as cur:
+            if schema not in self._schemas_existentes:
+                cur.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+                with self._cond:
+                    self._schemas_existentes.add(schema)
+                    self._m["schemas_criados"] += 1
+            cur.execute(f"SET search_path TO {schema}")
+        slot.schema = schema
+        slot.vinculada_em = time.monotonic()
+        with self._cond:
+            self._m["trocas_schema"] += 1
+
+    # ------------------------------------------------------------------ retirada/devolução
+
+    def _abrir(self, overflow: bool) -> _Slot:
+        if self._conectar is not None:
+            raw = self._conectar(self._conninfo)
+        else:
+            import psycopg
+            raw = psycopg.connect(self._conninfo)
+        try:
+            if self._configurar is not None:
+                self._configurar(raw)
+        except Exception:
+            self._fechar_raw(raw)
+            raise
+        return _Slot(raw, overflow)
+
+    @staticmethod
+    def _fechar_raw(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _saudavel(self, slot: _Slot) -> bool:
+        raw = slot.raw
+        if getattr(raw, "closed", False) or getattr(raw, "broken", False):
+            return False
+        return (time.monotonic() - slot.usada_em) <= self.max_ocioso_s
+
+    def _retirar_slot(self, schema: Optional[str]) -> _Slot:
+        inicio = None
+        with self._cond:
+            self._checar_pid()
+            while True:
+                # 1) ociosa já vinculada ao schema (LIFO: a mais quente primeiro)
+                escolhida = None
+                for i in range(len(self._ociosas) - 1, -1, -1):
+                    if self._ociosas[i].schema == schema:
+                        escolhida = self._ociosas.pop(i)
+                        break
+                # 2) qualquer ociosa (será revinculada)
+                if escolhida is None and self._ociosas:
+                    escolhida = self._ociosas.pop()
+                if escolhida is not None:
+                    if self._saudavel(escolhida):
+                        if escolhida.schema == schema and schema is not None:
+                            self._m["reusos_mesmo_schema"] += 1
+                        break
+                    self._abertas -= 1
+                    self._m["descartadas"] += 1
+                    raw_morta = escolhida.raw
+                    self._cond.release()
+                    try:
+                        self._fechar_raw(raw_morta)
+                    finally:
+                        self._cond.acquire()
+                    continue
+                # 3) abrir nova (dentro do tamanho ou do overflow)
+                if self._abertas < self.tamanho + self.overflow:
+                    overflow = self._abertas >= self.tamanho
+                    self._abertas += 1
+                    self._m["criadas"] += 1
+                    if overflow:
+                        self._m["overflow_criadas"] += 1
+                    escolhida = None
+                    break
+                # 4) esperar alguém devolver
+                if inicio is None:
+                    inicio = time.monotonic()
+                    self._m["esperas"] += 1
+                restante = self.timeout - (time.monotonic() - inicio)
+                if restante <= 0:
+                    self._m["timeouts"] += 1
+                    raise TimeoutError(
+                        f"Pool PostgreSQL esgotado ({self._abertas} conexões em uso) após {self.timeout:.0f}s"
+                    )
+                self._cond.wait(restante)
+            if inicio is not None:
+                espera_ms = (time.monotonic() - inicio) * 1000.0
+                self._m["espera_total_ms"] += espera_ms
+                self._m["espera_max_ms"] = max(self._m["espera_max_ms"], espera_ms)
+            self._m["checkouts"] += 1
+        if escolhida is not None:
+            return escolhida
+        try:
+            return self._abrir(overflow)
+        except Exception:
+            with self._cond:
+                self._abertas -= 1
+                self._cond.notify()
+            raise
+
+    def conexao(self, schema: Optional[str] = None) -> ConexaoPooled:
+        if self._conferir is not None:
+            try:
+                self._conferir()
+            except Exception:
+                pass
+        slot = self._retirar_slot(schema)
+        try:
+            self._vincular(slot, schema)
+        except Exception:
+            # Conexão morta no servidor (idle timeout, failover): tenta uma nova
+            self._descartar(slot)
+            slot = self._retirar_slot(schema)
+            try:
+                self._vincular(slot, schema)
+            except Exception:
+                self._descartar(slot)
+                raise
+        return ConexaoPooled(self, slot)
+
+    def _descartar(self, slot: _Slot):
+        with self._cond:
+            if slot.pid == self._pid:
+                self._abertas -= 1
+                self._m["descartadas"] += 1
+                self._cond.notify()
+        if slot.pid == os.getpid():
+            self._fechar_raw(slot.raw)
+
+    def _devolver(self, slot: _Slot):
+        if slot.pid != os.getpid():
+            return  # herdada de outro processo: nunca fechar/reutilizar
+        raw = slot.raw
+        reutilizavel = not getattr(raw, "closed", False) and not getattr(raw, "broken", False)
+        if reutilizavel:
+            try:
+                # Transação deixada aberta (autocommit desligado / erro) não volta suja
+                status = raw.info.transaction_status
+                if status != 0:  # 0 == TransactionStatus.IDLE
+                    raw.rollback()
+                    if raw.info.transaction_status != 0:
+                        reutilizavel = False
+            except Exception:
+                reutilizavel = False
+        if reutilizavel and not slot.overflow:
+            slot.usada_em = time.monotonic()
+            with self._cond:
+                if slot.pid == self._pid:
+                    self._ociosas.append(slot)
+                    self._cond.notify()
+                    return
+        self._descartar(slot)
@@ -0,0 +1,292 @@
+"""Store compartilhado de cotações/fundamentos (yfinance .info, Binance), com TTL por grupo de campos."""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+TTL_GRUPOS_PADRAO = {
+    "preco": 60.0,
+    "fundamentos": 6 * 3600.0,
+    "cadastro": 7 * 86400.0,
+}
+TTL_VAZIO = 120.0
+
+
+class _Voo:
+    __slots__ = ("evento", "resultado", "erro")
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+class QuoteStore:
+    def __init__(
+        self,
+        db_path: str,
+        conectar: Callable,
+        ttl_grupos: Optional[dict] = None,
+        lease_s: float = 15.0,
+        max_memoria: int = 5000,
+    ):
+        self.db_path = db_path
+        self._conectar = conectar
+        self.ttl_grupos = dict(TTL_GRUPOS_PADRAO)
+        self.ttl_grupos.update(ttl_grupos or {})
+        self.lease_s = float(lease_s)
+        self.max_memoria = int(max_memoria)
+        self._lock = threading.Lock()
+        self._memoria = {}  # (fonte, simbolo) -> (payload, buscado_em)
+        self._voos = {}  # (fonte, simbolo) -> _Voo
+        self._metricas = {}
+        self._tabelas_ok = False
+
+    # ------------------------------------------------------------------ SQLite
+
+    def _conn(self):
+        conn = self._conectar(self.db_path)
+        if not self._tabelas_ok:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cotacoes (
+                    fonte TEXT NOT NULL,
+                    simbolo TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    buscado_em REAL NOT NULL,
+                    PRIMARY KEY (fonte, simbolo)
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cotacoes_lease (
+                    fonte TEXT NOT NULL,
+                    simbolo TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    expira_em REAL NOT NULL,
+                    PRIMARY KEY (fonte, simbolo)
+                )
+                """
+            )
+            conn.commit()
+            self._tabelas_ok = True
+        return conn
+
+    def _ler_disco(self, fonte, simbolo):
+        conn = self._conn()
+        try:
+            row = conn.execute(
+                "SELECT payload, buscado_em FROM cotacoes WHERE fonte = ? AND simbolo = ?",
+                (fonte, simbolo),
+            ).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        try:
+            return json.loads(row[0]), float(row[1])
+        except ValueError:
+            return None
+
+    def _gravar_disco(self, fonte, simbolo, payload, buscado_em):
+        conn = self._conn()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO cotacoes (fonte, simbolo, payload, buscado_em) VALUES (?, ?, ?, ?)",
+                (fonte, simbolo, json.dumps(payload, default=str), buscado_em),
+            )
+            conn.execute("DELETE FROM cotacoes_lease WHERE fonte = ? AND simbolo = ?", (fonte, simbolo))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _pegar_lease(self, fonte, simbolo) -> bool:
+        """True se este processo ficou responsável pela busca (ou a lease anterior expirou)."""
+        agora = time.time()
+        conn = self._conn()
+        try:
+            cur = conn.execute(
+                """
+                INSERT INTO cotacoes_lease (fonte, simbolo, pid, expira_em) VALUES (?, ?, ?, ?)
+                ON CONFLICT (fonte, simbolo) DO UPDATE SET pid = excluded.pid, expira_em = excluded.expira_em
+                WHERE cotacoes_lease.expira_em < ?
+                """,
+                (fonte, simbolo, os.getpid(), agora + self.lease_s, agora),
+            )
+            conn.commit()
+            return cur.rowcount > 0
+        finally:
+            conn.close()
+
+    def _soltar_lease(self, fonte, simbolo):
+        try:
+            conn = self._conn()
+            try:
+                conn.execute(
+                    "DELETE FROM cotacoes_lease WHERE fonte = ? AND simbolo = ? AND pid = ?",
+                    (fonte, simbolo, os.getpid()),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            pass
+
+    # ------------------------------------------------------------------ API
+
+    def _conta(self, fonte, campo, n=1):
+        m = self._metricas.setdefault(
+            fonte, {"hits_memoria": 0, "hits_disco": 0, "misses": 0, "esperas": 0, "erros": 0, "vencidos_servidos": 0, "busca_ms_total": 0.0}
+        )
+        m[campo] += n
+
+    def _fresco(self, payload, buscado_em, ttl, agora):
+        if not payload:
+            ttl = min(ttl, TTL_VAZIO)
+        return agora - buscado_em <= ttl
+
+    def _guardar_memoria(self, chave, payload, buscado_em):
+        with self._lock:
+            if len(self._memoria) >= self.max_memoria and chave not in self._memoria:
+                # descarta a entrada mais antiga (dict mantém ordem de inserção)
+                self._memoria.pop(next(iter(self._memoria)), None)
+            self._memoria[chave] = (payload, buscado_em)
+
+    def obter(self, fonte: str, simbolo: str, buscar: Callable, grupo: str = "preco"):
+        """
+        Devolve o payload de (fonte, símbolo) com idade dentro do TTL de `grupo`,
+        chamando `buscar()` (no máximo uma vez entre chamadas concorrentes) se
+        preciso. O payload devolvido é uma cópia rasa: pode ser alterado.
+        """
+        ttl = self.ttl_grupos.get(grupo, self.ttl_grupos["preco"])
+        chave = (fonte, simbolo)
+        agora = time.time()
+        entrada = self._memoria.get(chave)
+        if entrada is not None and self._fresco(entrada[0], entrada[1], ttl, agora):
+            with self._lock:
+                self._conta(fonte, "hits_memoria")
+            return _copia(entrada[0])
+
+        with self._lock:
+            voo = self._voos.get(chave)
+            dono = voo is None
+            if dono:
+                voo = self._voos[chave] = _Voo()
+            else:
+                self._conta(fonte, "esperas")
+        if not dono:
+            voo.evento.wait()
+            if voo.erro is not None:
+                raise voo.erro
+            return _copia(voo.resultado)
+
+        try:
+            voo.resultado = self._obter_dono(fonte, simbolo, buscar, ttl)
+            return _copia(voo.resultado)
+        except Exception as e:
+            voo.erro = e
+            raise
+        finally:
+            with self._lock:
+                self._voos.pop(chave, None)
+            voo.evento.set()
+
+    def _obter_dono(self, fonte, simbolo, buscar, ttl):
+        chave = (fonte, simbolo)
+        try:
+            disco = self._ler_disco(fonte, simbolo)
+        except Exception:
+            disco = None
+        if disco is not None and self._fresco(disco[0], disco[1], ttl, time.time()):
+            self._guardar_memoria(chave, disco[0], disco[1])
+            with self._lock:
+                self._conta(fonte, "hits_disco")
+            return disco[0]
+
+        # outro worker buscando agora? espera a gravação dele (curto) antes de ir à fonte
+        try:
+            tem_lease = self._pegar_lease(fonte, simbolo)
+        except Exception:
+            tem_lease = True
+        if not tem_lease:
+            with self._lock:
+                self._conta(fonte, "esperas")
+            limite = time.time() + self.lease_s
+            while time.time() < limite:
+                time.sleep(0.1)
+                try:
+                    disco = self._ler_disco(fonte, simbolo)
+                except Exception:
+                    disco = None
+                if disco is not None and self._fresco(disco[0], disco[1], ttl, time.time()):
+                    self._guardar_memoria(chave, disco[0], disco[1])
+                    return disco[0]
+
+        with self._lock:
+            self._conta(fonte, "misses")
+        inicio = time.time()
+        try:
+            payload = buscar()
+        except Exception:
+            with self._lock:
+                self._conta(fonte, "erros")
+            self._soltar_lease(fonte, simbolo)
+            if disco is not None and disco[0]:
+                # fonte fora (erro, 429, circuito aberto no limitador): serve a última versão guardada
+                with self._lock:
+                    self._conta(fonte, "vencidos_servidos")
+                return disco[0]
+            raise
+        if payload is None:
+            payload = {}
+        buscado_em = time.time()
+        with self._lock:
+            self._conta(fonte, "busca_ms_total", (buscado_em - inicio) * 1000.0)
+        self._guardar_memoria(chave, payload, buscado_em)
+        try:
+            self._gravar_disco(fonte, simbolo, payload, buscado_em)
+        except Exception as e:
+            print(f"[cotacoes] aviso: não foi possível gravar {fonte}:{simbolo}: {e}")
+            self._soltar_lease(fonte, simbolo)
+        return payload
+
+    def invalidar(self, fonte: str, simbolo: str):
+        with self._lock:
+            self._memoria.pop((fonte, simbolo), None)
+        conn = self._conn()
+        try:
+            conn.execute("DELETE FROM cotacoes WHERE fonte = ? AND simbolo = ?", (fonte, simbolo))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def metricas(self) -> dict:
+        with self._lock:
+            out = {}
+            for fonte, m in self._metricas.items():
+                m = dict(m)
+                total = m["hits_memoria"] + m["hits_disco"] + m["misses"]
+                m["hit_rate"] = round((m["hits_memoria"] + m["hits_disco"]) / total, 4) if total else None
+                busca_ms_total = m.pop("busca_ms_total")
+                m["busca_ms_media"] = round(busca_ms_total / m["misses"], 1) if m["misses"] else None
+                out[fonte] = m
+            out["_memoria"] = {"entradas": len(self._memoria), "voos_em_andamento": len(self._voos)}
+        return out
+
+    def depois_do_fork_filho(self):
+        self._lock = threading.Lock()
+        self._voos = {}
+        self._metricas = {}
+
+
+def _copia(payload):
+    if isinstance(payload, dict):
+        return dict(payload)
+    if isinstance(payload, list):
+        return list(payload)
+    return payload
@@ -10,6 +10,11 @@ from typing import List, Dict, Set
 import time
 import os
 from datetime import datetime
+
+try:
+    from .limitador_upstream import chamar, upstream_da_url
+except ImportError:
+    from limitador_upstream import chamar, upstream_da_url
 try:
     import openpyxl
     from openpyxl import Workbook
@@ -175,7 +180,7 @@ def extrair_acoes_dadosdemercado() -> Dict[str, any]:
         max_tentativas = 3
         for tentativa in range(max_tentativas):
             try:
-                response = session.get(url_pagina1, timeout=30)
+                response = chamar(upstream_da_url(url_pagina1), lambda: session.get(url_pagina1, timeout=30))
                 response.raise_for_status()
                 break
             except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
@@ -228,7 +233,7 @@ def extrair_acoes_dadosdemercado() -> Dict[str, any]:
                     max_tentativas = 2
                     for tentativa in range(max_tentativas):
                         try:
-                            response = session.get(url_tentativa, timeout=30)
+                            response = chamar(upstream_da_url(url_tentativa), lambda: session.get(url_tentativa, timeout=30))
                             if response.status_code == 200:
                                 url_pagina = url_tentativa
                                 break
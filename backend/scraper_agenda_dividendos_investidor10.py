@@ -8,6 +8,11 @@ import re
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
+try:
+    from .limitador_upstream import chamar, upstream_da_url
+except ImportError:
+    from limitador_upstream import chamar, upstream_da_url
+
 def extrair_dividendos_tabela(tabela, tipo_ativo: str) -> List[Dict[str, Any]]:
     """Extrai dados de dividendos de uma tabela HTML do investidor10"""
     dividendos = []
@@ -179,7 +184,7 @@ def buscar_agenda_dividendos(mes: Optional[int] = None, ano: Optional[int] = Non
                 continue
             
             try:
-                response = requests.get(url, headers=headers, timeout=30)
+                response = chamar(upstream_da_url(url), lambda: requests.get(url, headers=headers, timeout=30))
                 response.raise_for_status()
                 
                 # Parsear HTML
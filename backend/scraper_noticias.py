@@ -11,6 +11,11 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from typing import List, Dict, Optional
 
+try:
+    from .limitador_upstream import chamar, upstream_da_url
+except ImportError:
+    from limitador_upstream import chamar, upstream_da_url
+
 # Limite de notícias para buscar resumo (evita muitas requisições)
 MAX_RESUMOS_PARALELOS = 20
 TIMEOUT_RESUMO_SEGUNDOS = 5
@@ -31,7 +36,7 @@ def extrair_resumo_da_url(url: str, timeout: int = TIMEOUT_RESUMO_SEGUNDOS) -> s
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
             "Accept-Language": "pt-BR,pt;q=0.9,en;q=0.8",
         }
-        resp = requests.get(url, headers=headers, timeout=timeout)
+        resp = chamar(upstream_da_url(url), lambda: requests.get(url, headers=headers, timeout=timeout))
         resp.raise_for_status()
         # Só parsear o início da resposta (meta costuma estar no head)
         soup = BeautifulSoup(resp.content[:150000], "html.parser")
@@ -67,7 +72,7 @@ def obter_noticias(limite: int = 20) -> List[Dict]:
         }
         
 
-        response = requests.get(url, headers=headers, timeout=10)
+        response = chamar(upstream_da_url(url), lambda: requests.get(url, headers=headers, timeout=10))
         response.raise_for_status()
         
   
@@ -287,7 +292,7 @@ def obter_detalhes_noticia(url: str) -> Optional[Dict]:
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = chamar(upstream_da_url(url), lambda: requests.get(url, headers=headers, timeout=10))
         response.raise_for_status()
         
         soup = BeautifulSoup(response.content, 'html.parser')
@@ -9,6 +9,11 @@ import re
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
+try:
+    from .limitador_upstream import chamar, upstream_da_url
+except ImportError:
+    from limitador_upstream import chamar, upstream_da_url
+
 def extrair_ranking_tabela(tabela, tipo_ativo: str) -> List[Dict[str, Any]]:
     """Extrai dados de ranking de uma tabela HTML"""
     ranking = []
@@ -208,7 +213,7 @@ def buscar_ranking_dividendos(tipo: str = 'acoes', mes: Optional[int] = None, an
     }
     
     try:
-        response = requests.get(url, headers=headers, timeout=15)
+        response = chamar(upstream_da_url(url), lambda: requests.get(url, headers=headers, timeout=15))
         response.raise_for_status()
         
         soup = BeautifulSoup(response.text, 'html.parser')
@@ -9,6 +9,11 @@ from typing import Dict, List, Any, Optional
 import time
 import re
 
+try:
+    from .limitador_upstream import chamar, upstream_da_url
+except ImportError:
+    from limitador_upstream import chamar, upstream_da_url
+
 def buscar_rankings_investidor10(tipo: str) -> Dict[str, Any]:
 
     urls = {
@@ -33,7 +38,7 @@ def buscar_rankings_investidor10(tipo: str) -> Dict[str, Any]:
             'Upgrade-Insecure-Requests': '1'
         }
         
-        response = requests.get(url, headers=headers, timeout=30)
+        response = chamar(upstream_da_url(url), lambda: requests.get(url, headers=headers, timeout=30))
         
         if response.status_code != 200:
             return {
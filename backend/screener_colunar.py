@@ -0,0 +1,151 @@
+"""Tabela colunar (NumPy) para os filtros e a ordenação do screener."""
+from __future__ import annotations
+
+from typing import Callable, Iterable, Optional, Sequence
+
+import numpy as np
+
+COLUNAS_NUMERICAS = (
+    "roe",
+    "dividend_yield",
+    "pl",
+    "pvp",
+    "liquidez_diaria",
+    "preco_atual",
+    "volume_medio",
+)
+COLUNAS_TEXTO = ("ticker", "setor", "tipo")
+
+
+def _texto(v):
+    return str(v).strip() if v is not None else ""
+
+
+def _op_in(col, valor):
+    if isinstance(valor, str):
+        valor = [valor]
+    if col.dtype == object:
+        return np.isin(col, [_texto(v) for v in valor])
+    return np.isin(col, [float(v) for v in valor])
+
+
+def _op_entre(col, valor):
+    lo, hi = valor
+    mask = np.ones(len(col), dtype=bool)
+    if lo is not None:
+        mask &= col >= lo
+    if hi is not None:
+        mask &= col <= hi
+    return mask
+
+
+OPERADORES: dict = {
+    ">=": lambda col, v: col >= v,
+    ">": lambda col, v: col > v,
+    "<=": lambda col, v: col <= v,
+    "<": lambda col, v: col < v,
+    "==": lambda col, v: col == (_texto(v) if col.dtype == object else v),
+    "!=": lambda col, v: col != (_texto(v) if col.dtype == object else v),
+    "in": _op_in,
+    "entre": _op_entre,
+}
+
+
+def registrar_operador(nome: str, funcao: Callable[[np.ndarray, object], np.ndarray]):
+    """Registra um operador de filtro: `funcao(coluna, valor) -> máscara booleana`."""
+    OPERADORES[nome] = funcao
+
+
+class TabelaColunar:
+    def __init__(self, registros: Sequence[dict], colunas: dict):
+        self.registros = list(registros)
+        self.colunas = colunas
+
+    @classmethod
+    def de_registros(
+        cls,
+        registros: Iterable[dict],
+        numericas: Sequence[str] = COLUNAS_NUMERICAS,
+        texto: Sequence[str] = COLUNAS_TEXTO,
+    ) -> "TabelaColunar":
+        registros = list(registros)
+        colunas = {}
+        for nome in numericas:
+            col = np.empty(len(registros), dtype=np.float64)
+            for i, r in enumerate(registros):
+                v = r.get(nome)
+                try:
+                    col[i] = float(v) if v is not None else np.nan
+                except (TypeError, ValueError):
+                    col[i] = np.nan
+            colunas[nome] = col
+        for nome in texto:
+            colunas[nome] = np.array([_texto(r.get(nome)) for r in registros], dtype=object)
+        return cls(registros, colunas)
+
+    def __len__(self):
+        return len(self.registros)
+
+    def mascara(self, spec: Iterable[tuple]) -> np.ndarray:
+        mask = np.ones(len(self.registros), dtype=bool)
+        with np.errstate(invalid="ignore"):
+            for coluna, operador, valor in spec:
+                if valor is None:
+                    continue
+                if isinstance(valor, str) and not valor.strip():
+                    continue
+                try:
+                    col = self.colunas[coluna]
+                except KeyError:
+                    raise KeyError(f"Coluna desconhecida no filtro: {coluna}") from None
+                try:
+                    op = OPERADORES[operador]
+                except KeyError:
+                    raise ValueError(f"Operador de filtro desconhecido: {operador}") from None
+                mask &= np.asarray(op(col, valor), dtype=bool)
+        return mask
+
+    def ordem(self, indices: np.ndarray, ordenar_por: str, desc: bool = True, limite: Optional[int] = None) -> np.ndarray:
+        """`indices` ordenados pela coluna (estável, NaN por último); com `limite`, só os k primeiros."""
+        col = self.colunas[ordenar_por]
+        if col.dtype == object:
+            chave = col[indices]
+            ordem = np.argsort(chave, kind="stable")
+            if desc:
+                ordem = ordem[::-1]
+            ordem = indices[ordem]
+            return ordem[:limite] if limite is not None else ordem
+        valores = col[indices]
+        nan = np.isnan(valores)
+        # chave crescente: desc vira -x; NaN vai para +inf (fim)
+        chave = np.where(nan, np.inf, -valores if desc else valores)
+        if limite is not None and limite < len(indices):
+            if limite <= 0:
+                return indices[:0]
+            corte = np.argpartition(chave, limite - 1)[:limite]
+            # empates no limiar: argpartition escolhe arbitrariamente; mantém a ordem original
+            limiar = chave[corte].max()
+            candidatos = np.flatnonzero(chave <= limiar)
+            candidatos = candidatos[np.argsort(chave[candidatos], kind="stable")][:limite]
+            return indices[candidatos]
+        return indices[np.argsort(chave, kind="stable")]
+
+    def selecionar(
+        self,
+        spec: Iterable[tuple] = (),
+        ordenar_por: Optional[str] = None,
+        desc: bool = True,
+        limite: Optional[int] = None,
+    ) -> np.ndarray:
+        """Índices das linhas que passam em `spec`, ordenados por `ordenar_por`."""
+        indices = np.flatnonzero(self.mascara(spec))
+        if ordenar_por is not None:
+            return self.ordem(indices, ordenar_por, desc, limite)
+        return indices[:limite] if limite is not None else indices
+
+    def linhas(self, indices: Iterable[int]) -> list:
+        """Cópias rasas dos registros (podem ser alteradas por quem chama)."""
+        return [dict(self.registros[i]) for i in indices]
+
+    def filtrar(self, spec=(), ordenar_por=None, desc=True, limite=None) -> list:
+        return self.linhas(self.selecionar(spec, ordenar_por, desc, limite))
@@ -0,0 +1,267 @@
+"""Séries do BCB SGS persistidas por série num SQLite compartilhado, com junção de intervalos."""
+from __future__ import annotations
+
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Optional
+
+JANELA_MAX_DIAS = 3650
+
+
+def _como_data(valor) -> date:
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    s = str(valor).strip()[:10]
+    if "/" in s:
+        return datetime.strptime(s, "%d/%m/%Y").date()
+    return datetime.strptime(s, "%Y-%m-%d").date()
+
+
+def _subtrair(inicio: date, fim: date, cobertos) -> list:
+    """Trechos de [inicio, fim] (inclusive) fora dos intervalos `cobertos` (ordenados)."""
+    faltando = []
+    cursor = inicio
+    for ini, fi in cobertos:
+        if fi < cursor:
+            continue
+        if ini > fim:
+            break
+        if ini > cursor:
+            faltando.append((cursor, ini - timedelta(days=1)))
+        cursor = max(cursor, fi + timedelta(days=1))
+        if cursor > fim:
+            break
+    if cursor <= fim:
+        faltando.append((cursor, fim))
+    return faltando
+
+
+def _fundir(intervalos) -> list:
+    """Junta intervalos que se sobrepõem ou encostam (dias consecutivos)."""
+    fundidos = []
+    for ini, fi in sorted(intervalos):
+        if fundidos and ini <= fundidos[-1][1] + timedelta(days=1):
+            if fi > fundidos[-1][1]:
+                fundidos[-1] = (fundidos[-1][0], fi)
+        else:
+            fundidos.append((ini, fi))
+    return fundidos
+
+
+class SeriesBcb:
+    def __init__(self, db_path: str, conectar: Callable, baixar: Callable, ttl_cauda_s: float = 6 * 3600.0):
+        """
+        `baixar(serie, inicio, fim)` devolve [(date, valor_texto), ...] do SGS
+        em [inicio, fim] (lista vazia se não houver dados) e levanta exceção
+        em erro de rede/HTTP.
+        """
+        self.db_path = db_path
+        self._conectar = conectar
+        self._baixar = baixar
+        self.ttl_cauda_s = float(ttl_cauda_s)
+        self._lock = threading.Lock()
+        self._locks_serie = {}
+        self._tabelas_ok = False
+        self._m = {"consultas": 0, "locais": 0, "downloads": 0, "pontos_baixados": 0, "erros": 0}
+
+    # ------------------------------------------------------------------ SQLite
+
+    def _conn(self):
+        conn = self._conectar(self.db_path)
+        if not self._tabelas_ok:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bcb_pontos (
+                    serie INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    valor TEXT NOT NULL,
+                    PRIMARY KEY (serie, data)
+                ) WITHOUT ROWID
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bcb_cobertura (
+                    serie INTEGER NOT NULL,
+                    inicio TEXT NOT NULL,
+                    fim TEXT NOT NULL,
+                    PRIMARY KEY (serie, inicio)
+                ) WITHOUT ROWID
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bcb_series (
+                    serie INTEGER PRIMARY KEY,
+                    cauda_verificada_em REAL NOT NULL
+                )
+                """
+            )
+            conn.commit()
+            self._tabelas_ok = True
+        return conn
+
+    def _estado(self, serie):
+        """(intervalos cobertos, data do último ponto, cauda_verificada_em)."""
+        conn = self._conn()
+        try:
+            intervalos = [
+                (_como_data(r[0]), _como_data(r[1]))
+                for r in conn.execute(
+                    "SELECT inicio, fim FROM bcb_cobertura WHERE serie = ? ORDER BY inicio", (serie,)
+                ).fetchall()
+            ]
+            ultimo = conn.execute("SELECT MAX(data) FROM bcb_pontos WHERE serie = ?", (serie,)).fetchone()[0]
+            row = conn.execute("SELECT cauda_verificada_em FROM bcb_series WHERE serie = ?", (serie,)).fetchone()
+        finally:
+            conn.close()
+        return intervalos, (_como_data(ultimo) if ultimo else None), (float(row[0]) if row else 0.0)
+
+    def _gravar(self, serie, pontos, intervalos, cauda_verificada_em=None):
+        conn = self._conn()
+        try:
+            cur = conn.cursor()
+            if pontos:
+                cur.executemany(
+                    "INSERT OR REPLACE INTO bcb_pontos (serie, data, valor) VALUES (?, ?, ?)",
+                    [(serie, d.isoformat(), v) for d, v in pontos],
+                )
+            cur.execute("DELETE FROM bcb_cobertura WHERE serie = ?", (serie,))
+            cur.executemany(
+                "INSERT INTO bcb_cobertura (serie, inicio, fim) VALUES (?, ?, ?)",
+                [(serie, ini.isoformat(), fi.isoformat()) for ini, fi in intervalos],
+            )
+            if cauda_verificada_em is not None:
+                cur.execute(
+                    "INSERT OR REPLACE INTO bcb_series (serie, cauda_verificada_em) VALUES (?, ?)",
+                    (serie, cauda_verificada_em),
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _ler(self, serie, inicio: date, fim: date) -> list:
+        conn = self._conn()
+        try:
+            return conn.execute(
+                "SELECT data, valor FROM bcb_pontos WHERE serie = ? AND data >= ? AND data <= ? ORDER BY data",
+                (serie, inicio.isoformat(), fim.isoformat()),
+            ).fetchall()
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------ download
+
+    def _lock_serie(self, serie):
+        with self._lock:
+            lock = self._locks_serie.get(serie)
+            if lock is None:
+                lock = self._locks_serie[serie] = threading.Lock()
+            return lock
+
+    def _atualizar(self, serie, inicio: date, fim: date) -> bool:
+        """Baixa os dias de [inicio, fim] ainda não cobertos. True se foi ao BCB."""
+        agora = time.time()
+        hoje = date.today()
+        fim = min(fim, hoje)
+        if inicio > fim:
+            return False
+        intervalos, ultimo, verificada_em = self._estado(serie)
+        cobertos = intervalos
+        if agora - verificada_em >= self.ttl_cauda_s:
+            # a cauda (dias depois do último ponto) pode ter ganho pontos desde a última consulta
+            recente = hoje - timedelta(days=45)
+            corte = (ultimo or recente) - timedelta(days=1)
+            cobertos = [(ini, min(fi, corte) if fi >= recente else fi) for ini, fi in intervalos]
+            cobertos = [(ini, fi) for ini, fi in cobertos if ini <= fi]
+        faltando = _subtrair(inicio, fim, cobertos)
+        if not faltando:
+            return False
+
+        pontos = []
+        baixados = []
+        for ini, fi in faltando:
+            cursor = ini
+            while cursor <= fi:
+                fim_janela = min(fi, cursor + timedelta(days=JANELA_MAX_DIAS - 1))
+                with self._lock:
+                    self._m["downloads"] += 1
+                pontos.extend((_como_data(d), str(v)) for d, v in (self._baixar(serie, cursor, fim_janela) or []))
+                baixados.append((cursor, fim_janela))
+                cursor = fim_janela + timedelta(days=1)
+        cauda = any(fi >= hoje - timedelta(days=1) for _, fi in baixados)
+        self._gravar(serie, pontos, _fundir(intervalos + baixados), agora if cauda else None)
+        with self._lock:
+            self._m["pontos_baixados"] += len(pontos)
+        return True
+
+    def _garantir(self, serie, inicio: date, fim: date):
+        with self._lock:
+            self._m["consultas"] += 1
+        baixou = False
+        try:
+            with self._lock_serie(serie):
+                baixou = self._atualizar(serie, inicio, fim)
+        except Exception as e:
+            with self._lock:
+                self._m["erros"] += 1
+            print(f"[BCB] aviso: atualização da série {serie} falhou: {e}")
+        if not baixou:
+            with self._lock:
+                self._m["locais"] += 1
+
+    # ------------------------------------------------------------------ API
+
+    def serie(self, serie: int, inicio, fim) -> list:
+        """Pontos de [inicio, fim] como o SGS devolve: [{'data': 'dd/mm/aaaa', 'valor': float}, ...]."""
+        serie = int(serie)
+        inicio, fim = _como_data(inicio), _como_data(fim)
+        self._garantir(serie, inicio, fim)
+        out = []
+        for d, v in self._ler(serie, inicio, fim):
+            try:
+                valor = float(str(v).replace(",", "."))
+            except ValueError:
+                continue
+            out.append({"data": _como_data(d).strftime("%d/%m/%Y"), "valor": valor})
+        return out
+
+    def ultimo(self, serie: int, janela_dias: int = 120) -> Optional[dict]:
+        """Último ponto publicado (como `/dados/ultimos/1`): {'data': 'dd/mm/aaaa', 'valor': texto} ou None."""
+        serie = int(serie)
+        hoje = date.today()
+        self._garantir(serie, hoje - timedelta(days=janela_dias), hoje)
+        conn = self._conn()
+        try:
+            row = conn.execute(
+                "SELECT data, valor FROM bcb_pontos WHERE serie = ? AND data <= ? ORDER BY data DESC LIMIT 1",
+                (serie, hoje.isoformat()),
+            ).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        return {"data": _como_data(row[0]).strftime("%d/%m/%Y"), "valor": row[1]}
+
+    def invalidar(self, serie: int):
+        conn = self._conn()
+        try:
+            conn.execute("DELETE FROM bcb_pontos WHERE serie = ?", (int(serie),))
+            conn.execute("DELETE FROM bcb_cobertura WHERE serie = ?", (int(serie),))
+            conn.execute("DELETE FROM bcb_series WHERE serie = ?", (int(serie),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return dict(self._m)
+
+    def depois_do_fork_filho(self):
+        self._lock = threading.Lock()
+        self._locks_serie = {}
+        self._m = {k: 0 for k in self._m}
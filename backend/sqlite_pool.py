@@ -0,0 +1,223 @@
+"""Cache de conexões SQLite abertas, por (arquivo .db, thread)."""
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+
+class ConexaoSqliteCacheada(sqlite3.Connection):
+    """
+    `sqlite3.Connection` cujo `close()` devolve a conexão ao cache.
+
+    É uma subclasse (e não um proxy) para que `isinstance(conn,
+    sqlite3.Connection)` continue valendo — o `pd.read_sql_query` depende disso.
+    """
+
+    def close(self):
+        pool = getattr(self, "_pool", None)
+        if pool is None:
+            sqlite3.Connection.close(self)
+            return
+        if not self._emprestada:
+            return
+        self._emprestada = False
+        pool._devolver(self)
+
+    def fechar_de_verdade(self):
+        self._pool = None
+        try:
+            sqlite3.Connection.close(self)
+        except Exception:
+            pass
+
+
+class SqlitePool:
+    def __init__(
+        self,
+        pragmas: Iterable[str] = (),
+        max_ociosas: int = 64,
+        max_ocioso_s: float = 300.0,
+        timeout: float = 30.0,
+        conferir: Optional[Callable[[], None]] = None,
+    ):
+        self._pragmas = tuple(pragmas)
+        # chamado a cada retirada, fora do lock (pode chamar fechar_sob)
+        self._conferir = conferir
+        self.max_ociosas = max(1, int(max_ociosas))
+        self.max_ocioso_s = float(max_ocioso_s)
+        self.timeout = float(timeout)
+        self._lock = threading.Lock()
+        # chave -> [entradas ociosas]; ordem do OrderedDict = LRU por chave
+        self._ociosas: "OrderedDict[tuple, list]" = OrderedDict()
+        self._n_ociosas = 0
+        self._em_uso = weakref.WeakSet()
+        self._pid = os.getpid()
+        self._ultima_varredura = time.monotonic()
+        self._zerar_metricas()
+
+    def _zerar_metricas(self):
+        self._m = {"checkouts": 0, "reusos": 0, "aberturas": 0, "evictions_lru": 0, "evictions_ociosas": 0}
+
+    def metricas(self) -> dict:
+        with self._lock:
+            m = dict(self._m)
+            m.update({
+                "ociosas": self._n_ociosas,
+                "em_uso": len(self._em_uso),
+                "max_ociosas": self.max_ociosas,
+                "chaves": len(self._ociosas),
+            })
+        return m
+
+    # ------------------------------------------------------------------ abertura
+
+    def _abrir(self, db_path: str, chave) -> ConexaoSqliteCacheada:
+        conn = sqlite3.connect(
+            db_path, check_same_thread=False, timeout=self.timeout, factory=ConexaoSqliteCacheada
+        )
+        try:
+            cur = conn.cursor()
+            for pragma in self._pragmas:
+                cur.execute(pragma)
+            cur.close()
+        except Exception:
+            pass
+        conn._pool = self
+        conn._chave = chave
+        conn._descartar = False
+        conn._emprestada = False
+        conn._usada_em = time.monotonic()
+        return conn
+
+    def conectar(self, db_path: str) -> ConexaoSqliteCacheada:
+        if self._conferir is not None:
+            try:
+                self._conferir()
+            except Exception:
+                pass
+        chave = (db_path, threading.get_ident())
+        conn = None
+        fechar = []
+        with self._lock:
+            self._checar_pid()
+            fechar.extend(self._varrer_ociosas())
+            lista = self._ociosas.get(chave)
+            if lista:
+                conn = lista.pop()
+                self._n_ociosas -= 1
+                if not lista:
+                    del self._ociosas[chave]
+                self._m["reusos"] += 1
+            self._m["checkouts"] += 1
+        for c in fechar:
+            c.fechar_de_verdade()
+        if conn is None:
+            conn = self._abrir(db_path, chave)
+            with self._lock:
+                self._m["aberturas"] += 1
+        conn._emprestada = True
+        with self._lock:
+            # WeakSet: uma conexão esquecida sem close() é coletada e fechada pelo sqlite3
+            self._em_uso.add(conn)
+        return conn
+
+    # ------------------------------------------------------------------ devolução / eviction
+
+    def _devolver(self, conn: ConexaoSqliteCacheada):
+        reutilizavel = not conn._descartar
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            reutilizavel = False
+        fechar = []
+        with self._lock:
+            self._em_uso.discard(conn)
+            if os.getpid() != self._pid:
+                return  # conexão de outro processo: nunca reutilizar
+            if reutilizavel:
+                conn._usada_em = time.monotonic()
+                self._ociosas.setdefault(conn._chave, []).append(conn)
+                self._ociosas.move_to_end(conn._chave)
+                self._n_ociosas += 1
+                while self._n_ociosas > self.max_ociosas:
+                    chave_lru, lista = next(iter(self._ociosas.items()))
+                    fechar.append(lista.pop(0))
+                    self._n_ociosas -= 1
+                    self._m["evictions_lru"] += 1
+                    if not lista:
+                        del self._ociosas[chave_lru]
+            else:
+                fechar.append(conn)
+        for c in fechar:
+            c.fechar_de_verdade()
+
+    def _varrer_ociosas(self) -> list:
+        """Com o lock: remove ociosas expiradas (no máximo a cada 30s)."""
+        agora = time.monotonic()
+        if agora - self._ultima_varredura < 30.0:
+            return []
+        self._ultima_varredura = agora
+        fechar = []
+        for chave in list(self._ociosas.keys()):
+            lista = self._ociosas[chave]
+            vivas = [c for c in lista if agora - c._usada_em <= self.max_ocioso_s]
+            fechar.extend(c for c in lista if agora - c._usada_em > self.max_ocioso_s)
+            self._n_ociosas -= len(lista) - len(vivas)
+            self._m["evictions_ociosas"] += len(lista) - len(vivas)
+            if vivas:
+                self._ociosas[chave] = vivas
+            else:
+                del self._ociosas[chave]
+        return fechar
+
+    def fechar_sob(self, diretorio: Optional[str] = None):
+        """Fecha as conexões cujo arquivo está sob `diretorio` (todas se None)."""
+        base = os.path.normcase(os.path.abspath(diretorio)) if diretorio else None
+
+        def _casa(db_path):
+            if base is None:
+                return True
+            p = os.path.normcase(os.path.abspath(db_path))
+            return p == base or p.startswith(base + os.sep)
+
+        fechar = []
+        with self._lock:
+            for chave in list(self._ociosas.keys()):
+                if _casa(chave[0]):
+                    lista = self._ociosas.pop(chave)
+                    self._n_ociosas -= len(lista)
+                    fechar.extend(lista)
+            for conn in list(self._em_uso):
+                if _casa(conn._chave[0]):
+                    conn._descartar = True
+        for c in fechar:
+            c.fechar_de_verdade()
+        return len(fechar)
+
+    # ------------------------------------------------------------------ fork
+
+    def _checar_pid(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._ociosas = OrderedDict()
+            self._n_ociosas = 0
+            self._em_uso = weakref.WeakSet()
+            self._pid = pid
+            self._zerar_metricas()
+
+    def antes_do_fork(self):
+        self.fechar_sob(None)
+
+    def depois_do_fork_filho(self):
+        self._lock = threading.Lock()
+        self._ociosas = OrderedDict()
+        self._n_ociosas = 0
+        self._em_uso = weakref.WeakSet()
+        self._pid = os.getpid()
+        self._zerar_metricas()
@@ -6,12 +6,20 @@ Se estiver correto, integramos no sistema no lugar do yfinance para criptos.
 
 Executar: python test_ccxt_cripto.py
 Requer: apenas Python 3 (urllib na stdlib).
+Sem rede: FINMAS_UPSTREAM_MODO=reproduzir python test_ccxt_cripto.py (serve a
+resposta gravada antes com FINMAS_UPSTREAM_MODO=gravar; ver gravacao_upstream.py).
 """
 
 import json
 import urllib.request
 from datetime import datetime
 
+try:
+    import gravacao_upstream
+    gravacao_upstream.ativar_do_ambiente()
+except ImportError:
+    pass
+
 # 12 principais criptos (símbolo Binance = base + USDT)
 CRIPTO_SYMBOLS = [
     "BTC",   # Bitcoin
@@ -0,0 +1,64 @@
+"""
+Testes das tabelas de fator acumulado (fatores_indexadores.py).
+
+Executar: python -m pytest -q test_fatores_indexadores.py
+Sem rede: a série vem de uma função local no lugar de `obter_serie_bcb`.
+"""
+
+from datetime import date
+
+import pytest
+
+from fatores_indexadores import FatoresIndexadores, TabelaFatores
+
+# IPCA mensal (% ao mês), no formato de obter_serie_bcb
+IPCA_PONTOS = [
+    {"data": "01/03/2024", "valor": 0.3},  # fora de ordem de propósito
+    {"data": "01/01/2024", "valor": 0.5},
+    {"data": "01/02/2024", "valor": 0.4},
+]
+
+
+def test_fator_e_o_produto_dos_periodos():
+    tab = TabelaFatores.de_pontos(IPCA_PONTOS)
+    fator, meses = tab.fator(date(2024, 1, 1), date(2024, 3, 15))
+    assert meses == 3
+    assert fator == pytest.approx(1.005 * 1.004 * 1.003)
+
+
+def test_fim_exclusivo_e_inicio_no_meio():
+    tab = TabelaFatores.de_pontos(IPCA_PONTOS)
+    assert tab.fator(date(2024, 1, 2), date(2024, 3, 1)) == (pytest.approx(1.004), 1)
+    assert tab.fator(date(2024, 1, 2), date(2024, 1, 20)) == (1.0, 0)
+
+
+def test_percentual_do_indexador():
+    tab = TabelaFatores.de_pontos(IPCA_PONTOS, pct=120.0)
+    fator, _ = tab.fator(date(2024, 1, 1), date(2024, 4, 1))
+    assert fator == pytest.approx(1.006 * 1.0048 * 1.0036)
+    assert tab.com_pct(100.0).fator(date(2024, 2, 1), date(2024, 4, 1))[0] == pytest.approx(1.004 * 1.003)
+
+
+def test_spread_ipca_mais_composto_por_periodo():
+    # IPCA+ com 0,5% ao mês: (1 + spread) entra uma vez por mês da série
+    tab = TabelaFatores.de_pontos(IPCA_PONTOS)
+    fator, meses = tab.fator(date(2024, 1, 1), date(2024, 4, 1), spread_periodo_pct=0.5)
+    assert meses == 3
+    assert fator == pytest.approx(1.005 * 1.004 * 1.003 * 1.005 ** 3)
+    assert fator == pytest.approx(1.0273037959, rel=1e-9)
+
+
+def test_fatores_indexadores_cobertura_e_cache():
+    chamadas = []
+
+    def obter_serie(serie_id, inicio, fim):
+        chamadas.append(serie_id)
+        return IPCA_PONTOS
+
+    fatores = FatoresIndexadores(obter_serie, ttl_s=3600)
+    assert fatores.fator("IPCA", date(2023, 6, 1), date(2024, 4, 1)) is None
+    fator, meses = fatores.fator("IPCA", date(2024, 1, 1), date(2024, 4, 1), pct=120.0, spread_periodo_pct=0.5)
+    assert meses == 3
+    assert fator == pytest.approx(1.006 * 1.0048 * 1.0036 * 1.005 ** 3)
+    assert fatores.tabela("IPCA", 120.0) is fatores.tabela("IPCA", 120.0)
+    assert chamadas == [433]
@@ -0,0 +1,82 @@
+"""
+Testes do motor Monte Carlo (monte_carlo.py).
+
+Executar: python -m pytest -q test_monte_carlo.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from monte_carlo import estimar_parametros, fator_covariancia, parametros_padrao, resumir, simular_caminhos
+
+
+def _retornos(n_meses, seed=7):
+    rng = np.random.default_rng(seed)
+    a = rng.normal(0.01, 0.05, n_meses)
+    b = 0.5 * a + rng.normal(0.005, 0.02, n_meses)
+    return pd.DataFrame({"Ações": a, "FIIs": b}, index=pd.date_range("2020-01-31", periods=n_meses, freq="ME"))
+
+
+def test_estimar_parametros_com_historico():
+    retornos = _retornos(36)
+    mu, cov, meses = estimar_parametros(retornos)
+    assert list(meses) == [36, 36]
+    assert mu == pytest.approx(retornos.mean().to_numpy())
+    assert cov == pytest.approx(retornos.cov().to_numpy())
+
+
+def test_classe_curta_usa_padrao_sem_correlacao():
+    retornos = _retornos(36)
+    retornos.loc[retornos.index[:30], "FIIs"] = np.nan  # só 6 meses
+    mu, cov, meses = estimar_parametros(retornos, min_meses=12)
+    mu_padrao, sigma_padrao = parametros_padrao()
+    assert list(meses) == [36, 6]
+    assert mu[1] == pytest.approx(mu_padrao)
+    assert cov[1, 1] == pytest.approx(sigma_padrao ** 2)
+    assert cov[0, 1] == 0.0 and cov[1, 0] == 0.0
+    assert cov[0, 0] == pytest.approx(retornos["Ações"].var())
+
+
+def test_covariancia_por_pares_no_trecho_comum():
+    retornos = _retornos(48)
+    retornos.loc[retornos.index[:12], "FIIs"] = np.nan
+    _, cov, _ = estimar_parametros(retornos)
+    comum = retornos.iloc[12:]
+    assert cov[0, 1] == pytest.approx(np.cov(comum["Ações"], comum["FIIs"])[0, 1])
+
+
+def test_fator_covariancia_reconstroi_matriz_psd():
+    cov = np.array([[0.04, 0.01], [0.01, 0.09]])
+    fator = fator_covariancia(cov)
+    assert fator @ fator.T == pytest.approx(cov)
+
+
+def test_fator_covariancia_projeta_autovalores_negativos():
+    # correlação 1,2 não é semidefinida: o autovalor negativo vira zero
+    cov = np.array([[1.0, 1.2], [1.2, 1.0]])
+    fator = fator_covariancia(cov)
+    w, v = np.linalg.eigh(cov)
+    assert fator @ fator.T == pytest.approx((v * np.clip(w, 0, None)) @ v.T)
+    assert np.linalg.eigvalsh(fator @ fator.T).min() >= -1e-12
+
+
+def test_resumir_percentis_e_probabilidade_de_perda():
+    finais = np.arange(1.0, 101.0)  # 1..100
+    res = resumir(finais, investido=25.5, confianca=90, amostra=10)
+    assert res["percentis"]["p5"] == pytest.approx(np.percentile(finais, 5))
+    assert res["percentis"]["p50"] == pytest.approx(50.5)
+    assert res["percentil_confianca"] == pytest.approx(np.percentile(finais, 10))
+    assert res["probabilidade_perda"] == pytest.approx(25.0)
+    assert res["valor_esperado"] == pytest.approx(50.5)
+    assert res["volatilidade"] == pytest.approx(finais.std() / 50.5)
+    assert res["cenarios"] == list(finais[:10])
+
+
+def test_simular_sem_volatilidade_e_deterministico():
+    mu = np.log([1.01, 1.0])
+    finais = simular_caminhos([100.0, 100.0], mu, np.zeros((2, 2)), meses=12, n_simulacoes=5,
+                              aporte_mensal=10.0, tamanho_lote=2, rng=np.random.default_rng(0))
+    # aporte de 10 dividido meio a meio: entra no início do mês e rende junto
+    esperado = 100.0 * 1.01 ** 12 + sum(5.0 * 1.01 ** k for k in range(1, 13)) + 100.0 + 5.0 * 12
+    assert finais == pytest.approx(np.full(5, esperado))
@@ -0,0 +1,141 @@
+"""
+Testes do ledger de posições (posicoes_ledger em models.py).
+
+Executar: python -m pytest -q test_posicoes_ledger.py
+Usa um SQLite em memória com as tabelas movimentacoes e posicoes_ledger; o
+incremental (_ledger_aplicar a cada INSERT) tem de bater com a reconstrução.
+"""
+
+import sqlite3
+
+import numpy as np
+import pytest
+
+import models
+
+ESTADO_VAZIO = (0.0, 0.0, 0.0, None)
+
+# (data, ticker, quantidade, preco, tipo) na ordem em que são registradas
+MOVIMENTACOES = [
+    ("2024-01-10", "PETR4", 100, 30.0, "compra"),
+    ("2024-01-10", "VALE3", 10, 70.0, "compra"),
+    ("2024-02-05", "PETR4", 50, 36.0, "compra"),
+    ("2024-02-05", "PETR4", 30, 40.0, "venda"),
+    ("2024-03-01", "VALE3", 10, 65.0, "venda"),
+    ("2024-03-15", "PETR4", 500, 38.0, "atualizado"),
+    ("2024-01-20", "PETR4", 20, 33.0, "compra"),  # retroativa: reconstrói o ticker
+    ("2024-04-02", "VALE3", 5, 60.0, "compra"),
+]
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        """CREATE TABLE movimentacoes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL, ticker TEXT NOT NULL,
+            nome_completo TEXT, quantidade REAL NOT NULL, preco REAL NOT NULL, tipo TEXT NOT NULL
+        )"""
+    )
+    conn.execute(
+        """CREATE TABLE posicoes_ledger (
+            ticker TEXT NOT NULL, data TEXT NOT NULL, quantidade REAL NOT NULL, custo_total REAL NOT NULL,
+            custo_medio REAL NOT NULL, lucro_realizado REAL NOT NULL, primeira_compra TEXT,
+            PRIMARY KEY (ticker, data)
+        ) WITHOUT ROWID"""
+    )
+    yield conn
+    conn.close()
+
+
+def _registrar(conn, movimentacoes):
+    c = conn.cursor()
+    for data, ticker, quantidade, preco, tipo in movimentacoes:
+        c.execute(
+            "INSERT INTO movimentacoes (data, ticker, nome_completo, quantidade, preco, tipo) VALUES (?, ?, ?, ?, ?, ?)",
+            (data, ticker, ticker, quantidade, preco, tipo),
+        )
+        models._ledger_aplicar(c, "?", data, ticker, quantidade, preco, tipo)
+    conn.commit()
+
+
+def _ledger(conn):
+    return conn.execute("SELECT * FROM posicoes_ledger ORDER BY ticker, data").fetchall()
+
+
+def test_passo_compra_venda_e_atualizado():
+    estado = models._ledger_passo(ESTADO_VAZIO, 100, 30.0, "compra", "2024-01-10")
+    estado = models._ledger_passo(estado, 50, 36.0, " Compra ", "2024-02-05")
+    assert estado == (150.0, pytest.approx(4800.0), 0.0, "2024-01-10")
+
+    estado = models._ledger_passo(estado, 30, 40.0, "venda", "2024-02-06")
+    assert estado[0] == 120.0
+    assert estado[1] == pytest.approx(120 * 32.0)  # baixa pelo custo médio
+    assert estado[2] == pytest.approx(30 * (40.0 - 32.0))
+
+    # 'atualizado' não mexe na posição
+    assert models._ledger_passo(estado, 500, 38.0, "atualizado", "2024-03-15") == estado
+
+    zerado = models._ledger_passo(estado, 120, 30.0, "venda", "2024-04-01")
+    assert zerado[:2] == (0.0, 0.0)
+    assert zerado[3] == "2024-01-10"
+
+
+def test_incremental_bate_com_reconstrucao(conn):
+    _registrar(conn, MOVIMENTACOES)
+    incremental = _ledger(conn)
+
+    n = models._ledger_reconstruir(conn.cursor(), "?")
+    conn.commit()
+    reconstruido = _ledger(conn)
+
+    assert n == len(reconstruido)
+    assert len(incremental) == len(reconstruido)
+    for a, b in zip(incremental, reconstruido):
+        assert a[:2] == b[:2]
+        assert a[2:6] == pytest.approx(b[2:6])
+        assert a[6] == b[6]
+
+
+def test_retroativa_reordena_o_ticker(conn):
+    _registrar(conn, MOVIMENTACOES)
+    linhas = {(r[0], r[1]): r for r in _ledger(conn)}
+    # a compra de 20 em 20/01 entra antes das linhas de fevereiro
+    assert linhas[("PETR4", "2024-01-20")][2] == 120.0
+    assert linhas[("PETR4", "2024-02-05")][2] == 140.0
+    medio = (100 * 30.0 + 20 * 33.0 + 50 * 36.0) / 170
+    assert linhas[("PETR4", "2024-02-05")][5] == pytest.approx(30 * (40.0 - medio))
+    assert linhas[("PETR4", "2024-03-15")][2] == 140.0
+
+
+def test_posicao_em_data_le_o_ultimo_dia_ate_a_data(conn, monkeypatch):
+    _registrar(conn, MOVIMENTACOES)
+    monkeypatch.setattr(
+        models,
+        "_consultar_banco_carteira",
+        lambda sql, params=(), usuario=None: conn.execute(sql.format(ph="?"), params).fetchall(),
+    )
+
+    assert models.obter_posicao_em_data("PETR4", "2024-01-09") is None
+    pos = models.obter_posicao_em_data("PETR4", "2024-02-28")
+    assert pos["quantidade"] == 140.0
+    assert pos["custo_medio"] == pytest.approx((100 * 30.0 + 20 * 33.0 + 50 * 36.0) / 170)
+    assert pos["primeira_compra"] == "2024-01-10"
+
+    vale = models.obter_posicao_em_data("VALE3", "2024-03-31")
+    assert vale["quantidade"] == 0.0
+    assert vale["lucro_realizado"] == pytest.approx(10 * (65.0 - 70.0))
+    assert models.obter_posicao_em_data("VALE3", "2024-04-02 10:00:00")["quantidade"] == 5.0
+
+
+def test_curva_comparada_nao_conta_atualizado_como_compra(conn):
+    # Mudança de comportamento: o replay antigo do histórico comparado somava a
+    # quantidade de 'atualizado' (100 + 500); pelo ledger a sobrescrita é neutra.
+    _registrar(conn, [
+        ("2024-01-10", "PETR4", 100, 30.0, "compra"),
+        ("2024-03-15", "PETR4", 500, 38.0, "atualizado"),
+    ])
+    posicoes = conn.execute("SELECT data, ticker, quantidade FROM posicoes_ledger ORDER BY data, ticker").fetchall()
+    pontos = np.array(["2024-01-09", "2024-02-29", "2024-03-31"], dtype="datetime64[ns]")
+    qtd = models._matriz_quantidades(posicoes, {}, ["PETR4"], pontos)
+    assert qtd[:, 0].tolist() == [0.0, 100.0, 100.0]
@@ -63,6 +63,17 @@ else
     echo "[$(date +'%Y-%m-%d %H:%M:%S')] ℹ Backup no startup desabilitado (ENABLE_STARTUP_BACKUP=false)"
 fi
 
+# Migrações de schema dos usuários (uma vez por deploy, fora das requisições).
+# Falha aqui não impede o start: o app aplica o que faltar sob demanda.
+ENABLE_STARTUP_MIGRATIONS="${ENABLE_STARTUP_MIGRATIONS:-true}"
+if [ "$ENABLE_STARTUP_MIGRATIONS" = "true" ]; then
+    echo "[$(date +'%Y-%m-%d %H:%M:%S')] Aplicando migrações de schema dos usuários..."
+    (cd /app/backend && python migrar_schemas.py) || \
+        echo "[$(date +'%Y-%m-%d %H:%M:%S')] AVISO: migrações com falha, serão reaplicadas sob demanda"
+else
+    echo "[$(date +'%Y-%m-%d %H:%M:%S')] ℹ Migrações no startup desabilitadas (ENABLE_STARTUP_MIGRATIONS=false)"
+fi
+
 echo "=========================================="
 echo "  Iniciando aplicação Gunicorn..."
 echo "=========================================="